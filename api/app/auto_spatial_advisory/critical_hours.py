@@ -9,15 +9,15 @@ import os
 import sys
 from time import perf_counter
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from aiohttp import ClientSession
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from app import configure_logging
 from app.auto_spatial_advisory.run_type import RunType
+from app.auto_spatial_advisory.zone_spatial_index import group_stations_by_zone
 from app.db.crud.auto_spatial_advisory import (
     get_all_sfms_fuel_type_records,
-    get_containing_zone,
     get_fuel_type_stats_in_advisory_area,
     get_run_parameters_by_id,
     get_run_parameters_id,
@@ -25,14 +25,13 @@ from app.db.crud.auto_spatial_advisory import (
 )
 from app.db.database import get_async_write_session_scope
 from app.db.models.auto_spatial_advisory import AdvisoryFuelStats, CriticalHours, HfiClassificationThresholdEnum, RunTypeEnum, SFMSFuelType
-from app.fire_behaviour import cffdrs
+from app.fire_behaviour import cffdrs_numpy
 from app.fire_behaviour.fuel_types import FUEL_TYPE_DEFAULTS, FuelTypeEnum
-from app.fire_behaviour.prediction import build_hourly_rh_dict, calculate_cfb, get_critical_hours
+from app.fire_behaviour.prediction import MORNING_HOURS_REVERSED, build_hourly_rh_dict, get_critical_hours_batch
 from app.hourlies import get_hourly_readings_in_time_interval
-from app.schemas.fba_calc import CriticalHoursHFI, WindResult
+from app.schemas.fba_calc import CriticalHoursHFI
 from app.schemas.observations import WeatherStationHourlyReadings
 from app.stations import get_stations_asynchronously
-from app.utils.geospatial import PointTransformer
 from app.utils.time import get_hour_20_from_date, get_julian_date
 from app.wildfire_one import wfwx_api
 from app.wildfire_one.schema_parsers import WFWXWeatherStation
@@ -132,129 +131,231 @@ async def save_critical_hours(db_session: AsyncSession, zone_unit_id: int, criti
     await save_all_critical_hours(db_session, critical_hours_to_save)
 
 
-def calculate_wind_speed_result(yesterday: dict, raw_daily: dict) -> WindResult:
+@dataclass(frozen=True)
+class CriticalHoursInputTable:
     """
-    Calculates new FWIs based on observed and forecast daily data from WF1.
-
-    :param yesterday: Weather parameter observations and FWIs from yesterday.
-    :param raw_daily: Forecasted weather parameters from WF1.
-    :return: A WindResult object with calculated FWIs.
+    Columnar inputs for calculating critical hours, with one row per zone, station and fuel type combination.
     """
-    # extract variables from wf1 that we need to calculate the fire behaviour advisory.
-    bui = cffdrs.bui_calc(raw_daily.get("duffMoistureCode", None), raw_daily.get("droughtCode", None))
-    temperature = raw_daily.get("temperature", None)
-    relative_humidity = raw_daily.get("relativeHumidity", None)
-    precipitation = raw_daily.get("precipitation", None)
 
-    wind_speed = raw_daily.get("windSpeed", None)
-    status = raw_daily.get("recordType").get("id")
+    zone_ids: np.ndarray
+    station_codes: np.ndarray
+    fuel_type_keys: np.ndarray
+    fuel_types: np.ndarray
+    percentage_conifer: np.ndarray
+    percentage_dead_balsam_fir: np.ndarray
+    crown_base_height: np.ndarray
+    cfl: np.ndarray
+    grass_cure: np.ndarray
+    bui: np.ndarray
+    ffmc: np.ndarray
+    isi: np.ndarray
+    wind_speed: np.ndarray
+    fmc: np.ndarray
+    yesterday_ffmc: np.ndarray
+    # last observed RH at each of prediction.MORNING_HOURS_REVERSED
+    morning_rh: np.ndarray
+
+    def take(self, rows) -> "CriticalHoursInputTable":
+        """
+        Selects rows of the table.
+
+        :param rows: Indices (or a mask) of the rows to select.
+        :return: A table of just those rows.
+        """
+        return CriticalHoursInputTable(**{field.name: getattr(self, field.name)[rows] for field in fields(self)})
+
+
+# Fuel types without a crown, so crown fraction burned is always 0 (see prediction.calculate_cfb)
+NO_CROWN_FUEL_TYPES = [FuelTypeEnum.D1.value, FuelTypeEnum.O1A.value, FuelTypeEnum.O1B.value, FuelTypeEnum.S1.value, FuelTypeEnum.S2.value, FuelTypeEnum.S3.value]
 
-    ffmc = cffdrs.fine_fuel_moisture_code(yesterday.get("fineFuelMoistureCode", None), temperature, relative_humidity, precipitation, wind_speed)
-    isi = cffdrs.initial_spread_index(ffmc, wind_speed)
-    fwi = cffdrs.fire_weather_index(isi, bui)
-    return WindResult(ffmc=ffmc, isi=isi, bui=bui, wind_speed=wind_speed, fwi=fwi, status=status)
 
+def get_fuel_type_enum(fuel_type_key: str) -> FuelTypeEnum:
+    """
+    Maps an SFMS fuel type code to a FuelTypeEnum.
+
+    :param fuel_type_key: The SFMS fuel type code, e.g. C-2 or O-1a/O-1b.
+    :return: The matching FuelTypeEnum.
+    """
+    if fuel_type_key.startswith("O"):
+        # Raster fuel grid doesn't differentiate between O1A and O1B so we default to O1B for now.
+        return FuelTypeEnum.O1B
+    return FuelTypeEnum(fuel_type_key.replace("-", ""))
 
-def calculate_critical_hours_for_station_by_fuel_type(
-    wfwx_station: WFWXWeatherStation,
-    critical_hours_inputs: CriticalHoursInputs,
-    fuel_type: FuelTypeEnum,
-    for_date: datetime,
-):
+
+def build_critical_hours_input_table(
+    stations_by_zone: Dict[int, List[WFWXWeatherStation]], fuel_types_by_zone: Dict[int, Dict[str, float]], critical_hours_inputs: CriticalHoursInputs, for_date: date
+) -> CriticalHoursInputTable:
     """
-    Calculate the critical hours for a fuel type - station pair.
+    Builds a columnar table of critical hours inputs for every valid station in each zone, crossed with the fuel types of that zone.
+    Station level values (BUI, FFMC, ISI, FMC) are calculated once per station, for all stations at once.
 
-    :param wfwx_station: The WFWXWeatherStation.
-    :param critical_hours_inputs: Dailies, yesterday dailies, hourlies required to calculate critical hours
-    :param fuel_type: The fuel type of interest.
+    :param stations_by_zone: A dictionary of lists of stations in fire zone units keyed by fire zone unit id.
+    :param fuel_types_by_zone: The fuel types and their areas exceeding a high HFI threshold, keyed by fire zone unit id.
+    :param critical_hours_inputs: Dailies, yesterday dailies and hourlies for all the stations.
     :param for_date: The date critical hours are being calculated for.
-    :return: The critical hours for the station and fuel type.
-    """
-    raw_daily = critical_hours_inputs.dailies_by_station_id[wfwx_station.wfwx_id]
-    raw_observations = critical_hours_inputs.hourly_observations_by_station_code[wfwx_station.code]
-    yesterday = critical_hours_inputs.yesterday_dailies_by_station_id[wfwx_station.wfwx_id]
-    last_observed_morning_rh_values = build_hourly_rh_dict(raw_observations.values)
-
-    wind_result = calculate_wind_speed_result(yesterday, raw_daily)
-    bui = wind_result.bui
-    ffmc = wind_result.ffmc
-    isi = wind_result.isi
-    fuel_type_info = FUEL_TYPE_DEFAULTS[fuel_type]
-    percentage_conifer = fuel_type_info.get("PC", None)
-    percentage_dead_balsam_fir = fuel_type_info.get("PDF", None)
-    crown_base_height = fuel_type_info.get("CBH", None)
-    cfl = fuel_type_info.get("CFL", None)
-    grass_cure = yesterday.get("grasslandCuring", None)
-    wind_speed = wind_result.wind_speed
-    yesterday_ffmc = yesterday.get("fineFuelMoistureCode", None)
-    julian_date = get_julian_date(for_date)
-    fmc = cffdrs.foliar_moisture_content(int(wfwx_station.lat), int(wfwx_station.long), wfwx_station.elevation, julian_date)
-    sfc = cffdrs.surface_fuel_consumption(fuel_type, bui, ffmc, percentage_conifer)
-    ros = cffdrs.rate_of_spread(
-        fuel_type,
-        isi=isi,
-        bui=bui,
-        fmc=fmc,
-        sfc=sfc,
-        pc=percentage_conifer,
-        cc=grass_cure,
-        pdf=percentage_dead_balsam_fir,
-        cbh=crown_base_height,
+    :return: The input table.
+    """
+    station_index_by_id: Dict[str, int] = {}
+    station_rows = []
+    for wfwx_stations in stations_by_zone.values():
+        for wfwx_station in wfwx_stations:
+            if wfwx_station.wfwx_id in station_index_by_id or not check_station_valid(wfwx_station, critical_hours_inputs):
+                continue
+            raw_daily = critical_hours_inputs.dailies_by_station_id[wfwx_station.wfwx_id]
+            yesterday = critical_hours_inputs.yesterday_dailies_by_station_id.get(wfwx_station.wfwx_id, {})
+            raw_observations = critical_hours_inputs.hourly_observations_by_station_code[wfwx_station.code]
+            try:
+                # A station with malformed data is left out, rather than failing the whole table
+                rh_by_hour = build_hourly_rh_dict(raw_observations.values)
+                station_row = np.array(
+                    (
+                        raw_daily.get("duffMoistureCode", None),
+                        raw_daily.get("droughtCode", None),
+                        raw_daily.get("temperature", None),
+                        raw_daily.get("relativeHumidity", None),
+                        raw_daily.get("precipitation", None),
+                        raw_daily.get("windSpeed", None),
+                        yesterday.get("fineFuelMoistureCode", None),
+                        yesterday.get("grasslandCuring", None),
+                        # FMCcalc expects integer latitude and a positive longitude
+                        int(wfwx_station.lat),
+                        abs(int(wfwx_station.long)),
+                        wfwx_station.elevation,
+                        *[rh_by_hour[hour] for hour in MORNING_HOURS_REVERSED],
+                    ),
+                    dtype=float,
+                )
+            except Exception as exc:
+                logger.warning(f"An error occurred when preparing critical hours inputs for station code: {wfwx_station.code}: {exc}")
+                continue
+            station_index_by_id[wfwx_station.wfwx_id] = len(station_rows)
+            station_rows.append(station_row)
+    stations = np.array(station_rows, dtype=float).reshape(len(station_rows), 11 + len(MORNING_HOURS_REVERSED))
+    dmc, dc, temperature, relative_humidity, precipitation, wind_speed, yesterday_ffmc, grass_cure, lat, long, elevation = stations[:, :11].T
+    bui = cffdrs_numpy.bui_calc(dmc, dc)
+    ffmc = cffdrs_numpy.ffmc_calc(yesterday_ffmc, temperature, relative_humidity, wind_speed, precipitation)
+    isi = cffdrs_numpy.isi_calc(ffmc, wind_speed)
+    fmc = cffdrs_numpy.fmc_calc(lat, long, elevation, get_julian_date(for_date), 0)
+
+    # cross each zone's stations with the zone's fuel types
+    zone_ids, station_codes, station_indices, fuel_type_keys, fuel_types = [], [], [], [], []
+    for zone_id, wfwx_stations in stations_by_zone.items():
+        zone_fuel_types = []
+        for fuel_type_key in fuel_types_by_zone.get(zone_id, {}).keys():
+            try:
+                zone_fuel_types.append((fuel_type_key, get_fuel_type_enum(fuel_type_key)))
+            except ValueError:
+                logger.warning(f"Unable to calculate critical hours for unknown fuel type: {fuel_type_key}")
+        for wfwx_station in wfwx_stations:
+            if wfwx_station.wfwx_id not in station_index_by_id:
+                continue
+            for fuel_type_key, fuel_type_enum in zone_fuel_types:
+                zone_ids.append(zone_id)
+                station_codes.append(wfwx_station.code)
+                station_indices.append(station_index_by_id[wfwx_station.wfwx_id])
+                fuel_type_keys.append(fuel_type_key)
+                fuel_types.append(fuel_type_enum.value)
+
+    station_indices = np.array(station_indices, dtype=int)
+    fuel_type_info = [FUEL_TYPE_DEFAULTS[FuelTypeEnum(fuel_type)] for fuel_type in fuel_types]
+
+    def fuel_type_column(key: str) -> np.ndarray:
+        return np.array([info.get(key, None) for info in fuel_type_info], dtype=float)
+
+    return CriticalHoursInputTable(
+        zone_ids=np.array(zone_ids, dtype=int),
+        station_codes=np.array(station_codes, dtype=int),
+        fuel_type_keys=np.array(fuel_type_keys, dtype=object),
+        fuel_types=np.array(fuel_types, dtype=object),
+        percentage_conifer=fuel_type_column("PC"),
+        percentage_dead_balsam_fir=fuel_type_column("PDF"),
+        crown_base_height=fuel_type_column("CBH"),
+        cfl=fuel_type_column("CFL"),
+        grass_cure=grass_cure[station_indices],
+        bui=bui[station_indices],
+        ffmc=ffmc[station_indices],
+        isi=isi[station_indices],
+        wind_speed=wind_speed[station_indices],
+        fmc=fmc[station_indices],
+        yesterday_ffmc=yesterday_ffmc[station_indices],
+        morning_rh=stations[station_indices, 11:],
     )
-    cfb = calculate_cfb(fuel_type, fmc, sfc, ros, crown_base_height)
 
-    critical_hours = get_critical_hours(
+
+def calculate_critical_hours_for_table(table: CriticalHoursInputTable) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates critical hours for every row of the input table at once.
+
+    :param table: The critical hours input table.
+    :return: Arrays of critical hours start and end times, NaN where there are no critical hours or they couldn't be calculated.
+    """
+    fuel_types = cffdrs_numpy.fuel_type_index(table.fuel_types)
+    sfc = cffdrs_numpy.sfc_calc(fuel_types, table.ffmc, table.bui, table.percentage_conifer, 0.35)
+    ros = cffdrs_numpy.ros_calc(
+        fuel_types, table.isi, table.bui, table.fmc, sfc, table.percentage_conifer, table.percentage_dead_balsam_fir, table.grass_cure, table.crown_base_height
+    )
+    cfb = np.where(np.isin(table.fuel_types, NO_CROWN_FUEL_TYPES), 0.0, cffdrs_numpy.cfb_calc(fuel_types, table.fmc, sfc, ros, table.crown_base_height))
+    return get_critical_hours_batch(
         4000,
-        fuel_type,
-        percentage_conifer,
-        percentage_dead_balsam_fir,
-        bui,
-        grass_cure,
-        crown_base_height,
-        ffmc,
-        fmc,
+        fuel_types,
+        table.percentage_conifer,
+        table.percentage_dead_balsam_fir,
+        table.bui,
+        table.grass_cure,
+        table.crown_base_height,
+        table.ffmc,
+        table.fmc,
         cfb,
-        cfl,
-        wind_speed,
-        yesterday_ffmc,
-        last_observed_morning_rh_values,
+        table.cfl,
+        table.wind_speed,
+        table.yesterday_ffmc,
+        table.morning_rh,
     )
 
-    return critical_hours
+
+def calculate_critical_hours_by_row(table: CriticalHoursInputTable) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates critical hours for each row of the input table separately, so that a row that can't be calculated is logged and skipped.
+
+    :param table: The critical hours input table.
+    :return: Arrays of critical hours start and end times, NaN where there are no critical hours or they couldn't be calculated.
+    """
+    start = np.full(len(table.zone_ids), np.nan)
+    end = np.full(len(table.zone_ids), np.nan)
+    for row in range(len(table.zone_ids)):
+        try:
+            row_start, row_end = calculate_critical_hours_for_table(table.take([row]))
+            start[row], end[row] = row_start[0], row_end[0]
+        except Exception as exc:
+            logger.warning(f"An error occurred when calculating critical hours for station code: {table.station_codes[row]} and fuel type: {table.fuel_type_keys[row]}: {exc}")
+    return start, end
 
 
-def calculate_critical_hours_by_fuel_type(wfwx_stations: List[WFWXWeatherStation], critical_hours_inputs: CriticalHoursInputs, fuel_types_by_area, for_date):
+def calculate_critical_hours_for_zones(
+    stations_by_zone: Dict[int, List[WFWXWeatherStation]], fuel_types_by_zone: Dict[int, Dict[str, float]], critical_hours_inputs: CriticalHoursInputs, for_date: date
+) -> Dict[int, Dict[str, List[CriticalHoursHFI]]]:
     """
-    Calculates the critical hours for each fuel type for all stations in a fire zone unit.
+    Calculates the critical hours for each fuel type for all stations in all fire zone units, in a single pass.
 
-    :param wfwx_stations: A list of WFWXWeatherStations in a single fire zone unit.
-    :param dailies_by_station_id: Today's weather observations (or forecasts) keyed by station guid.
-    :param yesterday_dailies_by_station_id: Yesterday's weather observations and FWIs keyed by station guid.
-    :param hourly_observations_by_station_id: Hourly observations from the past 4 days keyed by station guid.
-    :param fuel_types_by_area: The fuel types and their areas exceeding a high HFI threshold.
+    :param stations_by_zone: A dictionary of lists of stations in fire zone units keyed by fire zone unit id.
+    :param fuel_types_by_zone: The fuel types and their areas exceeding a high HFI threshold, keyed by fire zone unit id.
+    :param critical_hours_inputs: Dailies, yesterday dailies and hourlies for all the stations.
     :param for_date: The date critical hours are being calculated for.
-    :return: A dictionary of lists of critical hours keyed by fuel type code.
-    """
-    critical_hours_by_fuel_type = defaultdict(list)
-    for wfwx_station in wfwx_stations:
-        if check_station_valid(wfwx_station, critical_hours_inputs):
-            for fuel_type_key in fuel_types_by_area.keys():
-                if fuel_type_key.startswith("O"):
-                    # Raster fuel grid doesn't differentiate between O1A and O1B so we default to O1B for now.
-                    fuel_type_enum = FuelTypeEnum.O1B
-                else:
-                    fuel_type_enum = FuelTypeEnum(fuel_type_key.replace("-", ""))
-                try:
-                    # Placing critical hours calculation in a try/except block as failure to calculate critical hours for a single station/fuel type pair
-                    # shouldn't prevent us from continuing with other stations and fuel types.
-
-                    critical_hours = calculate_critical_hours_for_station_by_fuel_type(wfwx_station, critical_hours_inputs, fuel_type_enum, for_date)
-                    if critical_hours is not None and critical_hours.start is not None and critical_hours.end is not None:
-                        logger.info(f"Calculated critical hours for fuel type key: {fuel_type_key}, start: {critical_hours.start}, end: {critical_hours.end}")
-                        critical_hours_by_fuel_type[fuel_type_key].append(critical_hours)
-                except Exception as exc:
-                    logger.warning(f"An error occurred when calculating critical hours for station code: {wfwx_station.code} and fuel type: {fuel_type_key}: {exc} ")
-    return critical_hours_by_fuel_type
+    :return: A dictionary keyed by fire zone unit id, of dictionaries of lists of critical hours keyed by fuel type code.
+    """
+    table = build_critical_hours_input_table(stations_by_zone, fuel_types_by_zone, critical_hours_inputs, for_date)
+    try:
+        start, end = calculate_critical_hours_for_table(table)
+    except Exception as exc:
+        # Failure to calculate critical hours for a single station/fuel type pair shouldn't stop the rest
+        logger.warning(f"An error occurred when calculating critical hours for all stations at once, calculating them one at a time: {exc}")
+        start, end = calculate_critical_hours_by_row(table)
+    critical_hours_by_zone_and_fuel_type: Dict[int, Dict[str, List[CriticalHoursHFI]]] = defaultdict(lambda: defaultdict(list))
+    for row in np.flatnonzero(~np.isnan(start) & ~np.isnan(end)):
+        critical_hours = CriticalHoursHFI(start=float(start[row]), end=float(end[row]))
+        critical_hours_by_zone_and_fuel_type[int(table.zone_ids[row])][table.fuel_type_keys[row]].append(critical_hours)
+    logger.info(f"Calculated critical hours for {len(start)} station and fuel type combinations in {len(critical_hours_by_zone_and_fuel_type)} zones")
+    return critical_hours_by_zone_and_fuel_type
 
 
 def check_station_valid(wfwx_station: WFWXWeatherStation, critical_hours_inputs: CriticalHoursInputs) -> bool:
@@ -360,6 +461,7 @@ async def get_inputs_for_critical_hours(for_date: date, header: dict, wfwx_stati
 async def calculate_critical_hours_by_zone(db_session: AsyncSession, header: dict, stations_by_zone: Dict[int, List[WFWXWeatherStation]], run_parameters_id: int, for_date: date):
     """
     Calculates critical hours for fire zone units by heuristically determining critical hours for each station in the fire zone unit that are under advisory conditions (>4k HFI).
+    Dailies and hourlies are fetched once for the stations in all zones, and critical hours are calculated for all zones at once.
 
     :param db_session: An async database session.
     :param header: An authorization header for making requests to WF1.
@@ -367,21 +469,14 @@ async def calculate_critical_hours_by_zone(db_session: AsyncSession, header: dic
     :param run_parameters_id: The RunParameters object (ie. the SFMS run).
     :param for_date: The date critical hours are being calculated for.
     """
-    critical_hours_by_zone_and_fuel_type = defaultdict(str, defaultdict(list))
+    fuel_types_by_zone: Dict[int, Dict[str, float]] = {}
     for zone_key in stations_by_zone.keys():
         advisory_fuel_stats = await get_fuel_type_stats_in_advisory_area(db_session, zone_key, run_parameters_id)
-        fuel_types_by_area = get_fuel_types_by_area(advisory_fuel_stats)
-        wfwx_stations = stations_by_zone[zone_key]
-        critical_hours_inputs = await get_inputs_for_critical_hours(for_date, header, wfwx_stations)
-        critical_hours_by_fuel_type = calculate_critical_hours_by_fuel_type(
-            wfwx_stations,
-            critical_hours_inputs,
-            fuel_types_by_area,
-            for_date,
-        )
+        fuel_types_by_zone[zone_key] = get_fuel_types_by_area(advisory_fuel_stats)
 
-        if len(critical_hours_by_fuel_type) > 0:
-            critical_hours_by_zone_and_fuel_type[zone_key] = critical_hours_by_fuel_type
+    all_stations = list({station.wfwx_id: station for stations in stations_by_zone.values() for station in stations}.values())
+    critical_hours_inputs = await get_inputs_for_critical_hours(for_date, header, all_stations)
+    critical_hours_by_zone_and_fuel_type = calculate_critical_hours_for_zones(stations_by_zone, fuel_types_by_zone, critical_hours_inputs, for_date)
 
     for zone_id, critical_hours_by_fuel_type in critical_hours_by_zone_and_fuel_type.items():
         await save_critical_hours(db_session, zone_id, critical_hours_by_fuel_type, run_parameters_id)
@@ -413,13 +508,7 @@ async def calculate_critical_hours(run_type: RunType, run_datetime: datetime, fo
             all_stations = await get_stations_asynchronously()
             station_codes = list(station.code for station in all_stations)
             stations = await wfwx_api.get_wfwx_stations_from_station_codes(client_session, header, station_codes)
-            stations_by_zone: Dict[int, List[WFWXWeatherStation]] = defaultdict(list)
-            transformer = PointTransformer(4326, 3005)
-            for station in stations:
-                (x, y) = transformer.transform_coordinate(station.lat, station.long)
-                zone_id = await get_containing_zone(db_session, f"POINT({x} {y})", 3005)
-                if zone_id is not None:
-                    stations_by_zone[zone_id[0]].append(station)
+            stations_by_zone: Dict[int, List[WFWXWeatherStation]] = await group_stations_by_zone(db_session, stations)
 
             await calculate_critical_hours_by_zone(db_session, header, stations_by_zone, run_parameters_id, for_date)
 
@@ -6,17 +6,18 @@ from time import perf_counter
 import logging
 import os
 import tempfile
-from typing import Dict
+from typing import Dict, Optional
 import numpy as np
 from osgeo import gdal
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.sql import text
 from sqlalchemy.future import select
 from app import config
 from app.auto_spatial_advisory.classify_hfi import classify_hfi
+from app.auto_spatial_advisory.hfi_pipeline import HfiPipeline
 from app.auto_spatial_advisory.run_type import RunType
+from app.auto_spatial_advisory.zonal_stats import get_zone_label_rasters, zonal_percentiles, zonal_value_counts
 from app.db.crud.auto_spatial_advisory import get_run_parameters_id, save_advisory_elevation_stats, save_advisory_elevation_tpi_stats
-from app.db.database import get_async_read_session_scope, get_async_write_session_scope, DB_READ_STRING
+from app.db.database import get_async_read_session_scope, get_async_write_session_scope
 from app.db.models.auto_spatial_advisory import AdvisoryElevationStats, AdvisoryTPIStats
 from app.auto_spatial_advisory.hfi_filepath import get_raster_filepath, get_raster_tif_filename
 from app.utils.s3 import get_client
@@ -25,9 +26,11 @@ from app.utils.geospatial import raster_mul, warp_to_match_extent
 
 logger = logging.getLogger(__name__)
 DEM_GDAL_SOURCE = None
+# minimum, quartile 25, median, quartile 75 and maximum
+ELEVATION_PERCENTILES = [0, 25, 50, 75, 100]
 
 
-async def process_elevation_tpi(run_type: RunType, run_datetime: datetime, for_date: date):
+async def process_elevation_tpi(run_type: RunType, run_datetime: datetime, for_date: date, pipeline: Optional[HfiPipeline] = None):
     """
     Create new elevation statistics records for the given parameters.
 
@@ -35,6 +38,7 @@ async def process_elevation_tpi(run_type: RunType, run_datetime: datetime, for_d
     :param run_type: The type of run to process. (is it a forecast or actual run?)
     :param run_datetime: The date and time of the run to process. (when was the hfi file created?)
     :param for_date: The date of the hfi to process. (when is the hfi for?)
+    :param pipeline: Shared rasters for this HFI file, if the snow masked hfi is already in memory it's used instead of fetching it from S3.
     """
     logger.info("Processing elevation stats %s for run date: %s, for date: %s", run_type, run_datetime, for_date)
     perf_start = perf_counter()
@@ -46,7 +50,7 @@ async def process_elevation_tpi(run_type: RunType, run_datetime: datetime, for_d
 
         exists = (await session.execute(stmt)).scalars().first() is not None
         if not exists:
-            fire_zone_stats = await process_tpi_by_firezone(run_type, run_datetime.date(), for_date)
+            fire_zone_stats = await process_tpi_by_firezone(run_type, run_datetime.date(), for_date, pipeline)
             await store_elevation_tpi_stats(session, run_parameters_id, fire_zone_stats)
         else:
             logger.info("Elevation stats already computed")
@@ -123,8 +127,8 @@ async def process_threshold(threshold: int, source_path: str, temp_dir: str, run
     """
     threshold_mask_path = create_hfi_threshold_mask(threshold, source_path, temp_dir)
     upsampled_threshold_mask_path = upsample_threshold_mask(threshold, threshold_mask_path, temp_dir)
-    masked_dem_path = apply_threshold_mask_to_dem(threshold, upsampled_threshold_mask_path, temp_dir)
-    await process_elevation_by_firezone(threshold, masked_dem_path, run_parameters_id)
+    masked_dem_data = apply_threshold_mask_to_dem(upsampled_threshold_mask_path)
+    await process_elevation_by_firezone(threshold, masked_dem_data, run_parameters_id)
 
 
 def create_hfi_threshold_mask(threshold: int, classified_hfi: str, temp_dir: str):
@@ -184,31 +188,19 @@ def upsample_threshold_mask(threshold: int, source_path: str, temp_dir: str):
     return upsampled_threshold_mask_path
 
 
-def apply_threshold_mask_to_dem(threshold: int, mask_path: str, temp_dir: str):
+def apply_threshold_mask_to_dem(mask_path: str) -> np.ndarray:
     """
-    Multiplies the mask of HFI areas by the DEM. The resulting tif has elevation values at pixels where HFI exceeds the
+    Multiplies the mask of HFI areas by the DEM. The resulting array has elevation values at pixels where HFI exceeds the
     specified threshold, all other pixels are 0.
 
-    :param threshold: The current threshold being processed, 1 = 4k-10k, 2 = > 10k
     :param mask_path: The path to the mask tif
-    :param temp_dir: A temporary location for storing intermediate files
     """
-    masked_dem_path = os.path.join(temp_dir, f"masked_dem_threshold_{threshold}.tif")
-    dem_band = DEM_GDAL_SOURCE.GetRasterBand(1)
-    dem_data = dem_band.ReadAsArray()
+    dem_data = DEM_GDAL_SOURCE.GetRasterBand(1).ReadAsArray()
     mask = gdal.Open(mask_path, gdal.GA_ReadOnly)
     mask_data = mask.GetRasterBand(1).ReadAsArray()
     masked_dem_data = np.multiply(dem_data, mask_data)
-    output_driver = gdal.GetDriverByName("GTiff")
-    masked_dem = output_driver.Create(masked_dem_path, xsize=dem_band.XSize, ysize=dem_band.YSize, bands=1, eType=gdal.GDT_Int16)
-    masked_dem.SetGeoTransform(DEM_GDAL_SOURCE.GetGeoTransform())
-    masked_dem.SetProjection(DEM_GDAL_SOURCE.GetProjection())
-    masked_dem_band = masked_dem.GetRasterBand(1)
-    masked_dem_band.SetNoDataValue(0)
-    masked_dem_band.WriteArray(masked_dem_data)
     mask = None
-    masked_dem = None
-    return masked_dem_path
+    return masked_dem_data
 
 
 @dataclass(frozen=True)
@@ -225,15 +217,16 @@ class FireZoneTPIStats:
     pixel_size_metres: int
 
 
-async def process_tpi_by_firezone(run_type: RunType, run_date: date, for_date: date):
+async def process_tpi_by_firezone(run_type: RunType, run_date: date, for_date: date, pipeline: Optional[HfiPipeline] = None):
     """
     Given run parameters, lookup associated snow-masked HFI and static classified TPI geospatial data.
-    Cut out each fire zone shape from the above and intersect the TPI and HFI pixels, counting each pixel contributing to the TPI class.
+    Intersect the TPI and HFI pixels and count the pixels of each TPI class in every fire zone, using a cached fire zone label raster.
     Capture all fire zone stats keyed by its source_identifier.
 
     :param run_type: forecast or actual
     :param run_date: date the computation ran
     :param for_date: date the computation is for
+    :param pipeline: Shared rasters for this HFI file
     :return: fire zone TPI status
     """
 
@@ -248,8 +241,11 @@ async def process_tpi_by_firezone(run_type: RunType, run_date: date, for_date: d
     pixel_size_metres = int(tpi_source.GetGeoTransform()[1])
 
     hfi_raster_filename = get_raster_tif_filename(for_date)
-    hfi_raster_key = get_raster_filepath(run_date, run_type, hfi_raster_filename)
-    hfi_key = f"/vsis3/{bucket}/{hfi_raster_key}"
+    if pipeline is not None and pipeline.working_hfi_path is not None:
+        hfi_key = pipeline.working_hfi_path
+    else:
+        hfi_raster_key = get_raster_filepath(run_date, run_type, hfi_raster_filename)
+        hfi_key = f"/vsis3/{bucket}/{hfi_raster_key}"
     hfi_source: gdal.Dataset = gdal.Open(hfi_key, gdal.GA_ReadOnly)
 
     warped_mem_path = f"/vsimem/warp_{hfi_raster_filename}"
@@ -262,86 +258,48 @@ async def process_tpi_by_firezone(run_type: RunType, run_date: date, for_date: d
 
     fire_zone_stats: Dict[int, Dict[int, int]] = {}
     async with get_async_write_session_scope() as session:
-        stmt = text("SELECT id, source_identifier FROM advisory_shapes;")
-        result = await session.execute(stmt)
-
-        for row in result:
-            output_path = f"/vsimem/firezone_{row[1]}.tif"
-            warp_options = gdal.WarpOptions(format="GTiff", cutlineDSName=DB_READ_STRING, cutlineSQL=f"SELECT geom FROM advisory_shapes WHERE id={row[0]}", cropToCutline=True)
-            cut_hfi_masked_tpi: gdal.Dataset = gdal.Warp(output_path, hfi_masked_tpi, options=warp_options)
-            # Get unique values and their counts
-            tpi_classes, counts = np.unique(cut_hfi_masked_tpi.GetRasterBand(1).ReadAsArray(), return_counts=True)
-            cut_hfi_masked_tpi = None
-            gdal.Unlink(output_path)
-            tpi_class_freq_dist = dict(zip(tpi_classes, counts))
+        zone_label_rasters = await get_zone_label_rasters(session, hfi_masked_tpi)
+        hfi_masked_tpi_data = hfi_masked_tpi.GetRasterBand(1).ReadAsArray()
+        hfi_masked_tpi = None
 
+    for zone_labels in zone_label_rasters:
+        tpi_class_counts = zonal_value_counts(zone_labels.labels, hfi_masked_tpi_data, zone_labels.zone_ids)
+        for zone_id, counts in zip(zone_labels.zone_ids, tpi_class_counts):
+            tpi_class_freq_dist = {tpi_class: int(count) for tpi_class, count in enumerate(counts) if count > 0}
             # Drop TPI class 4, this is the no data value from the TPI raster
             tpi_class_freq_dist.pop(4, None)
-            fire_zone_stats[row[0]] = tpi_class_freq_dist
+            fire_zone_stats[int(zone_id)] = tpi_class_freq_dist
 
-        hfi_masked_tpi = None
-        return FireZoneTPIStats(fire_zone_stats=fire_zone_stats, pixel_size_metres=pixel_size_metres)
+    return FireZoneTPIStats(fire_zone_stats=fire_zone_stats, pixel_size_metres=pixel_size_metres)
 
 
-async def process_elevation_by_firezone(threshold: int, masked_dem_path: str, run_parameters_id: int):
+async def process_elevation_by_firezone(threshold: int, masked_dem_data: np.ndarray, run_parameters_id: int):
     """
-    Given a tif that only contains elevations values at pixels where HFI exceeds the threshold, calculate statistics
-    and store them in the API database.
+    Given an array that only contains elevations values at pixels where HFI exceeds the threshold, calculate statistics
+    for every fire zone in a single pass and store them in the API database.
 
     :param threshold: The current threshold being processed, 1 = 4k-10k, 2 = > 10k
-    :param mask_dem_path: The path to the dem that has had the upsampled hfi mask applied
+    :param masked_dem_data: The dem with the upsampled hfi mask applied
     :param run_parameters_id: The RunParameter object id associated with this run_type, for_date and run_datetime
     """
     async with get_async_write_session_scope() as session:
-        stmt = text("SELECT id, source_identifier FROM advisory_shapes;")
-        result = await session.execute(stmt)
-        rows = result.all()
-        for row in rows:
-            # using a temp dir here to prevent accumulation of large rasters as we run through this loop
-            with tempfile.TemporaryDirectory() as temp_dir:
-                firezone_elevation_threshold_path = intersect_raster_by_firezone(threshold, row[0], row[1], masked_dem_path, temp_dir)
-                stats = get_elevation_stats(firezone_elevation_threshold_path)
-                await store_elevation_stats(session, threshold, row[0], stats, run_parameters_id)
-
-
-def intersect_raster_by_firezone(threshold: int, advisory_shape_id: int, source_identifier: str, raster_path: str, temp_dir: str):
-    """
-    Given a raster and a fire zone id, use gdal.Warp to clip out a fire zone from which we can retrieve stats.
-
-    :param threshold: The current threshold being processed, 1 = 4k-10k, 2 = > 10k
-    :param advisory_shape_id: The id of the fire zone (aka advisory_shape object) to clip with
-    :param source_identifier: The source identifier of the fire zone.
-    :param raster_path: The path to the raster to be clipped.
-    :param temp_dir: A temporary location for storing intermediate files
-    """
-    output_path = os.path.join(temp_dir, f"firezone_{source_identifier}_threshold_{threshold}.tif")
-    warp_options = gdal.WarpOptions(format="GTiff", cutlineDSName=DB_READ_STRING, cutlineSQL=f"SELECT geom FROM advisory_shapes WHERE id={advisory_shape_id}", cropToCutline=True)
-    gdal.Warp(output_path, raster_path, options=warp_options)
-    return output_path
+        for zone_labels in await get_zone_label_rasters(session, DEM_GDAL_SOURCE):
+            percentiles, counts = zonal_percentiles(zone_labels.labels, masked_dem_data, zone_labels.zone_ids, ELEVATION_PERCENTILES, mask=masked_dem_data != 0)
+            for shape_id, shape_percentiles, count in zip(zone_labels.zone_ids, percentiles, counts):
+                stats = get_elevation_stats(shape_percentiles, count)
+                await store_elevation_stats(session, threshold, int(shape_id), stats, run_parameters_id)
 
 
-def get_elevation_stats(source_path: str):
+def get_elevation_stats(percentiles: np.ndarray, count: int):
     """
-    Extracts basic statistics from a raster.
+    Maps the elevation percentiles of a fire zone to basic statistics, all 0 when the zone has no elevation values.
 
-    :param source_path: The path to the raster of interest.
+    :param percentiles: The ELEVATION_PERCENTILES of the non-zero elevations in the fire zone.
+    :param count: The number of non-zero elevations in the fire zone.
     """
-    source = gdal.Open(source_path, gdal.GA_ReadOnly)
-    source_band = source.GetRasterBand(1)
-    source_data = source_band.ReadAsArray()
-    max_elevation = np.max(source_data)
-    if max_elevation == 0:
-        median = 0
-        minimum = 0
-        maximum = 0
-        quartile_25 = 0
-        quartile_75 = 0
-    else:
-        median = np.median(source_data[source_data != 0])
-        minimum = np.min(source_data[source_data != 0])
-        maximum = np.max(source_data[source_data != 0])
-        quartile_25 = np.percentile(source_data[source_data != 0], 25)
-        quartile_75 = np.percentile(source_data[source_data != 0], 75)
+    if count == 0:
+        return {"minimum": 0, "maximum": 0, "median": 0, "quartile_25": 0, "quartile_75": 0}
+    minimum, quartile_25, median, quartile_75, maximum = (float(value) for value in percentiles)
     return {"minimum": minimum, "maximum": maximum, "median": median, "quartile_25": quartile_25, "quartile_75": quartile_75}
 
 
@@ -0,0 +1,130 @@
+"""Shared state for processing a single SFMS HFI file through all of the auto spatial advisory stages.
+
+Without a pipeline, every stage (classified hfi polygons, elevation/TPI stats, fuel type areas) downloads the same HFI
+GeoTIFF from S3 and re-classifies it. The pipeline downloads the raster once into /vsimem, and holds the raw, classified
+and snow masked rasters for the stages that follow, along with how long each stage took.
+"""
+
+from contextlib import contextmanager
+from datetime import date, datetime
+import logging
+from time import perf_counter
+from typing import Dict, Optional
+import uuid
+import numpy as np
+from osgeo import gdal
+from app import config
+from app.auto_spatial_advisory.classify_hfi import classify_hfi
+from app.auto_spatial_advisory.common import get_s3_key
+from app.auto_spatial_advisory.run_type import RunType
+
+logger = logging.getLogger(__name__)
+
+
+def read_vsimem_bytes(path: str) -> bytes:
+    """
+    Reads the contents of a gdal virtual file (eg. /vsimem/...) into memory, eg. for uploading to S3.
+    """
+    stat = gdal.VSIStatL(path)
+    handle = gdal.VSIFOpenL(path, "rb")
+    try:
+        return gdal.VSIFReadL(1, stat.size, handle)
+    finally:
+        gdal.VSIFCloseL(handle)
+
+
+class HfiPipeline:
+    """
+    Holds the rasters shared by the stages of processing one SFMS HFI file. Rasters are loaded lazily, so a stage that
+    runs on its own only pays for what it uses.
+    """
+
+    def __init__(self, run_type: RunType, run_date: date, run_datetime: datetime, for_date: date):
+        self.run_type = run_type
+        self.run_date = run_date
+        self.run_datetime = run_datetime
+        self.for_date = for_date
+        # Every raster produced by the pipeline lives under this /vsimem directory.
+        self.work_dir = f"/vsimem/hfi_pipeline_{uuid.uuid4().hex}"
+        self.hfi_key = get_s3_key(run_type, run_date, for_date)
+        # Snow masked classified hfi, set by the classification stage, None if that stage didn't run.
+        self.working_hfi_path: Optional[str] = None
+        self.stage_timings: Dict[str, float] = {}
+        self._hfi_path: Optional[str] = None
+        self._hfi_data: Optional[np.ndarray] = None
+        self._classified_hfi_path: Optional[str] = None
+
+    def get_hfi_path(self) -> str:
+        """
+        Path to an in memory copy of the raw HFI GeoTIFF, downloaded from S3 the first time it's asked for.
+        """
+        if self._hfi_path is None:
+            gdal.SetConfigOption("AWS_SECRET_ACCESS_KEY", config.get("OBJECT_STORE_SECRET"))
+            gdal.SetConfigOption("AWS_ACCESS_KEY_ID", config.get("OBJECT_STORE_USER_ID"))
+            gdal.SetConfigOption("AWS_S3_ENDPOINT", config.get("OBJECT_STORE_SERVER"))
+            gdal.SetConfigOption("AWS_VIRTUAL_HOSTING", "FALSE")
+            hfi_path = f"{self.work_dir}/hfi.tif"
+            logger.info("Fetching %s into %s", self.hfi_key, hfi_path)
+            gdal.Translate(hfi_path, self.hfi_key, format="GTiff")
+            self._hfi_path = hfi_path
+        return self._hfi_path
+
+    def get_hfi_data(self) -> np.ndarray:
+        """
+        The raw HFI values.
+        """
+        if self._hfi_data is None:
+            hfi_ds = gdal.Open(self.get_hfi_path(), gdal.GA_ReadOnly)
+            self._hfi_data = hfi_ds.GetRasterBand(1).ReadAsArray()
+            hfi_ds = None
+        return self._hfi_data
+
+    def get_classified_hfi_path(self) -> str:
+        """
+        Path to the classified HFI (0 = < 4k, 1 = 4k-10k, 2 = > 10k), classified the first time it's asked for.
+        """
+        if self._classified_hfi_path is None:
+            classified_hfi_path = f"{self.work_dir}/classified.tif"
+            classify_hfi(self.get_hfi_path(), classified_hfi_path)
+            self._classified_hfi_path = classified_hfi_path
+        return self._classified_hfi_path
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Records how long the wrapped stage takes.
+        """
+        perf_start = perf_counter()
+        try:
+            yield self
+        finally:
+            self.stage_timings[name] = perf_counter() - perf_start
+
+    def log_stage_timings(self):
+        timings = ", ".join(f"{name}: {seconds:.3f}s" for name, seconds in self.stage_timings.items())
+        logger.info("HFI pipeline %s run date: %s, for date: %s - total: %.3fs (%s)", self.run_type, self.run_date, self.for_date, sum(self.stage_timings.values()), timings)
+
+    def close(self):
+        """
+        Releases all the in memory rasters.
+        """
+        self._hfi_data = None
+        gdal.RmdirRecursive(self.work_dir)
+        self._hfi_path = None
+        self._classified_hfi_path = None
+        self.working_hfi_path = None
+
+
+@contextmanager
+def use_hfi_pipeline(pipeline: Optional[HfiPipeline], run_type: RunType, run_date: date, run_datetime: datetime, for_date: date):
+    """
+    Yields the given pipeline, or a pipeline for just this stage (closed on exit) when a stage is run on its own.
+    """
+    if pipeline is not None:
+        yield pipeline
+        return
+    pipeline = HfiPipeline(run_type, run_date, run_datetime, for_date)
+    try:
+        yield pipeline
+    finally:
+        pipeline.close()
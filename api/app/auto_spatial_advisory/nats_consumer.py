@@ -4,7 +4,7 @@ Nats consumer setup for consuming processing messages
 import asyncio
 import json
 import datetime
-from datetime import datetime
+from datetime import date, datetime
 import logging
 from typing import List
 from starlette.background import BackgroundTasks
@@ -12,6 +12,7 @@ import nats
 from nats.js.api import StreamConfig, RetentionPolicy
 from nats.aio.msg import Msg
 from app.auto_spatial_advisory.critical_hours import calculate_critical_hours
+from app.auto_spatial_advisory.hfi_pipeline import HfiPipeline
 from app.auto_spatial_advisory.nats_config import server, stream_name, sfms_file_subject, subjects, hfi_classify_durable_group
 from app.auto_spatial_advisory.process_elevation_hfi import process_hfi_elevation
 from app.auto_spatial_advisory.process_hfi import RunType, process_hfi
@@ -39,6 +40,27 @@ def parse_nats_message(msg: Msg):
         return (run_type, run_date, run_datetime, for_date)
 
 
+async def process_sfms_hfi(run_type: RunType, run_date: date, run_datetime: datetime, for_date: date):
+    """
+    Runs every processing stage for a single SFMS HFI file, sharing the fetched and classified rasters between stages.
+    """
+    pipeline = HfiPipeline(run_type, run_date, run_datetime, for_date)
+    try:
+        with pipeline.stage("process_hfi"):
+            await process_hfi(run_type, run_date, run_datetime, for_date, pipeline)
+        with pipeline.stage("process_hfi_elevation"):
+            await process_hfi_elevation(run_type, run_date, run_datetime, for_date, pipeline)
+        with pipeline.stage("process_high_hfi_area"):
+            await process_high_hfi_area(run_type, run_datetime, for_date)
+        with pipeline.stage("process_fuel_type_hfi_by_shape"):
+            await process_fuel_type_hfi_by_shape(run_type, run_datetime, for_date, pipeline)
+        with pipeline.stage("calculate_critical_hours"):
+            await calculate_critical_hours(run_type, run_datetime, for_date)
+    finally:
+        pipeline.log_stage_timings()
+        pipeline.close()
+
+
 async def run():
     async def disconnected_cb():
         logger.info("Got disconnected!")
@@ -74,11 +96,7 @@ async def run():
                 await msg.ack()
                 run_type, run_date, run_datetime, for_date = parse_nats_message(msg)
                 logger.info("Awaiting process_hfi({}, {}, {})\n".format(run_type, run_date, for_date))
-                await process_hfi(run_type, run_date, run_datetime, for_date)
-                await process_hfi_elevation(run_type, run_date, run_datetime, for_date)
-                await process_high_hfi_area(run_type, run_datetime, for_date)
-                await process_fuel_type_hfi_by_shape(run_type, run_datetime, for_date)
-                await calculate_critical_hours(run_type, run_datetime, for_date)
+                await process_sfms_hfi(run_type, run_date, run_datetime, for_date)
             except Exception as e:
                 logger.error("Error processing HFI message: %s, adding back to queue", msg.data, exc_info=e)
                 background_tasks = BackgroundTasks()
@@ -3,24 +3,27 @@
 import logging
 from datetime import date, datetime
 from time import perf_counter
+from typing import Optional
 from app.auto_spatial_advisory.elevation import process_elevation_tpi
+from app.auto_spatial_advisory.hfi_pipeline import HfiPipeline
 from app.auto_spatial_advisory.run_type import RunType
 
 logger = logging.getLogger(__name__)
 
 
-async def process_hfi_elevation(run_type: RunType, run_date: date, run_datetime: datetime, for_date: date):
+async def process_hfi_elevation(run_type: RunType, run_date: date, run_datetime: datetime, for_date: date, pipeline: Optional[HfiPipeline] = None):
     """Create a new elevation based hfi analysis records for the given date.
 
     :param run_type: The type of run to process. (is it a forecast or actual run?)
     :param run_date: The date of the run to process. (when was the hfi file created?)
     :param for_date: The date of the hfi to process. (when is the hfi for?)
+    :param pipeline: Shared rasters for this HFI file.
     """
 
     logger.info("Processing HFI elevation %s for run date: %s, for date: %s", run_type, run_date, for_date)
     perf_start = perf_counter()
 
-    await process_elevation_tpi(run_type, run_datetime, for_date)
+    await process_elevation_tpi(run_type, run_datetime, for_date, pipeline)
 
     perf_end = perf_counter()
     delta = perf_end - perf_start
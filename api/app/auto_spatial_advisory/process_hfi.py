@@ -5,16 +5,18 @@ import os
 from datetime import date, datetime, timedelta
 from time import perf_counter
 import tempfile
-from shapely import wkb, wkt
-from shapely.validation import make_valid
+from typing import List, Optional, Tuple, Union
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
 from osgeo import ogr, osr
-from app.auto_spatial_advisory.common import get_s3_key
-from app.db.models.auto_spatial_advisory import ClassifiedHfi, HfiClassificationThreshold, RunTypeEnum
+from app import config
+from app.auto_spatial_advisory.hfi_pipeline import HfiPipeline, read_vsimem_bytes, use_hfi_pipeline
+from app.db.models.auto_spatial_advisory import HfiClassificationThreshold, RunTypeEnum
 from app.db.database import get_async_read_session_scope, get_async_write_session_scope
-from app.db.crud.auto_spatial_advisory import save_hfi, get_hfi_classification_threshold, HfiClassificationThresholdEnum, save_run_parameters, get_run_parameters_id
+from app.db.crud.auto_spatial_advisory import save_classified_hfi, get_hfi_classification_threshold, HfiClassificationThresholdEnum, save_run_parameters, get_run_parameters_id
 from app.db.crud.snow import get_last_processed_snow_by_source
 from app.db.models.snow import SnowSourceEnum
-from app.auto_spatial_advisory.classify_hfi import classify_hfi
 from app.auto_spatial_advisory.run_type import RunType
 from app.auto_spatial_advisory.snow import apply_snow_mask
 from app.geospatial import NAD83_BC_ALBERS
@@ -30,60 +32,80 @@ logger = logging.getLogger(__name__)
 HFI_GEOSPATIAL_PERMISSIONS = "public-read"
 HFI_PMTILES_MIN_ZOOM = 4
 HFI_PMTILES_MAX_ZOOM = 11
+# Number of classified hfi polygons written per multi-row INSERT.
+DEFAULT_HFI_INSERT_BATCH_SIZE = 1000
 
 
 class UnknownHFiClassification(Exception):
     """Raised when the hfi classification is not one of the expected values."""
 
 
-def get_threshold_from_hfi(feature: ogr.Feature, advisory: HfiClassificationThreshold, warning: HfiClassificationThreshold):
+def get_thresholds_from_hfi(hfi_values: np.ndarray, advisory: HfiClassificationThreshold, warning: HfiClassificationThreshold) -> np.ndarray:
     """
-    Parses the HFI id value (1 or 2) attributed to an ogr.Feature, and returns the id of the
-    appropriate HfiClassificationThreshold record in the database.
+    Maps HFI id values (1 or 2) attributed to polygonized features to the ids of the
+    appropriate HfiClassificationThreshold records in the database.
     """
-    hfi = feature.GetField(0)
-    if hfi == 1:
-        return advisory
-    elif hfi == 2:
-        return warning
-    else:
-        raise UnknownHFiClassification(f"unknown hfi value: {hfi}")
+    hfi_values = np.asarray(hfi_values)
+    unknown = (hfi_values != 1) & (hfi_values != 2)
+    if unknown.any():
+        raise UnknownHFiClassification(f"unknown hfi value: {hfi_values[unknown][0]}")
+    return np.where(hfi_values == 1, advisory.id, warning.id)
 
 
-def create_model_object(
-    feature: ogr.Feature,
+def read_hfi_features(layer: ogr.Layer) -> Tuple[List[int], List[bytes]]:
+    """
+    Reads the HFI id value and the WKB geometry of every feature in a polygonized HFI layer, in one sequential pass.
+    """
+    hfi_values = []
+    geometries = []
+    layer.ResetReading()
+    for feature in layer:
+        hfi_values.append(feature.GetField(0))
+        # NOTE: geometry.ExportToIsoWkb isn't consistent in it's return value between
+        # different versions of gdal (bytearray vs. bytestring) - so it's normalized to bytes.
+        geometries.append(bytes(feature.GetGeometryRef().ExportToIsoWkb()))
+    return hfi_values, geometries
+
+
+def create_classified_hfi_rows(
+    hfi_values: List[int],
+    geometries: List[bytes],
+    source_crs: Union[str, int],
     advisory: HfiClassificationThreshold,
     warning: HfiClassificationThreshold,
-    coordinate_transform: osr.CoordinateTransformation,
     run_type: RunType,
     run_datetime: datetime,
     for_date: date,
-) -> ClassifiedHfi:
-    threshold = get_threshold_from_hfi(feature, advisory, warning)
-    # https://gdal.org/api/python/osgeo.ogr.html#osgeo.ogr.Geometry
-    geometry: ogr.Geometry = feature.GetGeometryRef()
+) -> List[dict]:
+    """
+    Converts polygonized HFI features into advisory_classified_hfi rows, reprojecting and validating all the geometries
+    with vectorized shapely operations.
+
+    :param hfi_values: The HFI id value (1 or 2) of each feature.
+    :param geometries: The WKB geometry of each feature.
+    :param source_crs: The spatial reference of the geometries (WKT or EPSG code).
+    """
+    thresholds = get_thresholds_from_hfi(hfi_values, advisory, warning)
+    polygons = shapely.from_wkb(geometries)
     # Make sure the geometry is in EPSG:3005!
-    geometry.Transform(coordinate_transform)
-    # Would be very nice to go directly from the ogr.Geometry into the database,
-    # but I can't figure out how to have the wkt output also include the fact that
-    # the SRID is EPSG:3005. So we're doing this redundant step of creating a shapely
-    # geometry from wkt, then dumping it back into wkb, with srid=3005.
-    # NOTE: geometry.ExportToIsoWkb isn't consistent in it's return value between
-    # different versions of gdal (bytearray vs. bytestring) - so we're opting for
-    # wkt instead of wkb here for better compatibility.
-    polygon = wkt.loads(geometry.ExportToIsoWkt())
-    polygon = make_valid(polygon)
-    return ClassifiedHfi(
-        threshold=threshold.id, run_type=RunTypeEnum(run_type.value), run_datetime=run_datetime, for_date=for_date, geom=wkb.dumps(polygon, hex=True, srid=NAD83_BC_ALBERS)
-    )
-
-
-async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime, for_date: date):
+    transformer = Transformer.from_crs(CRS.from_user_input(source_crs), CRS.from_epsg(NAD83_BC_ALBERS), always_xy=True)
+    polygons = shapely.transform(polygons, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+    polygons = shapely.make_valid(polygons)
+    geoms = shapely.to_wkb(shapely.set_srid(polygons, NAD83_BC_ALBERS), hex=True, include_srid=True)
+    run_type_enum = RunTypeEnum(run_type.value)
+    return [
+        {"threshold": int(threshold), "run_type": run_type_enum, "run_datetime": run_datetime, "for_date": for_date, "geom": geom}
+        for threshold, geom in zip(thresholds, geoms)
+    ]
+
+
+async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime, for_date: date, pipeline: Optional[HfiPipeline] = None):
     """Create a new hfi record for the given date.
 
     :param run_type: The type of run to process. (is it a forecast or actual run?)
     :param run_date: The date of the run to process. (when was the hfi file created?)
     :param for_date: The date of the hfi to process. (when is the hfi for?)
+    :param pipeline: Shared rasters for this HFI file, the snow masked hfi is kept on it for later stages.
     """
 
     # Skip if we already have this run
@@ -97,12 +119,10 @@ async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime,
     logger.info("Processing HFI %s for run date: %s, for date: %s", run_type, run_date, for_date)
     perf_start = perf_counter()
 
-    hfi_key = get_s3_key(run_type, run_date, for_date)
-    logger.info(f"Key to HFI in object storage: {hfi_key}")
     async with get_client() as (client, bucket):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            temp_filename = os.path.join(temp_dir, "classified.tif")
-            classify_hfi(hfi_key, temp_filename)
+        with tempfile.TemporaryDirectory() as temp_dir, use_hfi_pipeline(pipeline, run_type, run_date, run_datetime, for_date) as hfi_pipeline:
+            logger.info(f"Key to HFI in object storage: {hfi_pipeline.hfi_key}")
+            temp_filename = hfi_pipeline.get_classified_hfi_path()
             # If something has gone wrong with the collection of snow coverage data and it has not been collected
             # within the past 7 days, don't apply an old snow mask, work with the classified hfi data as is
             if last_processed_snow is None or last_processed_snow[0].for_date + timedelta(days=7) < time_utils.get_utc_now():
@@ -110,7 +130,8 @@ async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime,
                 working_hfi_path = temp_filename
             else:
                 # Create a snow coverage mask from previously downloaded snow data.
-                working_hfi_path = await apply_snow_mask(temp_filename, last_processed_snow[0], temp_dir)
+                working_hfi_path = await apply_snow_mask(temp_filename, last_processed_snow[0], hfi_pipeline.work_dir)
+            hfi_pipeline.working_hfi_path = working_hfi_path
 
             raster_filename = get_raster_tif_filename(for_date)
             raster_key = get_raster_filepath(run_date, run_type, raster_filename)
@@ -119,7 +140,7 @@ async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime,
                 Bucket=bucket,
                 Key=raster_key,
                 ACL=HFI_GEOSPATIAL_PERMISSIONS,  # We need these to be accessible to everyone
-                Body=open(working_hfi_path, "rb"),
+                Body=read_vsimem_bytes(working_hfi_path),
             )
             logger.info("Done uploading %s", raster_key)
             with polygonize_in_memory(working_hfi_path, "hfi", "hfi") as layer:
@@ -143,21 +164,15 @@ async def process_hfi(run_type: RunType, run_date: date, run_datetime: datetime,
                 logger.info("Done uploading %s", key)
 
                 spatial_reference: osr.SpatialReference = layer.GetSpatialRef()
-                target_srs = osr.SpatialReference()
-                target_srs.ImportFromEPSG(NAD83_BC_ALBERS)
-                target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-                coordinate_transform = osr.CoordinateTransformation(spatial_reference, target_srs)
+                hfi_values, geometries = read_hfi_features(layer)
 
                 async with get_async_write_session_scope() as session:
                     advisory = await get_hfi_classification_threshold(session, HfiClassificationThresholdEnum.ADVISORY)
                     warning = await get_hfi_classification_threshold(session, HfiClassificationThresholdEnum.WARNING)
 
-                    logger.info("Writing HFI advisory zones to API database...")
-                    for i in range(layer.GetFeatureCount()):
-                        # https://gdal.org/api/python/osgeo.ogr.html#osgeo.ogr.Feature
-                        feature: ogr.Feature = layer.GetFeature(i)
-                        obj = create_model_object(feature, advisory, warning, coordinate_transform, run_type, run_datetime, for_date)
-                        await save_hfi(session, obj)
+                    classified_hfi = create_classified_hfi_rows(hfi_values, geometries, spatial_reference.ExportToWkt(), advisory, warning, run_type, run_datetime, for_date)
+                    logger.info("Writing %d HFI advisory zones to API database...", len(classified_hfi))
+                    await save_classified_hfi(session, classified_hfi, int(config.get("HFI_INSERT_BATCH_SIZE", DEFAULT_HFI_INSERT_BATCH_SIZE)))
 
                     # Store the unique combination of run type, run datetime and for date in the run_parameters table
                     await save_run_parameters(session, run_type, run_datetime, for_date)
@@ -0,0 +1,180 @@
+"""Zone label rasters and single pass zonal statistics for advisory shapes (fire zones).
+
+Instead of clipping a raster once per advisory shape, each raster grid is labelled once with the id of the advisory shape
+covering each pixel. Statistics for every shape then come out of a single pass over the raster arrays.
+
+Shapes of different types overlap (a fire zone unit is inside a fire centre), so each shape type gets a label raster of its
+own. Shapes of the same type don't overlap.
+"""
+
+from dataclasses import dataclass
+import logging
+from time import perf_counter
+from itertools import groupby
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+import numpy as np
+from osgeo import gdal
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.crud.auto_spatial_advisory import get_zone_shape_ids, get_zone_shapes_version
+from app.db.database import DB_READ_STRING
+
+logger = logging.getLogger(__name__)
+
+# Label of pixels not covered by any advisory shape.
+NO_ZONE_LABEL = 0
+# Number of distinct grids (SFMS, DEM, TPI) to keep labelled in memory.
+ZONE_LABEL_CACHE_SIZE = 3
+
+
+@dataclass(frozen=True)
+class ZoneLabelRaster:
+    """
+    Raster in which each pixel holds the id of the advisory shape of one shape type containing the pixel centre, or
+    NO_ZONE_LABEL.
+    """
+
+    shape_type: int
+    labels: np.ndarray
+    zone_ids: np.ndarray
+
+
+GridKey = Tuple[Tuple[float, ...], str, int, int]
+
+_zone_label_cache: Dict[Tuple[Hashable, GridKey], List[ZoneLabelRaster]] = {}
+
+
+def get_grid_key(dataset: gdal.Dataset) -> GridKey:
+    return (tuple(dataset.GetGeoTransform()), dataset.GetProjection(), dataset.RasterXSize, dataset.RasterYSize)
+
+
+def rasterize_zones(grid_key: GridKey, shape_type: int, max_zone_id: int) -> np.ndarray:
+    """
+    Burns the id of every advisory shape of the given type into a raster matching the given grid. Like a gdal.Warp cutline,
+    a pixel belongs to a shape when the pixel centre is inside the shape. Shapes are reprojected to the grid's spatial
+    reference.
+
+    :param grid_key: Geotransform, projection, x size and y size of the grid to label.
+    :param shape_type: The advisory shape type (eg. fire zone unit) to label.
+    :param max_zone_id: The largest advisory shape id, used to pick the smallest label data type.
+    :return: 2-d array of advisory shape ids.
+    """
+    geotransform, projection, x_size, y_size = grid_key
+    data_type = gdal.GDT_UInt16 if max_zone_id <= np.iinfo(np.uint16).max else gdal.GDT_UInt32
+    label_ds: gdal.Dataset = gdal.GetDriverByName("MEM").Create("zone_labels", x_size, y_size, 1, data_type)
+    label_ds.SetGeoTransform(geotransform)
+    label_ds.SetProjection(projection)
+    label_ds.GetRasterBand(1).Fill(NO_ZONE_LABEL)
+    rasterize_options = gdal.RasterizeOptions(attribute="id", SQLStatement=f"SELECT id, geom FROM advisory_shapes WHERE shape_type = {int(shape_type)}")
+    gdal.Rasterize(label_ds, DB_READ_STRING, options=rasterize_options)
+    labels = label_ds.GetRasterBand(1).ReadAsArray()
+    label_ds = None
+    return labels
+
+
+async def get_zone_label_rasters(session: AsyncSession, dataset: gdal.Dataset) -> List[ZoneLabelRaster]:
+    """
+    Returns a zone label raster per shape type for the grid of the given dataset, rasterizing the advisory shapes only when
+    the grid hasn't been seen before or the shapes have changed.
+
+    :param dataset: Any raster on the grid of interest (eg. the SFMS fuel type grid, the DEM, the classified TPI).
+    """
+    version = await get_zone_shapes_version(session)
+    grid_key = get_grid_key(dataset)
+    cache_key = (version, grid_key)
+    zone_label_rasters = _zone_label_cache.get(cache_key)
+    if zone_label_rasters is None:
+        perf_start = perf_counter()
+        zone_label_rasters = []
+        for shape_type, rows in groupby(await get_zone_shape_ids(session), key=lambda row: row[0]):
+            zone_ids = np.asarray([row[1] for row in rows], dtype=np.int64)
+            labels = rasterize_zones(grid_key, shape_type, int(zone_ids.max()))
+            zone_label_rasters.append(ZoneLabelRaster(shape_type=shape_type, labels=labels, zone_ids=zone_ids))
+        # drop labels of stale shapes, and the oldest grid when full
+        for key in [key for key in _zone_label_cache if key[0] != version]:
+            del _zone_label_cache[key]
+        if len(_zone_label_cache) >= ZONE_LABEL_CACHE_SIZE:
+            del _zone_label_cache[next(iter(_zone_label_cache))]
+        _zone_label_cache[cache_key] = zone_label_rasters
+        logger.info(
+            "Rasterized %d advisory shapes of %d types onto a %dx%d grid in %f seconds",
+            sum(len(raster.zone_ids) for raster in zone_label_rasters),
+            len(zone_label_rasters),
+            grid_key[2],
+            grid_key[3],
+            perf_counter() - perf_start,
+        )
+    return zone_label_rasters
+
+
+def get_zone_index(labels: np.ndarray, zone_ids: np.ndarray) -> np.ndarray:
+    """
+    Maps each label to the position of its zone in zone_ids, or -1 for pixels outside every zone.
+    """
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    labels = np.asarray(labels)
+    size = max(int(labels.max()) if labels.size else 0, int(zone_ids.max()) if zone_ids.size else 0) + 1
+    lookup = np.full(size, -1, dtype=np.int64)
+    lookup[zone_ids] = np.arange(len(zone_ids))
+    lookup[NO_ZONE_LABEL] = -1
+    return lookup[labels.ravel()]
+
+
+def zonal_value_counts(labels: np.ndarray, values: np.ndarray, zone_ids: Sequence[int], num_values: Optional[int] = None) -> np.ndarray:
+    """
+    Counts the pixels of each (non-negative integer) value in every zone, in one pass.
+
+    :param labels: Zone label raster.
+    :param values: Raster of class values (eg. fuel type id, TPI class) on the same grid as labels.
+    :param zone_ids: The zones to count, defines the row order of the result.
+    :param num_values: Number of value columns in the result, defaults to the largest value + 1.
+    :return: 2-d array of counts, indexed by [position in zone_ids, value].
+    """
+    zone_index = get_zone_index(labels, zone_ids)
+    values = np.asarray(values).ravel().astype(np.int64)
+    in_zone = zone_index >= 0
+    zone_index = zone_index[in_zone]
+    values = values[in_zone]
+    if num_values is None:
+        num_values = int(values.max()) + 1 if values.size else 1
+    in_range = (values >= 0) & (values < num_values)
+    counts = np.bincount(zone_index[in_range] * num_values + values[in_range], minlength=len(zone_ids) * num_values)
+    return counts.reshape(len(zone_ids), num_values)
+
+
+def zonal_percentiles(labels: np.ndarray, values: np.ndarray, zone_ids: Sequence[int], percentiles: Sequence[float], mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates percentiles (linear interpolation, as np.percentile) of the values in every zone from a single sort.
+
+    :param labels: Zone label raster.
+    :param values: Raster of values on the same grid as labels.
+    :param zone_ids: The zones of interest, defines the row order of the result.
+    :param percentiles: Percentiles in the range 0 - 100.
+    :param mask: Optional boolean raster, only pixels where the mask is True are included.
+    :return: Tuple of percentiles indexed by [position in zone_ids, percentile] (NaN for zones without values),
+             and the number of values in each zone.
+    """
+    zone_index = get_zone_index(labels, zone_ids)
+    values = np.asarray(values).ravel()
+    included = zone_index >= 0
+    if mask is not None:
+        included &= np.asarray(mask).ravel()
+    zone_index = zone_index[included]
+    values = values[included].astype(np.float64)
+
+    # sort by zone, then value, so that each zone is a contiguous run of sorted values
+    order = np.lexsort((values, zone_index))
+    sorted_values = values[order]
+    counts = np.bincount(zone_index, minlength=len(zone_ids))
+    starts = np.cumsum(counts) - counts
+
+    result = np.full((len(zone_ids), len(percentiles)), np.nan)
+    has_values = counts > 0
+    for column, percentile in enumerate(percentiles):
+        position = (counts[has_values] - 1) * (percentile / 100.0)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        fraction = position - lower
+        lower_values = sorted_values[starts[has_values] + lower]
+        upper_values = sorted_values[starts[has_values] + upper]
+        result[has_values, column] = lower_values + (upper_values - lower_values) * fraction
+    return result, counts
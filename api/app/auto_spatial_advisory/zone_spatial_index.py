@@ -0,0 +1,122 @@
+"""In memory spatial index of advisory shapes (fire zones), for point in zone lookups without a database round trip per point."""
+
+import logging
+from functools import lru_cache
+from time import perf_counter
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+import shapely
+from pyproj import Transformer
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.crud.auto_spatial_advisory import get_zone_shapes_version, get_zone_shapes_wkb
+
+logger = logging.getLogger(__name__)
+
+ZONE_SRID = 3005
+NO_ZONE = -1
+
+
+@lru_cache(maxsize=8)
+def get_transformer(source_srid: int, target_srid: int) -> Transformer:
+    """
+    Returns a cached pyproj transformer. Axis order follows the authority definition of each CRS, so for EPSG:4326
+    coordinates are (lat, long), matching app.utils.geospatial.PointTransformer.
+    """
+    return Transformer.from_crs(source_srid, target_srid)
+
+
+def transform_coordinates(xs: Sequence[float], ys: Sequence[float], source_srid: int, target_srid: int = ZONE_SRID) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms many coordinates in a single call.
+
+    :param xs: First axis of the source CRS (latitude for EPSG:4326).
+    :param ys: Second axis of the source CRS (longitude for EPSG:4326).
+    :return: Tuple of x and y arrays in the target CRS.
+    """
+    transformer = get_transformer(source_srid, target_srid)
+    return transformer.transform(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+
+
+class ZoneSpatialIndex:
+    """
+    STRtree over advisory shape geometries in EPSG:3005.
+    """
+
+    def __init__(self, zone_ids: Sequence[int], geometries: Sequence[shapely.Geometry], version: Optional[Hashable] = None):
+        self.zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.version = version
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_wkb(cls, rows: Iterable[Tuple[int, bytes]], version: Optional[Hashable] = None) -> "ZoneSpatialIndex":
+        rows = list(rows)
+        zone_ids = [row[0] for row in rows]
+        geometries = shapely.from_wkb([bytes(row[1]) for row in rows])
+        return cls(zone_ids, geometries, version)
+
+    def find_zones(self, xs: Sequence[float], ys: Sequence[float]) -> np.ndarray:
+        """
+        Finds the zone containing each point.
+
+        :param xs: Point x coordinates in EPSG:3005.
+        :param ys: Point y coordinates in EPSG:3005.
+        :return: Array of zone ids, NO_ZONE where a point isn't inside any zone. Where zones overlap, the lowest id wins.
+        """
+        points = shapely.points(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64))
+        result = np.full(len(points), NO_ZONE, dtype=np.int64)
+        if len(points) == 0 or len(self.zone_ids) == 0:
+            return result
+        # same semantics as ST_Contains(zone, point): points on a zone boundary are not contained
+        point_index, tree_index = self.tree.query(points, predicate="within")
+        # assign in descending id order, so the lowest id is written last
+        order = np.argsort(-self.zone_ids[tree_index], kind="stable")
+        result[point_index[order]] = self.zone_ids[tree_index[order]]
+        return result
+
+    def find_zones_for_lat_longs(self, lats: Sequence[float], longs: Sequence[float]) -> np.ndarray:
+        """
+        Finds the zone containing each EPSG:4326 (lat, long) coordinate.
+        """
+        xs, ys = transform_coordinates(lats, longs, 4326)
+        return self.find_zones(xs, ys)
+
+
+_zone_spatial_index: Optional[ZoneSpatialIndex] = None
+
+
+async def get_zone_spatial_index(session: AsyncSession) -> ZoneSpatialIndex:
+    """
+    Returns the process wide zone spatial index, (re)building it only when the advisory shapes have changed.
+    """
+    global _zone_spatial_index
+    version = await get_zone_shapes_version(session)
+    if _zone_spatial_index is None or _zone_spatial_index.version != version:
+        perf_start = perf_counter()
+        rows = await get_zone_shapes_wkb(session)
+        _zone_spatial_index = ZoneSpatialIndex.from_wkb(rows, version)
+        logger.info(f"Built zone spatial index of {len(rows)} shapes in {perf_counter() - perf_start:.3f}s")
+    return _zone_spatial_index
+
+
+async def get_zone_ids_for_lat_longs(session: AsyncSession, lats: Sequence[float], longs: Sequence[float]) -> List[Optional[int]]:
+    """
+    Looks up the zone containing each EPSG:4326 (lat, long) coordinate.
+
+    :return: Zone id for each coordinate, None where the coordinate isn't in any zone.
+    """
+    index = await get_zone_spatial_index(session)
+    zone_ids = index.find_zones_for_lat_longs(lats, longs)
+    return [None if zone_id == NO_ZONE else int(zone_id) for zone_id in zone_ids]
+
+
+async def group_stations_by_zone(session: AsyncSession, stations: Sequence) -> Dict[int, List]:
+    """
+    Groups stations (anything with lat and long attributes) by the zone that contains them. Stations outside every zone are dropped.
+    """
+    zone_ids = await get_zone_ids_for_lat_longs(session, [station.lat for station in stations], [station.long for station in stations])
+    stations_by_zone: Dict[int, List] = {}
+    for station, zone_id in zip(stations, zone_ids):
+        if zone_id is not None:
+            stations_by_zone.setdefault(zone_id, []).append(station)
+    return stations_by_zone
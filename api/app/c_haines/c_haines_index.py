@@ -1,9 +1,9 @@
 """ Logic pertaining to the generation of c_haines index from GDAL datasets.
 """
 import logging
-import struct
-from typing import Final, Tuple
+from typing import Tuple
 from functools import lru_cache
+import numpy
 from pyproj import CRS
 from osgeo import gdal
 from affine import Affine
@@ -65,21 +65,36 @@ def calculate_c_haines_index(t700: float, t850: float, d850: float) -> float:
     return ch
 
 
-def read_scanline(band, yoff):
-    """ Read a band scanline (up to the y-offset), returning an array of values.
+def calculate_c_haines_index_array(t700: numpy.ndarray, t850: numpy.ndarray, d850: numpy.ndarray) -> numpy.ndarray:
+    """ Array version of calculate_c_haines_index, giving exactly the same (float64) result for every cell.
 
-    A raster (image) may consist of multiple bands (e.g. for a colour image, one may have a band for
-    red, green, blue, and alpha).
-    A scanline, is a single row of a band.
-
-    band, definition: https://gdal.org/user/raster_data_model.html#raster-band
-    fetching a raster band: https://gdal.org/tutorials/raster_api_tut.html#fetching-a-raster-band
+    NOTE: Inputs are converted to float64 before doing any arithmetic, as calculate_c_haines_index does with
+    python floats, otherwise results would differ in the last few bits.
     """
-    scanline = band.ReadRaster(xoff=0, yoff=yoff,
-                               xsize=band.XSize, ysize=1,
-                               buf_xsize=band.XSize, buf_ysize=1,
-                               buf_type=gdal.GDT_Float32)
-    return struct.unpack('f' * band.XSize, scanline)
+    t700 = numpy.asarray(t700, dtype=numpy.float64)
+    t850 = numpy.asarray(t850, dtype=numpy.float64)
+    d850 = numpy.asarray(d850, dtype=numpy.float64)
+    # Temperature depression term.
+    ca = t850 - t700
+    ca /= 2
+    ca -= 2
+    # Dew point depression term.
+    cb = d850 / 3
+    cb -= 1
+    # Limit the extent to which dry air is able to affect the overall index (see calculate_c_haines_index).
+    very_dry = cb > 9
+    dry = (cb > 5) & ~very_dry
+    cb[dry] = 5 + (cb[dry] - 5) / 2
+    cb[very_dry] = 9
+    # Combine the two terms for the index.
+    ca += cb
+    return ca
+
+
+def read_band(band) -> numpy.ndarray:
+    """ Read a whole band as float32, the same values (and precision) the band would give scanline by
+    scanline. """
+    return band.ReadAsArray(buf_type=gdal.GDT_Float32)
 
 
 def get_geographic_bounding_box() -> Tuple[float]:
@@ -117,69 +132,51 @@ class BoundingBoxChecker():
             return True
         return False
 
+    def calculate_mask(self, x_size: int, y_size: int) -> numpy.ndarray:
+        """ Array of the same result as is_inside for every pixel of a x_size by y_size raster, with all the
+        raster coordinates transformed in one go. """
+        raster_y, raster_x = numpy.indices((y_size, x_size))
+        x_coordinates, y_coordinates = self.transform * (raster_x, raster_y)
+        lon, lat = self.raster_to_geo_transformer.transform(x_coordinates, y_coordinates)
+        lon0 = self.geo_bounding_box[0][0]
+        lat0 = self.geo_bounding_box[0][1]
+        lon1 = self.geo_bounding_box[1][0]
+        lat1 = self.geo_bounding_box[1][1]
+        return (lon0 < lon) & (lon < lon1) & (lat0 > lat) & (lat > lat1)
+
+
+@lru_cache(maxsize=8)
+def get_bounding_box_mask(transform: Affine, projection: str, x_size: int, y_size: int) -> numpy.ndarray:
+    """ Mask of the pixels inside the geographic bounding box, calculated once per grid geometry. """
+    logger.info('Calculating bounding box mask.')
+    crs = CRS.from_string(projection)
+    # Create a transformer to go from whatever the raster is, to geographic coordinates.
+    raster_to_geo_transformer = get_transformer(crs, NAD83_CRS)
+    mask = BoundingBoxChecker(transform, raster_to_geo_transformer).calculate_mask(x_size, y_size)
+    # The mask is shared, make sure nobody changes it.
+    mask.flags.writeable = False
+    return mask
+
 
 class CHainesGenerator():
     """ Class for generating c_haines data """
 
-    def __init__(self):
-        self.bound_checker: BoundingBoxChecker = None
-
-    def _prepare_bound_checker(self, grib_tmp_700: gdal.Dataset, grib_tmp_700_filename: str):
-        """ Prepare the boundary checker. """
-        if not self.bound_checker:
-            logger.info('Creating bound checker.')
-            transform: Affine = get_dataset_geometry(grib_tmp_700_filename)
-            crs = CRS.from_string(grib_tmp_700.GetProjection())
-            # Create a transformer to go from whatever the raster is, to geographic coordinates.
-            raster_to_geo_transformer = get_transformer(crs, NAD83_CRS)
-            self.bound_checker = BoundingBoxChecker(transform, raster_to_geo_transformer)
-        else:
-            logger.info('Re-using bound checker.')
-
-    def calculate_row_data(self,
-                           tmp_700_raster_band: gdal.Band,
-                           tmp_850_raster_band: gdal.Band,
-                           dew_850_raster_band: gdal.Band,
-                           y_row_index: int):
-        """ Calculate a row of c-haines raster data """
-        c_haines_row: Final = []
-        # Read the scanlines.
-        row_tmp_700: Final = read_scanline(tmp_700_raster_band, y_row_index)
-        row_tmp_850: Final = read_scanline(tmp_850_raster_band, y_row_index)
-        row_dew_850: Final = read_scanline(dew_850_raster_band, y_row_index)
-
-        # Iterate through values in row.
-        for x_column_index, (t700, t850, d850) in enumerate(zip(row_tmp_700, row_tmp_850, row_dew_850)):
-
-            if self.bound_checker.is_inside(x_column_index, y_row_index):
-                c_haines_row.append(calculate_c_haines_index(t700, t850, d850))
-            else:
-                c_haines_row.append(0)
-        return c_haines_row
-
-    def generate_c_haines(self, source_data: GDALData):
-        """ Given grib data sources, generate c_haines data. """
-
-        # Prepare the boundary checker.
-        # Boundary checking is very slow. We have to repeatedly convert a raster coordinate to a geographic
-        # coordinate, so we can save a lot of time by creating a boundary checker that caches results.
-        self._prepare_bound_checker(source_data.grib_tmp_700, source_data.grib_tmp_700_filename)
-
+    def generate_c_haines(self, source_data: GDALData) -> numpy.ndarray:
+        """ Given grib data sources, generate c_haines data (0 outside of the geographic bounding box). """
         # Load the raster data.
         tmp_850_raster_band = source_data.grib_tmp_850.GetRasterBand(1)
         tmp_700_raster_band = source_data.grib_tmp_700.GetRasterBand(1)
         dew_850_raster_band = source_data.grib_dew_850.GetRasterBand(1)
 
-        # Prepare the resultant data arrays.
-        c_haines_data: Final = []
+        # Boundary checking is slow - we have to convert every raster coordinate to a geographic coordinate,
+        # so the mask is only calculated once for each grid.
+        transform: Affine = get_dataset_geometry(source_data.grib_tmp_700_filename)
+        inside = get_bounding_box_mask(transform, source_data.grib_tmp_700.GetProjection(),
+                                       tmp_700_raster_band.XSize, tmp_700_raster_band.YSize)
 
-        # Iterate through rows (assuming all the raster bands have the same amount of rows)
         logger.info('Generating c-haines index data.')
-        for y_row_index in range(tmp_850_raster_band.YSize):
-
-            c_haines_row = self.calculate_row_data(
-                tmp_700_raster_band, tmp_850_raster_band, dew_850_raster_band, y_row_index)
-
-            c_haines_data.append(c_haines_row)
-
+        c_haines_data = calculate_c_haines_index_array(read_band(tmp_700_raster_band),
+                                                       read_band(tmp_850_raster_band),
+                                                       read_band(dew_850_raster_band))
+        c_haines_data[~inside] = 0
         return c_haines_data
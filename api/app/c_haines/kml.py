@@ -8,13 +8,9 @@ import logging
 from pyproj import Transformer, Proj
 from shapely.ops import transform
 from shapely.geometry import shape, Polygon
-from app.utils.s3 import object_exists
 from app.geospatial import WGS84
 from app.weather_models import ModelEnum
-from app.utils.s3 import get_client
 from app.c_haines import get_severity_string, SeverityEnum
-from app.c_haines.object_store import (ObjectTypeEnum,
-                                       generate_full_object_store_path)
 
 logger = logging.getLogger(__name__)
 
@@ -45,39 +41,6 @@ def get_severity_style(c_haines_index: SeverityEnum) -> str:
     return severity_style_map[c_haines_index]
 
 
-async def save_as_kml_to_s3(json_filename: str,
-                            source_projection,
-                            prediction_model: ModelEnum,
-                            model_run_timestamp: datetime,
-                            prediction_timestamp: datetime):
-    """ Given a geojson file, generate KML and store to S3 """
-    target_kml_path = generate_full_object_store_path(
-        prediction_model, model_run_timestamp, prediction_timestamp, ObjectTypeEnum.KML)
-    async with get_client() as (client, bucket):
-        # let's save some time, and check if the file doesn't already exists.
-        # it's super important we do this, since there are many c-haines cronjobs running in dev, all
-        # pointing to the same s3 bucket.
-        if await object_exists(client, bucket, target_kml_path):
-            logger.info('kml (%s) already exists - skipping', target_kml_path)
-            return
-
-        # generate the kml file
-        with io.StringIO() as sio:
-            severity_geojson_to_kml(json_filename, source_projection, sio,
-                                    prediction_model, model_run_timestamp, prediction_timestamp)
-            # smash it into binary
-            sio.seek(0)
-            bio = io.BytesIO(sio.read().encode('utf8'))
-            # go back to start
-            bio.seek(0)
-            # save it to s3
-            logger.info('uploading %s', target_kml_path)
-            await client.put_object(Bucket=bucket,
-                                    Key=target_kml_path,
-                                    ACL=C_HAINES_KML_PERMISSIONS,  # We need these to be accessible to everyone
-                                    Body=bio)
-
-
 def open_placemark(model: ModelEnum, severity: SeverityEnum, timestamp: datetime) -> str:
     """ Open kml <Placemark> tag. """
     kml = []
@@ -260,3 +223,16 @@ def severity_geojson_to_kml(geojson_filename: str,
                                             model_run_timestamp,
                                             prediction_timestamp):
             sio.write(part)
+
+
+def re_projected_geojson_to_kml(geojson_data: dict,
+                                model: ModelEnum,
+                                model_run_timestamp: datetime,
+                                prediction_timestamp: datetime) -> str:
+    """ Given geojson that has already been re-projected and classified (see
+    severity_index.re_project_and_classify_geojson), create a KML document. This saves re-projecting every
+    polygon a second time.
+    """
+    polygons = ((feature_2_kml_polygon(feature, None), feature['properties']['c_haines_index'])
+                for feature in geojson_data['features'])
+    return ''.join(generate_kml_prediction(polygons, model, model_run_timestamp, prediction_timestamp))
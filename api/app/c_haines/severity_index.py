@@ -1,33 +1,35 @@
 """ Logic pertaining to the generation of c_haines severity index from GDAL datasets.
 """
 import os
-import io
 import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import Final, Tuple, Generator, Optional, List
-from contextlib import contextmanager
+from typing import Dict, Final, Tuple, Generator, Optional, List, Set
+from contextlib import asynccontextmanager, contextmanager
 import tempfile
 import logging
 import json
 from osgeo import gdal, ogr
 import numpy
 from pyproj import Transformer, Proj
-from shapely.ops import transform
+import shapely
 from shapely.geometry import shape, mapping
 from aiobotocore.client import AioBaseClient
+from aiohttp import ClientSession
 from affine import Affine
-from app.utils.s3 import object_exists, object_exists_v2
+from app.utils.s3 import list_object_keys
 import app.utils.time as time_utils
 from app.weather_models import ModelEnum, ProjectionEnum
 from app.geospatial import WGS84
-from app.jobs.env_canada import get_model_run_hours, adjust_model_day, download, UnhandledPredictionModelType
+from app.jobs.env_canada import get_model_run_hours, adjust_model_day, UnhandledPredictionModelType
 from app.jobs.env_canada_utils import get_file_date_part
-from app.utils.s3 import get_client
+from app.jobs.grib_downloader import DOWNLOAD_TIMEOUT, GribDownloader, get_download_filename, remove_download
 from app.c_haines import get_severity_string
 from app.c_haines.c_haines_index import CHainesGenerator
 from app.c_haines import GDALData
-from app.c_haines.object_store import (ObjectTypeEnum, generate_full_object_store_path)
-from app.c_haines.kml import save_as_kml_to_s3
+from app.c_haines.object_store import (ObjectTypeEnum, generate_full_object_store_path,
+                                       generate_object_store_model_run_path)
+from app.c_haines.kml import C_HAINES_KML_PERMISSIONS, re_projected_geojson_to_kml
 from app import config
 from app.weather_models.process_grib import get_dataset_geometry
 
@@ -35,6 +37,10 @@ from app.weather_models.process_grib import get_dataset_geometry
 logger = logging.getLogger(__name__)
 
 C_HAINES_JSON_PERMISSIONS = 'public-read'
+# Rough peak memory needed per grid cell to process a prediction: the three bands, the c-haines index and the
+# temporary arrays used to calculate it, the severity and mask, and the in memory rasters that get polygonized.
+BYTES_PER_CELL = 64
+DEFAULT_MAX_MEMORY_BYTES = 1024 * 1024 * 1024
 
 
 def get_severity(c_haines_index) -> int:
@@ -229,27 +235,17 @@ def save_data_as_geojson(
 
 
 def generate_severity_data(c_haines_data):
-    """ Generate severity index data, iterating over c-haines data.
-    NOTE: Iterating to generate c-haines, and then iterating again to generate severity is a bit slower,
-    but results in much cleaner code.
-    """
+    """ Generate severity index and mask data from c-haines data, with the same thresholds as get_severity
+    (NaN is classed as extreme, as get_severity does). """
     logger.info('Generating c-haines severity index data.')
-    severity_data = []
-    mask_data = []
-    for row in c_haines_data:
-        severity_row = []
-        mask_row = []
-        for cell in row:
-            severity = get_severity(cell)
-            severity_row.append(severity)
-            # We ignore severity 0.
-            if severity == 0:
-                mask_row.append(0)
-            else:
-                mask_row.append(1)
-        severity_data.append(severity_row)
-        mask_data.append(mask_row)
-    return numpy.array(severity_data), numpy.array(mask_data)
+    c_haines_data = numpy.asarray(c_haines_data, dtype=numpy.float64)
+    # 0 - 4 : low, 4 - 8 : moderate, 8 - 11 : high, 11 + Extreme
+    severity_data = numpy.full(c_haines_data.shape, 3, dtype=numpy.int64)
+    for threshold in (11, 8, 4):
+        severity_data -= c_haines_data < threshold
+    # We ignore severity 0.
+    mask_data = (severity_data != 0).astype(numpy.int64)
+    return severity_data, mask_data
 
 
 class EnvCanadaPayload():
@@ -292,52 +288,103 @@ def re_project_and_classify_geojson(source_json_filename: str,
     project = Transformer.from_proj(proj_from, proj_to, always_xy=True)
     with open(source_json_filename, encoding="utf-8") as source_file:
         geojson_data = json.load(source_file)
-        # We need to sort the geojson by severity.
-        geojson_data['features'].sort(key=lambda feature: feature['properties']['severity'])
-        # Iterate through features.
-        for feature in geojson_data['features']:
-            # Replace "severity" with c-haines.
-            feature['properties'] = {"c_haines_index": get_severity_string(feature['properties']['severity'])}
-            # Re-project to WGS84
-            source_geometry = shape(feature['geometry'])
-            geometry = transform(project.transform, source_geometry)
-            geojson_geometry = mapping(geometry)
-            feature['geometry']['coordinates'] = geojson_geometry['coordinates']
+    features = geojson_data['features']
+    # We need to sort the geojson by severity.
+    features.sort(key=lambda feature: feature['properties']['severity'])
+    # Re-project to WGS84. All the coordinates are transformed in one go, which is a lot faster than
+    # transforming one feature at a time.
+    geometries = shapely.transform(
+        [shape(feature['geometry']) for feature in features],
+        lambda coordinates: numpy.column_stack(project.transform(coordinates[:, 0], coordinates[:, 1])))
+    for feature, geometry in zip(features, geometries):
+        # Replace "severity" with c-haines.
+        feature['properties'] = {"c_haines_index": get_severity_string(feature['properties']['severity'])}
+        feature['geometry']['coordinates'] = mapping(geometry)['coordinates']
     return geojson_data
 
 
-async def save_as_geojson_to_s3(source_json_filename: str,
-                                source_projection: str,
-                                prediction_model: ModelEnum,
-                                model_run_timestamp: datetime,
-                                prediction_timestamp: datetime):
-    """ Given a geojson file, ensure it's in the correct projection and then store to S3 """
-    target_path = generate_full_object_store_path(
-        prediction_model, model_run_timestamp, prediction_timestamp, ObjectTypeEnum.GEOJSON)
-    # let's save some time, and check if the file doesn't already exists.
-    # it's super important we do this, since there are many c-haines cronjobs running in dev, all
-    # pointing to the same s3 bucket.
-    async with get_client() as (client, bucket):
-        if await object_exists(client, bucket, target_path):
-            logger.info('json (%s) already exists - skipping', target_path)
-            return
+def _generate_c_haines_data(payload: EnvCanadaPayload) -> Tuple[numpy.ndarray, SourceInfo]:
+    # Open the grib files.
+    with open_gdal(payload.filename_tmp_700,
+                   payload.filename_tmp_850,
+                   payload.filename_dew_850) as source_data:
+        # Generate c_haines data
+        c_haines_data = CHainesGenerator().generate_c_haines(source_data)
+        # Store the projection and geotransform for later.
+        projection = source_data.grib_tmp_700.GetProjection()
+        geotransform: Affine = get_dataset_geometry(source_data.grib_tmp_700_filename)
+        # Store the dimensions for later.
+        band = source_data.grib_tmp_700.GetRasterBand(1)
+        rows = band.YSize
+        cols = band.XSize
+        # Package source info nicely.
+        source_info = SourceInfo(projection=projection,
+                                 geotransform=geotransform, rows=rows, cols=cols)
+
+    return c_haines_data, source_info
+
 
+def generate_c_haines_assets(payload: EnvCanadaPayload) -> Dict[ObjectTypeEnum, bytes]:
+    """ Generate the geojson and kml for a prediction from its grib files.
+
+    This is all cpu bound, so it's run in a worker process, letting several predictions be processed at once.
+    """
+    # Generate the c_haines data.
+    c_haines_data, source_info = _generate_c_haines_data(payload)
+    if config.get('C_HAINES_OUTPUT_TIFF') == 'True':
+        # Save as geotiff
+        _save_data_as_geotiff(payload, c_haines_data, source_info)
+    # Generate the severity index and mask data.
+    c_haines_severity_data, c_haines_mask_data = generate_severity_data(c_haines_data)
+    # We're done with the c_haines data, so we can clean up some memory.
+    del c_haines_data
+    with tempfile.TemporaryDirectory() as temporary_path:
+        json_filename = os.path.join(temporary_path, 'c-haines.geojson')
+        save_data_as_geojson(
+            c_haines_severity_data,
+            c_haines_mask_data,
+            source_info,
+            json_filename)
+        del c_haines_severity_data, c_haines_mask_data
         # re-project the geojson file from whatever it was, to WGS84.
-        re_projected_data = re_project_and_classify_geojson(source_json_filename, source_projection)
-
-        with io.StringIO() as sio:
-            json.dump(re_projected_data, sio)
-            # smash it into binary
-            sio.seek(0)
-            bio = io.BytesIO(sio.read().encode('utf8'))
-            # go back to start
-            bio.seek(0)
-            # smash it into the object store.
-            logger.info('uploading %s', target_path)
-            await client.put_object(Bucket=bucket,
-                                    Key=target_path,
-                                    ACL=C_HAINES_JSON_PERMISSIONS,
-                                    Body=bio)
+        geojson_data = re_project_and_classify_geojson(json_filename, source_info.projection)
+    kml = re_projected_geojson_to_kml(geojson_data, payload.model,
+                                      payload.model_run_timestamp, payload.prediction_timestamp)
+    return {ObjectTypeEnum.GEOJSON: json.dumps(geojson_data).encode('utf8'),
+            ObjectTypeEnum.KML: kml.encode('utf8')}
+
+
+def estimate_memory_use(filename: str) -> int:
+    """ Estimate the memory needed to process a prediction, from the size of the grid in one of its grib files.
+    (Only the header is read.) """
+    dataset = gdal.Open(filename, gdal.GA_ReadOnly)
+    try:
+        return dataset.RasterXSize * dataset.RasterYSize * BYTES_PER_CELL
+    finally:
+        del dataset
+
+
+class MemoryBudget():
+    """ Keep the estimated memory used by predictions that are processed at the same time under max_bytes.
+    A prediction that needs more than max_bytes on its own is still processed, just not alongside any others. """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        """ Wait until size bytes are available, and hold on to them for the duration of the context. """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.max_bytes)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.used -= size
+                self._condition.notify_all()
 
 
 class CHainesSeverityGenerator():
@@ -345,180 +392,142 @@ class CHainesSeverityGenerator():
     index polygons.
 
     Steps for generation of severity level as follows:
-    1) Download grib files.
-    2) Iterate through raster rows, generating an in memory raster containing c-haines severity indices.
-    3) Turn raster data into polygons, storing in intermediary GeoJSON file.
-    4) Write polygons to database.
+    1) List the kml and geojson that already exist for the model run.
+    2) Download grib files.
+    3) In a worker process: generate c-haines severity indices, turn the raster data into polygons, and
+       re-project the polygons to geojson and kml.
+    4) Upload the geojson and kml to the object store.
+
+    The predictions of a model run are processed concurrently: while C_HAINES_PROCESSES worker processes are
+    busy, grib files for the next predictions are downloaded and finished predictions are uploaded. The
+    estimated memory used by the predictions being processed is kept under C_HAINES_MAX_MEMORY_BYTES.
     """
 
     def __init__(self, model: ModelEnum, projection: ProjectionEnum, client: AioBaseClient, bucket: str):
         self.model = model
         self.projection = projection
-        self.c_haines_generator = CHainesGenerator()
         self.client: AioBaseClient = client
         self.bucket: str = bucket
 
-    def _collect_payload(self,
-                         urls: dict,
-                         model: ModelEnum,
-                         model_run_timestamp: datetime,
-                         prediction_timestamp: datetime,
-                         temporary_path: str) -> Optional[EnvCanadaPayload]:
-        """ Collect all the different things that make up our payload: our downloaded files,
-        model run, and prediction timestamp. """
-
-        def _download_files(urls: dict,
-                            model: ModelEnum,
-                            temporary_path: str) -> Optional[List[str]]:
-            """ Try to download all the files """
-            filenames = []
-            for key in make_model_levels(model):
-                # Try to download this file.
-                # TODO: would be nice to make the file download async
-                filename = download(urls[key], temporary_path,
-                                    'REDIS_CACHE_ENV_CANADA', 'REDIS_ENV_CANADA_CACHE_EXPIRY')
-                if not filename:
-                    # If we fail to download one of files, quit, don't try the others.
-                    logger.warning('failed to download %s', urls[key])
-                    return None
-                filenames.append(filename)
-            return filenames
-
-        filenames = _download_files(urls, self.model, temporary_path)
-        if filenames:
-            filename_tmp_700, filename_tmp_850, filename_dew_850 = filenames
-            payload = EnvCanadaPayload()
-            payload.filename_tmp_700 = filename_tmp_700
-            payload.filename_tmp_850 = filename_tmp_850
-            payload.filename_dew_850 = filename_dew_850
-            payload.model = model
-            payload.model_run_timestamp = model_run_timestamp
-            payload.prediction_timestamp = prediction_timestamp
-            return payload
-        return None
-
-    async def _assets_exist(self, model: ModelEnum,
-                            model_run_timestamp: datetime,
-                            prediction_timestamp: datetime) -> bool:
-        """ Return True if kml and geojson assets already exist, otherwise False """
-        tasks = []
-        kml_path = generate_full_object_store_path(
-            model,
-            model_run_timestamp,
-            prediction_timestamp,
-            ObjectTypeEnum.KML)
-        tasks.append(asyncio.create_task(object_exists_v2(kml_path)))
-
-        json_path = generate_full_object_store_path(
-            model,
-            model_run_timestamp,
-            prediction_timestamp,
-            ObjectTypeEnum.GEOJSON)
-        tasks.append(asyncio.create_task(object_exists_v2(json_path)))
-
-        if False in await asyncio.gather(*tasks):
-            return False
-        return True
-
-    async def _get_payloads(self, temporary_path) -> Generator[EnvCanadaPayload, None, None]:
-        """ Iterator that yields the next to process. """
-        utc_now = time_utils.get_utc_now()
-        for model_hour in get_model_run_hours(self.model):
-            for prediction_hour in model_prediction_hour_iterator(self.model):
-
-                urls, model_run_timestamp, prediction_timestamp = make_model_run_download_urls(
-                    self.model, utc_now, model_hour, prediction_hour)
-
-                # If the GeoJSON and the KML already exist, then we can skip this one.
-                if await self._assets_exist(self.model,
-                                            model_run_timestamp,
-                                            prediction_timestamp):
-                    logger.info('%s: already processed %s-%s',
-                                self.model,
-                                model_run_timestamp, prediction_timestamp)
-                    continue
-
-                payload = self._collect_payload(urls,
-                                                self.model,
-                                                model_run_timestamp,
-                                                prediction_timestamp,
-                                                temporary_path)
-                if payload:
-                    yield payload
+    async def _list_existing_assets(self, model_run_timestamp: datetime) -> Set[str]:
+        """ Return the keys of the kml and geojson that already exist for a model run. This is one (paginated)
+        listing per type of asset, instead of a lookup for every prediction. """
+        listings = await asyncio.gather(*[
+            list_object_keys(self.client, self.bucket,
+                             generate_object_store_model_run_path(self.model, model_run_timestamp, object_type) + '/')
+            for object_type in ObjectTypeEnum])
+        return set().union(*listings)
+
+    async def _download(self,
+                        downloader: GribDownloader,
+                        urls: dict,
+                        model_run_timestamp: datetime,
+                        prediction_timestamp: datetime,
+                        temporary_path: str) -> Optional[EnvCanadaPayload]:
+        """ Download the grib files for a prediction, returning None if any of them aren't available. """
+        levels = make_model_levels(self.model)
+        filenames = await asyncio.gather(*[
+            downloader.download(urls[level], temporary_path, get_download_filename(urls[level], self.model.value))
+            for level in levels])
+        if not all(filenames):
+            # If we fail to download one of files, there's no point keeping the others.
+            for level, filename in zip(levels, filenames):
+                if filename:
+                    remove_download(filename)
                 else:
-                    # If you didn't get one of them - you probably won't get the rest either!
-                    logger.info('Failed to download one of the model files - skipping the rest')
+                    logger.warning('failed to download %s', urls[level])
+            return None
+        payload = EnvCanadaPayload()
+        payload.filename_tmp_700, payload.filename_tmp_850, payload.filename_dew_850 = filenames
+        payload.model = self.model
+        payload.model_run_timestamp = model_run_timestamp
+        payload.prediction_timestamp = prediction_timestamp
+        return payload
+
+    async def _upload(self, targets: Dict[ObjectTypeEnum, str], assets: Dict[ObjectTypeEnum, bytes]):
+        """ Upload the assets that don't exist yet to the object store. """
+        permissions = {ObjectTypeEnum.KML: C_HAINES_KML_PERMISSIONS,
+                       ObjectTypeEnum.GEOJSON: C_HAINES_JSON_PERMISSIONS}
+        for target_path in targets.values():
+            logger.info('uploading %s', target_path)
+        await asyncio.gather(*[self.client.put_object(Bucket=self.bucket,
+                                                      Key=target_path,
+                                                      ACL=permissions[object_type],
+                                                      Body=assets[object_type])
+                               for object_type, target_path in targets.items()])
+
+    async def _process_model_run(self,
+                                 model_hour: int,
+                                 utc_now: datetime,
+                                 downloader: GribDownloader,
+                                 pool: Executor,
+                                 processes: int,
+                                 budget: MemoryBudget,
+                                 temporary_path: str) -> bool:
+        """ Process all the predictions of a model run that haven't been processed yet.
+
+        :return: False if some of the grib files weren't available (the model run isn't complete yet), otherwise
+        True.
+        """
+        loop = asyncio.get_running_loop()
+        predictions = [make_model_run_download_urls(self.model, utc_now, model_hour, prediction_hour)
+                       for prediction_hour in model_prediction_hour_iterator(self.model)]
+        existing_assets = await self._list_existing_assets(predictions[0][1])
+        # Limit how many predictions are downloaded ahead of the worker processes.
+        window = asyncio.Semaphore(2 * processes)
+        unavailable: List[datetime] = []
+
+        async def process_prediction(urls: dict, model_run_timestamp: datetime, prediction_timestamp: datetime,
+                                     targets: Dict[ObjectTypeEnum, str]):
+            async with window:
+                # If you didn't get one of the earlier predictions - you probably won't get this one either!
+                if unavailable and prediction_timestamp > min(unavailable):
+                    return
+                payload = await self._download(downloader, urls, model_run_timestamp, prediction_timestamp,
+                                               temporary_path)
+                if payload is None:
+                    unavailable.append(prediction_timestamp)
                     return
+                try:
+                    memory = await asyncio.to_thread(estimate_memory_use, payload.filename_tmp_700)
+                    async with budget.reserve(memory):
+                        assets = await loop.run_in_executor(pool, generate_c_haines_assets, payload)
+                finally:
+                    # Delete temporary files
+                    for filename in (payload.filename_tmp_700, payload.filename_tmp_850, payload.filename_dew_850):
+                        remove_download(filename)
+            # Uploading happens outside of the window, while the next predictions are being processed.
+            await self._upload(targets, assets)
 
-    def _generate_c_haines_data(
-            self,
-            payload: EnvCanadaPayload):
-
-        # Open the grib files.
-        with open_gdal(payload.filename_tmp_700,
-                       payload.filename_tmp_850,
-                       payload.filename_dew_850) as source_data:
-            # Generate c_haines data
-            c_haines_data = self.c_haines_generator.generate_c_haines(source_data)
-            # Store the projection and geotransform for later.
-            projection = source_data.grib_tmp_700.GetProjection()
-            geotransform: Affine = get_dataset_geometry(source_data.grib_tmp_700_filename)
-            # Store the dimensions for later.
-            band = source_data.grib_tmp_700.GetRasterBand(1)
-            rows = band.YSize
-            cols = band.XSize
-            # Package source info nicely.
-            source_info = SourceInfo(projection=projection,
-                                     geotransform=geotransform, rows=rows, cols=cols)
-
-        return c_haines_data, source_info
-
-    async def _persist_severity_data(self,
-                                     payload: EnvCanadaPayload,
-                                     c_haines_severity_data: numpy.ndarray,
-                                     c_haines_mask_data: numpy.ndarray,
-                                     source_info: SourceInfo):
-        with tempfile.TemporaryDirectory() as temporary_path:
-            json_filename = os.path.join(os.getcwd(), temporary_path, 'c-haines.geojson')
-            save_data_as_geojson(
-                c_haines_severity_data,
-                c_haines_mask_data,
-                source_info,
-                json_filename)
-
-            tasks = []
-            tasks.append(asyncio.create_task(
-                save_as_kml_to_s3(json_filename, source_info.projection,
-                                  payload.model,
-                                  payload.model_run_timestamp, payload.prediction_timestamp)
-            ))
-            tasks.append(asyncio.create_task(
-                save_as_geojson_to_s3(json_filename, source_info.projection,
-                                      payload.model,
-                                      payload.model_run_timestamp, payload.prediction_timestamp)
-            ))
-            await asyncio.gather(*tasks)
+        tasks = []
+        for urls, model_run_timestamp, prediction_timestamp in predictions:
+            targets = {object_type: generate_full_object_store_path(
+                self.model, model_run_timestamp, prediction_timestamp, object_type)
+                for object_type in ObjectTypeEnum}
+            # If the GeoJSON and the KML already exist, then we can skip this one.
+            # It's super important we check, since there are many c-haines cronjobs running in dev, all
+            # pointing to the same s3 bucket.
+            targets = {object_type: target_path for object_type, target_path in targets.items()
+                       if target_path not in existing_assets}
+            if not targets:
+                logger.info('%s: already processed %s-%s', self.model, model_run_timestamp, prediction_timestamp)
+                continue
+            tasks.append(process_prediction(urls, model_run_timestamp, prediction_timestamp, targets))
+        await asyncio.gather(*tasks)
+        return not unavailable
 
     async def generate(self):
         """ Entry point for generating and storing c-haines severity index. """
-        # Iterate through payloads that need processing.
-        with tempfile.TemporaryDirectory() as temporary_path:
-            async for payload in self._get_payloads(temporary_path):
-                # Generate the c_haines data.
-                c_haines_data, source_info = self._generate_c_haines_data(payload)
-                if config.get('C_HAINES_OUTPUT_TIFF') == 'True':
-                    # Save as geotiff
-                    _save_data_as_geotiff(payload, numpy.array(c_haines_data), source_info)
-                # Generate the severity index and mask data.
-                c_haines_severity_data, c_haines_mask_data = generate_severity_data(c_haines_data)
-                # We're done with the c_haines data, so we can clean up some memory.
-                del c_haines_data
-                # Save to s3.
-                await self._persist_severity_data(payload,
-                                                  c_haines_severity_data,
-                                                  c_haines_mask_data,
-                                                  source_info)
-                # Delete temporary files
-                os.remove(payload.filename_dew_850)
-                os.remove(payload.filename_tmp_700)
-                os.remove(payload.filename_tmp_850)
+        utc_now = time_utils.get_utc_now()
+        processes = int(config.get('C_HAINES_PROCESSES', 2))
+        budget = MemoryBudget(int(config.get('C_HAINES_MAX_MEMORY_BYTES', DEFAULT_MAX_MEMORY_BYTES)))
+        with tempfile.TemporaryDirectory() as temporary_path, ProcessPoolExecutor(max_workers=processes) as pool:
+            async with ClientSession(timeout=DOWNLOAD_TIMEOUT) as session:
+                downloader = GribDownloader(session, 'REDIS_CACHE_ENV_CANADA', 'REDIS_ENV_CANADA_CACHE_EXPIRY')
+                for model_hour in get_model_run_hours(self.model):
+                    if not await self._process_model_run(model_hour, utc_now, downloader, pool, processes,
+                                                         budget, temporary_path):
+                        # If you didn't get one of them - you probably won't get the rest either!
+                        logger.info('Failed to download one of the model files - skipping the rest')
+                        break
+                downloader.stats.log(f'{self.model} c-haines')
@@ -1,11 +1,12 @@
 """ Defines singleton class that keeps ecodivisions in memory for reuse """
 import os
 import json
-from typing import Dict
+from typing import Dict, List, Optional, Sequence, Tuple
 import logging
 import geopandas
-from shapely.geometry import Point
-from app.utils.redis import create_redis
+import numpy as np
+import shapely
+from shapely import STRtree
 
 
 dirname = os.path.dirname(__file__)
@@ -16,92 +17,93 @@ ecodiv_shape_file_path = os.path.join(
 
 logger = logging.getLogger(__name__)
 
+# (station code, latitude, longitude)
+StationLocation = Tuple[int, float, float]
 
-class EcodivisionSeasons:
-    """ Calculate ecodivisions, or do in memory lookup.
-    When used within a context manager, the in memory lookup uses redis as cache.
 
-    Caching one ecodivision in redis at a time isn't really a time save, it's faster to calculate a single
-    ecodivision, than look it up. Where it is a big time save, is caching the ecodivisions for a set of
-    stations.
+class EcodivisionIndex:
+    """ The ecodivision polygons in a spatial index, and the ecodivision of every station looked up so far.
+
+    Loaded once per process (see get_ecodivision_index), it's safe to share: a station's ecodivision only
+    depends on where it is.
     """
 
-    def __init__(self, cache_key: str):
-        """ The cache key would typically be a list of stations.
-        """
+    def __init__(self):
         with open(core_season_file_path, encoding="utf-8") as file_handle:
-            core_seasons = json.load(file_handle)
-        self.core_seasons = core_seasons
-        self.ecodivisions = geopandas.read_file(ecodiv_shape_file_path)
-        self.name_lookup: Dict[str, str] = {}
-        self.cache_key = cache_key
-        self.cache = None
-        self.update_cache_on_exit = False
-
-    def __enter__(self):
-        if self.cache_key:
-            self.cache_key = f'ecodivision_names:{self.cache_key}'
-            self.cache = create_redis()
-            try:
-                self.name_lookup = self.cache.get(self.cache_key)
-                if self.name_lookup is None:
-                    # cache failed - so just use an empty dict.
-                    self.name_lookup = {}
-                    # flag that we want to save this when we're done
-                    self.update_cache_on_exit = True
-                else:
-                    logger.info('redis cache hit %s', self.cache_key)
-                    self.name_lookup = json.loads(self.name_lookup)
-            except Exception as error:
-                # set the look to an empty dictionary.
-                self.name_lookup = {}
-                # set the cache object to None, so that we don't try to use
-                # the cache again.
-                self.cache = None
-                logger.error(error)
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        """ Caches ecodivision names in redis """
-        if self.cache and self.cache_key and self.update_cache_on_exit:
-            # cache the result for a day
-            try:
-                self.cache.set(self.cache_key, json.dumps(self.name_lookup), ex=86400)
-            except Exception as error:
-                # redis cache failing isn't a critical failure. we log it and keep
-                # going.
-                logger.error(error)
+            self.core_seasons = json.load(file_handle)
+        ecodivisions = geopandas.read_file(ecodiv_shape_file_path)
+        self.names = ecodivisions['CDVSNNM'].to_numpy()
+        self.geometries = ecodivisions.geometry.to_numpy()
+        # The polygons are large, and prepared geometries make each point in polygon test much faster.
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+        self.name_lookup: Dict[StationLocation, str] = {}
+
+    def _calculate_ecodivision_names(self, locations: List[StationLocation]) -> List[str]:
+        """ Calculate the ecodivision names for a list of stations, with one spatial index query """
+        names = [None] * len(locations)
+        in_bc = []
+        for index, (_, latitude, _) in enumerate(locations):
+            # if station's latitude >= 60 (approx.), it's in the Yukon, so it won't be captured
+            # in the shapefile, but it's considered to be part of the SUB-ARCTIC HIGHLANDS ecodivision.
+            if latitude >= 60:
+                names[index] = 'SUB-ARCTIC HIGHLANDS'
+            else:
+                in_bc.append(index)
+        if in_bc:
+            points = shapely.points([float(locations[index][2]) for index in in_bc],
+                                    [float(locations[index][1]) for index in in_bc])
+            # Candidates by bounding box, then point in polygon for each candidate.
+            point_index, ecodivision_index = self.tree.query(points)
+            within = shapely.contains(self.geometries[ecodivision_index], points[point_index])
+            point_index, ecodivision_index = point_index[within], ecodivision_index[within]
+            # A point on the boundary of two ecodivisions is in the first one (in shapefile order).
+            order = np.lexsort((ecodivision_index, point_index))
+            point_index, first = np.unique(point_index[order], return_index=True)
+            for point, ecodivision in zip(point_index, ecodivision_index[order][first]):
+                names[in_bc[point]] = self.names[ecodivision]
+        for index, name in enumerate(names):
+            if name is None:
+                # If we've reached here, the ecodivision for the station has not been found.
+                logger.error('Ecodivision not found for station code %s at lat %f long %f', *locations[index])
+                names[index] = 'DEFAULT'
+        return names
+
+    def get_ecodivision_names(self, locations: Sequence[StationLocation]) -> List[str]:
+        """ Returns the ecodivision name for each station, calculating the ones that haven't been looked up before
+        """
+        missing = list({location for location in locations if location not in self.name_lookup})
+        if missing:
+            self.name_lookup.update(zip(missing, self._calculate_ecodivision_names(missing)))
+        return [self.name_lookup[location] for location in locations]
+
+
+_ecodivision_index: Optional[EcodivisionIndex] = None
+
+
+def get_ecodivision_index() -> EcodivisionIndex:
+    """ The ecodivision index for this process, loaded on first use """
+    global _ecodivision_index  # pylint: disable=global-statement
+    if _ecodivision_index is None:
+        _ecodivision_index = EcodivisionIndex()
+    return _ecodivision_index
+
+
+class EcodivisionSeasons:
+    """ Ecodivision and core season lookups for stations, backed by the ecodivision index for this process.
+    """
+
+    def __init__(self):
+        self.index = get_ecodivision_index()
 
     def get_core_seasons(self):
         """Returns core seasons"""
-        return self.core_seasons
-
-    def _calculate_ecodivision_name(self, station_code: str, latitude: float, longitude: float) -> str:
-        """ Calculate and return the ecodivision name for a given lat/long coordinate """
-        # if station's latitude >= 60 (approx.), it's in the Yukon, so it won't be captured
-        # in the shapefile, but it's considered to be part of the SUB-ARCTIC HIGHLANDS ecodivision.
-        if latitude >= 60:
-            return 'SUB-ARCTIC HIGHLANDS'
-        station_coord = Point(float(longitude), float(latitude))
-        for _, ecodivision_row in self.ecodivisions.iterrows():
-            geom = ecodivision_row['geometry']
-            if station_coord.within(geom):
-                return ecodivision_row['CDVSNNM']
-
-        # If we've reached here, the ecodivision for the station has not been found.
-        logger.error('Ecodivision not found for station code %s at lat %f long %f',
-                     station_code, latitude, longitude)
-        return "DEFAULT"
-
-    def get_ecodivision_name(self, station_code: str, latitude: float, longitude: float):
+        return self.index.core_seasons
+
+    def get_ecodivision_names(self, locations: Sequence[StationLocation]) -> List[str]:
+        """ Returns the ecodivision name for each (station code, latitude, longitude) """
+        return self.index.get_ecodivision_names(locations)
+
+    def get_ecodivision_name(self, station_code: int, latitude: float, longitude: float) -> str:
         """ Returns the ecodivision name for a given lat/long coordinate """
-        # 1st we look to see if we have this one cached:
-        key = f'{station_code}:{latitude}:{longitude}'
-        value = self.name_lookup.get(key, None)
-        if value is None:
-            # Flag that we want to update the cache when we're done.
-            self.update_cache_on_exit = True
-            # We don't have it cached, so calculate it and cache it:
-            value = self._calculate_ecodivision_name(station_code, latitude, longitude)
-            self.name_lookup[key] = value
-        return value
+        return self.index.get_ecodivision_names([(station_code, latitude, longitude)])[0]
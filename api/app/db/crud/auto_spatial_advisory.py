@@ -46,6 +46,17 @@ async def save_hfi(session: AsyncSession, hfi: ClassifiedHfi):
     session.add(hfi)
 
 
+async def save_classified_hfi(session: AsyncSession, classified_hfi: List[dict], batch_size: int):
+    """
+    Writes classified hfi rows with one multi-row INSERT ... VALUES statement per batch.
+
+    :param classified_hfi: Column values of each advisory_classified_hfi row.
+    :param batch_size: Maximum number of rows per INSERT statement.
+    """
+    for start in range(0, len(classified_hfi), batch_size):
+        await session.execute(insert(ClassifiedHfi).values(classified_hfi[start : start + batch_size]))
+
+
 async def save_fuel_type(session: AsyncSession, fuel_type: FuelType):
     session.add(fuel_type)
 
@@ -484,6 +495,34 @@ async def get_containing_zone(session: AsyncSession, geometry: str, srid: int):
     return result.first()
 
 
+async def get_zone_shapes_version(session: AsyncSession) -> Tuple[int, Optional[int]]:
+    """
+    Returns a cheap fingerprint (row count and max id) of the advisory shapes, used to tell when an in memory copy is stale.
+    """
+    stmt = select(func.count(Shape.id), func.max(Shape.id))
+    result = await session.execute(stmt)
+    count, max_id = result.one()
+    return count, max_id
+
+
+async def get_zone_shape_ids(session: AsyncSession) -> List[Row]:
+    """
+    Returns the shape type and id of every advisory shape, in ascending order.
+    """
+    stmt = select(Shape.shape_type, Shape.id).order_by(Shape.shape_type, Shape.id)
+    result = await session.execute(stmt)
+    return result.all()
+
+
+async def get_zone_shapes_wkb(session: AsyncSession) -> List[Row]:
+    """
+    Returns the id and well known binary geometry (EPSG:3005) of every advisory shape.
+    """
+    stmt = select(Shape.id, func.ST_AsBinary(Shape.geom).label("geom")).order_by(Shape.id)
+    result = await session.execute(stmt)
+    return result.all()
+
+
 async def save_all_critical_hours(session: AsyncSession, critical_hours: List[CriticalHours]):
     session.add_all(critical_hours)
 
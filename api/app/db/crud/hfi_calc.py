@@ -2,37 +2,39 @@
 """
 from typing import List
 from sqlalchemy.engine import Row
-from sqlalchemy.engine.cursor import CursorResult
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, insert, update
-from app.db.database import get_read_session_scope
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, insert, select, update
+from app.db.database import get_async_read_session_scope
 from app.schemas.hfi_calc import DateRange, HFIAdminRemovedStation, HFIAdminStationUpdateRequest, HFIResultRequest
 from app.db.models.hfi_calc import (FireCentre, FuelType, HFIReady, PlanningArea, PlanningWeatherStation, HFIRequest,
                                     FireStartRange, FireCentreFireStartRange, FireStartLookup)
 from app.utils.time import get_utc_now
 
 
-def get_fire_weather_stations(session: Session) -> CursorResult:
+async def get_fire_weather_stations(session: AsyncSession) -> List[Row]:
     """ Get all PlanningWeatherStation with joined FuelType, PlanningArea and FireCentre
     for the provided list of station_codes. """
-    return session.query(PlanningWeatherStation, FuelType, PlanningArea, FireCentre)\
+    stmt = select(PlanningWeatherStation, FuelType, PlanningArea, FireCentre)\
         .join(FuelType, FuelType.id == PlanningWeatherStation.fuel_type_id)\
         .join(PlanningArea, PlanningArea.id == PlanningWeatherStation.planning_area_id)\
         .join(FireCentre, FireCentre.id == PlanningArea.fire_centre_id)\
-        .filter(PlanningWeatherStation.is_deleted == False)
+        .where(PlanningWeatherStation.is_deleted == False)
+    result = await session.execute(stmt)
+    return result.all()
 
 
-def get_all_stations(session: Session) -> List[Row]:
+async def get_all_stations(session: AsyncSession) -> List[Row]:
     """ Get all known planning weather stations """
-    return session.query(PlanningWeatherStation.station_code).all()
+    result = await session.execute(select(PlanningWeatherStation.station_code))
+    return result.all()
 
 
-def get_fire_centre_station_codes() -> List[int]:
+async def get_fire_centre_station_codes() -> List[int]:
     """ Retrieves station codes for fire centers
     """
     station_codes = []
-    with get_read_session_scope() as session:
-        station_query = get_all_stations(session)
+    async with get_async_read_session_scope() as session:
+        station_query = await get_all_stations(session)
         for station in station_query:
             if isinstance(station, dict):
                 station_codes.append(int(station['station_code']))
@@ -42,49 +44,58 @@ def get_fire_centre_station_codes() -> List[int]:
     return station_codes
 
 
-def get_fire_centre_stations(session, fire_centre_id: int) -> CursorResult:
+async def get_fire_centre_stations(session: AsyncSession, fire_centre_id: int) -> List[Row]:
     """ Get all the stations, along with default fuel type for a fire centre. """
-    return session.query(PlanningWeatherStation, FuelType)\
+    stmt = select(PlanningWeatherStation, FuelType)\
         .join(PlanningArea, PlanningArea.id == PlanningWeatherStation.planning_area_id)\
         .join(FuelType, FuelType.id == PlanningWeatherStation.fuel_type_id)\
-        .filter(PlanningWeatherStation.is_deleted == False)\
-        .filter(PlanningArea.fire_centre_id == fire_centre_id)
+        .where(PlanningWeatherStation.is_deleted == False)\
+        .where(PlanningArea.fire_centre_id == fire_centre_id)
+    result = await session.execute(stmt)
+    return result.all()
 
 
-def get_planning_weather_stations(session, fire_centre_id: int) -> List[PlanningWeatherStation]:
+async def get_planning_weather_stations(session: AsyncSession, fire_centre_id: int) -> List[PlanningWeatherStation]:
     """ Get all the stations for a fire centre. """
-    return session.query(PlanningWeatherStation)\
+    stmt = select(PlanningWeatherStation)\
         .join(PlanningArea, PlanningArea.id == PlanningWeatherStation.planning_area_id)\
-        .filter(PlanningArea.fire_centre_id == fire_centre_id)\
-        .filter(PlanningWeatherStation.is_deleted == False)\
-        .all()
+        .where(PlanningArea.fire_centre_id == fire_centre_id)\
+        .where(PlanningWeatherStation.is_deleted == False)
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
 
-def get_most_recent_updated_hfi_request(session: Session,
-                                        fire_centre_id: int,
-                                        date_range: DateRange) -> HFIRequest:
+async def get_most_recent_updated_hfi_request(session: AsyncSession,
+                                              fire_centre_id: int,
+                                              date_range: DateRange) -> HFIRequest:
     """ Get the most recently updated hfi request for a fire centre """
-    query = session.query(HFIRequest)\
-        .filter(HFIRequest.fire_centre_id == fire_centre_id)\
-        .filter(HFIRequest.prep_start_day == date_range.start_date)\
-        .filter(HFIRequest.prep_end_day == date_range.end_date)
-    return query.order_by(HFIRequest.create_timestamp.desc()).first()
+    stmt = select(HFIRequest)\
+        .where(HFIRequest.fire_centre_id == fire_centre_id)\
+        .where(HFIRequest.prep_start_day == date_range.start_date)\
+        .where(HFIRequest.prep_end_day == date_range.end_date)\
+        .order_by(HFIRequest.create_timestamp.desc())\
+        .limit(1)
+    result = await session.execute(stmt)
+    return result.scalars().first()
 
 
-def get_most_recent_updated_hfi_request_for_current_date(session: Session,
-                                                         fire_centre_id: int) -> HFIRequest:
+async def get_most_recent_updated_hfi_request_for_current_date(session: AsyncSession,
+                                                               fire_centre_id: int) -> HFIRequest:
     """ Get the most recently updated hfi request within some date range, for a fire centre """
     now = get_utc_now().date()
-    query = session.query(HFIRequest)\
-        .filter(HFIRequest.fire_centre_id == fire_centre_id)\
-        .filter(HFIRequest.prep_start_day <= now)\
-        .filter(HFIRequest.prep_end_day >= now)
-    return query.order_by(HFIRequest.create_timestamp.desc()).first()
+    stmt = select(HFIRequest)\
+        .where(HFIRequest.fire_centre_id == fire_centre_id)\
+        .where(HFIRequest.prep_start_day <= now)\
+        .where(HFIRequest.prep_end_day >= now)\
+        .order_by(HFIRequest.create_timestamp.desc())\
+        .limit(1)
+    result = await session.execute(stmt)
+    return result.scalars().first()
 
 
-def store_hfi_request(session: Session, hfi_result_request: HFIResultRequest, username: str):
+async def store_hfi_request(session: AsyncSession, hfi_result_request: HFIResultRequest, username: str):
     """ Store the supplied hfi request """
-    previous_latest_request = get_most_recent_updated_hfi_request(
+    previous_latest_request = await get_most_recent_updated_hfi_request(
         session,
         fire_centre_id=hfi_result_request.selected_fire_center_id,
         date_range=hfi_result_request.date_range)
@@ -96,13 +107,13 @@ def store_hfi_request(session: Session, hfi_result_request: HFIResultRequest, us
                                   create_user=username,
                                   request=hfi_result_request.json()).returning(HFIRequest.id)
     )
-    res = session.execute(stmt).fetchone()
+    res = (await session.execute(stmt)).fetchone()
     latest_hfi_request_id = res.id
     now = get_utc_now()
 
     if previous_latest_request is not None:
         # Copy over ready records for existing hfi request
-        latest_hfi_ready_records = get_latest_hfi_ready_records(session, previous_latest_request.id)
+        latest_hfi_ready_records = await get_latest_hfi_ready_records(session, previous_latest_request.id)
         updated_hfi_ready_records = []
         for latest_hfi_ready_record in latest_hfi_ready_records:
             updated_hfi_ready_records.append(HFIReady(hfi_request_id=latest_hfi_request_id,
@@ -112,10 +123,10 @@ def store_hfi_request(session: Session, hfi_result_request: HFIResultRequest, us
                                                       create_user=latest_hfi_ready_record.create_user,
                                                       update_timestamp=now,
                                                       update_user=username))
-        session.bulk_save_objects(updated_hfi_ready_records)
+        session.add_all(updated_hfi_ready_records)
     else:
         # Create ready records for new hfi request
-        planning_areas = get_planning_areas(session, hfi_result_request.selected_fire_center_id)
+        planning_areas = await get_planning_areas(session, hfi_result_request.selected_fire_center_id)
         new_hfi_ready_records = []
         for planning_area in planning_areas:
             new_hfi_ready_records.append(HFIReady(hfi_request_id=latest_hfi_request_id,
@@ -125,34 +136,34 @@ def store_hfi_request(session: Session, hfi_result_request: HFIResultRequest, us
                                                   create_user=username,
                                                   update_timestamp=now,
                                                   update_user=username))
-        session.bulk_save_objects(new_hfi_ready_records)
+        session.add_all(new_hfi_ready_records)
 
 
-def get_latest_hfi_ready_records(session: Session, hfi_request_id: int) -> List[HFIReady]:
+async def get_latest_hfi_ready_records(session: AsyncSession, hfi_request_id: int) -> List[HFIReady]:
     """ Retrieve the latest hfi ready records for each distinct planning area in a hfi request """
-    return session.query(HFIReady)\
-        .filter(HFIReady.hfi_request_id == hfi_request_id)\
-        .all()
+    result = await session.execute(select(HFIReady).where(HFIReady.hfi_request_id == hfi_request_id))
+    return result.scalars().all()
 
 
-def get_last_station_in_planning_area(session: Session, planning_area_id: int) -> PlanningWeatherStation:
+async def get_last_station_in_planning_area(session: AsyncSession, planning_area_id: int) -> PlanningWeatherStation:
     """ Get the last station in a planning area """
-    return session.query(PlanningWeatherStation)\
-        .filter(PlanningWeatherStation.planning_area_id == planning_area_id)\
-        .filter(PlanningWeatherStation.is_deleted == False)\
+    stmt = select(PlanningWeatherStation)\
+        .where(PlanningWeatherStation.planning_area_id == planning_area_id)\
+        .where(PlanningWeatherStation.is_deleted == False)\
         .order_by(desc(PlanningWeatherStation.order_of_appearance_in_planning_area_list))\
-        .first()
+        .limit(1)
+    result = await session.execute(stmt)
+    return result.scalars().first()
 
 
-def get_planning_areas(session: Session, fire_centre_id: int):
+async def get_planning_areas(session: AsyncSession, fire_centre_id: int) -> List[PlanningArea]:
     """ Retrieve the planning areas for a fire centre"""
-    return session.query(PlanningArea)\
-        .filter(PlanningArea.fire_centre_id == fire_centre_id)\
-        .all()
+    result = await session.execute(select(PlanningArea).where(PlanningArea.fire_centre_id == fire_centre_id))
+    return result.scalars().all()
 
 
-def get_stations_for_removal(session: Session,
-                             station_requests: List[HFIAdminRemovedStation]):
+async def get_stations_for_removal(session: AsyncSession,
+                                   station_requests: List[HFIAdminRemovedStation]) -> List[PlanningWeatherStation]:
     """ Returns the station model requested to remove, along with all
     stations in in planning area, in ascending order. """
     remove_request_planning_area_ids = [request.planning_area_id for request in station_requests]
@@ -161,30 +172,32 @@ def get_stations_for_removal(session: Session,
     # ordering is 1-based, row_id is 0-based
     remove_request_orders = [request.row_id + 1 for request in station_requests]
 
-    stations_to_remove = session.query(PlanningWeatherStation)\
-        .filter(PlanningWeatherStation.planning_area_id.in_(remove_request_planning_area_ids))\
-        .filter(PlanningWeatherStation.station_code.in_(remove_request_station_codes))\
-        .filter(PlanningWeatherStation.order_of_appearance_in_planning_area_list.in_(remove_request_orders))\
-        .all()
-    return stations_to_remove
+    stmt = select(PlanningWeatherStation)\
+        .where(PlanningWeatherStation.planning_area_id.in_(remove_request_planning_area_ids))\
+        .where(PlanningWeatherStation.station_code.in_(remove_request_station_codes))\
+        .where(PlanningWeatherStation.order_of_appearance_in_planning_area_list.in_(remove_request_orders))
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
 
-def get_stations_for_affected_planning_areas(session: Session, request: HFIAdminStationUpdateRequest):
+async def get_stations_for_affected_planning_areas(session: AsyncSession,
+                                                   request: HFIAdminStationUpdateRequest) -> List[PlanningWeatherStation]:
     removed_planning_area_ids = [remove_request.planning_area_id for remove_request in request.removed]
     added_planning_area_ids = [add_request.planning_area_id for add_request in request.added]
     affected_planning_area_ids = removed_planning_area_ids + added_planning_area_ids
 
-    return session.query(PlanningWeatherStation)\
-        .filter(PlanningWeatherStation.planning_area_id.in_(affected_planning_area_ids))\
-        .filter(PlanningWeatherStation.is_deleted == False)\
-        .order_by(PlanningWeatherStation.order_of_appearance_in_planning_area_list)\
-        .all()
+    stmt = select(PlanningWeatherStation)\
+        .where(PlanningWeatherStation.planning_area_id.in_(affected_planning_area_ids))\
+        .where(PlanningWeatherStation.is_deleted == False)\
+        .order_by(PlanningWeatherStation.order_of_appearance_in_planning_area_list)
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
 
-def unready_planning_areas(session: Session,
-                           fire_centre_id: int,
-                           username: str,
-                           planning_area_ids):
+async def unready_planning_areas(session: AsyncSession,
+                                 fire_centre_id: int,
+                                 username: str,
+                                 planning_area_ids):
     now = get_utc_now()
     query = update(HFIReady).values(
         {HFIReady.ready: False, HFIReady.update_user: username, HFIReady.update_timestamp: now})\
@@ -192,28 +205,29 @@ def unready_planning_areas(session: Session,
         .where(HFIReady.hfi_request_id == HFIRequest.id)\
         .where(HFIRequest.fire_centre_id == fire_centre_id)\
         .execution_options(synchronize_session="fetch")
-    session.execute(query)
+    await session.execute(query)
 
 
-def save_hfi_stations(session: Session,
-                      stations_to_save: List[PlanningWeatherStation]):
+async def save_hfi_stations(session: AsyncSession,
+                            stations_to_save: List[PlanningWeatherStation]):
 
-    session.bulk_save_objects(stations_to_save)
-    session.commit()
+    session.add_all(stations_to_save)
+    await session.commit()
 
 
-def toggle_ready(session: Session,
-                 fire_centre_id: int,
-                 planning_area_id: int,
-                 date_range: DateRange,
-                 username: str) -> HFIReady:
+async def toggle_ready(session: AsyncSession,
+                       fire_centre_id: int,
+                       planning_area_id: int,
+                       date_range: DateRange,
+                       username: str) -> HFIReady:
     """ Toggles the planning area ready state for an hfi request """
     now = get_utc_now()
-    hfi_request = get_most_recent_updated_hfi_request(session, fire_centre_id, date_range)
-    ready_state: HFIReady = session.query(HFIReady)\
-        .filter(HFIReady.planning_area_id == planning_area_id)\
-        .filter(HFIReady.hfi_request_id == hfi_request.id)\
-        .first()
+    hfi_request = await get_most_recent_updated_hfi_request(session, fire_centre_id, date_range)
+    stmt = select(HFIReady)\
+        .where(HFIReady.planning_area_id == planning_area_id)\
+        .where(HFIReady.hfi_request_id == hfi_request.id)\
+        .limit(1)
+    ready_state: HFIReady = (await session.execute(stmt)).scalars().first()
     if ready_state.ready is True:
         ready_state.ready = False
     else:
@@ -221,28 +235,35 @@ def toggle_ready(session: Session,
     ready_state.update_timestamp = now
     ready_state.update_user = username
     session.add(ready_state)
-    session.commit()
+    await session.commit()
+    # Attributes are expired on commit, and can't be lazy loaded once the (async) session is closed.
+    await session.refresh(ready_state)
     return ready_state
 
 
-def get_fire_centre_fire_start_ranges(session: Session, fire_centre_id: id) -> CursorResult:
+async def get_fire_centre_fire_start_ranges(session: AsyncSession, fire_centre_id: id) -> List[FireStartRange]:
     """ Get the fire start ranges for a fire centre """
-    return session.query(FireStartRange)\
+    stmt = select(FireStartRange)\
         .join(FireCentreFireStartRange, FireCentreFireStartRange.fire_start_range_id == FireStartRange.id)\
-        .filter(FireCentreFireStartRange.fire_centre_id == fire_centre_id)\
+        .where(FireCentreFireStartRange.fire_centre_id == fire_centre_id)\
         .order_by(FireCentreFireStartRange.order)
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
 
-def get_fire_start_lookup(session: Session) -> CursorResult:
+async def get_fire_start_lookup(session: AsyncSession) -> List[FireStartLookup]:
     """ Get the fire start lookup table """
-    return session.query(FireStartLookup)
+    result = await session.execute(select(FireStartLookup))
+    return result.scalars().all()
 
 
-def get_fuel_types(session: Session) -> CursorResult:
+async def get_fuel_types(session: AsyncSession) -> List[FuelType]:
     """ Get the fuel types table  """
-    return session.query(FuelType).order_by(FuelType.abbrev)
+    result = await session.execute(select(FuelType).order_by(FuelType.abbrev))
+    return result.scalars().all()
 
 
-def get_fuel_type_by_id(session: Session, fuel_type_id: int) -> FuelType:
+async def get_fuel_type_by_id(session: AsyncSession, fuel_type_id: int) -> FuelType:
     """ Get the fuel type for the supplied fuel type id """
-    return session.query(FuelType).filter(FuelType.id == fuel_type_id).first()
+    result = await session.execute(select(FuelType).where(FuelType.id == fuel_type_id).limit(1))
+    return result.scalars().first()
@@ -2,7 +2,7 @@
 """
 import datetime
 from typing import List
-from sqlalchemy import and_, select, text
+from sqlalchemy import and_, bindparam, select, text
 from sqlalchemy.sql import func
 from sqlalchemy.orm import Session
 from app.db.models.weather_models import (ModelRunPrediction, PredictionModel, PredictionModelRunTimestamp,
@@ -56,6 +56,43 @@ def get_actuals_left_outer_join_with_predictions(
         .order_by(PredictionModelRunTimestamp.prediction_run_timestamp.desc())
 
 
+def get_latest_predictions_for_actuals_for_stations(
+        session: Session, model_id: int, station_codes: List[int],
+        start_date: datetime, end_date: datetime):
+    """ For the hourly actuals of many stations, get the actual values and the values predicted for them by the most
+    recent run of the model, ordered by station, then weather date. This is the first (actual, prediction) pair of
+    each actual in get_actuals_left_outer_join_with_predictions, with only the columns needed to learn bias
+    adjustments selected.
+    """
+    stmt = select(HourlyActual.station_code,
+                  HourlyActual.weather_date,
+                  HourlyActual.temperature,
+                  HourlyActual.relative_humidity,
+                  HourlyActual.wind_speed,
+                  HourlyActual.wind_direction,
+                  ModelRunPrediction.prediction_timestamp,
+                  ModelRunPrediction.tmp_tgl_2,
+                  ModelRunPrediction.rh_tgl_2,
+                  ModelRunPrediction.wind_tgl_10,
+                  ModelRunPrediction.wdir_tgl_10)\
+        .distinct(HourlyActual.station_code, HourlyActual.weather_date)\
+        .outerjoin(ModelRunPrediction,
+                   and_(ModelRunPrediction.prediction_timestamp == HourlyActual.weather_date,
+                        ModelRunPrediction.station_code == HourlyActual.station_code))\
+        .outerjoin(PredictionModelRunTimestamp,
+                   PredictionModelRunTimestamp.id == ModelRunPrediction.prediction_model_run_timestamp_id)\
+        .where(HourlyActual.station_code.in_(station_codes),
+               HourlyActual.weather_date >= start_date,
+               HourlyActual.weather_date <= end_date,
+               HourlyActual.temp_valid == True,
+               HourlyActual.rh_valid == True,
+               PredictionModelRunTimestamp.prediction_model_id == model_id)\
+        .order_by(HourlyActual.station_code,
+                  HourlyActual.weather_date,
+                  PredictionModelRunTimestamp.prediction_run_timestamp.desc())
+    return session.execute(stmt)
+
+
 def save_hourly_actual(session: Session, hourly_actual: HourlyActual):
     """ Abstraction for writing HourlyActual to database. """
     session.add(hourly_actual)
@@ -72,6 +109,17 @@ def get_accumulated_precipitation(session: Session, station_code: int, start_dat
     return result
 
 
+def get_hourly_precipitation_for_stations(session: Session, station_codes: List[int],
+                                          start_datetime: datetime, end_datetime: datetime):
+    """ Get the station code, weather date and precipitation of hourly actuals for many stations, after the
+    start datetime, up to and including the end datetime. """
+    stmt = select(HourlyActual.station_code, HourlyActual.weather_date, HourlyActual.precipitation)\
+        .where(HourlyActual.station_code.in_(station_codes),
+               HourlyActual.weather_date > start_datetime,
+               HourlyActual.weather_date <= end_datetime)
+    return session.execute(stmt).all()
+
+
 def get_accumulated_precip_by_24h_interval(session: Session, station_code: int, start_datetime: datetime, end_datetime: datetime):
     """ Get the accumulated precip for 24 hour intervals for a given station code within the specified time interval.
     :param session: The ORM/database session.
@@ -141,3 +189,38 @@ def get_predicted_daily_precip(session: Session, model: PredictionModel, station
         .filter(func.date_part('hour', WeatherStationModelPrediction.prediction_timestamp) == 20)\
         .order_by(WeatherStationModelPrediction.prediction_timestamp)
     return result.all()
+
+
+def get_accumulated_precip_by_24h_interval_for_stations(session: Session, station_codes: List[int],
+                                                        start_datetime: datetime, end_datetime: datetime):
+    """ get_accumulated_precip_by_24h_interval for many stations in one query. """
+    stmt = text("""
+        SELECT day, station_code, sum(precipitation) actual_precip_24h
+        FROM
+            generate_series(:start_datetime, :end_datetime, '24 hours'::interval) day
+        LEFT JOIN
+            hourly_actuals
+        ON
+            weather_date <@ tstzrange(day - INTERVAL '24 hours', day, '(]')
+        WHERE
+            station_code IN :station_codes
+        GROUP BY
+            day, station_code;
+    """).bindparams(bindparam('station_codes', expanding=True))
+    result = session.execute(stmt, {'start_datetime': start_datetime, 'end_datetime': end_datetime,
+                                    'station_codes': list(station_codes)})
+    return result.all()
+
+
+def get_predicted_daily_precip_for_stations(session: Session, model: PredictionModel, station_codes: List[int],
+                                            start_datetime: datetime, end_datetime: datetime):
+    """ get_predicted_daily_precip for many stations in one query. """
+    result = session.query(WeatherStationModelPrediction)\
+        .join(PredictionModelRunTimestamp, PredictionModelRunTimestamp.id == WeatherStationModelPrediction.prediction_model_run_timestamp_id)\
+        .filter(PredictionModelRunTimestamp.prediction_model_id == model.id)\
+        .filter(WeatherStationModelPrediction.station_code.in_(station_codes))\
+        .filter(WeatherStationModelPrediction.prediction_timestamp >= start_datetime)\
+        .filter(WeatherStationModelPrediction.prediction_timestamp < end_datetime)\
+        .filter(func.date_part('hour', WeatherStationModelPrediction.prediction_timestamp) == 20)\
+        .order_by(WeatherStationModelPrediction.station_code, WeatherStationModelPrediction.prediction_timestamp)
+    return result.all()
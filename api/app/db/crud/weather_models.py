@@ -4,6 +4,7 @@ import logging
 import datetime
 from typing import List, Union
 from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
 from app.weather_models import ModelEnum, ProjectionEnum
@@ -81,6 +82,31 @@ def get_model_run_predictions_for_station(session: Session, station_code: int,
         .order_by(ModelRunPrediction.prediction_timestamp)
 
 
+def get_model_run_predictions_for_stations(session: Session, station_codes: List[int],
+                                           prediction_run: PredictionModelRunTimestamp) -> List[ModelRunPrediction]:
+    """ Get all the predictions for a provided model run and stations, ordered by station then time """
+    logger.info("Getting model predictions for %s stations for %s", len(station_codes), prediction_run)
+    return session.query(ModelRunPrediction)\
+        .filter(ModelRunPrediction.prediction_model_run_timestamp_id == prediction_run.id)\
+        .filter(ModelRunPrediction.station_code.in_(station_codes))\
+        .order_by(ModelRunPrediction.station_code, ModelRunPrediction.prediction_timestamp)\
+        .all()
+
+
+def upsert_model_run_predictions(session: Session, predictions: List[dict]):
+    """ Insert model run predictions, updating the given values of any prediction that already exists, with
+    a single INSERT ... ON CONFLICT DO UPDATE. Every prediction must have the same keys.
+    """
+    if not predictions:
+        return
+    key_columns = ('prediction_model_run_timestamp_id', 'prediction_timestamp', 'station_code')
+    stmt = insert(ModelRunPrediction).values(predictions)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: stmt.excluded[column] for column in predictions[0] if column not in key_columns})
+    session.execute(stmt)
+
+
 def delete_weather_station_model_predictions(session: Session, older_than: datetime):
     """ Delete any weather model prediction older than a certain date.
     """
@@ -418,6 +444,44 @@ def get_weather_station_model_prediction(session: Session,
                prediction_timestamp).first()
 
 
+def get_weather_station_model_prediction_apcp(session: Session,
+                                              station_codes: List[int],
+                                              prediction_model_run_timestamp_id: int):
+    """ Get the station code, prediction timestamp and accumulated precipitation of every weather station
+    prediction of a model run. """
+    return session.query(WeatherStationModelPrediction.station_code,
+                         WeatherStationModelPrediction.prediction_timestamp,
+                         WeatherStationModelPrediction.apcp_sfc_0)\
+        .filter(WeatherStationModelPrediction.prediction_model_run_timestamp_id ==
+                prediction_model_run_timestamp_id)\
+        .filter(WeatherStationModelPrediction.station_code.in_(station_codes))\
+        .all()
+
+
+def upsert_weather_station_model_predictions(session: Session, predictions: List[dict], batch_size: int = 1000):
+    """ Insert weather station model predictions, updating any prediction that already exists, with one
+    INSERT ... ON CONFLICT DO UPDATE per batch. Every prediction must have the same keys.
+
+    Model values that are None (e.g. a layer that failed to download) don't overwrite the value of an
+    existing prediction.
+    """
+    key_columns = ('station_code', 'prediction_model_run_timestamp_id', 'prediction_timestamp')
+    keep_existing_columns = ('tmp_tgl_2', 'wind_tgl_10', 'wdir_tgl_10')
+    table = WeatherStationModelPrediction.__table__
+    for index in range(0, len(predictions), batch_size):
+        stmt = insert(WeatherStationModelPrediction).values(predictions[index:index + batch_size])
+        set_ = {}
+        for column in predictions[0]:
+            if column in key_columns:
+                continue
+            if column in keep_existing_columns:
+                set_[column] = func.coalesce(stmt.excluded[column], table.c[column])
+            else:
+                set_[column] = stmt.excluded[column]
+        stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=set_)
+        session.execute(stmt)
+
+
 def refresh_morecast2_materialized_view(session: Session):
     start = datetime.datetime.now()
     logger.info("Refreshing morecast_2_materialized_view")
@@ -1,17 +1,29 @@
 """ This module contains functions for computing fire weather metrics.
+
+Calculations are done by app.fire_behaviour.cffdrs_numpy, a numpy port of the cffdrs R package, unless
+CFFDRS_BACKEND=R is set, in which case the R package is called via rpy2. The R package is also still used
+for hourly FFMC and for slope adjusted wind speed, neither of which have been ported.
 """
 import logging
 import math
 from typing import Optional
-import rpy2
-import rpy2.robjects as robjs
-from rpy2.robjects import pandas2ri
-from rpy2.rinterface import NULL
+import numpy as np
 import pandas as pd
-import app.utils.r_importer
+from app import config
+from app.fire_behaviour import cffdrs_numpy
 from app.utils.singleton import Singleton
 from app.schemas.fba_calc import FuelTypeEnum
 
+try:
+    # R is only required when CFFDRS_BACKEND=R, or for the functions that haven't been ported to numpy.
+    import rpy2
+    import rpy2.robjects as robjs
+    from rpy2.robjects import pandas2ri
+    from rpy2.rinterface import NULL
+    import app.utils.r_importer
+except ImportError:
+    rpy2 = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +33,9 @@ def _none2null(_):
     return robjs.r("NULL")
 
 
-none_converter = robjs.conversion.Converter("None converter")
-none_converter.py2rpy.register(type(None), _none2null)
+if rpy2 is not None:
+    none_converter = robjs.conversion.Converter("None converter")
+    none_converter.py2rpy.register(type(None), _none2null)
 
 
 @Singleton
@@ -30,6 +43,8 @@ class CFFDRS():
     """ Singleton that loads CFFDRS R lib once in memory for reuse."""
 
     def __init__(self):
+        if rpy2 is None:
+            raise CFFDRSException("rpy2 is not installed, the cffdrs R package is unavailable.")
         self.cffdrs = app.utils.r_importer.import_cffsdrs()
 
 
@@ -37,6 +52,22 @@ class CFFDRSException(Exception):
     """ CFFDRS contextual exception """
 
 
+def use_r_backend() -> bool:
+    """ Fire behaviour is calculated with the numpy port of cffdrs (app.fire_behaviour.cffdrs_numpy) by
+    default. Setting CFFDRS_BACKEND=R delegates to the cffdrs R package instead, which remains the reference
+    implementation. """
+    return config.get('CFFDRS_BACKEND', 'numpy').upper() == 'R'
+
+
+def _to_float(result: np.ndarray, message: str) -> float:
+    """ Turn the result of a numpy calculation into a float, raising CFFDRSException if it couldn't
+    be calculated. """
+    value = float(result)
+    if math.isnan(value):
+        raise CFFDRSException(message)
+    return value
+
+
 # Computable: SFC, FMC
 # To store in DB: PC, PDF, CC, CBH (attached to fuel type, red book)
 PARAMS_ERROR_MESSAGE = "One or more params passed to R call is None."
@@ -187,6 +218,8 @@ def flank_rate_of_spread(ros: float, bros: float, lb: float):
     #   FROS:   Flank Fire Spread Rate (m/min)
     #
     """
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.fros_calc(ros, bros, lb), "Failed to calculate FROS")
     result = CFFDRS.instance().cffdrs._FROScalc(ROS=ros, BROS=bros, LB=lb)
     if isinstance(result[0], float):
         return result[0]
@@ -234,6 +267,9 @@ def back_rate_of_spread(fuel_type: FuelTypeEnum,
             f"_BROScalc ; fuel_type: {fuel_type.value}, ffmc: {ffmc}, bui: {bui}, fmc: {fmc}, sfc: {sfc}"
         raise CFFDRSException(message)
 
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.bros_calc(fuel_type.value, ffmc, bui, wsv, fmc, sfc, pc, pdf, cc, cbh),
+                         "Failed to calculate BROS")
     if pc is None:
         pc = NULL
     if cc is None:
@@ -285,6 +321,8 @@ def bui_calc(dmc: float, dc: float):
     #
     # Returns: A single bui value
     """
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.bui_calc(dmc, dc), "Failed to calculate bui")
     result = CFFDRS.instance().cffdrs._buiCalc(dmc=dmc, dc=dc)
     if isinstance(result[0], float):
         return result[0]
@@ -317,6 +355,9 @@ def rate_of_spread_t(fuel_type: FuelTypeEnum,
     """
     # NOTE: CFFDRS documentation incorrectly states that HR is hours since ignition, it's actually
     # minutes.
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.rost_calc(fuel_type.value, ros_eq, minutes_since_ignition, cfb),
+                         "Failed to calculate ROSt")
     result = CFFDRS.instance().cffdrs._ROStcalc(FUELTYPE=fuel_type.value,
                                                 ROSeq=ros_eq,
                                                 HR=minutes_since_ignition,
@@ -335,7 +376,7 @@ def rate_of_spread(fuel_type: FuelTypeEnum,
                    cc: float,
                    pdf: float,
                    cbh: float):
-    """ Computes ROS by delegating to cffdrs R package.
+    """ Computes ROS using cffdrs.
     pdf: Percent Dead Balsam Fir (%)
 
     #   From cffdrs R package comments:
@@ -359,6 +400,9 @@ def rate_of_spread(fuel_type: FuelTypeEnum,
             f"_ROScalc ; fuel_type: {fuel_type.value}, isi: {isi}, bui: {bui}, fmc: {fmc}, sfc: {sfc}"
         raise CFFDRSException(message)
 
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.ros_calc(fuel_type.value, isi, bui, fmc, sfc, pc, pdf, cc, cbh),
+                         "Failed to calculate ROS")
     # For some reason, the registered converter can't turn a None to a NULL, but we need to
     # set these to NULL, despite setting a converter for None to NULL, because it it can only
     # convert a NULL to NULL. Doesn't make sense? Exactly.
@@ -390,7 +434,7 @@ def surface_fuel_consumption(
         bui: float,
         ffmc: float,
         pc: float):
-    """ Computes SFC by delegating to cffdrs R package
+    """ Computes SFC using cffdrs.
         Assumes a standard GFL of 0.35 kg/m ^ 2.
 
     # Args:
@@ -406,6 +450,8 @@ def surface_fuel_consumption(
         message = PARAMS_ERROR_MESSAGE + \
             f"_SFCcalc; fuel_type: {fuel_type.value}, bui: {bui}, ffmc: {ffmc}"
         raise CFFDRSException(message)
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.sfc_calc(fuel_type.value, ffmc, bui, pc, 0.35), "Failed to calculate SFC")
     if pc is None:
         pc = NULL
     result = CFFDRS.instance().cffdrs._SFCcalc(FUELTYPE=fuel_type.value,
@@ -438,6 +484,8 @@ def fire_distance(fuel_type: FuelTypeEnum, ros_eq: float, hr: int, cfb: float):
     # Returns:
     #   DISTt:    Head fire spread distance at time t
     """
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.distt_calc(fuel_type.value, ros_eq, hr, cfb), "Failed to calculate DISTt")
     result = CFFDRS.instance().cffdrs._DISTtcalc(fuel_type.value, ros_eq, hr, cfb)
     if isinstance(result[0], float):
         return result[0]
@@ -446,7 +494,7 @@ def fire_distance(fuel_type: FuelTypeEnum, ros_eq: float, hr: int, cfb: float):
 
 def foliar_moisture_content(lat: int, long: int, elv: float, day_of_year: int,
                             date_of_minimum_foliar_moisture_content: int = 0):
-    """ Computes FMC by delegating to cffdrs R package
+    """ Computes FMC using cffdrs.
         TODO: Find out the minimum fmc date that is passed as D0, for now it's 0. Passing 0 makes FFMCcalc
         calculate it.
 
@@ -466,6 +514,9 @@ def foliar_moisture_content(lat: int, long: int, elv: float, day_of_year: int,
     # FMCcalc expects longitude to always be a positive number.
     if long < 0:
         long = -long
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.fmc_calc(lat, long, elv, day_of_year, date_of_minimum_foliar_moisture_content),
+                         "Failed to calculate FMC")
     result = CFFDRS.instance().cffdrs._FMCcalc(LAT=lat, LONG=long, ELV=elv,
                                                DJ=day_of_year, D0=date_of_minimum_foliar_moisture_content)
     if isinstance(result[0], float):
@@ -474,7 +525,7 @@ def foliar_moisture_content(lat: int, long: int, elv: float, day_of_year: int,
 
 
 def length_to_breadth_ratio(fuel_type: FuelTypeEnum, wind_speed: float):
-    """ Computes L/B ratio by delegating to cffdrs R package
+    """ Computes L/B ratio using cffdrs.
 
     # Args:
     #   FUELTYPE: The Fire Behaviour Prediction FuelType
@@ -484,6 +535,8 @@ def length_to_breadth_ratio(fuel_type: FuelTypeEnum, wind_speed: float):
     """
     if wind_speed is None or fuel_type is None:
         return CFFDRSException()
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.lb_calc(fuel_type.value, wind_speed), "Failed to calculate LB")
     result = CFFDRS.instance().cffdrs._LBcalc(FUELTYPE=fuel_type.value, WSV=wind_speed)
     if isinstance(result[0], float):
         return result[0]
@@ -494,7 +547,7 @@ def length_to_breadth_ratio_t(fuel_type: FuelTypeEnum,
                               lb: float,
                               time_since_ignition: float,
                               cfb: float):
-    """ Computes L/B ratio by delegating to cffdrs R package
+    """ Computes L/B ratio using cffdrs.
 
     # Description:
     #   Computes the Length to Breadth ratio of an elliptically shaped fire at
@@ -520,6 +573,9 @@ def length_to_breadth_ratio_t(fuel_type: FuelTypeEnum,
     #   LBt: Length to Breadth ratio at time since ignition
     #
     """
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.lbt_calc(fuel_type.value, lb, time_since_ignition, cfb),
+                         "Failed to calculate LBt")
     result = CFFDRS.instance().cffdrs._LBtcalc(FUELTYPE=fuel_type.value, LB=lb,
                                                HR=time_since_ignition, CFB=cfb)
     if isinstance(result[0], float):
@@ -529,7 +585,7 @@ def length_to_breadth_ratio_t(fuel_type: FuelTypeEnum,
 
 def fine_fuel_moisture_code(ffmc: float, temperature: float, relative_humidity: float,
                             precipitation: float, wind_speed: float):
-    """ Computes Fine Fuel Moisture Code (FFMC) by delegating to cffdrs R package.
+    """ Computes Fine Fuel Moisture Code (FFMC) using cffdrs.
     This is necessary when recalculating certain fire weather indices based on
     user-defined input for wind speed.
 
@@ -546,6 +602,16 @@ def fine_fuel_moisture_code(ffmc: float, temperature: float, relative_humidity:
     if ffmc is None:
         logger.error("Failed to calculate FFMC; initial FFMC is required.")
         return None
+    if not use_r_backend():
+        if None in (temperature, relative_humidity, precipitation, wind_speed):
+            # R returns no result when passed a NULL temp, rh or prec (and throws for a NULL wind speed).
+            logger.error("Failed to calculate ffmc")
+            return None
+        result = float(cffdrs_numpy.ffmc_calc(ffmc, temperature, relative_humidity, wind_speed, precipitation))
+        if math.isnan(result):
+            logger.error("Failed to calculate ffmc")
+            return None
+        return result
     if temperature is None:
         temperature = NULL
     if relative_humidity is None:
@@ -571,7 +637,7 @@ def duff_moisture_code(dmc: float, temperature: float, relative_humidity: float,
                        precipitation: float, latitude: float = 55, month: int = 7,
                        latitude_adjust: bool = True):
     """
-    Computes Duff Moisture Code (DMC) by delegating to the cffdrs R package.
+    Computes Duff Moisture Code (DMC) using cffdrs.
 
     R function signature: 
     function (dmc_yda, temp, rh, prec, lat, mon, lat.adjust = TRUE)
@@ -595,16 +661,23 @@ def duff_moisture_code(dmc: float, temperature: float, relative_humidity: float,
     if dmc is None:
         logger.error("Failed to calculate DMC; initial DMC is required.")
         return None
+    if latitude is None:
+        latitude = 55
+    if month is None:
+        month = 7
+    if not use_r_backend():
+        result = float(cffdrs_numpy.dmc_calc(dmc, temperature, relative_humidity, precipitation,
+                                             latitude, month, latitude_adjust))
+        if math.isnan(result):
+            logger.error("Failed to calculate DMC")
+            return None
+        return result
     if temperature is None:
         temperature = NULL
     if relative_humidity is None:
         relative_humidity = NULL
     if precipitation is None:
         precipitation = NULL
-    if latitude is None:
-        latitude = 55
-    if month is None:
-        month = 7
     result = CFFDRS.instance().cffdrs._dmcCalc(dmc, temperature, relative_humidity, precipitation,
                                                latitude, month, latitude_adjust)
 
@@ -620,7 +693,7 @@ def duff_moisture_code(dmc: float, temperature: float, relative_humidity: float,
 def drought_code(dc: float, temperature: float, relative_humidity: float, precipitation: float,
                  latitude: float = 55, month: int = 7, latitude_adjust: bool = True) -> None:
     """
-    Computes Drought Code (DC) by delegating to the cffdrs R package.
+    Computes Drought Code (DC) using cffdrs.
 
     :param dc: The Drought Code (unitless) of the previous day
     :type dc: float
@@ -643,16 +716,23 @@ def drought_code(dc: float, temperature: float, relative_humidity: float, precip
     if dc is None:
         logger.error("Failed to calculate DC; initial DC is required.")
         return None
+    if latitude is None:
+        latitude = 55
+    if month is None:
+        month = 7
+    if not use_r_backend():
+        result = float(cffdrs_numpy.dc_calc(dc, temperature, relative_humidity, precipitation,
+                                            latitude, month, latitude_adjust))
+        if math.isnan(result):
+            logger.error("Failed to calculate DC")
+            return None
+        return result
     if temperature is None:
         temperature = NULL
     if relative_humidity is None:
         relative_humidity = NULL
     if precipitation is None:
         precipitation = NULL
-    if latitude is None:
-        latitude = 55
-    if month is None:
-        month = 7
     result = CFFDRS.instance().cffdrs._dcCalc(dc, temperature, relative_humidity, precipitation,
                                               latitude, month, latitude_adjust)
     if len(result) == 0:
@@ -665,7 +745,7 @@ def drought_code(dc: float, temperature: float, relative_humidity: float, precip
 
 
 def initial_spread_index(ffmc: float, wind_speed: float, fbp_mod: bool = False):
-    """ Computes Initial Spread Index (ISI) by delegating to cffdrs R package.
+    """ Computes Initial Spread Index (ISI) using cffdrs.
     This is necessary when recalculating ROS/HFI for modified FFMC values. Otherwise,
     should be using the ISI value retrieved from WFWX.
 
@@ -677,6 +757,8 @@ def initial_spread_index(ffmc: float, wind_speed: float, fbp_mod: bool = False):
     # Returns:
     #   ISI:    Intial Spread Index
     """
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.isi_calc(ffmc, wind_speed, fbp_mod), "Failed to calculate ISI")
     if ffmc is None:
         ffmc = NULL
     result = CFFDRS.instance().cffdrs._ISIcalc(ffmc=ffmc, ws=wind_speed, fbpMod=fbp_mod)
@@ -686,7 +768,7 @@ def initial_spread_index(ffmc: float, wind_speed: float, fbp_mod: bool = False):
 
 
 def fire_weather_index(isi: float, bui: float):
-    """ Computes Fire Weather Index (FWI) by delegating to cffdrs R package.
+    """ Computes Fire Weather Index (FWI) using cffdrs.
 
         Args:   isi:    Initial Spread Index
                 bui:    Buildup Index
@@ -694,6 +776,8 @@ def fire_weather_index(isi: float, bui: float):
         Returns: A single fwi value
     """
 
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.fwi_calc(isi, bui), "Failed to calculate fwi")
     result = CFFDRS.instance().cffdrs._fwiCalc(isi=isi, bui=bui)
     if isinstance(result[0], float):
         return result[0]
@@ -702,7 +786,7 @@ def fire_weather_index(isi: float, bui: float):
 
 def crown_fraction_burned(fuel_type: FuelTypeEnum, fmc: float, sfc: float,
                           ros: float, cbh: float) -> float:
-    """ Computes Crown Fraction Burned (CFB) by delegating to cffdrs R package.
+    """ Computes Crown Fraction Burned (CFB) using cffdrs.
     Value returned will be between 0-1.
 
     # Args:
@@ -716,6 +800,12 @@ def crown_fraction_burned(fuel_type: FuelTypeEnum, fmc: float, sfc: float,
     # Returns:
     #   CFB, CSI, RSO depending on which option was selected.
     """
+    if not use_r_backend():
+        if cbh is None or fmc is None:
+            message = PARAMS_ERROR_MESSAGE + \
+                f"_CFBcalc; fuel_type: {fuel_type.value}, cbh: {cbh}, fmc: {fmc}"
+            raise CFFDRSException(message)
+        return _to_float(cffdrs_numpy.cfb_calc(fuel_type.value, fmc, sfc, ros, cbh), "Failed to calculate CFB")
     if cbh is None:
         cbh = NULL
     if cbh is None or fmc is None:
@@ -732,7 +822,7 @@ def crown_fraction_burned(fuel_type: FuelTypeEnum, fmc: float, sfc: float,
 def total_fuel_consumption(
         fuel_type: FuelTypeEnum, cfb: float, sfc: float, pc: float, pdf: float, cfl: float):
     """ Computes Total Fuel Consumption (TFC), which is a required input to calculate Head Fire Intensity.
-    TFC is calculated by delegating to cffdrs R package.
+    TFC is calculated .
 
     # Args:
     #   FUELTYPE: The Fire Behaviour Prediction FuelType
@@ -753,6 +843,8 @@ def total_fuel_consumption(
         raise CFFDRSException(message)
     # According to fbp.Rd in cffdrs R package, Crown Fuel Load (CFL) can use default value of 1.0
     # without causing major impacts on final output.
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.tfc_calc(fuel_type.value, cfl, cfb, sfc, pc, pdf), "Failed to calculate TFC")
     if pc is None:
         pc = NULL
     if pdf is None:
@@ -772,7 +864,7 @@ def head_fire_intensity(fuel_type: FuelTypeEnum,
                         cfb: float,
                         cfl: float,
                         sfc: float):
-    """ Computes Head Fire Intensity (HFI) by delegating to cffdrs R package.
+    """ Computes Head Fire Intensity (HFI) using cffdrs.
     Calculating HFI requires a number of inputs that must be calculated first. This function
     first makes method calls to calculate the necessary intermediary values.
     """
@@ -786,13 +878,15 @@ def head_fire_intensity(fuel_type: FuelTypeEnum,
     # Returns:
     #   FI:   Fire Intensity (kW/m)
 
+    if not use_r_backend():
+        return _to_float(cffdrs_numpy.fi_calc(tfc, ros), "Failed to calculate FI")
     result = CFFDRS.instance().cffdrs._FIcalc(FC=tfc, ROS=ros)
     if isinstance(result[0], float):
         return result[0]
     raise CFFDRSException("Failed to calculate FI")
 
 
-def pandas_to_r_converter(df: pd.DataFrame) -> robjs.vectors.DataFrame:
+def pandas_to_r_converter(df: pd.DataFrame) -> 'robjs.vectors.DataFrame':
     """
     Convert pandas dataframe to an R data.frame object
 
@@ -811,7 +905,7 @@ def hourly_fine_fuel_moisture_code(weatherstream: pd.DataFrame, ffmc_old: float,
                                    time_step: int = 1, calc_step: bool = False, batch: bool = True,
                                    hourly_fwi: bool = False) -> pd.DataFrame:    
     """ Computes hourly FFMC based on noon FFMC using diurnal curve for approximation.
-    Delegates the calculation to cffdrs R package.
+    Delegates the calculation to cffdrs R package (there is no numpy port of hffmc, so this requires R).
     https://rdrr.io/rforge/cffdrs/man/hffmc.html
 
      Args: weatherstream:   Input weather stream data.frame which includes
@@ -854,6 +948,8 @@ def hourly_fine_fuel_moisture_code(weatherstream: pd.DataFrame, ffmc_old: float,
 
     # We have to change field names to exactly what the CFFDRS lib expects. 
     # This may need to be adjusted depending on the future data input model, which is currently unknown
+    if rpy2 is None:
+        raise CFFDRSException("Failed to calculate hffmc; rpy2 is not installed")
     column_name_map = {'temperature':'temp', 'relative_humidity': 'rh', 'wind_speed': 'ws', 'precipitation': 'prec', 'datetime': 'hr'}
     weatherstream = weatherstream.rename(columns=column_name_map)
 
@@ -882,44 +978,48 @@ def get_ffmc_for_target_hfi(
         ffmc: float, fmc: float, cfb: float, cfl: float, target_hfi: float):
     """ Returns a floating point value for minimum FFMC required (holding all other values constant)
         before HFI reaches the target_hfi (in kW/m).
+
+        FFMC is bisected on [0, 101], and the result is within 1% of the target HFI (or within 0.01 FFMC).
+        If FFMC of 101 still gives HFI < target_hfi, 101 is returned; if FFMC of 0 still gives
+        HFI >= target_hfi, 0 is returned. The ffmc argument is no longer needed, but is kept for compatibility.
         """
-    # start off using the actual FFMC value
-    experimental_ffmc = ffmc
-    experimental_sfc = surface_fuel_consumption(fuel_type, bui, experimental_ffmc, percentage_conifer)
-    experimental_isi = initial_spread_index(experimental_ffmc, wind_speed)
-    experimental_ros = rate_of_spread(fuel_type, experimental_isi, bui, fmc, experimental_sfc,
-                                      percentage_conifer,
-                                      grass_cure, percentage_dead_balsam_fir, crown_base_height)
-    experimental_hfi = head_fire_intensity(fuel_type,
-                                           percentage_conifer,
-                                           percentage_dead_balsam_fir,
-                                           experimental_ros, cfb,
-                                           cfl, experimental_sfc)
-    error_hfi = (target_hfi - experimental_hfi) / target_hfi
-
-   # FFMC has upper bound 101
-   # exit condition 1: FFMC of 101 still causes HFI < target_hfi
-   # exit condition 2: FFMC of 0 still causes HFI > target_hfi
-   # exit condition 3: relative error within 1%
-
-    while abs(error_hfi) > 0.01:
-        if experimental_ffmc >= 100.9 and experimental_hfi < target_hfi:
-            break
-        if experimental_ffmc <= 0.1:
-            break
-        if error_hfi > 0:  # if the error value is a positive number, make experimental FFMC value bigger
-            experimental_ffmc = min(101, experimental_ffmc + ((101 - experimental_ffmc) / 2))
-        else:  # if the error value is a negative number, need to make experimental FFMC value smaller
-            experimental_ffmc = max(0, experimental_ffmc - ((101 - experimental_ffmc) / 2))
+    if not use_r_backend():
+        solution = cffdrs_numpy.ffmc_for_target_hfi(
+            fuel_type.value, bui, wind_speed, fmc, cfb, cfl, target_hfi,
+            percentage_conifer, percentage_dead_balsam_fir, grass_cure, crown_base_height)
+        logger.debug('FFMC for target HFI %s found after %s iterations', target_hfi, int(solution.iterations))
+        critical_ffmc = _to_float(solution.ffmc, "Failed to calculate FFMC for target HFI")
+        return (critical_ffmc, float(solution.hfi))
+
+    def hfi_at(experimental_ffmc: float) -> float:
         experimental_isi = initial_spread_index(experimental_ffmc, wind_speed)
         experimental_sfc = surface_fuel_consumption(fuel_type, bui, experimental_ffmc, percentage_conifer)
         experimental_ros = rate_of_spread(fuel_type, experimental_isi, bui, fmc,
                                           experimental_sfc, percentage_conifer,
                                           grass_cure, percentage_dead_balsam_fir, crown_base_height)
-        experimental_hfi = head_fire_intensity(fuel_type,
-                                               percentage_conifer,
-                                               percentage_dead_balsam_fir, experimental_ros,
-                                               cfb, cfl, experimental_sfc)
-        error_hfi = (target_hfi - experimental_hfi) / target_hfi
-
-    return (experimental_ffmc, experimental_hfi)
+        return head_fire_intensity(fuel_type,
+                                   percentage_conifer,
+                                   percentage_dead_balsam_fir, experimental_ros,
+                                   cfb, cfl, experimental_sfc)
+
+    # HFI increases with FFMC, so the target is bracketed by [0, 101]
+    low, high = cffdrs_numpy.FFMC_MIN, cffdrs_numpy.FFMC_MAX
+    hfi_high = hfi_at(high)
+    # exit condition 1: FFMC of 101 still causes HFI < target_hfi
+    if hfi_high < target_hfi:
+        return (high, hfi_high)
+    # exit condition 2: FFMC of 0 still causes HFI >= target_hfi
+    hfi_low = hfi_at(low)
+    if hfi_low >= target_hfi:
+        return (low, hfi_low)
+    # exit condition 3: relative error within 1%, or the bracket has narrowed to 0.01
+    for _ in range(cffdrs_numpy.max_bisection_iterations(0.01)):
+        if abs(hfi_high - target_hfi) <= 0.01 * target_hfi:
+            break
+        middle = (low + high) / 2
+        hfi_middle = hfi_at(middle)
+        if hfi_middle >= target_hfi:
+            high, hfi_high = middle, hfi_middle
+        else:
+            low = middle
+    return (high, hfi_high)
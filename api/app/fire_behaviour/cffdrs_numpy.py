@@ -0,0 +1,779 @@
+""" Vectorized NumPy implementation of the Canadian Forest Fire Danger Rating System (CFFDRS).
+
+This module is a port of the internal functions of the cffdrs R package (.ISIcalc, .ROScalc, .SFCcalc etc.)
+that app.fire_behaviour.cffdrs used to delegate to via rpy2. Every function accepts scalars or arrays and
+follows NumPy broadcasting rules, so an entire stations x fuel types x days grid can be computed in one call,
+e.g.:
+
+    isi = isi_calc(ffmc[:, None, :], ws[:, None, :])                    # (stations, 1, days)
+    ros = ros_calc(fuel_types[None, :, None], isi, bui[:, None, :], ...)  # (stations, fuel types, days)
+
+The equations (and their quirks) are kept as close as possible to the R implementation so that results are
+numerically identical. Missing (None) inputs are treated as NaN, and a NaN input gives a NaN result, the
+same as an NA input gives NA in R. (np.where treats a NaN condition as False, where R's ifelse gives NA, so the
+functions that branch on an input set the result to NaN wherever that input is missing.)
+
+All variables names are laid out in the same manner as Forestry Canada Fire Danger Group (FCFDG) (1992).
+Development and Structure of the Canadian Forest Fire Behavior Prediction System." Technical Report
+ST-X-3, Forestry Canada, Ottawa, Ontario.
+
+Wotton, B.M., Alexander, M.E., Taylor, S.W. 2009. Updates and revisions to the 1992 Canadian forest fire
+behavior prediction system. Nat. Resour. Can., Can. For. Serv., Great Lakes For. Cent., Sault Ste. Marie,
+Ontario, Canada. Information Report GLC-X-10, 45p.
+"""
+from functools import wraps
+import math
+from typing import NamedTuple
+import numpy as np
+
+# Fuel types, in the order used by the parameter tables in the cffdrs R package.
+FUEL_TYPES = ('C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'D1', 'M1', 'M2', 'M3', 'M4',
+              'S1', 'S2', 'S3', 'O1A', 'O1B')
+FUEL_TYPE_INDEX = {fuel_type: index for index, fuel_type in enumerate(FUEL_TYPES)}
+# Index used for fuel types that the cffdrs R package doesn't know about (e.g. C7B, D2). It points at
+# the trailing NaN that is appended to every parameter table.
+UNKNOWN_FUEL_TYPE = len(FUEL_TYPES)
+
+
+def _table(*values) -> np.ndarray:
+    """ Build a parameter lookup table, with a trailing NaN for unknown fuel types. """
+    return np.array(values + (np.nan,), dtype=float)
+
+
+# Rate of spread equation parameters (.ROScalc)
+ROS_A = _table(90, 110, 110, 110, 30, 30, 45, 30, 0, 0, 120, 100, 75, 40, 55, 190, 250)
+ROS_B = _table(0.0649, 0.0282, 0.0444, 0.0293, 0.0697, 0.08, 0.0305, 0.0232, 0, 0, 0.0572, 0.0404,
+               0.0297, 0.0438, 0.0829, 0.031, 0.035)
+ROS_C0 = _table(4.5, 1.5, 3, 1.5, 4, 3, 2, 1.6, 0, 0, 1.4, 1.48, 1.3, 1.7, 3.2, 1.4, 1.7)
+# Buildup effect parameters (.BEcalc)
+BUI_O = _table(72, 64, 62, 66, 56, 62, 106, 32, 50, 50, 50, 50, 38, 63, 31, 1, 1)
+BE_Q = _table(0.9, 0.7, 0.75, 0.8, 0.8, 0.8, 0.85, 0.9, 0.8, 0.8, 0.8, 0.8, 0.75, 0.75, 0.75, 1, 1)
+
+# Day length adjustment factors for DMC (.dmcCalc)
+DMC_ELL01 = np.array([6.5, 7.5, 9, 12.8, 13.9, 13.9, 12.4, 10.9, 9.4, 8, 7, 6])
+DMC_ELL02 = np.array([7.9, 8.4, 8.9, 9.5, 9.9, 10.2, 10.1, 9.7, 9.1, 8.6, 8.1, 7.8])
+DMC_ELL03 = np.array([10.1, 9.6, 9.1, 8.5, 8.1, 7.8, 7.9, 8.3, 8.9, 9.4, 9.9, 10.2])
+DMC_ELL04 = np.array([11.5, 10.5, 9.2, 7.9, 6.8, 6.2, 6.5, 7.4, 8.7, 10, 11.2, 11.8])
+# Day length factors for DC (.dcCalc)
+DC_FL01 = np.array([-1.6, -1.6, -1.6, 0.9, 3.8, 5.8, 6.4, 5, 2.4, 0.4, -1.6, -1.6])
+DC_FL02 = np.array([6.4, 5, 2.4, 0.4, -1.6, -1.6, -1.6, -1.6, -1.6, 0.9, 3.8, 5.8])
+
+# Fuel types where acceleration is assumed to be that of a point source fire (.ROStcalc, .LBtcalc, .DISTtcalc)
+_POINT_SOURCE_FUEL_TYPES = ('C1', 'O1A', 'O1B', 'S1', 'S2', 'S3', 'D1')
+
+
+def _ignore_fp_errors(func):
+    """ np.where evaluates both branches, so suppress the floating point warnings raised by
+    the branch that isn't selected (e.g. log of a negative number). """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with np.errstate(all='ignore'):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _as_float(value) -> np.ndarray:
+    """ Convert input to a float array, turning None into NaN. """
+    return np.asarray(np.nan if value is None else value, dtype=float)
+
+
+def _nan_if_missing(result, *inputs) -> np.ndarray:
+    """ Set the result to NaN wherever any of the inputs is NaN """
+    missing = np.zeros(np.shape(result), dtype=bool)
+    for value in inputs:
+        missing = missing | np.isnan(value)
+    return np.where(missing, np.nan, result)
+
+
+def fuel_type_index(fuel_type) -> np.ndarray:
+    """ Convert a fuel type (or an array of fuel types) into indices into the parameter tables.
+    Accepts strings or FuelTypeEnum members. Unknown fuel types map to UNKNOWN_FUEL_TYPE. """
+    if isinstance(fuel_type, np.ndarray) and fuel_type.dtype.kind in 'iu':
+        # already converted
+        return fuel_type
+    fuel_types = np.asarray(fuel_type, dtype=object)
+    unique, inverse = np.unique(fuel_types, return_inverse=True)
+    lookup = np.array([FUEL_TYPE_INDEX.get(getattr(value, 'value', value), UNKNOWN_FUEL_TYPE) for value in unique],
+                      dtype=int)
+    return lookup[inverse].reshape(fuel_types.shape)
+
+
+def _is(index: np.ndarray, *fuel_types: str) -> np.ndarray:
+    """ Boolean mask of where index is one of fuel_types """
+    return np.isin(index, [FUEL_TYPE_INDEX[fuel_type] for fuel_type in fuel_types])
+
+
+@_ignore_fp_errors
+def isi_calc(ffmc, ws, fbp_mod: bool = False) -> np.ndarray:
+    """ Initial Spread Index (.ISIcalc)
+
+    ffmc:    Fine Fuel Moisture Code
+    ws:      Wind Speed (km/h)
+    fbp_mod: TRUE/FALSE if using the fbp modification at the extreme end
+    """
+    ffmc = _as_float(ffmc)
+    ws = _as_float(ws)
+    # Eq. 10 - Moisture content
+    fm = 147.27723 * (101 - ffmc) / (59.5 + ffmc)
+    # Eq. 24 - Wind Effect
+    # the ifelse, also takes care of the ISI modification for the fbp functions
+    if fbp_mod:
+        f_w = np.where(ws >= 40, 12 * (1 - np.exp(-0.0818 * (ws - 28))), np.exp(0.05039 * ws))
+    else:
+        f_w = np.exp(0.05039 * ws)
+    # Eq. 25 - Fine Fuel Moisture
+    f_f = 91.9 * np.exp(-0.1386 * fm) * (1 + (fm ** 5.31) / 49300000)
+    # Eq. 26 - Spread Index Equation
+    return 0.208 * f_w * f_f
+
+
+@_ignore_fp_errors
+def bui_calc(dmc, dc) -> np.ndarray:
+    """ Buildup Index (.buiCalc)
+
+    dmc: Duff Moisture Code
+    dc:  Drought Code
+    """
+    dmc = _as_float(dmc)
+    dc = _as_float(dc)
+    # Eq. 27a
+    bui1 = np.where((dmc == 0) & (dc == 0), 0, 0.8 * dc * dmc / (dmc + 0.4 * dc))
+    # Eq. 27b - next 3 lines
+    p = np.where(dmc == 0, 0, (dmc - bui1) / dmc)
+    cc = 0.92 + ((0.0114 * dmc) ** 1.7)
+    bui0 = dmc - cc * p
+    # Constraints
+    bui0 = np.where(bui0 < 0, 0, bui0)
+    return np.where(bui1 < dmc, bui0, bui1)
+
+
+@_ignore_fp_errors
+def fwi_calc(isi, bui) -> np.ndarray:
+    """ Fire Weather Index (.fwiCalc)
+
+    isi: Initial Spread Index
+    bui: Buildup Index
+    """
+    isi = _as_float(isi)
+    bui = _as_float(bui)
+    # Eqs. 28b, 28a, 29
+    bb = np.where(bui > 80,
+                  0.1 * isi * (1000 / (25 + 108.64 / np.exp(0.023 * bui))),
+                  0.1 * isi * (0.626 * (bui ** 0.809) + 2))
+    # Eqs. 30b, 30a
+    return np.where(bb <= 1, bb, np.exp(2.72 * ((0.434 * np.log(bb)) ** 0.647)))
+
+
+@_ignore_fp_errors
+def ffmc_calc(ffmc_yda, temp, rh, ws, prec) -> np.ndarray:
+    """ Fine Fuel Moisture Code (.ffmcCalc)
+
+    ffmc_yda: The Fine Fuel Moisture Code from previous iteration
+    temp:     Temperature (centigrade)
+    rh:       Relative Humidity (%)
+    ws:       Wind speed (km/h)
+    prec:     Precipitation (mm)
+    """
+    ffmc_yda = _as_float(ffmc_yda)
+    temp = _as_float(temp)
+    rh = _as_float(rh)
+    ws = _as_float(ws)
+    prec = _as_float(prec)
+    # Eq. 1 (cffdrs uses 147.27723 rather than the 147.2 of Van Wagner 1987)
+    wmo = 147.27723 * (101 - ffmc_yda) / (59.5 + ffmc_yda)
+    # Eq. 2 Rain reduction to allow for loss in overhead canopy
+    ra = np.where(prec > 0.5, prec - 0.5, prec)
+    # Eqs. 3a & 3b
+    wetting = 42.5 * ra * np.exp(-100 / (251 - wmo)) * (1 - np.exp(-6.93 / ra))
+    wmo = np.where(prec > 0.5,
+                   np.where(wmo > 150, wmo + 0.0015 * (wmo - 150) * (wmo - 150) * np.sqrt(ra) + wetting,
+                            wmo + wetting),
+                   wmo)
+    # The real moisture content of pine litter ranges up to about 250 percent, so we cap it at 250
+    wmo = np.where(wmo > 250, 250, wmo)
+    # Eq. 4 Equilibrium moisture content from drying
+    ed = 0.942 * (rh ** 0.679) + (11 * np.exp((rh - 100) / 10)) + 0.18 * \
+        (21.1 - temp) * (1 - 1 / np.exp(rh * 0.115))
+    # Eq. 5 Equilibrium moisture content from wetting
+    ew = 0.618 * (rh ** 0.753) + (10 * np.exp((rh - 100) / 10)) + 0.18 * \
+        (21.1 - temp) * (1 - 1 / np.exp(rh * 0.115))
+    # Eq. 6a (ko) Log drying rate at the normal temperature of 21.1 C
+    zl = np.where((wmo < ed) & (wmo < ew),
+                  0.424 * (1 - (((100 - rh) / 100) ** 1.7)) + 0.0694 * np.sqrt(ws) * (1 - ((100 - rh) / 100) ** 8),
+                  0)
+    # Eq. 6b Affect of temperature on drying rate
+    zl = zl * (0.581 * np.exp(0.0365 * temp))
+    # Eq. 8
+    wm = np.where((wmo < ed) & (wmo < ew), ew - (ew - wmo) / (10 ** zl), wmo)
+    # Eq. 7a (ko) Log wetting rate at the normal temperature of 21.1 C
+    zd = np.where(wmo > ed, 0.424 * (1 - (rh / 100) ** 1.7) + 0.0694 * np.sqrt(ws) * (1 - (rh / 100) ** 8), zl)
+    # Eq. 7b Affect of temperature on wetting rate
+    zd = zd * (0.581 * np.exp(0.0365 * temp))
+    # Eq. 9
+    wm = np.where(wmo > ed, ed + (wmo - ed) / (10 ** zd), wm)
+    # Eq. 10 Final ffmc calculation
+    ffmc1 = (59.5 * (250 - wm) / (147.27723 + wm))
+    # Constraints
+    ffmc1 = np.where(ffmc1 > 101, 101, ffmc1)
+    ffmc1 = np.where(ffmc1 < 0, 0, ffmc1)
+    return _nan_if_missing(ffmc1, ffmc_yda, temp, rh, ws, prec)
+
+
+@_ignore_fp_errors
+def dmc_calc(dmc_yda, temp, rh, prec, lat, mon, lat_adjust: bool = True) -> np.ndarray:
+    """ Duff Moisture Code (.dmcCalc)
+
+    dmc_yda:    The Duff Moisture Code from previous iteration
+    temp:       Temperature (centigrade)
+    rh:         Relative Humidity (%)
+    prec:       Precipitation (mm)
+    lat:        Latitude (decimal degrees)
+    mon:        Month (1-12)
+    lat_adjust: Latitude adjustment (TRUE/FALSE, default=TRUE)
+    """
+    dmc_yda = _as_float(dmc_yda)
+    temp = _as_float(temp)
+    rh = _as_float(rh)
+    prec = _as_float(prec)
+    lat = _as_float(lat)
+    month_index = np.asarray(mon, dtype=int) - 1
+    # Constrain low end of temperature
+    temp = np.where(temp < -1.1, -1.1, temp)
+    # Eq. 16 - The log drying rate
+    drying = 1.894 * (temp + 1.1) * (100 - rh) * 1e-04
+    rk = drying * DMC_ELL01[month_index]
+    # Adjust the day length and thus the drying rate, based on latitude and month
+    if lat_adjust:
+        rk = np.where((lat <= 30) & (lat > 10), drying * DMC_ELL02[month_index], rk)
+        rk = np.where((lat <= -10) & (lat > -30), drying * DMC_ELL03[month_index], rk)
+        rk = np.where((lat <= -30) & (lat >= -90), drying * DMC_ELL04[month_index], rk)
+        rk = np.where((lat <= 10) & (lat > -10), drying * 9, rk)
+    # Constrain P
+    ra = prec
+    # Eq. 11 - Net rain amount
+    rw = 0.92 * ra - 1.27
+    # Alteration to Eq. 12 to calculate more accurately
+    wmi = 20 + 280 / np.exp(0.023 * dmc_yda)
+    # Eqs. 13a, 13b, 13c
+    b = np.where(dmc_yda <= 33,
+                 100 / (0.5 + 0.3 * dmc_yda),
+                 np.where(dmc_yda <= 65, 14 - 1.3 * np.log(dmc_yda), 6.2 * np.log(dmc_yda) - 17.2))
+    # Eq. 14 - Moisture content after rain
+    wmr = wmi + 1000 * rw / (48.77 + b * rw)
+    # Alteration to Eq. 15 to calculate more accurately
+    pr = np.where(prec <= 1.5, dmc_yda, 43.43 * (5.6348 - np.log(wmr - 20)))
+    pr = np.where(pr < 0, 0, pr)
+    # Calculate final P (DMC)
+    dmc1 = pr + rk
+    dmc1 = np.where(dmc1 < 0, 0, dmc1)
+    if lat_adjust:
+        dmc1 = _nan_if_missing(dmc1, lat)
+    return _nan_if_missing(dmc1, dmc_yda, temp, rh, prec)
+
+
+@_ignore_fp_errors
+def dc_calc(dc_yda, temp, rh, prec, lat, mon, lat_adjust: bool = True) -> np.ndarray:
+    """ Drought Code (.dcCalc)
+
+    dc_yda:     The Drought Code from previous iteration
+    temp:       Temperature (centigrade)
+    rh:         Relative Humidity (%), not used by the calculation.
+    prec:       Precipitation (mm)
+    lat:        Latitude (decimal degrees)
+    mon:        Month (1-12)
+    lat_adjust: Latitude adjustment (TRUE/FALSE, default=TRUE)
+    """
+    dc_yda = _as_float(dc_yda)
+    temp = _as_float(temp)
+    prec = _as_float(prec)
+    lat = _as_float(lat)
+    month_index = np.asarray(mon, dtype=int) - 1
+    # Constrain temperature
+    temp = np.where(temp < -2.8, -2.8, temp)
+    # Eq. 22 - Potential Evapotranspiration
+    pe = (0.36 * (temp + 2.8) + DC_FL01[month_index]) / 2
+    # Daylength factor adjustment by latitude for Potential Evapotranspiration
+    if lat_adjust:
+        pe = np.where(lat <= -20, (0.36 * (temp + 2.8) + DC_FL02[month_index]) / 2, pe)
+        pe = np.where((lat > -20) & (lat <= 20), (0.36 * (temp + 2.8) + 1.4) / 2, pe)
+    # Cap potential evapotranspiration at 0 for negative winter DC values
+    pe = np.where(pe < 0, 0, pe)
+    ra = prec
+    # Eq. 18 - Effective Rainfall
+    rw = 0.83 * ra - 1.27
+    # Eq. 19
+    smi = 800 * np.exp(-1 * dc_yda / 400)
+    # Alteration to Eq. 21
+    dr0 = dc_yda - 400 * np.log(1 + 3.937 * rw / smi)
+    dr0 = np.where(dr0 < 0, 0, dr0)
+    # if precip is less than 2.8 then use yesterday's DC
+    dr = np.where(prec <= 2.8, dc_yda, dr0)
+    # Alteration to Eq. 23
+    dc1 = dr + pe
+    dc1 = np.where(dc1 < 0, 0, dc1)
+    if lat_adjust:
+        dc1 = _nan_if_missing(dc1, lat)
+    return _nan_if_missing(dc1, dc_yda, temp, prec)
+
+
+@_ignore_fp_errors
+def be_calc(fuel_type, bui) -> np.ndarray:
+    """ Buildup Effect (.BEcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    bui:       The Buildup Index value
+    """
+    index = fuel_type_index(fuel_type)
+    bui = _as_float(bui)
+    bui_o = BUI_O[index]
+    q = BE_Q[index]
+    # Eq. 54 (FCFDG 1992) The Buildup Effect
+    be = np.where((bui > 0) & (bui_o > 0), np.exp(50 * np.log(q) * (1 / bui - 1 / bui_o)), 1)
+    return _nan_if_missing(be, bui)
+
+
+def _basic_rsi(index: np.ndarray, isi: np.ndarray) -> np.ndarray:
+    """ Eq. 26 (FCFDG 1992) - Initial Rate of Spread for conifer, deciduous and slash types """
+    return ROS_A[index] * (1 - np.exp(-ROS_B[index] * isi)) ** ROS_C0[index]
+
+
+def _floor_ros(ros: np.ndarray) -> np.ndarray:
+    """ The cffdrs R package never returns a ROS of 0 """
+    return np.where(ros <= 0, 0.000001, ros)
+
+
+@_ignore_fp_errors
+def cfb_calc(fuel_type, fmc, sfc, ros, cbh, option: str = 'CFB') -> np.ndarray:
+    """ Crown Fraction Burned (.CFBcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType, not used by the calculation.
+    fmc:    Foliar Moisture Content
+    sfc:    Surface Fuel Consumption
+    ros:    Rate of Spread
+    cbh:    Crown Base Height
+    option: Which variable to calculate (CFB, CSI or RSO)
+    """
+    fmc = _as_float(fmc)
+    sfc = _as_float(sfc)
+    ros = _as_float(ros)
+    cbh = _as_float(cbh)
+    # Eq. 56 (FCFDG 1992) Critical surface intensity
+    csi = 0.001 * (cbh ** 1.5) * (460 + 25.9 * fmc) ** 1.5
+    if option == 'CSI':
+        return csi
+    # Eq. 57 (FCFDG 1992) Surface fire rate of spread (m/min)
+    rso = csi / (300 * sfc)
+    if option == 'RSO':
+        return rso
+    # Eq. 58 (FCFDG 1992) Crown fraction burned
+    cfb = np.where(ros > rso, 1 - np.exp(-0.23 * (ros - rso)), 0)
+    return _nan_if_missing(cfb, ros, rso)
+
+
+@_ignore_fp_errors
+def c6_calc(fuel_type, isi, bui, fmc, sfc, cbh, option: str = 'CFB') -> np.ndarray:
+    """ Rate of spread and crown fraction burned for the C6 fuel type (.C6calc)
+
+    option: Which variable to calculate (ROS, CFB, RSC or RSI)
+    """
+    isi = _as_float(isi)
+    fmc = _as_float(fmc)
+    # Eq. 59 (Wotton et. al. 2009) Crown flame temperature RSI
+    rsi = 30 * (1 - np.exp(-0.08 * isi)) ** 3
+    if option == 'RSI':
+        return rsi
+    # Eq. 60 (Wotton et. al. 2009) Average foliar moisture effect
+    fme_avg = 0.778
+    # Eq. 61 (Wotton et. al. 2009) Foliar moisture effect
+    fme = ((1.5 - 0.00275 * fmc) ** 4.) / (460 + (25.9 * fmc)) * 1000
+    # Eq. 64 (Wotton et. al. 2009) Crown fire spread rate (m/min)
+    rsc = 60 * (1 - np.exp(-0.0497 * isi)) * fme / fme_avg
+    if option == 'RSC':
+        return rsc
+    # Eq. 63 (Wotton et. al. 2009) Surface fire spread rate (m/min)
+    rss = rsi * be_calc(fuel_type, bui)
+    # Crown Fraction Burned
+    rso = cfb_calc(fuel_type, fmc, sfc, rss, cbh, option='RSO')
+    cfb = _nan_if_missing(np.where(rss > rso, cfb_calc(fuel_type, fmc, sfc, rss, cbh), 0), rss, rso)
+    if option == 'CFB':
+        return cfb
+    # Eq. 65 (Wotton et. al. 2009) Calculate Rate of spread (m/min)
+    return _nan_if_missing(np.where(rsc > rss, rss + cfb * (rsc - rss), rss), rsc)
+
+
+@_ignore_fp_errors
+def ros_calc(fuel_type, isi, bui, fmc, sfc, pc, pdf, cc, cbh) -> np.ndarray:
+    """ Rate of Spread (.ROScalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    isi:       Initial Spread Index
+    bui:       Buildup Index
+    fmc:       Foliar Moisture Content
+    sfc:       Surface Fuel Consumption (kg/m^2)
+    pc:        Percent Conifer (%)
+    pdf:       Percent Dead Balsam Fir (%)
+    cc:        Constant (grass curing)
+    cbh:       Crown to base height(m)
+
+    Returns ROS: Rate of spread (m/min)
+    """
+    index = fuel_type_index(fuel_type)
+    isi = _as_float(isi)
+    pc = _as_float(pc)
+    pdf = _as_float(pdf)
+    cc = _as_float(cc)
+    rsi = _basic_rsi(index, isi)
+    # The mixedwood fuel types are a blend of C2 and D1, calculated (by R) with a recursive call that ignores
+    # the buildup effect.
+    rsi_c2 = _floor_ros(_basic_rsi(FUEL_TYPE_INDEX['C2'], isi))
+    rsi_d1 = _floor_ros(_basic_rsi(FUEL_TYPE_INDEX['D1'], isi))
+    # Eq. 27 (FCFDG 1992) M1
+    rsi = np.where(_is(index, 'M1'), pc / 100 * rsi_c2 + (100 - pc) / 100 * rsi_d1, rsi)
+    # Eq. 28 (FCFDG 1992) M2
+    rsi = np.where(_is(index, 'M2'), pc / 100 * rsi_c2 + 0.2 * (100 - pc) / 100 * rsi_d1, rsi)
+    # Eq. 29 (FCFDG 1992) M3
+    rsi = np.where(_is(index, 'M3'), pdf / 100 * rsi + (1 - pdf / 100) * rsi_d1, rsi)
+    # Eq. 30 (FCFDG 1992) M4
+    rsi = np.where(_is(index, 'M4'), pdf / 100 * rsi + 0.2 * (1 - pdf / 100) * rsi_d1, rsi)
+    # Eq. 35b (Wotton et. al. 2009) Calculate Curing function for grass
+    cf = np.where(cc < 58.8, 0.005 * (np.exp(0.061 * cc) - 1), 0.176 + 0.02 * (cc - 58.8))
+    # Eq. 36 (FCFDG 1992) Calculate Grass RSI
+    rsi = np.where(_is(index, 'O1A', 'O1B'), rsi * cf, rsi)
+    # Calculate Surface spread rate with the buildup effect
+    rss = rsi * be_calc(index, bui)
+    ros = np.where(_is(index, 'C6'), c6_calc(index, isi, bui, fmc, sfc, cbh, option='ROS'), rss)
+    return _floor_ros(ros)
+
+
+@_ignore_fp_errors
+def sfc_calc(fuel_type, ffmc, bui, pc, gfl) -> np.ndarray:
+    """ Surface Fuel Consumption (.SFCcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    ffmc:      Fine Fuel Moisture Code
+    bui:       Buildup Index
+    pc:        Percent Conifer (%)
+    gfl:       Grass Fuel Load (kg/m^2)
+
+    Returns SFC: Surface Fuel Consumption (kg/m^2)
+    """
+    index = fuel_type_index(fuel_type)
+    ffmc = _as_float(ffmc)
+    bui = _as_float(bui)
+    pc = _as_float(pc)
+    gfl = _as_float(gfl)
+    sfc = np.full(np.broadcast(index, ffmc, bui).shape, -999.0)
+    # Eq. 9a/9b (Wotton et. al. 2009) - Solving for C1
+    sfc = np.where(_is(index, 'C1'),
+                   np.where(ffmc > 84,
+                            0.75 + 0.75 * (1 - np.exp(-0.23 * (ffmc - 84))) ** 0.5,
+                            0.75 - 0.75 * (1 - np.exp(-0.23 * (84 - ffmc))) ** 0.5),
+                   sfc)
+    # Eq. 10 (FCFDG 1992) - C2, M3, and M4
+    sfc = np.where(_is(index, 'C2', 'M3', 'M4'), 5 * (1 - np.exp(-0.0115 * bui)), sfc)
+    # Eq. 11 (FCFDG 1992) - C3, C4
+    sfc = np.where(_is(index, 'C3', 'C4'), 5 * (1 - np.exp(-0.0164 * bui)) ** 2.24, sfc)
+    # Eq. 12 (FCFDG 1992) - C5, C6
+    sfc = np.where(_is(index, 'C5', 'C6'), 5 * (1 - np.exp(-0.0149 * bui)) ** 2.48, sfc)
+    # Eqs. 13, 14, 15 (FCFDG 1992) - C7
+    sfc = np.where(_is(index, 'C7'),
+                   np.where(ffmc > 70, 2 * (1 - np.exp(-0.104 * (ffmc - 70))), 0) +
+                   1.5 * (1 - np.exp(-0.0201 * bui)),
+                   sfc)
+    # Eq. 16 (FCFDG 1992) - D1
+    sfc = np.where(_is(index, 'D1'), 1.5 * (1 - np.exp(-0.0183 * bui)), sfc)
+    # Eq. 17 (FCFDG 1992) - M1 and M2
+    sfc = np.where(_is(index, 'M1', 'M2'),
+                   pc / 100 * 5 * (1 - np.exp(-0.0115 * bui)) + ((100 - pc) / 100 * 1.5 * (1 - np.exp(-0.0183 * bui))),
+                   sfc)
+    # Eq. 18 (FCFDG 1992) - Grass
+    sfc = np.where(_is(index, 'O1A', 'O1B'), gfl, sfc)
+    # Eqs. 19, 20, 25 (FCFDG 1992) - S1
+    sfc = np.where(_is(index, 'S1'), 4 * (1 - np.exp(-0.025 * bui)) + 4 * (1 - np.exp(-0.034 * bui)), sfc)
+    # Eqs. 21, 22, 25 (FCFDG 1992) - S2
+    sfc = np.where(_is(index, 'S2'), 10 * (1 - np.exp(-0.013 * bui)) + 6 * (1 - np.exp(-0.06 * bui)), sfc)
+    # Eqs. 23, 24, 25 (FCFDG 1992) - S3
+    sfc = np.where(_is(index, 'S3'), 12 * (1 - np.exp(-0.0166 * bui)) + 20 * (1 - np.exp(-0.021 * bui)), sfc)
+    # Unknown fuel types can't be calculated (R would return the 0.000001 floor)
+    sfc = np.where(index == UNKNOWN_FUEL_TYPE, np.nan, sfc)
+    # Constrain SFC value
+    return np.where(sfc <= 0, 0.000001, sfc)
+
+
+@_ignore_fp_errors
+def tfc_calc(fuel_type, cfl, cfb, sfc, pc, pdf, option: str = 'TFC') -> np.ndarray:
+    """ Total Fuel Consumption (.TFCcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    cfl:       Crown Fuel Load (kg/m^2)
+    cfb:       Crown Fraction Burned (0-1)
+    sfc:       Surface Fuel Consumption (kg/m^2)
+    pc:        Percent Conifer (%)
+    pdf:       Percent Dead Balsam Fir (%)
+    option:    Type of output (TFC, CFC, default=TFC)
+    """
+    index = fuel_type_index(fuel_type)
+    cfl = _as_float(cfl)
+    cfb = _as_float(cfb)
+    sfc = _as_float(sfc)
+    pc = _as_float(pc)
+    pdf = _as_float(pdf)
+    # Eq. 66a (Wotton 2009) - Crown Fuel Consumption (CFC)
+    cfc = cfl * cfb
+    # Eq. 66b, 66c (Wotton 2009) - CFC for mixedwood fuel types
+    cfc = np.where(_is(index, 'M1', 'M2'), pc / 100 * cfc, np.where(_is(index, 'M3', 'M4'), pdf / 100 * cfc, cfc))
+    if option == 'CFC':
+        return cfc
+    # Eq. 67 (FCFDG 1992) - Total Fuel Consumption
+    return sfc + cfc
+
+
+def fi_calc(fc, ros) -> np.ndarray:
+    """ Fire Intensity (.FIcalc)
+
+    fc:  Fuel Consumption (kg/m^2)
+    ros: Rate of Spread (m/min)
+
+    Returns FI: Fire Intensity (kW/m)
+    """
+    # Eq. 69 (FCFDG 1992) Fire Intensity (kW/m)
+    return 300 * _as_float(fc) * _as_float(ros)
+
+
+@_ignore_fp_errors
+def fmc_calc(lat, long, elv, dj, d0) -> np.ndarray:
+    """ Foliar Moisture Content (.FMCcalc)
+
+    lat:  Latitude (decimal degrees)
+    long: Longitude (decimal degrees, positive)
+    elv:  Elevation (metres)
+    dj:   Day of year (often referred to as julian date)
+    d0:   Date of minimum foliar moisture content
+    """
+    lat = _as_float(lat)
+    long = _as_float(long)
+    elv = _as_float(elv)
+    dj = _as_float(dj)
+    d0 = _as_float(d0)
+    # Eqs. 1 & 3 (FCFDG 1992) Normalized latitude
+    latn = np.where(d0 <= 0,
+                    np.where(elv <= 0,
+                             46 + 23.4 * np.exp(-0.0360 * (150 - long)),
+                             43 + 33.7 * np.exp(-0.0351 * (150 - long))),
+                    0)
+    # Eqs. 2 & 4 (FCFDG 1992) Date of minimum foliar moisture content. This is only calculated if D0 is not
+    # explicitly passed.
+    d0 = np.where(d0 <= 0,
+                  np.where(elv <= 0, 151 * (lat / latn), 142.1 * (lat / latn) + 0.0172 * elv),
+                  d0)
+    # Round D0 to the nearest integer because it is a date (R rounds half to even, as does NumPy)
+    d0 = np.round(d0, 0)
+    # Eq. 5 (FCFDG 1992) Number of days between day of year and date of min FMC
+    nd = np.abs(dj - d0)
+    # Eqs. 6, 7, & 8 (FCFDG 1992) Foliar moisture content
+    fmc = np.where(nd < 30,
+                   85 + 0.0189 * nd ** 2,
+                   np.where(nd < 50, 32.9 + 3.17 * nd - 0.0288 * nd ** 2, 120))
+    return _nan_if_missing(fmc, nd)
+
+
+@_ignore_fp_errors
+def lb_calc(fuel_type, wsv) -> np.ndarray:
+    """ Length to Breadth ratio (.LBcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    wsv:       The Wind Speed (km/h)
+    """
+    wsv = _as_float(wsv)
+    # Eq. 79 (FCFDG 1992) (Grass) and Eq. 80 (FCFDG 1992) (all other fuel types)
+    lb = np.where(_is(fuel_type_index(fuel_type), 'O1A', 'O1B'),
+                  np.where(wsv < 1.0, 1.0, 1.1 * (wsv ** 0.464)),
+                  1.0 + 8.729 * ((1 - np.exp(-0.030 * wsv)) ** (2.155)))
+    return lb
+
+
+def _acceleration(index: np.ndarray, cfb: np.ndarray) -> np.ndarray:
+    """ Eq. 72 (FCFDG 1992) Acceleration parameter (alpha) """
+    return np.where(_is(index, *_POINT_SOURCE_FUEL_TYPES), 0.115, 0.115 - 18.8 * (cfb ** 2.5) * np.exp(-8 * cfb))
+
+
+@_ignore_fp_errors
+def lbt_calc(fuel_type, lb, hr, cfb) -> np.ndarray:
+    """ Length to Breadth ratio at time since ignition (.LBtcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    lb:        Length to Breadth ratio
+    hr:        Time since ignition (the R documentation says hours, it's actually minutes)
+    cfb:       Crown Fraction Burned
+    """
+    alpha = _acceleration(fuel_type_index(fuel_type), _as_float(cfb))
+    # Eq. 81 (Wotton et.al. 2009) LB at time since ignition
+    return (_as_float(lb) - 1) * (1 - np.exp(-alpha * _as_float(hr))) + 1
+
+
+@_ignore_fp_errors
+def rost_calc(fuel_type, ros_eq, hr, cfb) -> np.ndarray:
+    """ Rate of Spread at time since ignition (.ROStcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    ros_eq:    Equilibrium Rate of Spread (m/min)
+    hr:        Time since ignition (the R documentation says hours, it's actually minutes)
+    cfb:       Crown Fraction Burned
+    """
+    alpha = _acceleration(fuel_type_index(fuel_type), _as_float(cfb))
+    # Eq. 70 (FCFDG 1992) ROS at time since ignition
+    return _as_float(ros_eq) * (1 - np.exp(-alpha * _as_float(hr)))
+
+
+@_ignore_fp_errors
+def distt_calc(fuel_type, ros_eq, hr, cfb) -> np.ndarray:
+    """ Head fire spread distance at time t (.DISTtcalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    ros_eq:    The predicted equilibrium rate of spread (m/min)
+    hr:        The elapsed time (min)
+    cfb:       Crown Fraction Burned
+    """
+    alpha = _acceleration(fuel_type_index(fuel_type), _as_float(cfb))
+    hr = _as_float(hr)
+    # Eq. 71 (FCFDG 1992) Calculate Head fire spread distance
+    return _as_float(ros_eq) * (hr + np.exp(-alpha * hr) / alpha - 1 / alpha)
+
+
+def fros_calc(ros, bros, lb) -> np.ndarray:
+    """ Flank Fire Spread Rate (.FROScalc)
+
+    ros:  Fire Rate of Spread (m/min)
+    bros: Back Fire Rate of Spread (m/min)
+    lb:   Length to breadth ratio
+    """
+    # Eq. 89 (FCFDG 1992)
+    return (_as_float(ros) + _as_float(bros)) / _as_float(lb) / 2
+
+
+@_ignore_fp_errors
+def bros_calc(fuel_type, ffmc, bui, wsv, fmc, sfc, pc, pdf, cc, cbh) -> np.ndarray:
+    """ Back Fire Spread Rate (.BROScalc)
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    ffmc:      Fine Fuel Moisture Code
+    bui:       Buildup Index
+    wsv:       Wind Speed Vector
+    fmc:       Foliar Moisture Content
+    sfc:       Surface Fuel Consumption
+    pc:        Percent Conifer
+    pdf:       Percent Dead Balsam Fir
+    cc:        Degree of Curing (just "C" in FCFDG 1992)
+    cbh:       Crown Base Height
+    """
+    ffmc = _as_float(ffmc)
+    # Eq. 46 (FCFDG 1992) Calculate the FFMC function from ISI equation
+    m = 147.27723 * (101 - ffmc) / (59.5 + ffmc)
+    # Eq. 45 (FCFDG 1992)
+    f_f = 91.9 * np.exp(-0.1386 * m) * (1.0 + (m ** 5.31) / 49300000.0)
+    # Eq. 75 (FCFDG 1992) Calculate the Back fire wind function
+    bf_w = np.exp(-0.05039 * _as_float(wsv))
+    # Calculate the ISI associated with the back fire spread rate
+    # Eq. 76 (FCFDG 1992)
+    bisi = 0.208 * bf_w * f_f
+    # Eq. 77 (FCFDG 1992) Calculate final Back fire spread rate
+    return ros_calc(fuel_type, bisi, bui, fmc, sfc, pc, pdf, cc, cbh)
+
+
+# FFMC is bounded on [0, 101]
+FFMC_MIN = 0.0
+FFMC_MAX = 101.0
+
+
+class TargetHFISolution(NamedTuple):
+    """ Result of solving for the FFMC at which HFI reaches a target. """
+    # Lowest FFMC found with HFI >= target (FFMC_MAX if the target is never reached, FFMC_MIN if it's always exceeded)
+    ffmc: np.ndarray
+    # HFI at ffmc
+    hfi: np.ndarray
+    # Number of bisection steps taken
+    iterations: np.ndarray
+
+
+def hfi_for_ffmc(fuel_type, ffmc, bui, ws, fmc, cfb, cfl, pc, pdf, cc, cbh) -> np.ndarray:
+    """ Head Fire Intensity (kW/m) for an FFMC, holding everything else (including CFB) constant.
+
+    fuel_type: The Fire Behaviour Prediction FuelType
+    ffmc:      Fine Fuel Moisture Code
+    bui:       Buildup Index
+    ws:        Wind Speed (km/h)
+    fmc:       Foliar Moisture Content
+    cfb:       Crown Fraction Burned (0-1)
+    cfl:       Crown Fuel Load (kg/m^2)
+    pc:        Percent Conifer (%)
+    pdf:       Percent Dead Balsam Fir (%)
+    cc:        Degree of Curing (%)
+    cbh:       Crown Base Height (m)
+    """
+    isi = isi_calc(ffmc, ws)
+    sfc = sfc_calc(fuel_type, ffmc, bui, pc, 0.35)
+    ros = ros_calc(fuel_type, isi, bui, fmc, sfc, pc, pdf, cc, cbh)
+    tfc = tfc_calc(fuel_type, cfl, cfb, sfc, pc, pdf)
+    return fi_calc(tfc, ros)
+
+
+def max_bisection_iterations(ffmc_tolerance: float) -> int:
+    """ Upper bound on the number of bisection steps needed to narrow [FFMC_MIN, FFMC_MAX] down to ffmc_tolerance """
+    return max(0, math.ceil(math.log2((FFMC_MAX - FFMC_MIN) / ffmc_tolerance)))
+
+
+@_ignore_fp_errors
+def ffmc_for_target_hfi(fuel_type, bui, ws, fmc, cfb, cfl, target_hfi,
+                        pc=None, pdf=None, cc=None, cbh=None,
+                        hfi_tolerance: float = 0.01, ffmc_tolerance: float = 0.01) -> TargetHFISolution:
+    """ Find the lowest FFMC at which HFI reaches target_hfi, for any number of inputs at once.
+
+    HFI increases monotonically with FFMC, so the root is bracketed by [FFMC_MIN, FFMC_MAX] and found by
+    bisection. Each row stops once its HFI is within hfi_tolerance (relative) of the target, or once its
+    bracket is narrower than ffmc_tolerance, so no row takes more than max_bisection_iterations(ffmc_tolerance)
+    steps. The returned FFMC always has HFI >= target_hfi, except when even FFMC_MAX falls short of the target.
+    Rows with missing inputs give NaN.
+    """
+    inputs = np.broadcast_arrays(fuel_type_index(fuel_type), _as_float(bui), _as_float(ws), _as_float(fmc),
+                                 _as_float(cfb), _as_float(cfl), _as_float(target_hfi), _as_float(pc),
+                                 _as_float(pdf), _as_float(cc), _as_float(cbh))
+    shape = inputs[0].shape
+    index, bui, ws, fmc, cfb, cfl, target_hfi, pc, pdf, cc, cbh = [value.ravel() for value in inputs]
+
+    def hfi_at(ffmc: np.ndarray, rows) -> np.ndarray:
+        return hfi_for_ffmc(index[rows], ffmc, bui[rows], ws[rows], fmc[rows], cfb[rows], cfl[rows],
+                            pc[rows], pdf[rows], cc[rows], cbh[rows])
+
+    every_row = slice(None)
+    low = np.full(index.shape, FFMC_MIN)
+    high = np.full(index.shape, FFMC_MAX)
+    hfi_low = hfi_at(low, every_row)
+    hfi_high = hfi_at(high, every_row)
+    iterations = np.zeros(index.shape, dtype=int)
+
+    # Rows with HFI < target at FFMC_MAX never reach the target, so the answer is FFMC_MAX. Rows with
+    # HFI >= target at FFMC_MIN always exceed it, so the answer is FFMC_MIN.
+    always_exceeded = hfi_low >= target_hfi
+    high[always_exceeded] = FFMC_MIN
+    hfi_high[always_exceeded] = hfi_low[always_exceeded]
+    invalid = np.isnan(hfi_low) | np.isnan(hfi_high)
+    active = ~invalid & ~always_exceeded & (hfi_high >= target_hfi) & \
+        (np.abs(hfi_high - target_hfi) > hfi_tolerance * target_hfi)
+
+    rows = np.flatnonzero(active)
+    while rows.size > 0:
+        middle = (low[rows] + high[rows]) / 2
+        hfi_middle = hfi_at(middle, rows)
+        reached = hfi_middle >= target_hfi[rows]
+        high[rows[reached]] = middle[reached]
+        hfi_high[rows[reached]] = hfi_middle[reached]
+        low[rows[~reached]] = middle[~reached]
+        iterations[rows] += 1
+        converged = (np.abs(hfi_high[rows] - target_hfi[rows]) <= hfi_tolerance * target_hfi[rows]) | \
+            (high[rows] - low[rows] <= ffmc_tolerance)
+        rows = rows[~converged]
+
+    high[invalid] = np.nan
+    hfi_high[invalid] = np.nan
+    return TargetHFISolution(ffmc=high.reshape(shape), hfi=hfi_high.reshape(shape),
+                             iterations=iterations.reshape(shape))
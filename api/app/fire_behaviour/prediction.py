@@ -1,21 +1,28 @@
 """ Fire Behaviour Analysis Calculator Tool
 """
+import csv
 from enum import Enum
 import math
 import os
-from typing import List
+from typing import List, Optional, Sequence, Tuple
 import logging
-import pandas as pd
+import numpy as np
 from app.fire_behaviour.fuel_types import is_grass_fuel_type
 from app.schemas.fba_calc import FuelTypeEnum
 from app.schemas.observations import WeatherReading
 from app.schemas.fba_calc import CriticalHoursHFI
 from app.utils.singleton import Singleton
-from app.fire_behaviour import cffdrs, c7b
+from app.fire_behaviour import cffdrs, cffdrs_numpy, c7b
 from app.utils.time import convert_utc_to_pdt, get_julian_date_now
 
 logger = logging.getLogger(__name__)
 
+# Hours (24H clock) searched for the start of critical hours, latest first
+MORNING_HOURS_REVERSED = np.arange(12.0, 6.0, -1.0)
+AFTERNOON_HOURS_REVERSED = np.arange(16.0, 12.0, -1.0)
+# Hours searched for the end of critical hours, from 14:00 until 08:00 the next day
+EVENING_HOURS = np.arange(14.0, 32.0)
+
 
 class FireTypeEnum(str, Enum):
     """ Enumerator for the three different fire types. """
@@ -38,40 +45,37 @@ class DiurnalFFMCLookupTable():
     """ Singleton that loads diurnal FFMC lookup tables from Red Book once, for reuse.
     afternoon_overnight.csv is Table 4.1 from Red Book, 3rd ed., 2018;
     morning.csv is Table 4.2 from Red Book, 3rd ed., 2018.
+
+    The tables are compiled into dense arrays:
+    afternoon_ffmc[daily FFMC row, hour], keyed by afternoon_daily_ffmc and afternoon_hours;
+    morning_ffmc[previous day's daily FFMC row, hour, RH band], keyed by morning_prev_day_daily_ffmc,
+    morning_hours and morning_rh_bounds[hour, RH band] = (lower bound, upper bound).
     """
 
     def __init__(self):
         afternoon_filename = os.path.join(os.path.dirname(__file__),
                                           '../data/diurnal_ffmc_lookups/afternoon_overnight.csv')
-        with open(afternoon_filename, 'rb') as afternoon_file:
-            afternoon_df = pd.read_csv(afternoon_file)
-        afternoon_df.columns = afternoon_df.columns.astype(int)
-        afternoon_df.set_index(17, inplace=True)
+        with open(afternoon_filename, 'r', encoding='utf-8-sig') as afternoon_file:
+            afternoon_rows = list(csv.reader(afternoon_file))
+        hours = np.array(afternoon_rows[0], dtype=float)
+        values = np.array(afternoon_rows[1:], dtype=float)
+        # the table is keyed by the daily FFMC, which is the FFMC at 17:00
+        key_column = hours == 17
+        self.afternoon_daily_ffmc = values[:, key_column].ravel()
+        self.afternoon_hours = hours[~key_column]
+        self.afternoon_ffmc = values[:, ~key_column]
 
         morning_filename = os.path.join(os.path.dirname(__file__),
                                         '../data/diurnal_ffmc_lookups/morning.csv')
-        with open(morning_filename, 'rb') as morning_file:
-            morning_df = pd.read_csv(morning_file, header=[0, 1])
-        prev_days_daily_ffmc_keys = morning_df.iloc[:, 0].values
-        df_col_labels = morning_df.columns.values
-        hour_lookup_keys = ['']
-        rh_lookup_keys = ['']
-
-        for level_1, level_2 in df_col_labels:
-            if 'Unnamed' in str(level_2):
-                continue
-            if 'Unnamed' not in str(level_1):
-                hour = int(level_1)
-                hour_lookup_keys += 3 * [hour]
-            rh_lookup_keys += [level_2]
-
-        morning_df.set_index(prev_days_daily_ffmc_keys, inplace=True)
-        header = pd.MultiIndex.from_tuples(list(zip(hour_lookup_keys, rh_lookup_keys)), names=['hour', 'RH'])
-        morning_df.columns = header
-        morning_df.drop(columns=[('', '')], inplace=True)
-
-        self.afternoon_df = afternoon_df
-        self.morning_df = morning_df
+        with open(morning_filename, 'r', encoding='utf-8-sig') as morning_file:
+            hour_labels, rh_labels, *morning_rows = list(csv.reader(morning_file))
+        # the first column is the previous day's daily FFMC, followed by 3 RH bands for each hour
+        values = np.array(morning_rows, dtype=float)
+        self.morning_prev_day_daily_ffmc = values[:, 0]
+        self.morning_hours = np.array([label for label in hour_labels[1:] if label != ''], dtype=float)
+        self.morning_rh_bounds = np.array([label.split('-') for label in rh_labels[1:]],
+                                          dtype=float).reshape(len(self.morning_hours), 3, 2)
+        self.morning_ffmc = values[:, 1:].reshape(len(values), len(self.morning_hours), 3)
 
 
 def calculate_cfb(fuel_type: FuelTypeEnum, fmc: float, sfc: float, ros: float, cbh: float):
@@ -145,44 +149,54 @@ def get_approx_flame_length(head_fire_intensity: float):
     return math.sqrt(head_fire_intensity / 300)
 
 
-def get_afternoon_overnight_diurnal_ffmc(hour_of_interest: int, daily_ffmc: float):
+def _nearest(keys: np.ndarray, values) -> np.ndarray:
+    """ Index of the key nearest to each value.
+    Uses argsort (rather than argmin) so that values exactly between two keys resolve to the same key
+    that the original pandas lookup (index - value).argsort() picked.
+    """
+    return np.abs(np.asarray(values, dtype=float)[..., None] - keys).argsort(axis=-1)[..., 0]
+
+
+def get_afternoon_overnight_diurnal_ffmc(hour_of_interest, daily_ffmc):
     """ Returns the diurnal FFMC (an approximation) estimated for the given hour_of_interest,
     based on the daily_ffmc.
     Hour_of_interest should be expressed in PDT time zone, and can only be between the hours
     1300 and 0700 the next morning. Otherwise, must use different function.
+    Accepts arrays, e.g. hour_of_interest of shape (1, hours) and daily_ffmc of shape (stations, 1)
+    gives the diurnal curve for every station. NaN is returned where daily_ffmc is NaN.
     """
-
-    afternoon_df = DiurnalFFMCLookupTable.instance().afternoon_df
-
-    # find index (solar noon FFMC) of afternoon_df that is nearest to solar_noon_ffmc value
-    row = afternoon_df.iloc[abs((afternoon_df.index - daily_ffmc)).argsort()[:1]]
-    if hour_of_interest >= 23.5:
-        hour_of_interest = hour_of_interest - 24.0
-    # determine minimum absolute value difference between hour_of_interest and column labels
-    min_abs_diff = abs(row.columns - hour_of_interest).sort_values()[0]
-    row_index = row.columns.get_loc(min_abs_diff + hour_of_interest)
-    return row.iloc[:, row_index].values[0]
-
-
-def get_morning_diurnal_ffmc(hour_of_interest: int, prev_day_daily_ffmc: float, hourly_rh: float):
+    table = DiurnalFFMCLookupTable.instance()
+    hour_of_interest = np.asarray(hour_of_interest, dtype=float)
+    hour_of_interest = np.where(hour_of_interest >= 23.5, hour_of_interest - 24.0, hour_of_interest)
+    daily_ffmc = np.asarray(daily_ffmc, dtype=float)
+    # find the row whose daily FFMC is nearest to daily_ffmc
+    row = _nearest(table.afternoon_daily_ffmc, daily_ffmc)
+    # find the nearest hour, going with the later hour when two are equally near
+    later_first = np.argsort(-table.afternoon_hours, kind='stable')
+    column = later_first[np.abs(hour_of_interest[..., None] - table.afternoon_hours[later_first]).argmin(axis=-1)]
+    return np.where(np.isnan(daily_ffmc), np.nan, table.afternoon_ffmc[row, column])[()]
+
+
+def get_morning_diurnal_ffmc(hour_of_interest, prev_day_daily_ffmc, hourly_rh):
     """ Returns the diurnal FFMC (an approximation) estimated for the given hour_of_interest,
     based on the estimated RH value for the hour_of_interest.
+    Accepts arrays (broadcast against each other). NaN is returned where the hour isn't in the
+    table, hourly_rh isn't in any of the RH bands, or prev_day_daily_ffmc is NaN.
     """
-    morning_df = DiurnalFFMCLookupTable.instance().morning_df
-
-    # find index (previous day's daily FFMC) of morning_df that is nearest to prev_day_daily_ffmc
-    row = morning_df.iloc[abs((morning_df.index - prev_day_daily_ffmc)).argsort()[:1]]
-
-    # the RH column labels are strings expressing ranges. Must extract lower and upper bounds
-    for range_rh_value in row[hour_of_interest].columns:
-        bounds = str(range_rh_value).split('-')
-        lower_bound = int(bounds[0])
-        upper_bound = int(bounds[1])
-        if lower_bound <= hourly_rh <= upper_bound:
-            return row[hour_of_interest][range_rh_value].values[0]
-
-    # we should never actually reach this return statement
-    return None
+    table = DiurnalFFMCLookupTable.instance()
+    hour_of_interest, prev_day_daily_ffmc, hourly_rh = np.broadcast_arrays(
+        np.asarray(hour_of_interest, dtype=float), np.asarray(prev_day_daily_ffmc, dtype=float),
+        np.asarray(hourly_rh, dtype=float))
+    # find the row whose previous day's daily FFMC is nearest to prev_day_daily_ffmc
+    row = _nearest(table.morning_prev_day_daily_ffmc, prev_day_daily_ffmc)
+    is_hour = hour_of_interest[..., None] == table.morning_hours
+    column = is_hour.argmax(axis=-1)
+    # the first RH band (lower_bound <= RH <= upper_bound) that hourly_rh falls in
+    bounds = table.morning_rh_bounds[column]
+    in_band = (bounds[..., 0] <= hourly_rh[..., None]) & (hourly_rh[..., None] <= bounds[..., 1])
+    band = in_band.argmax(axis=-1)
+    found = is_hour.any(axis=-1) & in_band.any(axis=-1) & ~np.isnan(prev_day_daily_ffmc)
+    return np.where(found, table.morning_ffmc[row, column, band], np.nan)[()]
 
 
 def get_critical_hours_start(critical_ffmc: float, daily_ffmc: float,
@@ -202,23 +216,20 @@ def get_critical_hours_start(critical_ffmc: float, daily_ffmc: float,
     logger.debug('Daily FFMC %s >= critical FFMC %s', daily_ffmc, critical_ffmc)
     solar_noon_diurnal_ffmc = get_afternoon_overnight_diurnal_ffmc(13, daily_ffmc)
     if solar_noon_diurnal_ffmc >= critical_ffmc:
-        clock_time = 12.0
-        hourly_rh = last_observed_morning_rh_values[clock_time]
-        while get_morning_diurnal_ffmc(clock_time, prev_day_daily_ffmc, hourly_rh) >= critical_ffmc:
-            clock_time -= 1.0
-            if clock_time < 7.0:
-                break
-            hourly_rh = last_observed_morning_rh_values[clock_time]
-        # add back the hour that caused FFMC to drop below critical_ffmc
-        clock_time += 1.0
-        return clock_time
-    # else the start of critical hours is sometime in the afternoon (between 12:00 and 17:00)
-    clock_time = 16.0
-    while get_afternoon_overnight_diurnal_ffmc(clock_time, daily_ffmc) >= critical_ffmc:
-        clock_time -= 1.0
+        # work back from 12:00 to 07:00, looking for the hour at which FFMC drops below critical_ffmc
+        hourly_rh = np.array([last_observed_morning_rh_values[hour] for hour in MORNING_HOURS_REVERSED],
+                             dtype=float)
+        curve = get_morning_diurnal_ffmc(MORNING_HOURS_REVERSED, prev_day_daily_ffmc, hourly_rh)
+        clock_time = _first_hour_below(MORNING_HOURS_REVERSED, curve, critical_ffmc)
+        if clock_time is None:
+            # FFMC is above critical_ffmc all morning
+            return 7.0
+    else:
+        # the start of critical hours is sometime in the afternoon (between 12:00 and 17:00)
+        curve = get_afternoon_overnight_diurnal_ffmc(AFTERNOON_HOURS_REVERSED, daily_ffmc)
+        clock_time = _first_hour_below(AFTERNOON_HOURS_REVERSED, curve, critical_ffmc)
     # add back the hour that caused FFMC to drop below critical_ffmc
-    clock_time += 1.0
-    return clock_time
+    return clock_time + 1.0
 
 
 def get_critical_hours_end(critical_ffmc: float, solar_noon_ffmc: float, critical_hour_start: float):
@@ -231,14 +242,16 @@ def get_critical_hours_end(critical_ffmc: float, solar_noon_ffmc: float, critica
     if critical_hour_start < 13:
         # if critical_hour_start is in the morning, we know that based on the diurnal curve,
         # the critical hour is going to extend into the afternoon, so set clock_time to then
-        clock_time = 14.0
+        first_hour = 14.0
     else:
-        clock_time = critical_hour_start + 1.0    # increase time in increments of 1 hours
-
-    while get_afternoon_overnight_diurnal_ffmc(clock_time, solar_noon_ffmc) >= critical_ffmc:
-        clock_time += 1.0
-        if clock_time >= 32:  # break if clock_time is now 08:00 of the next day
-            break
+        first_hour = critical_hour_start + 1.0    # increase time in increments of 1 hours
+
+    # look until 08:00 of the next day
+    hours = np.arange(first_hour, 32.0)
+    curve = get_afternoon_overnight_diurnal_ffmc(hours, solar_noon_ffmc)
+    clock_time = _first_hour_below(hours, curve, critical_ffmc)
+    if clock_time is None:
+        clock_time = 32.0
     # subtract the hour that caused FFMC to drop below critical_ffmc
     clock_time -= 1.0
     if clock_time >= 24.0:
@@ -246,6 +259,14 @@ def get_critical_hours_end(critical_ffmc: float, solar_noon_ffmc: float, critica
     return clock_time
 
 
+def _first_hour_below(hours: np.ndarray, curve: np.ndarray, critical_ffmc: float) -> Optional[float]:
+    """ Returns the first of hours at which the diurnal FFMC curve is below critical_ffmc, or None """
+    below = ~(curve >= critical_ffmc)
+    if not below.any():
+        return None
+    return float(hours[below.argmax()])
+
+
 def get_critical_hours(
         target_hfi: int, fuel_type: FuelTypeEnum, percentage_conifer: float,
         percentage_dead_balsam_fir: float, bui: float,
@@ -290,6 +311,66 @@ def get_critical_hours(
     return CriticalHoursHFI(start=critical_hours_start, end=critical_hours_end)
 
 
+def get_critical_hours_batch(
+        target_hfi, fuel_type, percentage_conifer, percentage_dead_balsam_fir, bui,
+        grass_cure, crown_base_height, daily_ffmc, fmc, cfb, cfl,
+        wind_speed, prev_daily_ffmc, morning_rh) -> Tuple[np.ndarray, np.ndarray]:
+    """ Vectorized get_critical_hours, for many station/fuel type rows at once.
+    All arguments are 1-D arrays (or scalars) of the same length, except morning_rh, which is
+    the last observed RH at each of MORNING_HOURS_REVERSED (one row per station/fuel type row).
+    Returns arrays of critical hours start and end, which are NaN where there are no critical hours
+    (or they can't be calculated).
+    """
+    solution = cffdrs_numpy.ffmc_for_target_hfi(
+        fuel_type, bui, wind_speed, fmc, cfb, cfl, target_hfi,
+        percentage_conifer, percentage_dead_balsam_fir, grass_cure, crown_base_height)
+    critical_ffmc = solution.ffmc
+    daily_ffmc = np.asarray(daily_ffmc, dtype=float)
+    prev_daily_ffmc = np.asarray(prev_daily_ffmc, dtype=float)
+    target_hfi = np.asarray(target_hfi, dtype=float)
+    logger.debug('Solved %s critical FFMCs in at most %s iterations', critical_ffmc.size,
+                 solution.iterations.max(initial=0))
+
+    # Scenario 1: FFMC of 101 can't reach target_hfi, so no critical hours.
+    no_critical_hours = (critical_ffmc >= 100.9) & (solution.hfi < target_hfi)
+    # Scenario 2: target_hfi is reached even with FFMC of 0, so all hours are critical.
+    all_hours_critical = (critical_ffmc == 0.0) & (solution.hfi >= target_hfi)
+    # Scenario 3: hours of the day with diurnally adjusted FFMC >= critical_ffmc.
+    # Daily FFMC represents peak burning, so if it's below critical FFMC there are no critical hours.
+    reaches_critical = ~no_critical_hours & ~all_hours_critical & (daily_ffmc >= critical_ffmc)
+
+    # The start of critical hours is the hour after the last hour before solar noon that is below
+    # critical FFMC. If FFMC is already critical at solar noon, that is in the morning (working back
+    # from 12:00 to 07:00), otherwise it's in the afternoon (working back from 16:00).
+    solar_noon_ffmc = get_afternoon_overnight_diurnal_ffmc(13, daily_ffmc)
+    morning_curve = get_morning_diurnal_ffmc(MORNING_HOURS_REVERSED, prev_daily_ffmc[:, None], morning_rh)
+    morning_start = _hours_after_first_below(MORNING_HOURS_REVERSED, morning_curve, critical_ffmc, 1.0, 7.0)
+    afternoon_curve = get_afternoon_overnight_diurnal_ffmc(AFTERNOON_HOURS_REVERSED, daily_ffmc[:, None])
+    afternoon_start = _hours_after_first_below(AFTERNOON_HOURS_REVERSED, afternoon_curve, critical_ffmc, 1.0,
+                                               np.nan)
+    start = np.where(solar_noon_ffmc >= critical_ffmc, morning_start, afternoon_start)
+
+    # The end of critical hours is the hour before FFMC drops below critical FFMC, looking from
+    # 14:00 (or the hour after start, if start is in the afternoon) until 08:00 of the next day.
+    first_hour = np.where(start < 13, 14.0, start + 1.0)
+    end_curve = get_afternoon_overnight_diurnal_ffmc(EVENING_HOURS, daily_ffmc[:, None])
+    end_curve = np.where(EVENING_HOURS >= first_hour[:, None], end_curve, np.inf)
+    end = _hours_after_first_below(EVENING_HOURS, end_curve, critical_ffmc, -1.0, 31.0)
+    end = np.where(end >= 24.0, end - 24.0, end)
+
+    start = np.where(all_hours_critical, 13.0, np.where(reaches_critical, start, np.nan))
+    end = np.where(all_hours_critical, 7.0, np.where(reaches_critical, end, np.nan))
+    return start, end
+
+
+def _hours_after_first_below(hours: np.ndarray, curves: np.ndarray, critical_ffmc: np.ndarray,
+                             offset: float, default: float) -> np.ndarray:
+    """ For each row of curves (diurnal FFMC at hours), the first hour at which FFMC is below
+    critical_ffmc plus offset, or default if FFMC never drops below critical_ffmc. """
+    below = ~(curves >= critical_ffmc[:, None])
+    return np.where(below.any(axis=-1), hours[below.argmax(axis=-1)] + offset, default)
+
+
 def build_hourly_rh_dict(hourly_observations: List[WeatherReading]):
     """ Builds a dictionary of the most recently observed RH values between 0700 and 1200 H
     for a station. Returns the dictionary.
@@ -503,3 +584,93 @@ def calculate_fire_behaviour_prediction(latitude: float,
         pdf=pdf,
         cbh=cbh,
         cfl=cfl)
+
+
+# Fuel types without a crown to burn - see calculate_cfb.
+_NO_CROWN_FUEL_TYPES = ('D1', 'O1A', 'O1B', 'S1', 'S2', 'S3')
+_FIRE_TYPES = (FireTypeEnum.SURFACE, FireTypeEnum.INTERMITTENT_CROWN, FireTypeEnum.CONTINUOUS_CROWN)
+
+
+def calculate_fire_behaviour_predictions(
+        latitude: Sequence[float],
+        longitude: Sequence[float],
+        elevation: Sequence[float],
+        fuel_type: Sequence[FuelTypeEnum],
+        bui: Sequence[Optional[float]],
+        ffmc: Sequence[Optional[float]],
+        wind_speed: Sequence[Optional[float]],
+        cc: Sequence[Optional[float]],
+        pc: Sequence[Optional[float]],
+        isi: Sequence[Optional[float]],
+        pdf: Sequence[Optional[float]],
+        cbh: Sequence[Optional[float]],
+        cfl: Sequence[Optional[float]]) -> List[Optional[FireBehaviourPrediction]]:
+    """ Vectorized calculate_fire_behaviour_prediction, for many rows (e.g. station x day) at once.
+
+    Returns a prediction for each row, or None where calculate_fire_behaviour_prediction would have
+    raised FireBehaviourPredictionInputError or CFFDRSException. C7B rows, and all rows when using the
+    R backend, are calculated one at a time with calculate_fire_behaviour_prediction.
+    """
+    count = len(fuel_type)
+    predictions: List[Optional[FireBehaviourPrediction]] = [None] * count
+
+    def _scalar(row: int):
+        try:
+            predictions[row] = calculate_fire_behaviour_prediction(
+                latitude=latitude[row], longitude=longitude[row], elevation=elevation[row],
+                fuel_type=fuel_type[row], bui=bui[row], ffmc=ffmc[row], wind_speed=wind_speed[row], cc=cc[row],
+                pc=pc[row], isi=isi[row], pdf=pdf[row], cbh=cbh[row], cfl=cfl[row])
+        except (FireBehaviourPredictionInputError, cffdrs.CFFDRSException) as error:
+            logger.info('Error calculating fire behaviour prediction: %s', error)
+
+    if cffdrs.use_r_backend():
+        for row in range(count):
+            _scalar(row)
+        return predictions
+    is_c7b = np.array([value == FuelTypeEnum.C7B for value in fuel_type], dtype=bool)
+    for row in np.flatnonzero(is_c7b):
+        _scalar(row)
+    if is_c7b.all():
+        return predictions
+
+    def _floats(values) -> np.ndarray:
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+
+    index = cffdrs_numpy.fuel_type_index(np.array([FuelTypeEnum(value).value for value in fuel_type], dtype=object))
+    bui, ffmc, wind_speed, cc, pc, isi, pdf, cbh, cfl = (
+        _floats(values) for values in (bui, ffmc, wind_speed, cc, pc, isi, pdf, cbh, cfl))
+    grass = np.array([is_grass_fuel_type(value) for value in fuel_type], dtype=bool)
+    # The same checks as calculate_fire_behaviour_prediction (and the cffdrs functions it calls)
+    failed = np.isnan(wind_speed) | np.isnan(bui) | np.isnan(ffmc) | (np.isnan(cc) & grass) | np.isnan(isi)
+
+    # FMCcalc expects longitude to always be a positive number.
+    fmc = cffdrs_numpy.fmc_calc(_floats(latitude), np.abs(_floats(longitude)), _floats(elevation),
+                                get_julian_date_now(), 0)
+    sfc = cffdrs_numpy.sfc_calc(index, ffmc, bui, pc, 0.35)
+    ros = cffdrs_numpy.ros_calc(index, isi, bui, fmc, sfc, pc, pdf, cc, cbh)
+    no_crown = np.isin(index, [cffdrs_numpy.FUEL_TYPE_INDEX[value] for value in _NO_CROWN_FUEL_TYPES])
+    cfb = np.where(no_crown, 0.0, cffdrs_numpy.cfb_calc(index, fmc, sfc, ros, cbh))
+    tfc = cffdrs_numpy.tfc_calc(index, cfl, cfb, sfc, pc, pdf)
+    hfi = cffdrs_numpy.fi_calc(tfc, ros)
+    lb_ratio = cffdrs_numpy.lb_calc(index, wind_speed)
+    # Without slope, the net effective wind speed is the wind speed.
+    bros = cffdrs_numpy.bros_calc(index, ffmc, bui, wind_speed, fmc, sfc, pc, pdf, cc, cbh)
+    fire_spread_distance = cffdrs_numpy.distt_calc(index, ros + bros, 60, cfb)
+    length_to_breadth_at_time = cffdrs_numpy.lbt_calc(index, lb_ratio, 60, cfb)
+    with np.errstate(all='ignore'):
+        sixty_minute_fire_size = math.pi / (4.0 * length_to_breadth_at_time) * fire_spread_distance ** 2 / 10000.0
+    for value in (fmc, sfc, ros, cfb, tfc, hfi, lb_ratio, bros, fire_spread_distance, length_to_breadth_at_time):
+        failed |= np.isnan(value)
+
+    intensity_group = np.digitize(hfi, [500, 1000, 2000, 4000]) + 1
+    # Indices into _FIRE_TYPES - see get_fire_type.
+    fire_type = np.digitize(cfb, [0.1, 0.9])
+    fire_type[index == cffdrs_numpy.FUEL_TYPE_INDEX['D1']] = 0
+
+    for row in np.flatnonzero(~failed & ~is_c7b):
+        predictions[row] = FireBehaviourPrediction(ros=float(ros[row]),
+                                                   hfi=float(hfi[row]),
+                                                   intensity_group=int(intensity_group[row]),
+                                                   sixty_minute_fire_size=float(sixty_minute_fire_size[row]),
+                                                   fire_type=_FIRE_TYPES[fire_type[row]])
+    return predictions
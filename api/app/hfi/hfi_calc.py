@@ -1,17 +1,17 @@
 """ HFI calculation logic """
+import asyncio
 import math
 import logging
-from typing import Optional, List, Dict, Set, Tuple
+from collections import defaultdict
+from typing import Awaitable, Callable, Optional, List, Dict, Set, Tuple, TypeVar
 from datetime import date, datetime, timedelta, timezone
 from statistics import mean
 from aiohttp.client import ClientSession
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import app
-from app.db.database import get_read_session_scope
+from app.db.database import get_async_read_session_scope
 from app.db.models.hfi_calc import FuelType as FuelTypeModel
-from app.fire_behaviour.cffdrs import CFFDRSException
-from app.fire_behaviour.prediction import (
-    FireBehaviourPredictionInputError, calculate_fire_behaviour_prediction, FireBehaviourPrediction)
+from app.fire_behaviour.prediction import calculate_fire_behaviour_predictions, FireBehaviourPrediction
 from app.schemas.hfi_calc import (DailyResult, DateRange,
                                   FireStartRange, HFIResultRequest,
                                   PlanningAreaResult,
@@ -33,42 +33,50 @@ from app.db.crud.hfi_calc import (get_fire_weather_stations,
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+
+async def run_in_read_session(query: Callable[..., Awaitable[T]], *args) -> T:
+    """ Run a query in a read session of its own. A session runs one query at a time, so queries that don't
+    depend on each other each get their own session, to run at the same time. """
+    async with get_async_read_session_scope() as orm_session:
+        return await query(orm_session, *args)
 
-def generate_station_daily(raw_daily: dict,
-                           station: WFWXWeatherStation,
-                           fuel_type: FuelTypeModel) -> StationDaily:
-    """ Transform from the raw daily json object returned by wf1, to our daily object.
-    """
-    pc = fuel_type.percentage_conifer
-    pdf = fuel_type.percentage_dead_fir
-    # we use the fuel type lookup to get default values.
-    cbh = FUEL_TYPE_DEFAULTS[fuel_type.fuel_type_code]["CBH"]
-    cfl = FUEL_TYPE_DEFAULTS[fuel_type.fuel_type_code]["CFL"]
-    isi = raw_daily.get('initialSpreadIndex', None)
-    bui = raw_daily.get('buildUpIndex', None)
-    ffmc = raw_daily.get('fineFuelMoistureCode', None)
-    cc = raw_daily.get('grasslandCuring', None)
-    wind_speed = raw_daily.get('windSpeed', None)
-
-    try:
-        fire_behaviour_prediction = calculate_fire_behaviour_prediction(
-            latitude=station.lat,
-            longitude=station.long,
-            elevation=station.elevation,
-            fuel_type=FuelTypeEnum[fuel_type.fuel_type_code],
-            bui=bui,
-            ffmc=ffmc,
-            wind_speed=wind_speed,
-            cc=cc,
-            pc=pc,
-            isi=isi,
-            pdf=pdf,
-            cbh=cbh,
-            cfl=cfl)
-    except (FireBehaviourPredictionInputError, CFFDRSException) as error:
-        logger.info("Error calculating fire behaviour prediction for station %s : %s", station.code, error)
-        fire_behaviour_prediction = FireBehaviourPrediction(None, None, None, None, None)
 
+def generate_station_dailies(
+        rows: List[Tuple[dict, WFWXWeatherStation, FuelTypeModel]]) -> List[StationDaily]:
+    """ Transform from the raw daily json objects returned by wf1, to our daily objects, calculating the fire
+    behaviour for all the (raw daily, station, fuel type) rows at once.
+    """
+    fuel_type_codes = [FuelTypeEnum[fuel_type.fuel_type_code] for _, _, fuel_type in rows]
+    fire_behaviour_predictions = calculate_fire_behaviour_predictions(
+        latitude=[station.lat for _, station, _ in rows],
+        longitude=[station.long for _, station, _ in rows],
+        elevation=[station.elevation for _, station, _ in rows],
+        fuel_type=fuel_type_codes,
+        bui=[raw_daily.get('buildUpIndex', None) for raw_daily, _, _ in rows],
+        ffmc=[raw_daily.get('fineFuelMoistureCode', None) for raw_daily, _, _ in rows],
+        wind_speed=[raw_daily.get('windSpeed', None) for raw_daily, _, _ in rows],
+        cc=[raw_daily.get('grasslandCuring', None) for raw_daily, _, _ in rows],
+        pc=[fuel_type.percentage_conifer for _, _, fuel_type in rows],
+        isi=[raw_daily.get('initialSpreadIndex', None) for raw_daily, _, _ in rows],
+        pdf=[fuel_type.percentage_dead_fir for _, _, fuel_type in rows],
+        # we use the fuel type lookup to get default values.
+        cbh=[FUEL_TYPE_DEFAULTS[fuel_type.fuel_type_code]["CBH"] for _, _, fuel_type in rows],
+        cfl=[FUEL_TYPE_DEFAULTS[fuel_type.fuel_type_code]["CFL"] for _, _, fuel_type in rows])
+
+    station_dailies = []
+    for (raw_daily, station, _), fire_behaviour_prediction in zip(rows, fire_behaviour_predictions):
+        if fire_behaviour_prediction is None:
+            logger.info("Error calculating fire behaviour prediction for station %s", station.code)
+            fire_behaviour_prediction = FireBehaviourPrediction(None, None, None, None, None)
+        station_dailies.append(_build_station_daily(raw_daily, station, fire_behaviour_prediction))
+    return station_dailies
+
+
+def _build_station_daily(raw_daily: dict,
+                         station: WFWXWeatherStation,
+                         fire_behaviour_prediction: FireBehaviourPrediction) -> StationDaily:
     return StationDaily(
         code=station.code,
         date=datetime.fromtimestamp(raw_daily['weatherTimestamp'] / 1000, tz=timezone.utc),
@@ -79,7 +87,7 @@ def generate_station_daily(raw_daily: dict,
         wind_direction=raw_daily.get('windDirection', None),
         precipitation=raw_daily.get('precipitation', None),
         grass_cure_percentage=raw_daily.get('grasslandCuring', None),
-        ffmc=ffmc,
+        ffmc=raw_daily.get('fineFuelMoistureCode', None),
         dmc=raw_daily.get('duffMoistureCode', None),
         dc=raw_daily.get('droughtCode', None),
         fwi=raw_daily.get('fireWeatherIndex', None),
@@ -90,8 +98,8 @@ def generate_station_daily(raw_daily: dict,
         # You can see current stations/rating on this page here:
         # https://wfapps.nrs.gov.bc.ca/pub/wfwx-danger-summary-war/dangerSummary
         danger_class=raw_daily.get('dangerForest', None),
-        isi=isi,
-        bui=bui,
+        isi=raw_daily.get('initialSpreadIndex', None),
+        bui=raw_daily.get('buildUpIndex', None),
         rate_of_spread=fire_behaviour_prediction.ros,
         hfi=fire_behaviour_prediction.hfi,
         observation_valid=raw_daily.get('observationValidInd', None),
@@ -105,91 +113,93 @@ def generate_station_daily(raw_daily: dict,
     )
 
 
-def get_prep_day_dailies(dailies_date: date, area_dailies: List[StationDaily]) -> List[StationDaily]:
-    """ Return all the dailies (that's noon, or 20 hours UTC) for a given date """
-    dailies_date_time = get_hour_20_from_date(dailies_date)
-    return list(filter(lambda daily: (daily.date == dailies_date_time), area_dailies))
+def group_dailies_by_date(area_dailies: List[StationDaily]) -> Dict[datetime, List[StationDaily]]:
+    """ Group dailies by their date (noon, or 20 hours UTC) """
+    dailies_by_date: Dict[datetime, List[StationDaily]] = defaultdict(list)
+    for daily in area_dailies:
+        dailies_by_date[daily.date].append(daily)
+    return dailies_by_date
 
 
 async def hydrate_fire_centres():
     """Get detailed fire_centres from db and WFWX"""
 
-    with get_read_session_scope() as session:
+    async with get_async_read_session_scope() as session:
         # Fetch all fire weather stations from the database.
-        station_query = get_fire_weather_stations(session)
-        # Prepare a dictionary for storing station info in.
-        station_info_dict = {}
-        # Prepare empty data structures to be used in HFIWeatherStationsResponse
-        fire_centres_list = []
-        planning_areas_dict = {}
-        fire_centres_dict = {}
-
-        # Iterate through all the database records, collecting all the data we need.
-        for (station_record, fuel_type_record, planning_area_record, fire_centre_record) in station_query:
-            station_info = {
-                'fuel_type': FuelTypeSchema(
-                    id=fuel_type_record.id,
-                    abbrev=fuel_type_record.abbrev,
-                    fuel_type_code=fuel_type_record.fuel_type_code,
-                    description=fuel_type_record.description,
-                    percentage_conifer=fuel_type_record.percentage_conifer,
-                    percentage_dead_fir=fuel_type_record.percentage_dead_fir),
-                'order_of_appearance_in_planning_area_list': station_record.order_of_appearance_in_planning_area_list,
-                'planning_area': planning_area_record,
-                'fire_centre': fire_centre_record
+        station_query = await get_fire_weather_stations(session)
+    # Prepare a dictionary for storing station info in.
+    station_info_dict = {}
+    # Prepare empty data structures to be used in HFIWeatherStationsResponse
+    fire_centres_list = []
+    planning_areas_dict = {}
+    fire_centres_dict = {}
+
+    # Iterate through all the database records, collecting all the data we need.
+    for (station_record, fuel_type_record, planning_area_record, fire_centre_record) in station_query:
+        station_info = {
+            'fuel_type': FuelTypeSchema(
+                id=fuel_type_record.id,
+                abbrev=fuel_type_record.abbrev,
+                fuel_type_code=fuel_type_record.fuel_type_code,
+                description=fuel_type_record.description,
+                percentage_conifer=fuel_type_record.percentage_conifer,
+                percentage_dead_fir=fuel_type_record.percentage_dead_fir),
+            'order_of_appearance_in_planning_area_list': station_record.order_of_appearance_in_planning_area_list,
+            'planning_area': planning_area_record,
+            'fire_centre': fire_centre_record
+        }
+        if station_info_dict.get(station_record.station_code) is None:
+            station_info_dict[station_record.station_code] = [station_info]
+        else:
+            station_info_dict[station_record.station_code].append(station_info)
+
+        if fire_centres_dict.get(fire_centre_record.id) is None:
+            fire_centres_dict[fire_centre_record.id] = {
+                'fire_centre_record': fire_centre_record,
+                'planning_area_records': [planning_area_record],
+                'planning_area_objects': []
+            }
+        else:
+            fire_centres_dict.get(fire_centre_record.id)[
+                'planning_area_records'].append(planning_area_record)
+            fire_centres_dict[fire_centre_record.id]['planning_area_records'] = list(
+                set(fire_centres_dict.get(fire_centre_record.id).get('planning_area_records')))
+
+        if planning_areas_dict.get(planning_area_record.id) is None:
+            planning_areas_dict[planning_area_record.id] = {
+                'planning_area_record': planning_area_record,
+                'order_of_appearance_in_list': planning_area_record.order_of_appearance_in_list,
+                'station_codes': [station_record.station_code],
+                'station_objects': []
             }
-            if station_info_dict.get(station_record.station_code) is None:
-                station_info_dict[station_record.station_code] = [station_info]
-            else:
-                station_info_dict[station_record.station_code].append(station_info)
-
-            if fire_centres_dict.get(fire_centre_record.id) is None:
-                fire_centres_dict[fire_centre_record.id] = {
-                    'fire_centre_record': fire_centre_record,
-                    'planning_area_records': [planning_area_record],
-                    'planning_area_objects': []
-                }
-            else:
-                fire_centres_dict.get(fire_centre_record.id)[
-                    'planning_area_records'].append(planning_area_record)
-                fire_centres_dict[fire_centre_record.id]['planning_area_records'] = list(
-                    set(fire_centres_dict.get(fire_centre_record.id).get('planning_area_records')))
-
-            if planning_areas_dict.get(planning_area_record.id) is None:
-                planning_areas_dict[planning_area_record.id] = {
-                    'planning_area_record': planning_area_record,
-                    'order_of_appearance_in_list': planning_area_record.order_of_appearance_in_list,
-                    'station_codes': [station_record.station_code],
-                    'station_objects': []
-                }
-            else:
-                planning_areas_dict[planning_area_record.id]['station_codes'].append(
-                    station_record.station_code)
-
-        # We're still missing some data that we need from wfwx, so give it the list of stations
-        wfwx_stations_data = await get_stations_by_codes(list(station_info_dict.keys()))
-        # Iterate through all the stations from wildfire one.
-
-        for wfwx_station in wfwx_stations_data:
-            # Combine everything.
-            station_properties = WeatherStationProperties(
-                name=wfwx_station.name,
-                elevation=wfwx_station.elevation,
-                wfwx_station_uuid=wfwx_station.wfwx_station_uuid)
-
-            for station_info in station_info_dict[wfwx_station.code]:
-                weather_station = WeatherStation(code=wfwx_station.code,
-                                                 order_of_appearance_in_planning_area_list=station_info[
-                                                     'order_of_appearance_in_planning_area_list'],
-                                                 station_props=station_properties)
-                station_info['station'] = weather_station
-                for planning_station in station_info_dict[wfwx_station.code]:
-                    existing_station_codes = [
-                        s.code for s in planning_areas_dict[planning_station['planning_area'].id]['station_objects']]
-
-                    if weather_station.code not in existing_station_codes:
-                        planning_areas_dict[planning_station['planning_area'].id]['station_objects'].append(
-                            weather_station)
+        else:
+            planning_areas_dict[planning_area_record.id]['station_codes'].append(
+                station_record.station_code)
+
+    # We're still missing some data that we need from wfwx, so give it the list of stations
+    wfwx_stations_data = await get_stations_by_codes(list(station_info_dict.keys()))
+    # Iterate through all the stations from wildfire one.
+
+    for wfwx_station in wfwx_stations_data:
+        # Combine everything.
+        station_properties = WeatherStationProperties(
+            name=wfwx_station.name,
+            elevation=wfwx_station.elevation,
+            wfwx_station_uuid=wfwx_station.wfwx_station_uuid)
+
+        for station_info in station_info_dict[wfwx_station.code]:
+            weather_station = WeatherStation(code=wfwx_station.code,
+                                             order_of_appearance_in_planning_area_list=station_info[
+                                                 'order_of_appearance_in_planning_area_list'],
+                                             station_props=station_properties)
+            station_info['station'] = weather_station
+            for planning_station in station_info_dict[wfwx_station.code]:
+                existing_station_codes = [
+                    s.code for s in planning_areas_dict[planning_station['planning_area'].id]['station_objects']]
+
+                if weather_station.code not in existing_station_codes:
+                    planning_areas_dict[planning_station['planning_area'].id]['station_objects'].append(
+                        weather_station)
 
     # create PlanningArea objects containing all corresponding WeatherStation objects
     for key, val in planning_areas_dict.items():
@@ -214,7 +224,6 @@ async def hydrate_fire_centres():
 
 
 async def calculate_latest_hfi_results(
-        orm_session: Session,
         request: HFIResultRequest,
         fire_centre_fire_start_ranges: List[FireStartRange]) -> Tuple[List[PlanningAreaResult], DateRange]:
     """Set up time range and fire centre data for calculating HFI results"""
@@ -238,16 +247,17 @@ async def calculate_latest_hfi_results(
         for station in fire_centre_stations:
             fire_centre_station_code_ids.add(station.station_code)
 
-        fire_start_lookup = build_fire_start_prep_level_lookup(orm_session)
-
-        wfwx_stations: List[WFWXWeatherStation] = await get_wfwx_stations_from_station_codes(
-            session, header, list(fire_centre_station_code_ids))
+        # The lookups from the database don't depend on the stations from wfwx, so they're loaded at the same time.
+        wfwx_stations: List[WFWXWeatherStation]
+        fire_start_lookup, fuel_type_lookup, wfwx_stations = await asyncio.gather(
+            run_in_read_session(build_fire_start_prep_level_lookup),
+            run_in_read_session(generate_fuel_type_lookup),
+            get_wfwx_stations_from_station_codes(session, header, list(fire_centre_station_code_ids)))
 
         wfwx_station_ids = [wfwx_station.wfwx_id for wfwx_station in wfwx_stations]
         raw_dailies_generator = await get_raw_dailies_in_range_generator(
             session, header, wfwx_station_ids, start_timestamp, end_timestamp)
         raw_dailies: List[dict] = [raw_daily async for raw_daily in raw_dailies_generator]
-        fuel_type_lookup: Dict[int, FuelTypeModel] = generate_fuel_type_lookup(orm_session)
 
         results = calculate_hfi_results(fuel_type_lookup,
                                         fire_centre_fire_start_ranges,
@@ -261,9 +271,9 @@ async def calculate_latest_hfi_results(
         return results, valid_date_range
 
 
-def build_fire_start_prep_level_lookup(orm_session) -> Dict[int, Dict[int, int]]:
+async def build_fire_start_prep_level_lookup(orm_session: AsyncSession) -> Dict[int, Dict[int, int]]:
     """ Build a mapping from fire start range id to mean intensity group to prep level """
-    fire_start_lookup_records = get_fire_start_lookup(orm_session)
+    fire_start_lookup_records = await get_fire_start_lookup(orm_session)
     fire_start_lookup = {}
     for lookup in fire_start_lookup_records:
         if lookup.fire_start_range_id not in fire_start_lookup:
@@ -272,14 +282,14 @@ def build_fire_start_prep_level_lookup(orm_session) -> Dict[int, Dict[int, int]]
     return fire_start_lookup
 
 
-def load_fire_start_ranges(orm_session, fire_centre_id: int) -> List[FireStartRange]:
+async def load_fire_start_ranges(orm_session: AsyncSession, fire_centre_id: int) -> List[FireStartRange]:
     """ Fetch the fire start ranges for a fire centre from the database, and return them as a list of
     schema objects.
     """
     return [FireStartRange(
         label=fire_start_range.label,
         id=fire_start_range.id)
-        for fire_start_range in get_fire_centre_fire_start_ranges(orm_session, fire_centre_id)]
+        for fire_start_range in await get_fire_centre_fire_start_ranges(orm_session, fire_centre_id)]
 
 
 def initialize_planning_area_fire_starts(
@@ -308,9 +318,10 @@ def calculate_daily_results(num_prep_days: int,
                             num_unique_station_codes: int) -> Tuple[List[DailyResult], bool]:
     """ Calculate the daily results for a planning area."""
     daily_results: List[DailyResult] = []
+    dailies_by_date = group_dailies_by_date(area_dailies)
     for index in range(num_prep_days):
         dailies_date = start_date + timedelta(days=index)
-        prep_day_dailies = get_prep_day_dailies(dailies_date, area_dailies)
+        prep_day_dailies = dailies_by_date.get(get_hour_20_from_date(dailies_date), [])
         daily_fire_starts: FireStartRange = planning_area_fire_starts[area_id][index]
         mean_intensity_group = calculate_mean_intensity(prep_day_dailies, num_unique_station_codes)
         prep_level = calculate_prep_level(mean_intensity_group, daily_fire_starts, fire_start_lookup)
@@ -328,36 +339,46 @@ def calculate_daily_results(num_prep_days: int,
     return daily_results, all_dailies_valid
 
 
-def generate_fuel_type_lookup(orm_session: Session) -> Dict[int, FuelTypeModel]:
+async def generate_fuel_type_lookup(orm_session: AsyncSession) -> Dict[int, FuelTypeModel]:
     """ Generate a lookup table for fuel types. """
-    fuel_types = get_fuel_types(orm_session)
+    fuel_types = await get_fuel_types(orm_session)
     return {fuel_type.id: fuel_type for fuel_type in fuel_types}
 
 
-def calculate_station_dailies(
+def calculate_fire_centre_dailies(
         raw_dailies: List[dict],
-        station_info_list: List[StationInfo],
+        planning_area_station_info: Dict[int, List[StationInfo]],
         station_lookup: Dict[str, WFWXWeatherStation],
-        fuel_type_lookup: Dict[int, FuelTypeModel]) -> List[StationDaily]:
-    """ Build a list of dailies with results from the fire behaviour calculations. """
-    area_dailies: List[StationDaily] = []
-
-    selected_station_codes = [
-        station.station_code for station in filter(
-            lambda station: (station.selected), station_info_list)]
-    station_info_lookup = {station.station_code: station for station in station_info_list}
-
-    for raw_daily in raw_dailies:
-        wfwx_station_id = raw_daily['stationId']
-        wfwx_station = station_lookup[wfwx_station_id]
+        fuel_type_lookup: Dict[int, FuelTypeModel]) -> Dict[int, List[StationDaily]]:
+    """ Build the list of dailies, with results from the fire behaviour calculations, for each planning area.
+
+    Fire behaviour is calculated once for the whole fire centre, for each raw daily and fuel type - a station
+    in more than one planning area is only calculated again if it has a different fuel type.
+    """
+    daily_station_codes = [station_lookup[raw_daily['stationId']].code for raw_daily in raw_dailies]
+    rows: List[Tuple[dict, WFWXWeatherStation, FuelTypeModel]] = []
+    row_lookup: Dict[Tuple[int, int], int] = {}
+    area_rows: Dict[int, List[int]] = {}
+
+    for area_id, station_info_list in planning_area_station_info.items():
+        selected_station_codes = set(station.station_code for station in station_info_list if station.selected)
+        station_info_lookup = {station.station_code: station for station in station_info_list}
+        area_rows[area_id] = []
         # Filter list of dailies to include only those for the selected stations and area.
         # No need to sort by date, we can't trust that the list doesn't have dates missing - so we
         # have a bit of code that snatches from this list filtering by date.
-        if wfwx_station.code in selected_station_codes:
-            station_info: StationInfo = station_info_lookup[wfwx_station.code]
-            fuel_type = fuel_type_lookup[station_info.fuel_type_id]
-            area_dailies.append(generate_station_daily(raw_daily, wfwx_station, fuel_type))
-    return area_dailies
+        for daily_index, station_code in enumerate(daily_station_codes):
+            if station_code in selected_station_codes:
+                fuel_type_id = station_info_lookup[station_code].fuel_type_id
+                key = (daily_index, fuel_type_id)
+                if key not in row_lookup:
+                    row_lookup[key] = len(rows)
+                    raw_daily = raw_dailies[daily_index]
+                    rows.append((raw_daily, station_lookup[raw_daily['stationId']], fuel_type_lookup[fuel_type_id]))
+                area_rows[area_id].append(row_lookup[key])
+
+    station_dailies = generate_station_dailies(rows)
+    return {area_id: [station_dailies[row] for row in rows_in_area] for area_id, rows_in_area in area_rows.items()}
 
 
 def calculate_hfi_results(fuel_type_lookup: Dict[int, FuelTypeModel],
@@ -375,12 +396,14 @@ def calculate_hfi_results(fuel_type_lookup: Dict[int, FuelTypeModel],
     station_lookup: Dict[str, WFWXWeatherStation] = {station.wfwx_id: station for station in wfwx_stations}
     wfwx_station_codes: Set[int] = set([station.code for station in wfwx_stations])
 
+    fire_centre_dailies = calculate_fire_centre_dailies(raw_dailies,
+                                                        planning_area_station_info,
+                                                        station_lookup,
+                                                        fuel_type_lookup)
+
     for area_id in planning_area_station_info.keys():
 
-        area_dailies = calculate_station_dailies(raw_dailies,
-                                                 planning_area_station_info[area_id],
-                                                 station_lookup,
-                                                 fuel_type_lookup)
+        area_dailies = fire_centre_dailies[area_id]
 
         # Initialize with defaults if empty/wrong length
         # TODO: Sometimes initialize_planning_area_fire_starts is called twice. Look into this once
@@ -0,0 +1,179 @@
+""" Render HFI PDFs in a pool of worker processes.
+
+Templating and wkhtmltopdf are slow and synchronous, so they're kept off the event loop: at most
+HFI_PDF_PROCESSES PDFs are rendered at a time, at most HFI_PDF_QUEUE_SIZE more wait for a worker, and anything
+past that is turned away. Finished PDFs are kept (the last HFI_PDF_CACHE_SIZE of them) under a hash of everything
+that goes into them, so downloading an unchanged prep cycle again is served without rendering it again.
+"""
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from jinja2 import Environment, FunctionLoader
+from app import config
+from app.hfi.pdf_generator import generate_pdf
+from app.hfi.pdf_template import get_template, get_template_version
+from app.schemas.hfi_calc import FireCentre, HFIResultResponse
+from app.schemas.shared import FuelType
+
+
+logger = logging.getLogger(__name__)
+
+
+class PDFRenderQueueFull(Exception):
+    """ Raised when too many PDFs are already waiting to be rendered """
+
+
+class PDFRenderTimeout(Exception):
+    """ Raised when a PDF isn't rendered within HFI_PDF_TIMEOUT_SECONDS """
+
+
+@dataclass
+class PDFRenderStats:
+    """ Metrics for the PDFs rendered by this process """
+    renders: int = 0
+    cache_hits: int = 0
+    rejected: int = 0
+    timeouts: int = 0
+    failures: int = 0
+    # PDFs waiting for a worker process.
+    queue_depth: int = 0
+    render_seconds: float = 0
+    max_render_seconds: float = 0
+
+    def log(self):
+        mean_render_seconds = self.render_seconds / self.renders if self.renders else 0
+        logger.info('hfi pdf: %d rendered (mean %.2f seconds, max %.2f seconds), %d from cache, %d queued, '
+                    '%d rejected, %d timed out, %d failed',
+                    self.renders, mean_render_seconds, self.max_render_seconds, self.cache_hits,
+                    self.queue_depth, self.rejected, self.timeouts, self.failures)
+
+
+def render_pdf(result: HFIResultResponse,
+               fire_centres: List[FireCentre],
+               idir: Optional[str],
+               datetime_generated: datetime,
+               fuel_types: Dict[int, FuelType]) -> Tuple[bytes, str, float]:
+    """ Render a PDF (in a worker process), returning the PDF, its filename and how long it took to render """
+    start = perf_counter()
+    # Loads template as string from a function
+    # See: https://jinja.palletsprojects.com/en/3.0.x/api/?highlight=functionloader#jinja2.FunctionLoader
+    jinja_env = Environment(loader=FunctionLoader(get_template), autoescape=True)
+    pdf_bytes, pdf_filename = generate_pdf(result, fire_centres, idir, datetime_generated, jinja_env, fuel_types)
+    return pdf_bytes, pdf_filename, perf_counter() - start
+
+
+def get_cache_key(result: HFIResultResponse,
+                  fire_centres: List[FireCentre],
+                  idir: Optional[str],
+                  fuel_types: Dict[int, FuelType]) -> str:
+    """ Hash of everything that goes into a PDF, except for the time it's generated at """
+    sha256 = hashlib.sha256(get_template_version().encode())
+    sha256.update((idir or '').encode())
+    sha256.update(result.json().encode())
+    for fire_centre in fire_centres:
+        sha256.update(fire_centre.json().encode())
+    for fuel_type_id in sorted(fuel_types):
+        sha256.update(fuel_types[fuel_type_id].json().encode())
+    return sha256.hexdigest()
+
+
+class PDFRenderer:
+    """ Renders PDFs in a process pool (created on first use), with a bounded queue, a timeout and a cache.
+
+    Identical PDFs requested at the same time are rendered once.
+    """
+
+    def __init__(self,
+                 processes: Optional[int] = None,
+                 queue_size: Optional[int] = None,
+                 timeout_seconds: Optional[float] = None,
+                 cache_size: Optional[int] = None):
+        self.processes = processes or int(config.get('HFI_PDF_PROCESSES', 2))
+        self.queue_size = queue_size if queue_size is not None else int(config.get('HFI_PDF_QUEUE_SIZE', 8))
+        self.timeout_seconds = timeout_seconds or float(config.get('HFI_PDF_TIMEOUT_SECONDS', 60))
+        self.cache_size = cache_size if cache_size is not None else int(config.get('HFI_PDF_CACHE_SIZE', 32))
+        self.stats = PDFRenderStats()
+        self._pool: Optional[Executor] = None
+        self._cache: OrderedDict[str, Tuple[bytes, str]] = OrderedDict()
+        # Renders that have been submitted to the pool and haven't finished, by cache key.
+        self._rendering: Dict[str, asyncio.Task] = {}
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        return self._pool
+
+    def _update_queue_depth(self):
+        self.stats.queue_depth = max(0, len(self._rendering) - self.processes)
+
+    def _cache_pdf(self, key: str, pdf: Tuple[bytes, str]):
+        self._cache[key] = pdf
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _render(self, key: str, *args) -> Tuple[bytes, str]:
+        try:
+            pdf_bytes, pdf_filename, render_seconds = await asyncio.wrap_future(
+                self._get_pool().submit(render_pdf, *args))
+        except Exception:
+            self.stats.failures += 1
+            raise
+        finally:
+            # A render that was waited on for too long is still counted until its worker is done with it.
+            if self._rendering.get(key) is asyncio.current_task():
+                del self._rendering[key]
+            self._update_queue_depth()
+        self.stats.renders += 1
+        self.stats.render_seconds += render_seconds
+        self.stats.max_render_seconds = max(self.stats.max_render_seconds, render_seconds)
+        self._cache_pdf(key, (pdf_bytes, pdf_filename))
+        logger.info('rendered %s in %.2f seconds', pdf_filename, render_seconds)
+        self.stats.log()
+        return pdf_bytes, pdf_filename
+
+    async def render(self,
+                     result: HFIResultResponse,
+                     fire_centres: List[FireCentre],
+                     idir: Optional[str],
+                     datetime_generated: datetime,
+                     fuel_types: Dict[int, FuelType]) -> Tuple[bytes, str]:
+        """ Returns the PDF of the HFI results, and its filename. A cached PDF keeps the time (and filename) it was
+        originally generated with. """
+        key = get_cache_key(result, fire_centres, idir, fuel_types)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.stats.cache_hits += 1
+            return self._cache[key]
+        task = self._rendering.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            if len(self._rendering) >= self.processes + self.queue_size:
+                self.stats.rejected += 1
+                self.stats.log()
+                raise PDFRenderQueueFull(f'{len(self._rendering)} PDFs are already being rendered')
+            task = asyncio.create_task(self._render(key, result, fire_centres, idir, datetime_generated, fuel_types))
+            self._rendering[key] = task
+            self._update_queue_depth()
+        try:
+            # The render carries on if this request gives up on it, so that it can be cached.
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout_seconds)
+        except asyncio.TimeoutError as exception:
+            self.stats.timeouts += 1
+            self.stats.log()
+            raise PDFRenderTimeout(f'PDF not rendered within {self.timeout_seconds} seconds') from exception
+
+
+_pdf_renderer: Optional[PDFRenderer] = None
+
+
+def get_pdf_renderer() -> PDFRenderer:
+    """ The PDF renderer for this process """
+    global _pdf_renderer  # pylint: disable=global-statement
+    if _pdf_renderer is None:
+        _pdf_renderer = PDFRenderer()
+    return _pdf_renderer
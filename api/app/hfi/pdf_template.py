@@ -1,8 +1,13 @@
 """String representations of templates for in memory loading"""
 from enum import Enum
+from functools import lru_cache
+import hashlib
 import os
 
 CSS_PATH = os.path.join(os.path.dirname(__file__), "style.css")
+TEMPLATE_PATHS = (os.path.join(os.path.dirname(__file__), 'templates/daily_template.jinja.html'),
+                  os.path.join(os.path.dirname(__file__), 'templates/prep_template.jinja.html'),
+                  CSS_PATH)
 
 
 class PDFTemplateName(Enum):
@@ -23,3 +28,13 @@ def get_template(template_name: str):
                                "templates/prep_template.jinja.html"),
                   'r', encoding="utf-8") as prep_template:
             return prep_template.read()
+
+
+@lru_cache(maxsize=1)
+def get_template_version() -> str:
+    """ Hash of the templates and stylesheet, changes whenever the look of the PDF does """
+    sha256 = hashlib.sha256()
+    for path in TEMPLATE_PATHS:
+        with open(path, 'rb') as template_file:
+            sha256.update(template_file.read())
+    return sha256.hexdigest()
@@ -1,5 +1,8 @@
 import os
-from typing import List
+from itertools import groupby
+import math
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
 import logging
 import requests
 import numpy
@@ -10,24 +13,24 @@ from app.db.crud.weather_models import (
     get_processed_file_record,
     get_processed_file_count,
     get_prediction_model_run_timestamp_records,
-    get_model_run_predictions_for_station,
-    get_weather_station_model_prediction,
+    get_model_run_predictions_for_stations,
+    get_weather_station_model_prediction_apcp,
+    upsert_weather_station_model_predictions,
     delete_weather_station_model_predictions,
     delete_model_run_predictions,
     refresh_morecast2_materialized_view,
 )
-from app.weather_models.machine_learning import StationMachineLearning
+from app.weather_models.machine_learning import ModelMachineLearning
+from app.jobs.grib_cache import get_grib_cache
+from app.jobs.grib_downloader import get_download_filename
 from app.weather_models import ModelEnum
-from app.weather_models.interpolate import construct_interpolated_noon_prediction, interpolate_between_two_points
-from app.schemas.stations import WeatherStation
+from app.weather_models.interpolate import construct_interpolated_noon_prediction
 from app import config, configure_logging
 import app.utils.time as time_utils
-from app.utils.redis import create_redis
 from app.stations import get_stations_synchronously, StationSourceEnum
-from app.db.models.weather_models import (ProcessedModelRunUrl, PredictionModelRunTimestamp,
-                                          WeatherStationModelPrediction, ModelRunPrediction)
+from app.db.models.weather_models import ProcessedModelRunUrl, PredictionModelRunTimestamp, ModelRunPrediction
 import app.db.database
-from app.db.crud.observations import get_accumulated_precipitation
+from app.db.crud.observations import get_hourly_precipitation_for_stations
 
 # If running as its own process, configure logging appropriately.
 if __name__ == "__main__":
@@ -37,6 +40,7 @@ logger = logging.getLogger(__name__)
 
 # Keys for weather variables that require interpolation between 1800 and 2100
 SCALAR_MODEL_VALUE_KEYS_FOR_INTERPOLATION = ("tmp_tgl_2", "rh_tgl_2", "wind_tgl_10", "apcp_sfc_0")
+SECONDS_PER_DAY = 24 * 60 * 60
 
 
 class UnhandledPredictionModelType(Exception):
@@ -53,60 +57,43 @@ def download(url: str, path: str, config_cache_var: str, model_name: str, config
     NOTE: was using wget library initially, but has the drawback of not being able to control where the
     temporary files are stored. This is problematic, as giving the application write access to /app
     is a security concern.
-    TODO: Would be nice to make this an async
+    NOTE: model runs are downloaded concurrently with app.jobs.grib_downloader, this is for one off downloads.
     """
-    if model_name == 'GFS':
-        original_filename = os.path.split(url)[-1]
-        # NOTE: This is a very not-ideal way to interpolate the filename.
-        # The original_filename that we get from the url is too long and must be condensed.
-        # It also has multiple '.' chars in the URL that must be removed for the filename to be valid.
-        # As long as NOAA's API remains unchanged, we'll have all the info we need (run datetimes,
-        # projections, etc.) in the first 81 characters of original_filename.
-        # An alternative would be to build out a regex to look for
-        filename = original_filename[:81].replace('.', '')
-    else:
-        # Infer filename from url.
-        filename = os.path.split(url)[-1]
+    filename = get_download_filename(url, model_name)
     # Construct target location for downloaded file.
     target = os.path.join(os.getcwd(), path, filename)
     # Get the file.
-    # We don't strictly need to use redis - but it helps a lot when debugging on a local machine, it
+    # We don't strictly need to cache - but it helps a lot when debugging on a local machine, it
     # saves having to re-download the file all the time.
     # It also save a lot of bandwidth in our dev environment, where we have multiple workers downloading
     # the same files over and over.
-    if config.get(config_cache_var) == 'True':
-        cache = create_redis()
-        try:
-            cached_object = cache.get(url)
-        except Exception as error:
-            cached_object = None
-            logger.error(error)
-    else:
-        cached_object = None
-        cache = None
-    if cached_object:
+    cache = get_grib_cache() if config.get(config_cache_var) == 'True' else None
+    cached = cache.lookup(url) if cache else None
+    if cached and cache.is_fresh(cached, float(config.get(config_cache_expiry_var, 21600))) \
+            and cache.copy_to(cached, target):
         logger.info('Cache hit %s', url)
-        # Store the cached object in a file
-        with open(target, 'wb') as file_object:
-            # Write the file.
-            file_object.write(cached_object)
     else:
         logger.info('Downloading %s', url)
         # It's important to have a timeout on the get, otherwise the call may get stuck for an indefinite
         # amount of time - there is no default value for timeout. During testing, it was observed that
         # downloads usually complete in less than a second.
-        response = requests.get(url, timeout=60)
+        headers = cache.conditional_headers(cached) if cached else {}
+        response = requests.get(url, timeout=60, headers=headers)
+        if response.status_code == 304 and not (cached and cache.copy_to(cache.revalidated(cached), target)):
+            # The cached file was evicted in the meantime, get it again.
+            response = requests.get(url, timeout=60)
+        # If the cached file is still current.
+        if response.status_code == 304:
+            logger.info('Cache hit %s', url)
         # If the response is 200/OK.
-        if response.status_code == 200:
+        elif response.status_code == 200:
             # Store the response.
             with open(target, 'wb') as file_object:
                 # Write the file.
                 file_object.write(response.content)
             # Cache the response
             if cache:
-                with open(target, 'rb') as file_object:
-                    # Cache for 6 hours (21600 seconds)
-                    cache.set(url, file_object.read(), ex=config.get(config_cache_expiry_var, 21600))
+                cache.put(url, target, response.headers.get('ETag'), response.headers.get('Last-Modified'))
         elif response.status_code == 404:
             # We expect this to happen frequently - just log for info.
             logger.info('404 error for %s', url)
@@ -183,6 +170,59 @@ def accumulate_nam_precipitation(nam_cumulative_precip: float, prediction: Model
     return (cumulative_precip, current_precip)
 
 
+# Multiplier for station codes in station/time keys, larger than any timestamp in seconds.
+STATION_KEY_STRIDE = 10 ** 10
+
+
+def to_optional_floats(array: numpy.ndarray) -> List[Optional[float]]:
+    """ Convert an array to a list of floats, with None in place of NaN (e.g. for writing to the database). """
+    return [None if math.isnan(value) else value for value in array.tolist()]
+
+
+def get_station_time_keys(station_codes, seconds) -> numpy.ndarray:
+    """ Sortable key for each station and time (in seconds), so that a station's predictions can be looked up
+    by time with numpy.searchsorted. """
+    return (numpy.asarray(station_codes, dtype=numpy.int64) * STATION_KEY_STRIDE
+            + numpy.asarray(seconds, dtype=numpy.float64).astype(numpy.int64))
+
+
+def calculate_delta_precip(keys: numpy.ndarray, apcp: numpy.ndarray,
+                           run_keys: numpy.ndarray, run_apcp: numpy.ndarray) -> numpy.ndarray:
+    """ Change in accumulated precip since the station's previous prediction in the model run (run_keys, sorted,
+    with matching run_apcp). The first prediction with apcp for a station (hour 001 or 003, depending on the
+    model type) has a delta equal to its apcp.
+    """
+    previous = numpy.searchsorted(run_keys, keys, side='left') - 1
+    safe_previous = numpy.maximum(previous, 0)
+    has_previous = (previous >= 0) & (run_keys[safe_previous] // STATION_KEY_STRIDE == keys // STATION_KEY_STRIDE)
+    return numpy.where(has_previous, apcp - run_apcp[safe_previous], apcp)
+
+
+def calculate_model_precip_24h(keys: numpy.ndarray, apcp: numpy.ndarray,
+                               run_keys: numpy.ndarray,
+                               run_apcp: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """ Precip over the previous 24 hours, from the station's prediction 24 hours earlier in the model run, and
+    whether there is such a prediction (NaN precip where there isn't). We can end up with very very small negative
+    numbers due to floating point math, so the absolute value is used to avoid displaying -0.0.
+    """
+    day_before = keys - SECONDS_PER_DAY
+    index = numpy.minimum(numpy.searchsorted(run_keys, day_before), len(run_keys) - 1)
+    has_previous_day = run_keys[index] == day_before
+    return numpy.where(has_previous_day, numpy.abs(apcp - run_apcp[index]), numpy.nan), has_previous_day
+
+
+def sum_station_precip(start_keys: numpy.ndarray, end_keys: numpy.ndarray,
+                       actual_keys: numpy.ndarray, actual_precip: numpy.ndarray) -> numpy.ndarray:
+    """ Sum of a station's hourly precip after each start, up to and including each end (station/time keys).
+    actual_keys must be sorted. Missing precip values are skipped, like SUM() in SQL.
+    """
+    precip = numpy.nan_to_num(actual_precip, nan=0.0)
+    cumulative_precip = numpy.concatenate([[0.0], numpy.cumsum(precip)])
+    first = numpy.searchsorted(actual_keys, start_keys, side='right')
+    last = numpy.searchsorted(actual_keys, end_keys, side='right')
+    return cumulative_precip[last] - cumulative_precip[first]
+
+
 class ModelValueProcessor:
     """ Iterate through model runs that have completed, and calculate the interpolated weather predictions.
     """
@@ -196,250 +236,180 @@ class ModelValueProcessor:
     def _process_model_run(self, model_run: PredictionModelRunTimestamp, model_type: ModelEnum):
         """ Interpolate predictions in the provided model run for all stations. """
         logger.info('Interpolating values for model run: %s', model_run)
-        # Iterate through stations.
-        for index, station in enumerate(self.stations):
-            logger.info('Interpolating model run %s (%s/%s) for %s:%s',
-                        model_run.id,
-                        index, self.station_count,
-                        station.code, station.name)
-            # Process this model run for station.
-            self._process_model_run_for_station(model_run, station, model_type)
-        # Commit all the weather station model predictions (it's fast if we line them all up and commit
-        # them in one go.)
+        perf_start = perf_counter()
+        station_codes = [station.code for station in self.stations]
+        # Learn the bias adjustment for every station at once.
+        machine = ModelMachineLearning(
+            session=self.session,
+            model=model_run.prediction_model,
+            station_codes=station_codes,
+            max_learn_date=model_run.prediction_run_timestamp)
+        machine.learn()
+        station_predictions, interpolated = self._create_station_predictions(model_run, model_type, station_codes)
+        self._add_precip_to_predictions(model_run, station_codes, station_predictions)
+        self._add_bias_adjustments_to_predictions(station_predictions, interpolated, machine)
+        # Write all the weather station model predictions in one go.
         logger.info('commit to database...')
+        upsert_weather_station_model_predictions(self.session, station_predictions)
         self.session.commit()
-        logger.info('done commit.')
-
-    def _add_interpolated_bias_adjustments_to_prediction(self, station_prediction: WeatherStationModelPrediction, machine: StationMachineLearning):
-        # We need to interpolate prediction for 2000 using predictions for 1800 and 2100
-        # Predict the temperature
-        temp_at_1800 = machine.predict_temperature(station_prediction.tmp_tgl_2,
-                                                    station_prediction.prediction_timestamp.replace(hour=18))
-        temp_at_2100 = machine.predict_temperature(station_prediction.tmp_tgl_2,
-                                        station_prediction.prediction_timestamp.replace(hour=21))
-        station_prediction.bias_adjusted_temperature = interpolate_between_two_points(18, 21, temp_at_1800,
-                                                                                        temp_at_2100, 20)
-        # Predict the rh
-        rh_at_1800 = machine.predict_rh(station_prediction.rh_tgl_2,
-                                        station_prediction.prediction_timestamp.replace(hour=18))
-        rh_at_2100 = machine.predict_rh(station_prediction.rh_tgl_2,
-                            station_prediction.prediction_timestamp.replace(hour=21))
-        station_prediction.bias_adjusted_rh = interpolate_between_two_points(18, 21, rh_at_1800, rh_at_2100, 20)
-
-        # Predict the wind speed
-        wind_speed_at_1800 = machine.predict_wind_speed(station_prediction.wind_tgl_10,
-                                                        station_prediction.prediction_timestamp.replace(hour=18))
-        wind_speed_at_2100 = machine.predict_wind_speed(station_prediction.wind_tgl_10,
-                                            station_prediction.prediction_timestamp.replace(hour=21))
-        station_prediction.bias_adjusted_wind_speed = interpolate_between_two_points(18, 21, wind_speed_at_1800,
-                                                                                        wind_speed_at_2100, 20)
-        
-        # Predict the wind direction
-        wind_direction_at_1800 = station_prediction.bias_adjusted_wdir = machine.predict_wind_direction(
-            station_prediction.wind_tgl_10,
-            station_prediction.wdir_tgl_10,
-            station_prediction.prediction_timestamp.replace(hour=18)
-        )
-        wind_direction_at_2100 = station_prediction.bias_adjusted_wdir = machine.predict_wind_direction(
-            station_prediction.wind_tgl_10,
-            station_prediction.wdir_tgl_10,
-            station_prediction.prediction_timestamp.replace(hour=21)
-        )
-        station_prediction.bias_adjusted_wdir = interpolate_between_two_points(18, 21, wind_direction_at_1800,
-                                                                                wind_direction_at_2100, 20)
-
-        # Predict the 24h precipitation. No interpolation necessary due to the underlying model training.
-        station_prediction.bias_adjusted_precip_24h = machine.predict_precipitation(
-            station_prediction.precip_24h,
-            station_prediction.prediction_timestamp
-        )
-    
-    def _add_bias_adjustments_to_prediction(self, station_prediction: WeatherStationModelPrediction,
-                                  machine: StationMachineLearning):
-        # Predict the temperature
-        station_prediction.bias_adjusted_temperature = machine.predict_temperature(
-            station_prediction.tmp_tgl_2,
-            station_prediction.prediction_timestamp)
-    
-        # Predict the rh
-        station_prediction.bias_adjusted_rh = machine.predict_rh(station_prediction.rh_tgl_2,
-                                                                    station_prediction.prediction_timestamp)
-    
-        # Predict the wind speed
-        station_prediction.bias_adjusted_wind_speed = machine.predict_wind_speed(
-            station_prediction.wind_tgl_10,
-            station_prediction.prediction_timestamp
-        )
-
-        # Predict the wind direction
-        station_prediction.bias_adjusted_wdir = machine.predict_wind_direction(
-            station_prediction.wind_tgl_10,
-            station_prediction.wdir_tgl_10,
-            station_prediction.prediction_timestamp
-        )
-
-        # Predict the 24h precipitation
-        station_prediction.bias_adjusted_precip_24h = machine.predict_precipitation(
-            station_prediction.precip_24h,
-            station_prediction.prediction_timestamp
-        )
-
-    def _process_prediction(self,
-                            prediction: ModelRunPrediction,
-                            station: WeatherStation,
-                            model_run: PredictionModelRunTimestamp,
-                            machine: StationMachineLearning,
-                            prediction_is_interpolated: bool):
-        """ Create a WeatherStationModelPrediction from the ModelRunPrediction data.
+        logger.info('Processed model run %s: %s station predictions for %s stations in %.3fs',
+                    model_run.id, len(station_predictions), self.station_count, perf_counter() - perf_start)
+
+    def _create_station_predictions(self, model_run: PredictionModelRunTimestamp, model_type: ModelEnum,
+                                    station_codes: List[int]) -> Tuple[List[dict], numpy.ndarray]:
+        """ Create the weather station predictions (without precip or bias adjustments) for every prediction of
+        the model run, along with whether each one was interpolated.
         """
-        # If there's already a prediction, we want to update it
-        station_prediction = get_weather_station_model_prediction(
-            self.session, station.code, model_run.id, prediction.prediction_timestamp)
-        if station_prediction is None:
-            station_prediction = WeatherStationModelPrediction()
-        # Populate the weather station prediction object.
-        station_prediction.station_code = station.code
-        station_prediction.prediction_model_run_timestamp_id = model_run.id
-        station_prediction.prediction_timestamp = prediction.prediction_timestamp
-        # Calculate the interpolated values.
+        predictions = get_model_run_predictions_for_stations(self.session, station_codes, model_run)
+        update_date = time_utils.get_utc_now()
+        # Keyed by station and time, so a repeated prediction replaces the earlier one.
+        station_predictions: Dict[tuple, dict] = {}
+        interpolated: Dict[tuple, bool] = {}
+
+        def add(prediction: ModelRunPrediction, station_code: int, prediction_is_interpolated: bool):
+            key = (station_code, prediction.prediction_timestamp)
+            station_predictions[key] = self._create_station_prediction(prediction, station_code, model_run,
+                                                                       update_date)
+            interpolated[key] = prediction_is_interpolated
+
+        for station_code, station_model_predictions in groupby(predictions, key=lambda prediction: prediction.station_code):
+            nam_cumulative_precip = 0.0
+            prev_prediction = None
+            for prediction in station_model_predictions:
+                # NAM model requires manual calculation of cumulative precip
+                if model_type == ModelEnum.NAM:
+                    nam_cumulative_precip, prediction.apcp_sfc_0 = accumulate_nam_precipitation(
+                        nam_cumulative_precip, prediction, model_run.prediction_run_timestamp.hour)
+                if (prev_prediction is not None
+                        and prev_prediction.prediction_timestamp.hour == 18
+                        and prediction.prediction_timestamp.hour == 21):
+                    noon_prediction = construct_interpolated_noon_prediction(prev_prediction, prediction, SCALAR_MODEL_VALUE_KEYS_FOR_INTERPOLATION)
+                    add(noon_prediction, station_code, True)
+                add(prediction, station_code, False)
+                prev_prediction = prediction
+        return list(station_predictions.values()), numpy.array(list(interpolated.values()), dtype=bool)
+
+    def _create_station_prediction(self, prediction: ModelRunPrediction, station_code: int,
+                                   model_run: PredictionModelRunTimestamp, update_date: datetime) -> dict:
+        """ Create a weather station prediction from the ModelRunPrediction data. """
         # 2020 Dec 15, Sybrand: Encountered situation where tmp_tgl_2 was None, add this workaround for it.
         # NOTE: Not sure why this value would ever be None. This could happen if for whatever reason, the
-        # tmp_tgl_2 layer failed to download and process, while other layers did.
+        # tmp_tgl_2 layer failed to download and process, while other layers did. A None tmp_tgl_2 (or wind)
+        # doesn't overwrite an existing value, see upsert_weather_station_model_predictions.
         if prediction.tmp_tgl_2 is None:
             logger.warning('tmp_tgl_2 is None for ModelRunPrediction.id == %s', prediction.id)
-        else:
-            station_prediction.tmp_tgl_2 = prediction.tmp_tgl_2
-
         # 2020 Dec 10, Sybrand: Encountered situation where rh_tgl_2 was None, add this workaround for it.
         # NOTE: Not sure why this value would ever be None. This could happen if for whatever reason, the
         # rh_tgl_2 layer failed to download and process, while other layers did.
         if prediction.rh_tgl_2 is None:
             # This is unexpected, so we log it.
             logger.warning('rh_tgl_2 is None for ModelRunPrediction.id == %s', prediction.id)
-            station_prediction.rh_tgl_2 = None
-        else:
-            station_prediction.rh_tgl_2 = prediction.rh_tgl_2
-        # Check that apcp_sfc_0 is None, since accumulated precipitation
-        # does not exist for 00 hour.
-        if prediction.apcp_sfc_0 is None:
-            station_prediction.apcp_sfc_0 = 0.0
-        else:
-            station_prediction.apcp_sfc_0 = prediction.apcp_sfc_0
-        # Calculate the delta_precipitation and 24 hour precip based on station's previous prediction_timestamp
-        # for the same model run
-        self.session.flush()
-        station_prediction.precip_24h = self._calculate_past_24_hour_precip(
-            station, model_run, prediction, station_prediction)
-        station_prediction.delta_precip = self._calculate_delta_precip(
-            station, model_run, prediction, station_prediction)
-
-        # Get the closest wind speed
-        if prediction.wind_tgl_10 is not None:
-            station_prediction.wind_tgl_10 = prediction.wind_tgl_10
-        # Get the closest wind direcion
-        if prediction.wdir_tgl_10 is not None:
-            station_prediction.wdir_tgl_10 = prediction.wdir_tgl_10
-
-        if prediction_is_interpolated:
-            # Dealing with a numerical weather model that only has predictions at 3 hour intervals,
-            # so no 20:00 UTC prediction available in the trained linear regression
-            self._add_interpolated_bias_adjustments_to_prediction(station_prediction, machine)
-            
-        else:
-            # No interpolation required
-            self._add_bias_adjustments_to_prediction(station_prediction, machine)
-
-        # Update the update time (this might be an update)
-        station_prediction.update_date = time_utils.get_utc_now()
-        # Add this prediction to the session (we'll commit it later.)
-        self.session.add(station_prediction)
-
-    def _calculate_past_24_hour_precip(self, station: WeatherStation, model_run: PredictionModelRunTimestamp,
-                                       prediction: ModelRunPrediction, station_prediction: WeatherStationModelPrediction):
-        """ Calculate the predicted precipitation over the previous 24 hours within the specified model run.
-        If the model run does not contain a prediction timestamp for 24 hours prior to the current prediction,
-        return the predicted precipitation from the previous run of the same model for the same time frame. """
-        start_prediction_timestamp = prediction.prediction_timestamp - timedelta(days=1)
-        # Check if a prediction exists for this model run 24 hours in the past
-        previous_prediction_from_same_model_run = get_weather_station_model_prediction(self.session, station.code,
-                                                                                       model_run.id, start_prediction_timestamp)
-        # If a prediction from 24 hours ago from the same model run exists, return the difference in cumulative precipitation
-        # between now and then as our total for the past 24 hours. We can end up with very very small negative numbers due
-        # to floating point math, so return absolute value to avoid displaying -0.0.
-        if previous_prediction_from_same_model_run is not None:
-            return abs(station_prediction.apcp_sfc_0 - previous_prediction_from_same_model_run.apcp_sfc_0)
-
-        # We're within 24 hours of the start of a model run so we don't have cumulative precipitation for a full 24h.
-        # We use actual precipitation from our API hourly_actuals table to make up the missing hours.
-        prediction_timestamp = station_prediction.prediction_timestamp
-        # Create new datetime with time of 00:00 hours as the end time.
-        end_prediction_timestamp = datetime(year=prediction_timestamp.year,
-                                            month=prediction_timestamp.month,
-                                            day=prediction_timestamp.day,
-                                            tzinfo=timezone.utc)
-        actual_precip = get_accumulated_precipitation(
-            self.session, station.code, start_prediction_timestamp, end_prediction_timestamp)
-        return actual_precip + station_prediction.apcp_sfc_0
-
-    def _calculate_delta_precip(self, station, model_run, prediction, station_prediction):
-        """ Calculate the station_prediction's delta_precip based on the previous precip
-        prediction for the station
-        """
-        results = self.session.query(WeatherStationModelPrediction).\
-            filter(WeatherStationModelPrediction.station_code == station.code).\
-            filter(WeatherStationModelPrediction.prediction_model_run_timestamp_id == model_run.id).\
-            filter(WeatherStationModelPrediction.prediction_timestamp < prediction.prediction_timestamp).\
-            order_by(WeatherStationModelPrediction.prediction_timestamp.desc()).\
-            limit(1).first()
-        # If there exists a previous prediction for the station from the same model run
-        if results is not None:
-            return station_prediction.apcp_sfc_0 - results.apcp_sfc_0
-        # If there is no prior prediction within the same model run, it means that station_prediction is
-        # the first prediction with apcp for the current model run (hour 001 or 003, depending on the
-        # model type). In this case, delta_precip will be equal to the apcp
-        return station_prediction.apcp_sfc_0
-
-    def _process_model_run_for_station(self,
-                                       model_run: PredictionModelRunTimestamp,
-                                       station: WeatherStation,
-                                       model_type: ModelEnum):
-        """ Process the model run for the provided station.
+        return {
+            'station_code': station_code,
+            'prediction_model_run_timestamp_id': model_run.id,
+            'prediction_timestamp': prediction.prediction_timestamp,
+            'tmp_tgl_2': prediction.tmp_tgl_2,
+            'rh_tgl_2': prediction.rh_tgl_2,
+            # Accumulated precipitation does not exist for 00 hour.
+            'apcp_sfc_0': 0.0 if prediction.apcp_sfc_0 is None else float(prediction.apcp_sfc_0),
+            'wind_tgl_10': prediction.wind_tgl_10,
+            'wdir_tgl_10': prediction.wdir_tgl_10,
+            'update_date': update_date,
+        }
+
+    def _add_precip_to_predictions(self, model_run: PredictionModelRunTimestamp, station_codes: List[int],
+                                   station_predictions: List[dict]):
+        """ Calculate the delta precip and 24 hour precip of every prediction in the model run.
+
+        Delta precip is the change in accumulated precip since the station's previous prediction in the model
+        run. 24 hour precip is the change since the station's prediction 24 hours earlier, or within 24 hours
+        of the start of a model run (where there's no such prediction), the actual precip from the hourly
+        actuals up to midnight plus the accumulated precip.
         """
-        # Extract the coordinate.
-        coordinate = [station.long, station.lat]
-        # Lookup the grid our weather station is in.
-        logger.info("Getting grid for coordinate %s and model %s",
-                    coordinate, model_run.prediction_model)
-        machine = StationMachineLearning(
-            session=self.session,
-            model=model_run.prediction_model,
-            target_coordinate=coordinate,
-            station_code=station.code,
-            max_learn_date=model_run.prediction_run_timestamp)
-        machine.learn()
-
-        # Get all the predictions associated to this particular model run.
-        query = get_model_run_predictions_for_station(self.session, station.code, model_run)
-
-        nam_cumulative_precip = 0.0
-        # Iterate through all the predictions.
-        prev_prediction = None
-
-        for prediction in query:
-            # NAM model requires manual calculation of cumulative precip
-            if model_type == ModelEnum.NAM:
-                nam_cumulative_precip, prediction.apcp_sfc_0 = accumulate_nam_precipitation(
-                    nam_cumulative_precip, prediction, model_run.prediction_run_timestamp.hour)
-            if (prev_prediction is not None
-                    and prev_prediction.prediction_timestamp.hour == 18
-                    and prediction.prediction_timestamp.hour == 21):
-                noon_prediction = construct_interpolated_noon_prediction(prev_prediction, prediction, SCALAR_MODEL_VALUE_KEYS_FOR_INTERPOLATION)
-                self._process_prediction(
-                    noon_prediction, station, model_run, machine, True)
-            self._process_prediction(
-                prediction, station, model_run, machine, False)
-
-            prev_prediction = prediction
+        if not station_predictions:
+            return
+        timestamps = [station_prediction['prediction_timestamp'] for station_prediction in station_predictions]
+        codes = numpy.array([station_prediction['station_code'] for station_prediction in station_predictions],
+                            dtype=numpy.int64)
+        keys = get_station_time_keys(codes, [timestamp.timestamp() for timestamp in timestamps])
+        apcp = numpy.array([station_prediction['apcp_sfc_0'] for station_prediction in station_predictions],
+                           dtype=numpy.float64)
+
+        # Every prediction of the model run, those already in the database, replaced by the ones being written.
+        run_apcp = {int(get_station_time_keys([code], [timestamp.timestamp()])[0]): value
+                    for code, timestamp, value in get_weather_station_model_prediction_apcp(
+                        self.session, station_codes, model_run.id)}
+        run_apcp.update(zip(keys.tolist(), apcp.tolist()))
+        run_keys = numpy.array(sorted(run_apcp), dtype=numpy.int64)
+        run_apcp_values = numpy.array([run_apcp[key] for key in run_keys.tolist()], dtype=numpy.float64)
+
+        delta_precip = calculate_delta_precip(keys, apcp, run_keys, run_apcp_values)
+        precip_24h, has_previous_day = calculate_model_precip_24h(keys, apcp, run_keys, run_apcp_values)
+
+        # We're within 24 hours of the start of a model run so we don't have cumulative precipitation for a
+        # full 24h. We use actual precipitation from our API hourly_actuals table to make up the missing hours.
+        missing = numpy.flatnonzero(~has_previous_day)
+        if len(missing) > 0:
+            start_timestamps = [timestamps[index] - timedelta(days=1) for index in missing]
+            end_timestamps = [datetime(year=timestamps[index].year, month=timestamps[index].month,
+                                       day=timestamps[index].day, tzinfo=timezone.utc) for index in missing]
+            actuals = get_hourly_precipitation_for_stations(self.session, numpy.unique(codes[missing]).tolist(),
+                                                            min(start_timestamps), max(end_timestamps))
+            actual_keys = get_station_time_keys([actual.station_code for actual in actuals],
+                                                [actual.weather_date.timestamp() for actual in actuals])
+            actual_precip = numpy.array([actual.precipitation for actual in actuals], dtype=numpy.float64)
+            order = numpy.argsort(actual_keys, kind='stable')
+            actual_precip_24h = sum_station_precip(
+                get_station_time_keys(codes[missing], [timestamp.timestamp() for timestamp in start_timestamps]),
+                get_station_time_keys(codes[missing], [timestamp.timestamp() for timestamp in end_timestamps]),
+                actual_keys[order], actual_precip[order])
+            precip_24h[missing] = actual_precip_24h + apcp[missing]
+
+        for station_prediction, delta, precip in zip(station_predictions, to_optional_floats(delta_precip),
+                                                     to_optional_floats(precip_24h)):
+            station_prediction['delta_precip'] = delta
+            station_prediction['precip_24h'] = precip
+
+    def _add_bias_adjustments_to_predictions(self, station_predictions: List[dict],
+                                             interpolated: numpy.ndarray, machine: ModelMachineLearning):
+        """ Bias adjust all the predictions of a model run in one pass. """
+        def values(key: str) -> numpy.ndarray:
+            return numpy.array([station_prediction[key] for station_prediction in station_predictions],
+                               dtype=numpy.float64)
+
+        station_codes = numpy.array([station_prediction['station_code'] for station_prediction in station_predictions],
+                                    dtype=numpy.int64)
+        hours = numpy.array([station_prediction['prediction_timestamp'].hour for station_prediction in station_predictions],
+                            dtype=numpy.int64)
+        temperatures = values('tmp_tgl_2')
+        rhs = values('rh_tgl_2')
+        wind_speeds = values('wind_tgl_10')
+        wind_dirs = values('wdir_tgl_10')
+
+        def adjust(predict, *model_values) -> numpy.ndarray:
+            adjusted = predict(station_codes, *model_values, hours)
+            if not interpolated.any():
+                return adjusted
+            # We need to interpolate prediction for 2000 using predictions for 1800 and 2100 when dealing
+            # with a numerical weather model that only has predictions at 3 hour intervals, so there's no
+            # 20:00 UTC prediction available in the trained linear regression.
+            at_1800 = predict(station_codes, *model_values, numpy.full_like(hours, 18))
+            at_2100 = predict(station_codes, *model_values, numpy.full_like(hours, 21))
+            # Same arithmetic as interpolate_between_two_points(18, 21, at_1800, at_2100, 20)
+            interpolated_20 = (at_2100 - at_1800) / (21 - 18) * (20 - 18) + at_1800
+            return numpy.where(interpolated, interpolated_20, adjusted)
+
+        bias_adjusted = {
+            'bias_adjusted_temperature': adjust(machine.predict_temperature, temperatures),
+            'bias_adjusted_rh': adjust(machine.predict_rh, rhs),
+            'bias_adjusted_wind_speed': adjust(machine.predict_wind_speed, wind_speeds),
+            'bias_adjusted_wdir': adjust(machine.predict_wind_direction, wind_speeds, wind_dirs),
+            # No interpolation necessary for 24h precipitation due to the underlying model training.
+            'bias_adjusted_precip_24h': machine.predict_precipitation(station_codes, values('precip_24h'), hours),
+        }
+        for key, adjusted_values in bias_adjusted.items():
+            for station_prediction, value in zip(station_predictions, to_optional_floats(adjusted_values)):
+                station_prediction[key] = value
 
     def _mark_model_run_interpolated(self, model_run: PredictionModelRunTimestamp):
         """ Having completely processed a model run, we can mark it has having been interpolated.
@@ -3,9 +3,9 @@ from datetime import date
 from osgeo import gdal
 import asyncio
 import logging
-import math
 import numpy as np
 import os
+from pyproj import Transformer
 import requests
 import sys
 import tempfile
@@ -17,6 +17,7 @@ from app.geospatial import WGS84
 from app.db.models.grass_curing import PercentGrassCuring
 from app.rocketchat_notifications import send_rocketchat_notification
 from app.stations import get_stations_asynchronously
+from app.weather_models.grid_index import get_station_grid_index
 
 logger = logging.getLogger(__name__)
 
@@ -80,17 +81,13 @@ class GrassCuringJob():
         :return: A tuple of a weather station code and the percent grass curing at its location.
         """
         raster_band = data_source.GetRasterBand(1)
-        data_np_array = raster_band.ReadAsArray()
-        data_np_array = np.array(data_np_array)
+        data_np_array = np.array(raster_band.ReadAsArray())
         forward_transform = Affine.from_gdal(*data_source.GetGeoTransform())
-        reverse_transform = ~forward_transform
-        for station in stations:
-            longitude = station.long
-            latitude = station.lat
-            px, py = reverse_transform * (longitude, latitude)
-            px = math.floor(px)
-            py = math.floor(py)
-            yield (station.code, data_np_array[py][px])
+        # The raster has been reprojected to EPSG:4326, so station coordinates can be used as is.
+        transformer = Transformer.from_crs(WGS84, WGS84, always_xy=True)
+        grid_index = get_station_grid_index(GRASS_CURING_COVERAGE_ID, stations, forward_transform, transformer,
+                                            raster_band.XSize, raster_band.YSize)
+        yield from zip(grid_index.station_codes.tolist(), grid_index.sample(data_np_array).tolist())
 
 
     async def _get_last_for_date(self):
@@ -0,0 +1,193 @@
+""" On disk cache of downloaded grib files.
+
+Files are stored by the hash of their url and version (ETag, or Last-Modified), so a file that changes on the
+server gets a new entry, and the old one is eventually evicted. Cached files are plain grib files, that GDAL can
+open (and memory map) directly, and they're hard linked into place when possible so a cache hit doesn't copy
+anything.
+
+Writes are atomic (written to a temporary file in the cache directory, then renamed), so several workers can
+share a cache directory, and files cached before a job crashed are reused when it's re-run. When the cache grows
+past its size limit, the least recently used files are evicted. The size of the cache is kept as a running total,
+so the cache directory is only walked when the cache first grows (and when it's full).
+"""
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from app import config
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+class CacheEntry(NamedTuple):
+    """ A cached version of a url """
+    url: str
+    path: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    stored_at: float
+
+
+@dataclass
+class CacheStats:
+    """ Counters for a grib cache """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def log(self, name: str):
+        logger.info('%s grib cache: %d hits, %d misses, %d evictions', name, self.hits, self.misses, self.evictions)
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+class GribCache:
+    """ Size bounded, content addressed, on disk cache of downloaded files.
+
+    The layout of the cache directory is:
+    objects/<first two characters of key>/<key><extension> - the cached files.
+    urls/<hash of url>.json - the latest version of each url, with the key of the file holding it.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        # Size of the cached files, calculated the first time a file is cached. Other workers sharing the
+        # directory aren't counted until it's next walked (on eviction).
+        self.total_bytes: Optional[int] = None
+        for name in ('objects', 'urls', 'tmp'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.directory, 'urls', f'{_hash(url)}.json')
+
+    def _object_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, 'objects', key[:2], f'{key}{extension}')
+
+    def _write_atomic(self, path: str, content: str):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+        with os.fdopen(file_descriptor, 'w') as file_object:
+            file_object.write(content)
+        os.replace(temporary_path, path)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """ The latest cached version of a url, or None if it isn't cached (or has been evicted). """
+        try:
+            with open(self._url_path(url), 'r') as file_object:
+                entry = CacheEntry(**json.load(file_object))
+        except (OSError, ValueError, TypeError):
+            entry = None
+        if entry is None or not os.path.exists(entry.path):
+            self.stats.misses += 1
+            return None
+        return entry
+
+    @staticmethod
+    def is_fresh(entry: CacheEntry, max_age_seconds: float) -> bool:
+        """ True if the entry was stored (or revalidated against the server) less than max_age_seconds ago. """
+        return time.time() - entry.stored_at < max_age_seconds
+
+    @staticmethod
+    def conditional_headers(entry: CacheEntry) -> Dict[str, str]:
+        """ Headers for a conditional request, that gets a 304 if the cached version is still current. """
+        if entry.etag:
+            return {'If-None-Match': entry.etag}
+        if entry.last_modified:
+            return {'If-Modified-Since': entry.last_modified}
+        return {}
+
+    def revalidated(self, entry: CacheEntry) -> CacheEntry:
+        """ Record that the server confirmed the cached version is current. """
+        entry = entry._replace(stored_at=time.time())
+        self._write_atomic(self._url_path(entry.url), json.dumps(entry._asdict()))
+        return entry
+
+    def copy_to(self, entry: CacheEntry, target: str) -> bool:
+        """ Put the cached file at target, returning False if it was evicted in the meantime. """
+        try:
+            # touch the file - eviction goes by least recently used.
+            os.utime(entry.path)
+            try:
+                os.link(entry.path, target)
+            except OSError:
+                # different file system (or no hard link support) - fall back to copying.
+                shutil.copyfile(entry.path, target)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return False
+        self.stats.hits += 1
+        return True
+
+    def put(self, url: str, source: str, etag: Optional[str], last_modified: Optional[str]) -> CacheEntry:
+        """ Cache the file at source as the latest version of url. """
+        key = _hash(f'{url}\n{etag or last_modified or ""}')
+        path = self._object_path(key, os.path.splitext(source)[1])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = os.path.join(self.directory, 'tmp', f'{key}.{os.getpid()}')
+        try:
+            os.link(source, temporary_path)
+        except OSError:
+            shutil.copyfile(source, temporary_path)
+        # The same version of a url may be cached again, replacing the file.
+        replaced_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary_path, path)
+        entry = CacheEntry(url, path, etag, last_modified, time.time())
+        self._write_atomic(self._url_path(url), json.dumps(entry._asdict()))
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self._list_files())
+        else:
+            self.total_bytes += os.path.getsize(path) - replaced_bytes
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        return entry
+
+    def _list_files(self) -> List[Tuple[float, int, str]]:
+        """ The modification time, size and path of every cached file """
+        files = []
+        for root, _, names in os.walk(os.path.join(self.directory, 'objects')):
+            for name in names:
+                try:
+                    file_stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((file_stat.st_mtime, file_stat.st_size, os.path.join(root, name)))
+        return files
+
+    def evict(self):
+        """ Remove the least recently used files until the cache is within its size limit. """
+        files = self._list_files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats.evictions += 1
+            logger.info('Evicted %s from grib cache', path)
+        self.total_bytes = total
+
+
+_grib_caches: Dict[str, GribCache] = {}
+
+
+def get_grib_cache() -> GribCache:
+    """ The grib cache for this process, in GRIB_CACHE_DIRECTORY (defaults to a directory in the system temp
+    directory) """
+    directory = config.get('GRIB_CACHE_DIRECTORY') or os.path.join(tempfile.gettempdir(), 'grib_cache')
+    if directory not in _grib_caches:
+        _grib_caches[directory] = GribCache(directory, int(config.get('GRIB_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+    return _grib_caches[directory]
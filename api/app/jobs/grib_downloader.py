@@ -0,0 +1,311 @@
+""" Concurrent downloading of weather model grib files.
+
+Model runs are made up of hundreds of grib files. Instead of downloading and processing one file at a time, files
+are downloaded concurrently (with a limit on the number of connections, and the request rate per host) while
+previously downloaded files are being processed. A bounded queue between the downloads and the processing limits
+how many downloaded files are waiting on disk at any one time.
+"""
+import asyncio
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+from time import perf_counter
+from typing import AsyncGenerator, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from app import config
+from app.jobs.grib_cache import CacheEntry, GribCache, get_grib_cache
+
+
+logger = logging.getLogger(__name__)
+
+# Downloads usually complete in seconds, but there is no default read timeout - without one a download may get
+# stuck for an indefinite amount of time.
+DOWNLOAD_TIMEOUT = ClientTimeout(total=None, sock_connect=60, sock_read=60)
+CHUNK_SIZE = 1024 * 1024
+
+
+class RetryableDownloadError(Exception):
+    """ Exception raised when a download failed in a way that is worth trying again (e.g. 503, or a truncated
+    response) """
+
+
+class CacheEvictedError(Exception):
+    """ Exception raised when the server confirmed the cached version of a file is current, but the cached
+    file was evicted before it could be used """
+
+
+class DownloadResult(NamedTuple):
+    """ Outcome of downloading a url. target is None if the url was not found. """
+    url: str
+    target: Optional[str]
+    error: Optional[Exception] = None
+
+
+@dataclass
+class DownloadStats:
+    """ Throughput metrics for a set of downloads """
+    files: int = 0
+    bytes: int = 0
+    not_found: int = 0
+    skipped: int = 0
+    cache_hits: int = 0
+    retries: int = 0
+    start: float = field(default_factory=perf_counter)
+
+    def log(self, name: str):
+        seconds = perf_counter() - self.start
+        megabytes = self.bytes / (1024 * 1024)
+        logger.info('%s: downloaded %d files (%.1f MB) in %.1f seconds (%.2f MB/s), '
+                    '%d unchanged, %d from cache, %d not found, %d retries',
+                    name, self.files, megabytes, seconds, megabytes / seconds if seconds > 0 else 0,
+                    self.skipped, self.cache_hits, self.not_found, self.retries)
+
+
+class HostRateLimiter:
+    """ Space out requests to the same host, so that no more than requests_per_second are started per host.
+    A requests_per_second of 0 disables rate limiting. """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_request: Dict[str, float] = {}
+
+    async def wait(self, host: str):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_request.get(host, now))
+        self._next_request[host] = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def get_download_filename(url: str, model_name: str) -> str:
+    """ Name of the file a url is downloaded to """
+    original_filename = os.path.split(url)[-1]
+    if model_name == 'GFS':
+        # NOTE: This is a very not-ideal way to interpolate the filename.
+        # The original_filename that we get from the url is too long and must be condensed.
+        # It also has multiple '.' chars in the URL that must be removed for the filename to be valid.
+        # As long as NOAA's API remains unchanged, we'll have all the info we need (run datetimes,
+        # projections, etc.) in the first 81 characters of original_filename.
+        # An alternative would be to build out a regex to look for
+        return original_filename[:81].replace('.', '')
+    return original_filename
+
+
+def _meta_path(target: str) -> str:
+    return f'{target}.meta'
+
+
+def _read_meta(target: str) -> dict:
+    try:
+        with open(_meta_path(target), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(target: str, meta: dict):
+    with open(_meta_path(target), 'w') as file:
+        json.dump(meta, file)
+
+
+def remove_download(target: str):
+    """ Delete a downloaded file, along with the ETag/Content-Length we kept for it """
+    for path in (target, _meta_path(target)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _is_unchanged(meta: dict, remote: dict, size: int) -> bool:
+    """ True if the file on the server is the one we have on disk. The ETag is used if the server gives us one,
+    otherwise the Last-Modified and Content-Length. """
+    if remote['etag'] and meta.get('etag'):
+        return remote['etag'] == meta['etag']
+    return (remote['last_modified'] is not None
+            and remote['last_modified'] == meta.get('last_modified')
+            and remote['content_length'] == size)
+
+
+class GribDownloader:
+    """ Download grib files concurrently, with a limit on the number of concurrent downloads, per host rate
+    limiting and retries with exponential backoff.
+
+    Files are streamed to a .part file, and moved into place once complete. A failed download is resumed from
+    where it left off (using a Range request) when retried, and a file that is already on disk is only downloaded
+    again if the ETag (or Last-Modified and Content-Length) on the server has changed.
+    """
+
+    def __init__(self,
+                 session: ClientSession,
+                 config_cache_var: Optional[str] = None,
+                 config_cache_expiry_var: Optional[str] = None,
+                 concurrency: Optional[int] = None,
+                 requests_per_second: Optional[float] = None,
+                 retries: Optional[int] = None,
+                 backoff_seconds: Optional[float] = None):
+        self.session = session
+        self.config_cache_var = config_cache_var
+        self.config_cache_expiry_var = config_cache_expiry_var
+        self.concurrency = concurrency or int(config.get('GRIB_DOWNLOAD_CONCURRENCY', 4))
+        self.rate_limiter = HostRateLimiter(requests_per_second if requests_per_second is not None
+                                            else float(config.get('GRIB_DOWNLOAD_REQUESTS_PER_SECOND', 10)))
+        self.retries = retries if retries is not None else int(config.get('GRIB_DOWNLOAD_RETRIES', 3))
+        self.backoff_seconds = backoff_seconds if backoff_seconds is not None \
+            else float(config.get('GRIB_DOWNLOAD_BACKOFF_SECONDS', 1))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.stats = DownloadStats()
+
+    def _get_cache(self) -> Optional[GribCache]:
+        # We don't strictly need to cache - but it helps a lot when debugging on a local machine, it saves having
+        # to re-download the file all the time, and a job that's re-run after a crash doesn't have to download
+        # everything again.
+        if self.config_cache_var and config.get(self.config_cache_var) == 'True':
+            return get_grib_cache()
+        return None
+
+    def log_stats(self, name: str):
+        """ Log the download stats, and the stats of the grib cache (if caching is on) """
+        self.stats.log(name)
+        cache = self._get_cache()
+        if cache:
+            cache.stats.log(name)
+
+    async def download(self, url: str, path: str, filename: str) -> Optional[str]:
+        """ Download a url to path/filename, retrying on connection errors, 429 and 5xx responses.
+
+        :return: The location of the downloaded file, or None if the url was not found.
+        """
+        target = os.path.join(path, filename)
+        cache = self._get_cache()
+        cached = cache.lookup(url) if cache else None
+        if cached and cache.is_fresh(cached, float(config.get(self.config_cache_expiry_var, 21600))) \
+                and cache.copy_to(cached, target):
+            logger.info('Cache hit %s', url)
+            self.stats.cache_hits += 1
+            return target
+
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    return await self._fetch(url, target, cache, cached)
+            except CacheEvictedError:
+                # download it again, without asking the server if the cached copy is current.
+                cached = None
+            except (RetryableDownloadError, ClientError, asyncio.TimeoutError) as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff_seconds * 2 ** attempt
+                attempt += 1
+                self.stats.retries += 1
+                logger.warning('Retrying %s in %.1f seconds: %r', url, delay, error)
+                await asyncio.sleep(delay)
+
+    async def _fetch(self,
+                     url: str,
+                     target: str,
+                     cache: Optional[GribCache],
+                     cached: Optional[CacheEntry]) -> Optional[str]:
+        part = f'{target}.part'
+        meta = _read_meta(target)
+        complete = os.path.exists(target)
+        offset = 0
+        headers = {}
+        if complete:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            elif meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        elif os.path.exists(part) and (meta.get('etag') or meta.get('last_modified')):
+            offset = os.path.getsize(part)
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = meta.get('etag') or meta['last_modified']
+        elif cached:
+            # the cached version is stale, check if the server has a newer one.
+            headers = cache.conditional_headers(cached)
+
+        await self.rate_limiter.wait(urlsplit(url).hostname)
+        logger.info('Downloading %s', url)
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304:
+                self.stats.skipped += 1
+                if not complete and cached:
+                    if not cache.copy_to(cache.revalidated(cached), target):
+                        raise CacheEvictedError(f'Cached copy of {url} was evicted')
+                    self.stats.cache_hits += 1
+                return target
+            if response.status == 404:
+                # We expect this to happen frequently - just log for info.
+                logger.info('404 error for %s', url)
+                self.stats.not_found += 1
+                return None
+            if response.status == 429 or response.status >= 500:
+                raise RetryableDownloadError(f'{response.status} response for {url}')
+            response.raise_for_status()
+
+            content_length = response.content_length
+            remote = {'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'content_length': content_length}
+            if complete and _is_unchanged(meta, remote, os.path.getsize(target)):
+                self.stats.skipped += 1
+                return target
+            if response.status != 206:
+                offset = 0
+            if content_length is not None:
+                remote['content_length'] = offset + content_length
+            # The validators are written before the body, so that an interrupted download can be resumed.
+            _write_meta(target, remote)
+            with open(part, 'ab' if offset else 'wb') as file_object:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    file_object.write(chunk)
+                    self.stats.bytes += len(chunk)
+
+        if remote['content_length'] is not None and os.path.getsize(part) != remote['content_length']:
+            raise RetryableDownloadError(f'Incomplete download of {url}')
+        os.replace(part, target)
+        self.stats.files += 1
+        if cache:
+            cache.put(url, target, remote['etag'], remote['last_modified'])
+        return target
+
+    async def download_all(self,
+                           downloads: Sequence[Tuple[str, str]],
+                           path: str,
+                           queue_size: Optional[int] = None) -> AsyncGenerator[DownloadResult, None]:
+        """ Download (url, filename) pairs into path, yielding each result as soon as its download completes.
+
+        Downloads continue in the background while the caller processes results. No more than queue_size
+        completed downloads are kept waiting, which bounds the amount of disk used. Download errors are
+        yielded (not raised) so that one bad url doesn't stop the rest of a model run.
+        """
+        pending: asyncio.Queue = asyncio.Queue()
+        for item in downloads:
+            pending.put_nowait(item)
+        results: asyncio.Queue = asyncio.Queue(
+            maxsize=queue_size or int(config.get('GRIB_DOWNLOAD_QUEUE_SIZE', self.concurrency)))
+
+        async def worker():
+            while True:
+                try:
+                    url, filename = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    result = DownloadResult(url, await self.download(url, path, filename))
+                except Exception as error:
+                    result = DownloadResult(url, None, error)
+                await results.put(result)
+
+        workers: List[asyncio.Task] = [asyncio.create_task(worker())
+                                       for _ in range(min(self.concurrency, len(downloads)))]
+        try:
+            for _ in range(len(downloads)):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -1,5 +1,6 @@
 """ A script that downloads weather models from NCEI NOAA HTTPS data server
 """
+import asyncio
 import os
 import sys
 import datetime
@@ -7,6 +8,7 @@ import pytz
 from typing import Generator
 import logging
 import tempfile
+from aiohttp import ClientSession
 from sqlalchemy.orm import Session
 from urllib.parse import parse_qs, urlsplit
 from app.db.crud.weather_models import (
@@ -17,7 +19,8 @@ from app.db.crud.weather_models import (
 )
 from app.jobs.common_model_fetchers import (CompletedWithSomeExceptions, ModelValueProcessor,
                                             apply_data_retention_policy, check_if_model_run_complete,
-                                            download, flag_file_as_processed)
+                                            flag_file_as_processed)
+from app.jobs.grib_downloader import DOWNLOAD_TIMEOUT, GribDownloader, get_download_filename, remove_download
 from app import configure_logging
 import app.utils.time as time_utils
 from app.weather_models import ModelEnum, ProjectionEnum
@@ -280,6 +283,14 @@ class NOAA():
     def process_model_run_urls(self, urls):
         """ Process the urls for a model run.
         """
+        asyncio.run(self._process_model_run_urls(urls))
+
+    async def _process_model_run_urls(self, urls):
+        """ Download the urls that haven't been processed yet, processing each grib file as soon as it has been
+        downloaded (while the rest are still downloading).
+        """
+        downloads = []
+        model_infos = {}
         for url in urls:
             try:
                 # check the database for a record of this file:
@@ -290,27 +301,41 @@ class NOAA():
                     logger.debug("file already processed %s", url)
                 else:
                     model_run_timestamp, prediction_timestamp = parse_url_for_timestamps(url, self.model_type)
-                    model_info = ModelRunInfo(self.model_type, self.projection, model_run_timestamp, prediction_timestamp)
-                    # download the file:
-                    with tempfile.TemporaryDirectory() as temporary_path:
-                        downloaded = download(url, temporary_path, "REDIS_CACHE_NOAA", self.model_type.value, "REDIS_NOAA_CACHE_EXPIRY")
+                    model_infos[url] = ModelRunInfo(self.model_type, self.projection, model_run_timestamp, prediction_timestamp)
+                    downloads.append((url, get_download_filename(url, self.model_type.value)))
+            except Exception as exception:
+                self.exception_count += 1
+                logger.error("unexpected exception processing %s", url, exc_info=exception)
+        if not downloads:
+            return
+
+        with tempfile.TemporaryDirectory() as temporary_path:
+            async with ClientSession(timeout=DOWNLOAD_TIMEOUT) as client_session:
+                downloader = GribDownloader(client_session, "REDIS_CACHE_NOAA", "REDIS_NOAA_CACHE_EXPIRY")
+                async for url, downloaded, error in downloader.download_all(downloads, temporary_path):
+                    try:
+                        if error:
+                            raise error
                         if downloaded:
                             self.files_downloaded += 1
                             # If we've downloaded the file ok, we can now process it.
                             try:
-                                self.grib_processor.process_grib_file(downloaded, model_info, self.session)
+                                # Processing happens in a thread, so that downloads continue in the meantime.
+                                await asyncio.to_thread(self.grib_processor.process_grib_file,
+                                                        downloaded, model_infos[url], self.session)
                                 # Flag the file as processed
                                 flag_file_as_processed(url, self.session)
                                 self.files_processed += 1
                             finally:
                                 # delete the file when done.
-                                os.remove(downloaded)
-            except Exception as exception:
-                self.exception_count += 1
-                # We catch and log exceptions, but keep trying to download.
-                # We intentionally catch a broad exception, as we want to try and download as much
-                # as we can.
-                logger.error("unexpected exception processing %s", url, exc_info=exception)
+                                remove_download(downloaded)
+                    except Exception as exception:
+                        self.exception_count += 1
+                        # We catch and log exceptions, but keep trying to download.
+                        # We intentionally catch a broad exception, as we want to try and download as much
+                        # as we can.
+                        logger.error("unexpected exception processing %s", url, exc_info=exception)
+                downloader.log_stats(self.model_type.value)
 
     def process_model_run(self, model_run_hour):
         """ Process a particular model run """
@@ -10,6 +10,7 @@ from datetime import timedelta, datetime, timezone
 from collections.abc import Generator
 import logging
 import tempfile
+from aiohttp import ClientSession
 from sqlalchemy.orm import Session
 from app.db.database import get_write_session_scope
 from app.db.crud.weather_models import (
@@ -19,7 +20,8 @@ from app.db.crud.weather_models import (
     get_rdps_sfms_urls_for_deletion,
     delete_rdps_sfms_urls,
 )
-from app.jobs.common_model_fetchers import CompletedWithSomeExceptions, download
+from app.jobs.common_model_fetchers import CompletedWithSomeExceptions
+from app.jobs.grib_downloader import DOWNLOAD_TIMEOUT, GribDownloader, remove_download
 from app.weather_models import ModelEnum
 from app import configure_logging
 import app.utils.time as time_utils
@@ -72,7 +74,8 @@ class RDPSGrib:
         return f"weather_models/{(ModelEnum.RDPS).lower()}/{self.date_key}/{model_run_hour:02d}/{weather_param}/{file_name}"
 
     async def _process_model_run_urls(self, model_run_hour: int, weather_param: str, urls: list[str]):
-        """Process the urls for a model run."""
+        """Process the urls for a model run, uploading each file to S3 as soon as it has been downloaded."""
+        downloads = []
         for url in urls:
             try:
                 # check the database for a record of this file:
@@ -80,30 +83,39 @@ class RDPSGrib:
                 if processed_url:
                     # This url has already been processed - so we skip it.
                     logger.debug("file already processed %s", url)
-                    continue
                 else:
-                    # download the file:
-                    with tempfile.TemporaryDirectory() as temporary_path:
-                        downloaded = download(url, temporary_path, "REDIS_CACHE_ENV_CANADA", ModelEnum.RDPS, "REDIS_ENV_CANADA_CACHE_EXPIRY")
+                    downloads.append((url, self._get_file_name_from_url(url)))
+            except Exception as exception:
+                self.exception_count += 1
+                logger.error("unexpected exception processing %s", url, exc_info=exception)
+        if not downloads:
+            return
+
+        with tempfile.TemporaryDirectory() as temporary_path:
+            async with ClientSession(timeout=DOWNLOAD_TIMEOUT) as client_session, get_client() as (client, bucket):
+                downloader = GribDownloader(client_session, "REDIS_CACHE_ENV_CANADA", "REDIS_ENV_CANADA_CACHE_EXPIRY")
+                async for url, downloaded, error in downloader.download_all(downloads, temporary_path):
+                    try:
+                        if error:
+                            raise error
                         if downloaded:
                             self.files_downloaded += 1
-                            file_name = self._get_file_name_from_url(url)
-                            file_path = os.path.join(temporary_path, file_name)
-                            key = self._generate_s3_key(model_run_hour, weather_param, file_name)
+                            key = self._generate_s3_key(model_run_hour, weather_param, os.path.basename(downloaded))
                             # If we've downloaded the file ok, we can now save it to S3 storage.
                             try:
-                                async with get_client() as (client, bucket):
-                                    await client.put_object(Bucket=bucket, Key=key, Body=open(file_path, "rb"))
-                                    create_saved_model_run_for_sfms_url(self.session, url, key)
+                                with open(downloaded, "rb") as file_object:
+                                    await client.put_object(Bucket=bucket, Key=key, Body=file_object)
+                                create_saved_model_run_for_sfms_url(self.session, url, key)
                             finally:
                                 # delete the file when done.
-                                os.remove(downloaded)
-            except Exception as exception:
-                self.exception_count += 1
-                # We catch and log exceptions, but keep trying to download.
-                # We intentionally catch a broad exception, as we want to try and download as much
-                # as we can.
-                logger.error("unexpected exception processing %s", url, exc_info=exception)
+                                remove_download(downloaded)
+                    except Exception as exception:
+                        self.exception_count += 1
+                        # We catch and log exceptions, but keep trying to download.
+                        # We intentionally catch a broad exception, as we want to try and download as much
+                        # as we can.
+                        logger.error("unexpected exception processing %s", url, exc_info=exception)
+                downloader.log_stats(f"RDPS {model_run_hour:02d}Z {weather_param}")
 
     async def _process_model_run(self, model_run_hour: int):
         """Process a particular RDPS model run"""
@@ -10,14 +10,14 @@ from fastapi.middleware.cors import CORSMiddleware
 import sentry_sdk
 from starlette.applications import Starlette
 from app import schemas, configure_logging
-from app.percentile import get_precalculated_percentiles
+from app.percentile import get_precalculated_percentiles, load_percentile_store
 from app.auth import authentication_required, audit
 from app import config
 from app import health
 from app import hourlies
 from app.rocketchat_notifications import send_rocketchat_notification
 from app.routers import fba, forecasts, weather_models, c_haines, stations, hfi_calc, fba_calc, sfms, morecast_v2
-from app.fire_behaviour.cffdrs import CFFDRS
+from app.fire_behaviour.cffdrs import CFFDRS, use_r_backend
 
 
 configure_logging()
@@ -140,14 +140,18 @@ async def get_health():
         logger.debug('/health - healthy: %s. %s',
                      health_check.get('healthy'), health_check.get('message'))
 
-        # Instantiate the CFFDRS singleton. Binding to R can take quite some time...
-        cffdrs_start = perf_counter()
-        CFFDRS.instance()
-        cffdrs_end = perf_counter()
-        delta = cffdrs_end - cffdrs_start
-        # Any delta below 100 milliseconds is just noise in the logs.
-        if delta > 0.1:
-            logger.info('%f seconds added by CFFDRS startup', delta)
+        # Load the pre-calculated percentiles, so the first percentile request doesn't have to.
+        await load_percentile_store()
+
+        if use_r_backend():
+            # Instantiate the CFFDRS singleton. Binding to R can take quite some time...
+            cffdrs_start = perf_counter()
+            CFFDRS.instance()
+            cffdrs_end = perf_counter()
+            delta = cffdrs_end - cffdrs_start
+            # Any delta below 100 milliseconds is just noise in the logs.
+            if delta > 0.1:
+                logger.info('%f seconds added by CFFDRS startup', delta)
 
         return health_check
     except Exception as exception:
@@ -179,6 +183,7 @@ async def get_percentiles(request: schemas.percentiles.PercentileRequest):
     try:
         logger.info('/percentiles/')
 
+        await load_percentile_store()
         percentiles = get_precalculated_percentiles(request)
 
         return percentiles
@@ -1,14 +1,113 @@
 """ This module contains logic to get pre-calculated 90th percentile.
 """
 
+import asyncio
 import os
 import logging
-from statistics import mean
+import sys
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
 from fastapi import HTTPException, status
 import app.schemas.percentiles
 
 logger = logging.getLogger(__name__)
 
+data_folder = os.path.join(os.path.dirname(__file__), 'data')
+
+
+class YearRangePercentiles:
+    """ The pre-calculated percentiles for all the stations in a year range, as columns: one row per station,
+    with ffmc, isi and bui as float arrays (nan where a station doesn't have a value). The station summaries are
+    kept as json, and only parsed for the stations in a response. """
+
+    def __init__(self, summaries: List[app.schemas.percentiles.StationSummary]):
+        self.records: List[bytes] = [summary.json().encode() for summary in summaries]
+        self.row_by_code: Dict[int, int] = {summary.station.code: row for row, summary in enumerate(summaries)}
+        self.ffmc = np.array([summary.ffmc or np.nan for summary in summaries], dtype=np.float64)
+        self.isi = np.array([summary.isi or np.nan for summary in summaries], dtype=np.float64)
+        self.bui = np.array([summary.bui or np.nan for summary in summaries], dtype=np.float64)
+        # Only stations with all three values count towards the mean values.
+        self.complete = ~(np.isnan(self.ffmc) | np.isnan(self.isi) | np.isnan(self.bui))
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the value columns, the station summaries and the station code lookup """
+        return (self.ffmc.nbytes + self.isi.nbytes + self.bui.nbytes + self.complete.nbytes
+                + sys.getsizeof(self.records) + sum(sys.getsizeof(record) for record in self.records)
+                + sys.getsizeof(self.row_by_code))
+
+    def summary(self, row: int) -> app.schemas.percentiles.StationSummary:
+        """ The station summary of a row """
+        return app.schemas.percentiles.StationSummary.parse_raw(self.records[row])
+
+    def rows(self, station_codes: Iterable[int]) -> np.ndarray:
+        """ The rows for a list of station codes. Raises KeyError for an unknown station code. """
+        return np.array([self.row_by_code[code] for code in station_codes], dtype=np.int64)
+
+
+class PercentileStore:
+    """ The pre-calculated percentiles for every year range in the data folder, keyed by (start, end) year. """
+
+    def __init__(self, year_ranges: Dict[Tuple[int, int], YearRangePercentiles]):
+        self.year_ranges = year_ranges
+
+    @classmethod
+    def load(cls, folder: str = data_folder) -> 'PercentileStore':
+        """ Load the <start>-<end>/<station code>.json files in folder """
+        year_ranges = {}
+        for name in sorted(os.listdir(folder)):
+            try:
+                year_range = tuple(int(year) for year in name.split('-'))
+            except ValueError:
+                continue
+            if len(year_range) != 2 or not os.path.isdir(os.path.join(folder, name)):
+                continue
+            summaries = [app.schemas.percentiles.StationSummary.parse_file(os.path.join(folder, name, filename))
+                         for filename in sorted(os.listdir(os.path.join(folder, name)))
+                         if filename.endswith('.json')]
+            year_ranges[year_range] = YearRangePercentiles(summaries)
+        store = cls(year_ranges)
+        logger.info('loaded percentiles for %d year ranges, %d stations, %d bytes',
+                    len(year_ranges), sum(len(percentiles.records) for percentiles in year_ranges.values()),
+                    store.nbytes)
+        return store
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the percentiles of all year ranges """
+        return sum(percentiles.nbytes for percentiles in self.year_ranges.values())
+
+    def get(self, start: int, end: int) -> Optional[YearRangePercentiles]:
+        """ The percentiles for a year range, or None if the year range isn't supported """
+        return self.year_ranges.get((start, end))
+
+
+_percentile_store: Optional[PercentileStore] = None
+_percentile_store_lock = threading.Lock()
+
+
+def get_percentile_store() -> PercentileStore:
+    """ The percentile store for this process, loaded on first use """
+    global _percentile_store  # pylint: disable=global-statement
+    if _percentile_store is None:
+        with _percentile_store_lock:
+            if _percentile_store is None:
+                _percentile_store = PercentileStore.load()
+    return _percentile_store
+
+
+async def load_percentile_store() -> PercentileStore:
+    """ The percentile store for this process, loaded (on first use) in a worker thread, so that reading the
+    files doesn't block the event loop """
+    if _percentile_store is not None:
+        return _percentile_store
+    return await asyncio.get_running_loop().run_in_executor(None, get_percentile_store)
+
+
+def _mean(values: np.ndarray) -> Optional[float]:
+    return float(values.mean()) if values.size else None
+
 
 def get_precalculated_percentiles(request: app.schemas.percentiles.PercentileRequest):
     """ Return the pre calculated percentile response
@@ -22,37 +121,31 @@ def get_precalculated_percentiles(request: app.schemas.percentiles.PercentileReq
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail='Weather station is not found.')
 
-    foldername = os.path.join(
-        os.path.dirname(__file__), f"data/{year_range_start}-{year_range_end}")
-    logger.info(foldername)
+    percentiles = get_percentile_store().get(year_range_start, year_range_end)
 
-    if not os.path.exists(foldername):
+    if percentiles is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail='The year range is not currently supported.')
 
+    try:
+        rows = percentiles.rows(request.stations)
+    except KeyError as error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='Weather station is not found.') from error
+
     response = app.schemas.percentiles.CalculatedResponse(
         percentile=90,
         year_range=app.schemas.percentiles.YearRange(
             start=year_range_start, end=year_range_end)
     )
 
-    bui = []
-    isi = []
-    ffmc = []
-    for code in request.stations:
-        filename = os.path.join(foldername, f"{code}.json")
-        summary = app.schemas.percentiles.StationSummary.parse_file(filename)
-
-        if summary.bui and summary.isi and summary.ffmc:
-            bui.append(summary.bui)
-            isi.append(summary.isi)
-            ffmc.append(summary.ffmc)
-
-        response.stations[code] = summary
+    for code, row in zip(request.stations, rows):
+        response.stations[code] = percentiles.summary(row)
 
+    complete_rows = rows[percentiles.complete[rows]]
     response.mean_values = app.schemas.percentiles.MeanValues()
-    response.mean_values.bui = mean(bui) if bui else None
-    response.mean_values.isi = mean(isi) if isi else None
-    response.mean_values.ffmc = mean(ffmc) if ffmc else None
+    response.mean_values.bui = _mean(percentiles.bui[complete_rows])
+    response.mean_values.isi = _mean(percentiles.isi[complete_rows])
+    response.mean_values.ffmc = _mean(percentiles.ffmc[complete_rows])
 
     return response
@@ -1,23 +1,22 @@
 """ Routers for HFI Calculator """
+import asyncio
 import logging
 import json
 from typing import List, Optional, Dict, Tuple
 from datetime import date
-from jinja2 import Environment, FunctionLoader
 from fastapi import APIRouter, HTTPException, Response, Depends, status
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
 from app.hfi.fire_centre_cache import (clear_cached_hydrated_fire_centres,
                                        get_cached_hydrated_fire_centres,
                                        put_cached_hydrated_fire_centres)
 from app.hfi.hfi_admin import get_unique_planning_area_ids, update_stations
 from app.utils.time import get_pst_now, get_utc_now
 from app.hfi.hfi_calc import calculate_latest_hfi_results, hydrate_fire_centres
-from app.hfi.pdf_generator import generate_pdf
-from app.hfi.pdf_template import get_template
+from app.hfi.pdf_renderer import PDFRenderQueueFull, PDFRenderTimeout, get_pdf_renderer
 from app.hfi.hfi_calc import (initialize_planning_area_fire_starts,
                               validate_date_range,
-                              load_fire_start_ranges)
+                              load_fire_start_ranges,
+                              run_in_read_session)
 from app.schemas.hfi_calc import (HFIAdminStationUpdateRequest, HFIAllReadyStatesResponse,
                                   HFIResultRequest,
                                   HFIResultResponse,
@@ -46,7 +45,7 @@ from app.db.crud.hfi_calc import (get_fuel_type_by_id,
                                   toggle_ready, save_hfi_stations, unready_planning_areas)
 from app.db.crud.hfi_calc import get_fuel_types as crud_get_fuel_types
 import app.db.models.hfi_calc
-from app.db.database import get_read_session_scope, get_write_session_scope
+from app.db.database import get_async_read_session_scope, get_async_write_session_scope
 
 
 logger = logging.getLogger(__name__)
@@ -60,8 +59,7 @@ router = APIRouter(
 )
 
 
-def get_prepared_request(
-        session: Session,
+async def get_prepared_request(
         fire_centre_id: int,
         date_range: Optional[DateRange]) -> Tuple[HFIResultRequest, bool, List[FireStartRange]]:
     """ Attempt to load the most recent request from the database, failing that creates a new request all
@@ -69,15 +67,18 @@ def get_prepared_request(
 
     TODO: give this function a better name.
     """
-    fire_centre_fire_start_ranges = list(load_fire_start_ranges(session, fire_centre_id))
     if date_range:
-        stored_request = get_most_recent_updated_hfi_request(session,
-                                                             fire_centre_id,
-                                                             date_range)
+        stored_request_query = run_in_read_session(get_most_recent_updated_hfi_request,
+                                                   fire_centre_id,
+                                                   date_range)
         # NOTE: We could be real nice here, and look for a prep period that intercepts, and grab data there.
     else:
         # No date range specified!
-        stored_request = get_most_recent_updated_hfi_request_for_current_date(session, fire_centre_id)
+        stored_request_query = run_in_read_session(get_most_recent_updated_hfi_request_for_current_date,
+                                                   fire_centre_id)
+    fire_centre_fire_start_ranges, stored_request = await asyncio.gather(
+        run_in_read_session(load_fire_start_ranges, fire_centre_id),
+        stored_request_query)
     request_loaded = True if stored_request else False
 
     if request_loaded:
@@ -100,7 +101,7 @@ def get_prepared_request(
 
         num_prep_days = date_range.days_in_range()
 
-        fire_centre_stations = get_fire_centre_stations(session, fire_centre_id)
+        fire_centre_stations = await run_in_read_session(get_fire_centre_stations, fire_centre_id)
         lowest_fire_starts = fire_centre_fire_start_ranges[0]
         for station, fuel_type in fire_centre_stations:
             selected_station_code_ids.add(station.station_code)
@@ -130,14 +131,12 @@ def get_prepared_request(
 
 
 async def calculate_and_create_response(
-        session: Session,
         result_request: HFIResultRequest,
         fire_centre_fire_start_ranges: List[FireStartRange]) -> HFIResultResponse:
     """ Calculate the HFI results and create a response object. """
 
     (results,
      valid_date_range) = await calculate_latest_hfi_results(
-        session,
         result_request,
         fire_centre_fire_start_ranges)
 
@@ -150,7 +149,7 @@ async def calculate_and_create_response(
         fire_start_ranges=fire_centre_fire_start_ranges)
 
 
-def save_request_in_database(request: HFIResultRequest, username: str) -> bool:
+async def save_request_in_database(request: HFIResultRequest, username: str) -> bool:
     """ Save the request to the database (if there's a valid prep period).
 
     Returns:
@@ -159,8 +158,8 @@ def save_request_in_database(request: HFIResultRequest, username: str) -> bool:
     if request.date_range is not None and \
             request.date_range.start_date is not None and \
             request.date_range.end_date is not None:
-        with get_write_session_scope() as session:
-            store_hfi_request(session, request, username)
+        async with get_async_write_session_scope() as session:
+            await store_hfi_request(session, request, username)
             return True
     return False
 
@@ -181,8 +180,8 @@ async def get_fuel_types(response: Response) -> FuelTypesResponse:
     # allow browser to cache fuel_types for 1 week because they won't change often (or possibly ever)
     response.headers["Cache-Control"] = "max-age=604800"
 
-    with get_read_session_scope() as session:
-        result = crud_get_fuel_types(session)
+    async with get_async_read_session_scope() as session:
+        result = await crud_get_fuel_types(session)
     fuel_types = []
     for fuel_type_record in result:
         fuel_types.append(fuel_type_model_to_schema(fuel_type_record))
@@ -199,27 +198,24 @@ async def set_planning_area_station(
                 fire_centre_id, start_date, end_date, planning_area_id, station_code, enable)
     response.headers["Cache-Control"] = no_cache
 
-    with get_read_session_scope() as session:
-        # We get an existing request object (it will load from the DB or create it
-        # from scratch if it doesn't exist).
-        request, _, fire_centre_fire_start_ranges = get_prepared_request(session,
-                                                                         fire_centre_id,
-                                                                         DateRange(
-                                                                             start_date=start_date,
-                                                                             end_date=end_date))
+    # We get an existing request object (it will load from the DB or create it
+    # from scratch if it doesn't exist).
+    request, _, fire_centre_fire_start_ranges = await get_prepared_request(fire_centre_id,
+                                                                           DateRange(
+                                                                               start_date=start_date,
+                                                                               end_date=end_date))
 
-        # Set the station selected or not.
-        station_info_list = request.planning_area_station_info[planning_area_id]
-        station_info = next(info for info in station_info_list if info.station_code == station_code)
-        station_info.selected = enable
+    # Set the station selected or not.
+    station_info_list = request.planning_area_station_info[planning_area_id]
+    station_info = next(info for info in station_info_list if info.station_code == station_code)
+    station_info.selected = enable
 
-        # Get the response.
-        request_response = await calculate_and_create_response(
-            session, request, fire_centre_fire_start_ranges)
+    # Get the response.
+    request_response = await calculate_and_create_response(request, fire_centre_fire_start_ranges)
 
     # We save the request in the database. (We do this right at the end, so that we don't
     # save a broken request by accident.)
-    save_request_in_database(request, token.get('idir_username', None))
+    await save_request_in_database(request, token.get('idir_username', None))
     return request_response
 
 
@@ -234,29 +230,27 @@ async def set_planning_area_station_fuel_type(
                 planning_area_id, station_code, fuel_type_id)
     response.headers["Cache-Control"] = no_cache
 
-    with get_read_session_scope() as session:
-        # We get an existing request object (it will load from the DB or create it
-        # from scratch if it doesn't exist).
-        request, _, fire_centre_fire_start_ranges = get_prepared_request(
-            session,
+    # We get an existing request object (it will load from the DB or create it
+    # from scratch if it doesn't exist), and the fuel type, at the same time.
+    (request, _, fire_centre_fire_start_ranges), fuel_type = await asyncio.gather(
+        get_prepared_request(
             fire_centre_id,
             DateRange(start_date=start_date,
-                      end_date=end_date))
+                      end_date=end_date)),
+        run_in_read_session(get_fuel_type_by_id, fuel_type_id))
 
-        # Validate the fuel type id.
-        fuel_type = get_fuel_type_by_id(session, fuel_type_id)
-        if fuel_type is None:
-            raise HTTPException(status_code=500, detail="Fuel type not found")
+    # Validate the fuel type id.
+    if fuel_type is None:
+        raise HTTPException(status_code=500, detail="Fuel type not found")
 
-        # Set the fuel type for the station.
-        station_info_list = request.planning_area_station_info[planning_area_id]
-        station_info = next(info for info in station_info_list if info.station_code == station_code)
-        station_info.fuel_type_id = fuel_type_id
+    # Set the fuel type for the station.
+    station_info_list = request.planning_area_station_info[planning_area_id]
+    station_info = next(info for info in station_info_list if info.station_code == station_code)
+    station_info.fuel_type_id = fuel_type_id
 
-        request_response = await calculate_and_create_response(
-            session, request, fire_centre_fire_start_ranges)
+    request_response = await calculate_and_create_response(request, fire_centre_fire_start_ranges)
 
-    save_request_in_database(request, token.get('idir_username', None))
+    await save_request_in_database(request, token.get('idir_username', None))
     return request_response
 
 
@@ -281,30 +275,27 @@ async def set_fire_start_range(
                 prep_day_date, fire_start_range_id)
     response.headers["Cache-Control"] = no_cache
 
-    with get_read_session_scope() as session:
-        # We get an existing request object (it will load from the DB or create it
-        # from scratch if it doesn't exist).
-        request, _, fire_centre_fire_start_ranges = get_prepared_request(session,
-                                                                         fire_centre_id,
-                                                                         DateRange(start_date=start_date,
-                                                                                   end_date=end_date))
-
-        # We set the fire start range in the planning area for the provided prep day.
-        if prep_day_date <= request.date_range.end_date:
-            delta = prep_day_date - request.date_range.start_date
-            fire_start_range = next(item for
-                                    item in fire_centre_fire_start_ranges if item.id == fire_start_range_id)
-            request.planning_area_fire_starts[planning_area_id][delta.days] = FireStartRange(
-                id=fire_start_range.id, label=fire_start_range.label)
-        else:
-            logger.info('prep date falls outside of the prep period')
+    # We get an existing request object (it will load from the DB or create it
+    # from scratch if it doesn't exist).
+    request, _, fire_centre_fire_start_ranges = await get_prepared_request(fire_centre_id,
+                                                                           DateRange(start_date=start_date,
+                                                                                     end_date=end_date))
+
+    # We set the fire start range in the planning area for the provided prep day.
+    if prep_day_date <= request.date_range.end_date:
+        delta = prep_day_date - request.date_range.start_date
+        fire_start_range = next(item for
+                                item in fire_centre_fire_start_ranges if item.id == fire_start_range_id)
+        request.planning_area_fire_starts[planning_area_id][delta.days] = FireStartRange(
+            id=fire_start_range.id, label=fire_start_range.label)
+    else:
+        logger.info('prep date falls outside of the prep period')
 
-        # Get the response.
-        request_response = await calculate_and_create_response(
-            session, request, fire_centre_fire_start_ranges)
+    # Get the response.
+    request_response = await calculate_and_create_response(request, fire_centre_fire_start_ranges)
 
     # We save the request in the database.
-    save_request_in_database(request, token.get('idir_username', None))
+    await save_request_in_database(request, token.get('idir_username', None))
     return request_response
 
 
@@ -333,20 +324,15 @@ async def get_hfi_result_with_date(fire_centre_id: int,
         logger.info('/hfi-calc/load/%s/%s/%s', fire_centre_id, start_date, end_date)
         response.headers["Cache-Control"] = no_cache
 
-        with get_read_session_scope() as session:
-            if start_date and end_date:
-                date_range = DateRange(start_date=start_date, end_date=end_date)
-            else:
-                date_range = None
-            request, _, fire_centre_fire_start_ranges = get_prepared_request(session,
-                                                                             fire_centre_id,
-                                                                             date_range)
-
-            # Get the response.
-            request_response = await calculate_and_create_response(
-                session, request, fire_centre_fire_start_ranges)
+        if start_date and end_date:
+            date_range = DateRange(start_date=start_date, end_date=end_date)
+        else:
+            date_range = None
+        request, _, fire_centre_fire_start_ranges = await get_prepared_request(fire_centre_id,
+                                                                               date_range)
 
-        return request_response
+        # Get the response.
+        return await calculate_and_create_response(request, fire_centre_fire_start_ranges)
 
     except Exception as exc:
         logger.critical(exc, exc_info=True)
@@ -382,16 +368,17 @@ async def get_all_ready_records(
     logger.info("/fire_centre/%s/start_date/%s/end_date/%s/ready", fire_centre_id, start_date, end_date)
     response.headers["Cache-Control"] = no_cache
 
-    with get_read_session_scope() as session:
-        hfi_request = get_most_recent_updated_hfi_request(session,
-                                                          fire_centre_id,
-                                                          DateRange(
-                                                              start_date=start_date,
-                                                              end_date=end_date))
+    async with get_async_read_session_scope() as session:
+        hfi_request = await get_most_recent_updated_hfi_request(session,
+                                                                fire_centre_id,
+                                                                DateRange(
+                                                                    start_date=start_date,
+                                                                    end_date=end_date))
         if hfi_request is None:
             return HFIAllReadyStatesResponse(ready_states=[])
         ready_states: List[HFIReadyState] = []
-        ready_records: List[app.db.models.hfi_calc.HFIReady] = get_latest_hfi_ready_records(session, hfi_request.id)
+        ready_records: List[app.db.models.hfi_calc.HFIReady] = await get_latest_hfi_ready_records(session,
+                                                                                                  hfi_request.id)
         for record in ready_records:
             ready_states.append(HFIReadyState(planning_area_id=record.planning_area_id,
                                               hfi_request_id=record.hfi_request_id,
@@ -411,9 +398,9 @@ async def toggle_planning_area_ready(fire_centre_id: int, planning_area_id: int,
                 fire_centre_id, planning_area_id, start_date, end_date)
     response.headers["Cache-Control"] = no_cache
 
-    with get_write_session_scope() as session:
+    async with get_async_write_session_scope() as session:
         username = token.get('idir_username', None)
-        ready_state = toggle_ready(session, fire_centre_id, planning_area_id, DateRange(
+        ready_state = await toggle_ready(session, fire_centre_id, planning_area_id, DateRange(
             start_date=start_date,
             end_date=end_date),
             username)
@@ -433,10 +420,10 @@ async def admin_update_stations(request: HFIAdminStationUpdateRequest,
     """ Apply updates for a list of stations. """
     logger.info('/hfi-calc/admin/stations')
     username = token.get('idir_username', None)
-    with get_write_session_scope() as db_session:
+    async with get_async_write_session_scope() as db_session:
         timestamp = get_utc_now()
-        stations_to_remove = get_stations_for_removal(db_session, request.removed)
-        all_planning_area_stations = get_stations_for_affected_planning_areas(db_session, request)
+        stations_to_remove = await get_stations_for_removal(db_session, request.removed)
+        all_planning_area_stations = await get_stations_for_affected_planning_areas(db_session, request)
         stations_to_save = update_stations(
             stations_to_remove,
             all_planning_area_stations,
@@ -445,13 +432,13 @@ async def admin_update_stations(request: HFIAdminStationUpdateRequest,
             username)
         affected_planning_area_ids = get_unique_planning_area_ids(stations_to_save)
         try:
-            save_hfi_stations(db_session, stations_to_save)
-            unready_planning_areas(db_session, request.fire_centre_id,
-                                   username, affected_planning_area_ids)
+            await save_hfi_stations(db_session, stations_to_save)
+            await unready_planning_areas(db_session, request.fire_centre_id,
+                                         username, affected_planning_area_ids)
             clear_cached_hydrated_fire_centres()
         except IntegrityError as exception:
             logger.info(exception, exc_info=exception)
-            db_session.rollback()
+            await db_session.rollback()
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="Station already exists in planning area")
 
@@ -467,38 +454,39 @@ async def get_pdf(
     """ Returns a PDF of the HFI results for the supplied fire centre and start date. """
     logger.info('/hfi-calc/fire_centre/%s/%s/%s/pdf', fire_centre_id, start_date, end_date)
 
-    with get_read_session_scope() as session:
-        if start_date and end_date:
-            date_range = DateRange(start_date=start_date, end_date=end_date)
-        else:
-            date_range = None
-
-        request, _, fire_centre_fire_start_ranges = get_prepared_request(session,
-                                                                         fire_centre_id,
-                                                                         date_range)
-
-        # Get the response.
-        request_response = await calculate_and_create_response(
-            session, request, fire_centre_fire_start_ranges)
+    if start_date and end_date:
+        date_range = DateRange(start_date=start_date, end_date=end_date)
+    else:
+        date_range = None
 
-        fuel_types_result = crud_get_fuel_types(session)
-        fuel_types: Dict[int, FuelType] = {fuel_type_record.id: fuel_type_model_to_schema(
-            fuel_type_record) for fuel_type_record in fuel_types_result}
+    request, _, fire_centre_fire_start_ranges = await get_prepared_request(fire_centre_id,
+                                                                           date_range)
 
-    fire_centres_list = await hydrate_fire_centres()
-
-    # Loads template as string from a function
-    # See: https://jinja.palletsprojects.com/en/3.0.x/api/?highlight=functionloader#jinja2.FunctionLoader
-    jinja_env = Environment(loader=FunctionLoader(get_template), autoescape=True)
+    # The response, fuel types and fire centres don't depend on each other.
+    request_response, fuel_types_result, fire_centres_list = await asyncio.gather(
+        calculate_and_create_response(request, fire_centre_fire_start_ranges),
+        run_in_read_session(crud_get_fuel_types),
+        hydrate_fire_centres())
+    fuel_types: Dict[int, FuelType] = {fuel_type_record.id: fuel_type_model_to_schema(
+        fuel_type_record) for fuel_type_record in fuel_types_result}
 
     username = token.get('idir_username', None)
 
-    pdf_bytes, pdf_filename = generate_pdf(request_response,
-                                           fire_centres_list,
-                                           username,
-                                           get_pst_now(),
-                                           jinja_env,
-                                           fuel_types)
+    # The PDF is rendered in a worker process, so this doesn't hold up the event loop.
+    try:
+        pdf_bytes, pdf_filename = await get_pdf_renderer().render(request_response,
+                                                                  fire_centres_list,
+                                                                  username,
+                                                                  get_pst_now(),
+                                                                  fuel_types)
+    except PDFRenderQueueFull as exception:
+        logger.warning(exception)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Too many PDFs are being generated, please try again shortly') from exception
+    except PDFRenderTimeout as exception:
+        logger.error(exception)
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail='PDF generation timed out') from exception
 
     return Response(pdf_bytes, headers={'Content-Disposition': f'attachment; filename={pdf_filename}',
                                         'Access-Control-Expose-Headers': 'Content-Disposition',
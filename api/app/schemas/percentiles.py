@@ -1,6 +1,6 @@
 """ This module contains pydandict schemas relating to the percentile calculator for the API.
 """
-from typing import List, Dict
+from typing import List, Dict, Optional
 from pydantic import BaseModel
 from app.schemas.stations import WeatherStation
 
@@ -20,9 +20,9 @@ class PercentileRequest(BaseModel):
 
 class StationSummary(BaseModel):
     """ The summary of daily weather data for a given station. """
-    ffmc: float = None
-    isi: float = None
-    bui: float = None
+    ffmc: Optional[float] = None
+    isi: Optional[float] = None
+    bui: Optional[float] = None
     years: List[int]
     station: WeatherStation
 
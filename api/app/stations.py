@@ -8,7 +8,6 @@ import logging
 import enum
 from typing import List, Final
 import json
-from aiohttp.client import ClientSession
 from sqlalchemy.engine.row import Row
 from app.schemas.stations import (WeatherStation,
                                   GeoJsonWeatherStation,
@@ -20,9 +19,8 @@ from app.schemas.stations import (WeatherStation,
 import app.db.database
 from app.db.crud.stations import get_noon_forecast_observation_union
 from app.wildfire_one import wfwx_api
-from app.wildfire_one.wfwx_api import (get_auth_header,
-                                       get_detailed_stations,
-                                       get_station_data,
+from app.wildfire_one.schema_parsers import station_list_mapper
+from app.wildfire_one.wfwx_api import (get_detailed_stations,
                                        use_wfwx)
 
 logger = logging.getLogger(__name__)
@@ -173,9 +171,7 @@ async def get_stations_as_geojson(
 
 async def get_stations_asynchronously():
     """ Get list of stations asynchronously """
-    async with ClientSession() as session:
-        header = await get_auth_header(session)
-        return await get_station_data(session, header)
+    return await wfwx_api.station_registry.map(station_list_mapper)
 
 
 def get_stations_synchronously(station_source: StationSourceEnum) -> List[WeatherStation]:
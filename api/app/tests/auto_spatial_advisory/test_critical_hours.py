@@ -1,10 +1,27 @@
 import os
+from datetime import date, datetime, timezone
+from unittest.mock import AsyncMock
 import pytest
 import math
 import numpy as np
 import json
-from app.auto_spatial_advisory.critical_hours import CriticalHoursInputs, calculate_representative_hours, check_station_valid, determine_start_time, determine_end_time
+from app.auto_spatial_advisory import critical_hours as critical_hours_module
+from app.auto_spatial_advisory.critical_hours import (
+    CriticalHoursInputs,
+    calculate_critical_hours_by_zone,
+    calculate_critical_hours_for_zones,
+    calculate_representative_hours,
+    check_station_valid,
+    determine_start_time,
+    determine_end_time,
+)
+from app.fire_behaviour import cffdrs
+from app.fire_behaviour.fuel_types import FUEL_TYPE_DEFAULTS, FuelTypeEnum
+from app.fire_behaviour.prediction import build_hourly_rh_dict, calculate_cfb, get_critical_hours
 from app.schemas.fba_calc import CriticalHoursHFI
+from app.schemas.observations import WeatherReading, WeatherStationHourlyReadings
+from app.schemas.stations import WeatherStation
+from app.utils.time import get_julian_date
 from app.wildfire_one.schema_parsers import WFWXWeatherStation
 
 dirname = os.path.dirname(__file__)
@@ -138,3 +155,142 @@ def test_representative_hours(critical_hours, expected_start_end):
     Given a list of critical hours, return the representative critical hours
     """
     assert calculate_representative_hours(critical_hours) == expected_start_end
+
+
+def _critical_hours_inputs(stations):
+    """
+    Builds dailies, yesterday dailies and morning hourlies for the given stations, with the station's index varying the weather
+    """
+    dailies, yesterdays, hourlies = {}, {}, {}
+    for index, station in enumerate(stations):
+        dailies[station.wfwx_id] = {
+            "duffMoistureCode": 60 + 10 * index,
+            "droughtCode": 300 + 20 * index,
+            "fineFuelMoistureCode": 90,
+            "temperature": 24 + index,
+            "relativeHumidity": 25,
+            "windSpeed": 10 + 3 * index,
+            "precipitation": 0,
+        }
+        yesterdays[station.wfwx_id] = {"fineFuelMoistureCode": 89 + index, "grasslandCuring": 80}
+        readings = [
+            WeatherReading(datetime=datetime(2024, 8, 15, 14 + hour, tzinfo=timezone.utc), relative_humidity=70 - 8 * hour - index) for hour in range(6)
+        ]
+        hourlies[station.code] = WeatherStationHourlyReadings(values=readings, station=WeatherStation(code=station.code, name=station.name, lat=station.lat, long=station.long))
+    return CriticalHoursInputs(dailies_by_station_id=dailies, yesterday_dailies_by_station_id=yesterdays, hourly_observations_by_station_code=hourlies)
+
+
+def _scalar_critical_hours(station, critical_hours_inputs, fuel_type, for_date):
+    """
+    Critical hours for a station and fuel type, calculated one value at a time
+    """
+    daily = critical_hours_inputs.dailies_by_station_id[station.wfwx_id]
+    yesterday = critical_hours_inputs.yesterday_dailies_by_station_id[station.wfwx_id]
+    rh_values = build_hourly_rh_dict(critical_hours_inputs.hourly_observations_by_station_code[station.code].values)
+    info = FUEL_TYPE_DEFAULTS[fuel_type]
+    bui = cffdrs.bui_calc(daily["duffMoistureCode"], daily["droughtCode"])
+    ffmc = cffdrs.fine_fuel_moisture_code(yesterday["fineFuelMoistureCode"], daily["temperature"], daily["relativeHumidity"], daily["precipitation"], daily["windSpeed"])
+    isi = cffdrs.initial_spread_index(ffmc, daily["windSpeed"])
+    fmc = cffdrs.foliar_moisture_content(int(station.lat), int(station.long), station.elevation, get_julian_date(for_date))
+    sfc = cffdrs.surface_fuel_consumption(fuel_type, bui, ffmc, info["PC"])
+    ros = cffdrs.rate_of_spread(fuel_type, isi, bui, fmc, sfc, info["PC"], yesterday["grasslandCuring"], info["PDF"], info["CBH"])
+    cfb = calculate_cfb(fuel_type, fmc, sfc, ros, info["CBH"])
+    return get_critical_hours(
+        4000, fuel_type, info["PC"], info["PDF"], bui, yesterday["grasslandCuring"], info["CBH"], ffmc, fmc, cfb, info["CFL"], daily["windSpeed"], yesterday["fineFuelMoistureCode"], rh_values
+    )
+
+
+zone_stations = [
+    WFWXWeatherStation(wfwx_id=f"station-{index}", code=index, name=f"STATION {index}", latitude=49 + index, longitude=-120 - index, elevation=500 + 100 * index, zone_code=None)
+    for index in range(4)
+]
+
+
+def test_calculate_critical_hours_for_zones():
+    """
+    Critical hours calculated for all zones at once match calculating each station and fuel type separately
+    """
+    stations_by_zone = {1: zone_stations[:2], 2: zone_stations[2:]}
+    fuel_types_by_zone = {1: {"C-2": 10.0, "C-3": 5.0, "M-1/M-2": 1.0}, 2: {"C-2": 3.0, "O-1a/O-1b": 7.0, "S-1": 2.0}}
+    inputs = _critical_hours_inputs(zone_stations)
+    for_date = date(2024, 8, 15)
+
+    result = calculate_critical_hours_for_zones(stations_by_zone, fuel_types_by_zone, inputs, for_date)
+
+    expected_count = 0
+    for zone_id, stations in stations_by_zone.items():
+        for fuel_type_key in fuel_types_by_zone[zone_id]:
+            expected = []
+            if fuel_type_key != "M-1/M-2":
+                fuel_type = FuelTypeEnum.O1B if fuel_type_key.startswith("O") else FuelTypeEnum(fuel_type_key.replace("-", ""))
+                expected = [hours for hours in (_scalar_critical_hours(station, inputs, fuel_type, for_date) for station in stations) if hours is not None]
+            expected_count += len(expected)
+            assert result.get(zone_id, {}).get(fuel_type_key, []) == expected
+    assert expected_count > 0
+
+
+def test_calculate_critical_hours_for_zones_skips_invalid_stations():
+    """
+    Stations without hourlies are left out, and zones without any critical hours aren't in the result
+    """
+    inputs = _critical_hours_inputs(zone_stations)
+    del inputs.hourly_observations_by_station_code[zone_stations[0].code]
+    result = calculate_critical_hours_for_zones({1: zone_stations[:1], 2: zone_stations[1:2]}, {1: {"C-2": 1.0}, 2: {"C-2": 1.0}}, inputs, date(2024, 8, 15))
+    assert list(result.keys()) == [2]
+    assert len(result[2]["C-2"]) == 1
+
+
+def test_calculate_critical_hours_for_zones_skips_malformed_station():
+    """
+    A station with malformed data is logged and left out, the other stations are still calculated
+    """
+    inputs = _critical_hours_inputs(zone_stations)
+    inputs.dailies_by_station_id[zone_stations[1].wfwx_id]["temperature"] = "not a number"
+    fuel_types_by_zone = {1: {"C-2": 1.0, "C-3": 1.0}}
+    result = calculate_critical_hours_for_zones({1: zone_stations[:3]}, fuel_types_by_zone, inputs, date(2024, 8, 15))
+    expected = calculate_critical_hours_for_zones({1: zone_stations[0:3:2]}, fuel_types_by_zone, _critical_hours_inputs(zone_stations), date(2024, 8, 15))
+    assert result == expected
+    assert len(result[1]["C-2"]) > 0
+
+
+def test_calculate_critical_hours_for_zones_isolates_failing_rows(monkeypatch: pytest.MonkeyPatch):
+    """
+    If calculating all the rows at once fails, each row is calculated separately, and only the rows that fail are left out
+    """
+    stations_by_zone = {1: zone_stations[:2], 2: zone_stations[2:]}
+    fuel_types_by_zone = {1: {"C-2": 10.0, "C-3": 5.0}, 2: {"C-2": 3.0, "S-1": 2.0}}
+    inputs = _critical_hours_inputs(zone_stations)
+    for_date = date(2024, 8, 15)
+    # station 1 is the only station with a yesterday FFMC of 90
+    expected = calculate_critical_hours_for_zones({1: zone_stations[:1], 2: zone_stations[2:]}, fuel_types_by_zone, inputs, for_date)
+    get_critical_hours_batch = critical_hours_module.get_critical_hours_batch
+
+    def failing_get_critical_hours_batch(*args):
+        if np.any(args[12] == 90):
+            raise ValueError("bad row")
+        return get_critical_hours_batch(*args)
+
+    monkeypatch.setattr(critical_hours_module, "get_critical_hours_batch", failing_get_critical_hours_batch)
+    result = calculate_critical_hours_for_zones(stations_by_zone, fuel_types_by_zone, inputs, for_date)
+    assert result == expected
+    assert len(result[1]["C-2"]) > 0
+
+
+@pytest.mark.anyio
+async def test_calculate_critical_hours_by_zone_fetches_inputs_once(anyio_backend, monkeypatch: pytest.MonkeyPatch):
+    """
+    Dailies and hourlies are fetched once for the stations of every zone
+    """
+    inputs = _critical_hours_inputs(zone_stations)
+    get_inputs = AsyncMock(return_value=inputs)
+    save = AsyncMock()
+    monkeypatch.setattr(critical_hours_module, "get_inputs_for_critical_hours", get_inputs)
+    monkeypatch.setattr(critical_hours_module, "get_fuel_type_stats_in_advisory_area", AsyncMock(return_value=[]))
+    monkeypatch.setattr(critical_hours_module, "get_fuel_types_by_area", lambda _: {"C-2": 1.0})
+    monkeypatch.setattr(critical_hours_module, "save_critical_hours", save)
+
+    await calculate_critical_hours_by_zone(None, {}, {1: zone_stations[:2], 2: zone_stations[2:]}, 1, date(2024, 8, 15))
+
+    get_inputs.assert_called_once()
+    assert [station.code for station in get_inputs.call_args.args[2]] == [0, 1, 2, 3]
+    assert sorted(call.args[1] for call in save.call_args_list) == [1, 2]
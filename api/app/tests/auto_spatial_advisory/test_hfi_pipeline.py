@@ -0,0 +1,67 @@
+""" Unit tests for the shared HFI processing pipeline """
+from datetime import date, datetime, timezone
+from unittest.mock import AsyncMock
+import pytest
+from app.auto_spatial_advisory import nats_consumer
+from app.auto_spatial_advisory.hfi_pipeline import HfiPipeline, use_hfi_pipeline
+from app.auto_spatial_advisory.run_type import RunType
+
+run_date = date(2024, 8, 10)
+run_datetime = datetime(2024, 8, 10, 20, tzinfo=timezone.utc)
+for_date = date(2024, 8, 11)
+
+
+def test_use_hfi_pipeline(mocker):
+    """ A stage run on its own gets a pipeline of its own, which is closed when the stage is done """
+    close = mocker.patch.object(HfiPipeline, "close")
+    shared = HfiPipeline(RunType.FORECAST, run_date, run_datetime, for_date)
+    with use_hfi_pipeline(shared, RunType.FORECAST, run_date, run_datetime, for_date) as pipeline:
+        assert pipeline is shared
+    assert close.call_count == 0
+
+    with use_hfi_pipeline(None, RunType.FORECAST, run_date, run_datetime, for_date) as pipeline:
+        assert pipeline is not shared
+        assert pipeline.hfi_key.endswith("/sfms/uploads/forecast/2024-08-10/hfi20240811.tif")
+    assert close.call_count == 1
+
+
+def test_hfi_fetched_once(mocker):
+    """ The hfi raster is only fetched from S3 and classified once, however many stages use it """
+    translate = mocker.patch("app.auto_spatial_advisory.hfi_pipeline.gdal.Translate")
+    classify = mocker.patch("app.auto_spatial_advisory.hfi_pipeline.classify_hfi")
+    pipeline = HfiPipeline(RunType.ACTUAL, run_date, run_datetime, for_date)
+    assert pipeline.get_classified_hfi_path() == pipeline.get_classified_hfi_path() == f"{pipeline.work_dir}/classified.tif"
+    assert pipeline.get_hfi_path() == f"{pipeline.work_dir}/hfi.tif"
+    translate.assert_called_once_with(f"{pipeline.work_dir}/hfi.tif", pipeline.hfi_key, format="GTiff")
+    classify.assert_called_once_with(f"{pipeline.work_dir}/hfi.tif", f"{pipeline.work_dir}/classified.tif")
+
+
+@pytest.mark.anyio
+async def test_process_sfms_hfi(monkeypatch, mocker):
+    """ Every stage shares one pipeline, and gets timed """
+    close = mocker.patch.object(HfiPipeline, "close")
+    stages = {name: AsyncMock() for name in ["process_hfi", "process_hfi_elevation", "process_high_hfi_area", "process_fuel_type_hfi_by_shape", "calculate_critical_hours"]}
+    for name, stage in stages.items():
+        monkeypatch.setattr(nats_consumer, name, stage)
+    log_stage_timings = mocker.spy(HfiPipeline, "log_stage_timings")
+
+    await nats_consumer.process_sfms_hfi(RunType.FORECAST, run_date, run_datetime, for_date)
+
+    pipeline = stages["process_hfi"].call_args.args[-1]
+    assert isinstance(pipeline, HfiPipeline)
+    assert stages["process_hfi_elevation"].call_args.args[-1] is pipeline
+    assert stages["process_fuel_type_hfi_by_shape"].call_args.args[-1] is pipeline
+    assert list(pipeline.stage_timings) == list(stages)
+    assert log_stage_timings.call_count == 1
+    assert close.call_count == 1
+
+
+@pytest.mark.anyio
+async def test_process_sfms_hfi_failure_closes_pipeline(monkeypatch, mocker):
+    """ A failing stage still releases the in memory rasters """
+    close = mocker.patch.object(HfiPipeline, "close")
+    monkeypatch.setattr(nats_consumer, "process_hfi", AsyncMock())
+    monkeypatch.setattr(nats_consumer, "process_hfi_elevation", AsyncMock(side_effect=RuntimeError("boom")))
+    with pytest.raises(RuntimeError):
+        await nats_consumer.process_sfms_hfi(RunType.FORECAST, run_date, run_datetime, for_date)
+    assert close.call_count == 1
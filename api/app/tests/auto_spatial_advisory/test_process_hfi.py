@@ -0,0 +1,50 @@
+""" Unit tests for converting and writing classified hfi polygons """
+from datetime import date, datetime, timezone
+from unittest.mock import AsyncMock
+import pytest
+import shapely
+from shapely.geometry import Polygon
+from app.auto_spatial_advisory.process_hfi import UnknownHFiClassification, create_classified_hfi_rows
+from app.auto_spatial_advisory.run_type import RunType
+from app.db.crud.auto_spatial_advisory import save_classified_hfi
+from app.db.models.auto_spatial_advisory import HfiClassificationThreshold, RunTypeEnum
+
+advisory = HfiClassificationThreshold(id=1, name="advisory")
+warning = HfiClassificationThreshold(id=2, name="warning")
+run_datetime = datetime(2024, 8, 10, 20, tzinfo=timezone.utc)
+for_date = date(2024, 8, 11)
+
+
+def test_create_classified_hfi_rows():
+    """ Geometries are reprojected to EPSG:3005, made valid and written as EWKB """
+    square = Polygon([(-123.0, 49.0), (-123.0, 49.1), (-122.9, 49.1), (-122.9, 49.0)])
+    bowtie = Polygon([(-123.0, 49.0), (-122.9, 49.1), (-122.9, 49.0), (-123.0, 49.1)])
+    rows = create_classified_hfi_rows([1, 2], [square.wkb, bowtie.wkb], 4326, advisory, warning, RunType.FORECAST, run_datetime, for_date)
+
+    assert [row["threshold"] for row in rows] == [1, 2]
+    assert all(row["run_type"] == RunTypeEnum.forecast and row["for_date"] == for_date for row in rows)
+    geoms = [shapely.from_wkb(row["geom"]) for row in rows]
+    assert all(shapely.get_srid(geom) == 3005 for geom in geoms)
+    assert all(geom.is_valid for geom in geoms)
+    # BC Albers coordinates for southern BC
+    min_x, min_y, _, _ = geoms[0].bounds
+    assert 1.2e6 < min_x < 1.3e6
+    assert 4.4e5 < min_y < 4.6e5
+
+
+def test_create_classified_hfi_rows_unknown_hfi():
+    """ Only hfi values 1 (advisory) and 2 (warning) are expected """
+    square = Polygon([(0, 0), (0, 1), (1, 1), (1, 0)])
+    with pytest.raises(UnknownHFiClassification):
+        create_classified_hfi_rows([1, 3], [square.wkb, square.wkb], 3005, advisory, warning, RunType.ACTUAL, run_datetime, for_date)
+
+
+@pytest.mark.anyio
+async def test_save_classified_hfi_batches():
+    """ Rows are written with one multi-row insert per batch """
+    session = AsyncMock()
+    rows = [{"threshold": 1, "run_type": RunTypeEnum.actual, "run_datetime": run_datetime, "for_date": for_date, "geom": None}] * 5
+    await save_classified_hfi(session, rows, 2)
+    assert session.execute.await_count == 3
+    await save_classified_hfi(session, [], 2)
+    assert session.execute.await_count == 3
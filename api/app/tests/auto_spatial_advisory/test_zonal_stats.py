@@ -0,0 +1,96 @@
+""" Unit tests for single pass zonal statistics """
+from unittest.mock import AsyncMock, MagicMock
+import numpy as np
+import pytest
+from app.auto_spatial_advisory import zonal_stats
+from app.auto_spatial_advisory.elevation import ELEVATION_PERCENTILES, get_elevation_stats
+from app.auto_spatial_advisory.process_fuel_type_area import calculate_fuel_type_areas
+from app.auto_spatial_advisory.zonal_stats import get_zone_index, get_zone_label_rasters, zonal_percentiles, zonal_value_counts
+from app.db.models.auto_spatial_advisory import SFMSFuelType
+
+# zone 7 doesn't cover any pixels, 0 is outside every zone
+zone_ids = np.array([3, 5, 7])
+labels = np.array([[3, 3, 5, 0], [3, 5, 5, 0], [0, 5, 3, 3]], dtype=np.uint16)
+values = np.array([[1, 2, 2, 9], [0, 4, 2, 9], [1, 1, 4, 1]], dtype=np.int16)
+
+
+def test_zone_index():
+    """ Labels map to the position of their zone, -1 outside any zone """
+    assert get_zone_index(labels, zone_ids).tolist() == [0, 0, 1, -1, 0, 1, 1, -1, -1, 1, 0, 0]
+
+
+def test_zonal_value_counts():
+    """ Counts of each value per zone, matching a per zone np.unique """
+    counts = zonal_value_counts(labels, values, zone_ids)
+    # values outside every zone (9) don't widen the result
+    assert counts.shape == (3, 5)
+    for row, zone_id in enumerate(zone_ids):
+        zone_values, zone_counts = np.unique(values[labels == zone_id], return_counts=True)
+        expected = np.zeros(5, dtype=np.int64)
+        expected[zone_values] = zone_counts
+        assert counts[row].tolist() == expected.tolist()
+    assert zonal_value_counts(labels, values, zone_ids, num_values=3)[1].tolist() == [0, 1, 2]
+
+
+def test_zonal_percentiles():
+    """ Percentiles per zone match np.percentile on each zone's values """
+    rng = np.random.default_rng(42)
+    random_labels = rng.integers(0, 6, size=(50, 40))
+    dem = rng.integers(-10, 3000, size=(50, 40)).astype(np.int16)
+    dem[rng.random((50, 40)) < 0.3] = 0
+    random_zone_ids = np.array([1, 2, 3, 4, 5, 6])
+    percentiles, counts = zonal_percentiles(random_labels, dem, random_zone_ids, ELEVATION_PERCENTILES, mask=dem != 0)
+    for row, zone_id in enumerate(random_zone_ids):
+        zone_values = dem[(random_labels == zone_id) & (dem != 0)]
+        assert counts[row] == len(zone_values)
+        if len(zone_values) == 0:
+            assert np.isnan(percentiles[row]).all()
+        else:
+            assert np.allclose(percentiles[row], np.percentile(zone_values, ELEVATION_PERCENTILES))
+
+
+def test_elevation_stats():
+    """ Elevation stats for a zone with values, and all 0 for a zone without """
+    percentiles, counts = zonal_percentiles(labels, values, zone_ids, ELEVATION_PERCENTILES, mask=values != 0)
+    assert get_elevation_stats(percentiles[0], counts[0]) == {"minimum": 1, "maximum": 4, "median": 1.5, "quartile_25": 1, "quartile_75": 2.5}
+    assert get_elevation_stats(percentiles[2], counts[2]) == {"minimum": 0, "maximum": 0, "median": 0, "quartile_25": 0, "quartile_75": 0}
+
+
+def test_fuel_type_areas():
+    """ Only combustible fuel types with some area are included """
+    fuel_types = [SFMSFuelType(fuel_type_id=fuel_type_id) for fuel_type_id in [-10000, 1, 2, 4, 99, 102]]
+    counts = zonal_value_counts(labels, values, zone_ids, num_values=256)
+    assert calculate_fuel_type_areas(counts[1], 4e6, fuel_types) == {1: 4e6, 2: 8e6, 4: 4e6}
+    assert calculate_fuel_type_areas(counts[2], 4e6, fuel_types) == {}
+
+
+@pytest.mark.anyio
+async def test_overlapping_shapes(anyio_backend, monkeypatch: pytest.MonkeyPatch):
+    """ A fire centre and the fire zone units inside it each get every pixel they cover """
+    fire_centre, fire_zone_unit = 1, 3
+    # fire centre 20 covers the whole grid, fire zone units 4 and 9 split it
+    burned_labels = {
+        fire_centre: np.full((2, 3), 20, dtype=np.uint16),
+        fire_zone_unit: np.array([[4, 4, 9], [4, 9, 9]], dtype=np.uint16),
+    }
+    rasterize_zones = MagicMock(side_effect=lambda grid_key, shape_type, max_zone_id: burned_labels[shape_type])
+    monkeypatch.setattr(zonal_stats, "_zone_label_cache", {})
+    monkeypatch.setattr(zonal_stats, "rasterize_zones", rasterize_zones)
+    monkeypatch.setattr(zonal_stats, "get_zone_shapes_version", AsyncMock(return_value=(3, 20)))
+    monkeypatch.setattr(zonal_stats, "get_zone_shape_ids", AsyncMock(return_value=[(fire_centre, 20), (fire_zone_unit, 4), (fire_zone_unit, 9)]))
+    dataset = MagicMock()
+    dataset.GetGeoTransform.return_value = (0, 2000, 0, 0, 0, -2000)
+    dataset.RasterXSize, dataset.RasterYSize = 3, 2
+
+    zone_label_rasters = await get_zone_label_rasters(MagicMock(), dataset)
+
+    fuel_types = np.array([[1, 2, 2], [1, 1, 2]])
+    counts = {}
+    for raster in zone_label_rasters:
+        for zone_id, zone_counts in zip(raster.zone_ids, zonal_value_counts(raster.labels, fuel_types, raster.zone_ids, num_values=3)):
+            counts[int(zone_id)] = zone_counts.tolist()
+    assert counts == {20: [0, 3, 3], 4: [0, 2, 1], 9: [0, 1, 2]}
+    assert [call.args[1] for call in rasterize_zones.call_args_list] == [fire_centre, fire_zone_unit]
+    # the grid is only rasterized once
+    assert await get_zone_label_rasters(MagicMock(), dataset) is zone_label_rasters
+    assert rasterize_zones.call_count == 2
@@ -0,0 +1,56 @@
+""" Unit tests for the in memory zone spatial index """
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+import numpy as np
+import pytest
+from shapely.geometry import MultiPolygon, box
+from app.auto_spatial_advisory import zone_spatial_index
+from app.auto_spatial_advisory.zone_spatial_index import NO_ZONE, ZoneSpatialIndex, group_stations_by_zone, transform_coordinates
+
+
+def _zone_rows():
+    # two zones side by side, and a third overlapping the east half of zone 2
+    return [
+        (1, MultiPolygon([box(0, 0, 10, 10)]).wkb),
+        (2, MultiPolygon([box(10, 0, 20, 10)]).wkb),
+        (3, MultiPolygon([box(15, 0, 30, 10)]).wkb),
+    ]
+
+
+def test_find_zones():
+    """ Points are assigned to the zone containing them, lowest id where zones overlap """
+    index = ZoneSpatialIndex.from_wkb(_zone_rows())
+    zones = index.find_zones([5, 12, 17, 25, 50, 10], [5, 5, 5, 5, 5, 5])
+    # (10, 5) is on a shared boundary, which ST_Contains doesn't consider contained
+    assert zones.tolist() == [1, 2, 2, 3, NO_ZONE, NO_ZONE]
+    assert index.find_zones([], []).tolist() == []
+
+
+def test_transform_coordinates():
+    """ Coordinates are (lat, long), like PointTransformer; BC Albers has a false easting of 1,000,000 at its origin (45N, 126W) """
+    xs, ys = transform_coordinates([45.0, 45.0], [-126.0, -126.0], 4326)
+    assert xs == pytest.approx([1000000.0, 1000000.0], abs=0.01)
+    assert ys == pytest.approx([0.0, 0.0], abs=0.01)
+
+
+@pytest.mark.anyio
+async def test_group_stations_by_zone(monkeypatch):
+    """ Index is built once and reused until the shapes version changes """
+    version = AsyncMock(return_value=(3, 3))
+    shapes = AsyncMock(return_value=_zone_rows())
+    monkeypatch.setattr(zone_spatial_index, "_zone_spatial_index", None)
+    monkeypatch.setattr(zone_spatial_index, "get_zone_shapes_version", version)
+    monkeypatch.setattr(zone_spatial_index, "get_zone_shapes_wkb", shapes)
+    # project trivially so that lat/long are treated as x/y in the test geometry
+    monkeypatch.setattr(zone_spatial_index, "transform_coordinates", lambda xs, ys, source_srid: (np.asarray(xs), np.asarray(ys)))
+
+    stations = [SimpleNamespace(code=code, lat=lat, long=5) for code, lat in [(1, 5), (2, 12), (3, 25), (4, 50), (5, 7)]]
+    stations_by_zone = await group_stations_by_zone(None, stations)
+    assert {zone: [station.code for station in zone_stations] for zone, zone_stations in stations_by_zone.items()} == {1: [1, 5], 2: [2], 3: [3]}
+
+    await group_stations_by_zone(None, stations)
+    assert shapes.await_count == 1
+
+    version.return_value = (4, 4)
+    await group_stations_by_zone(None, stations)
+    assert shapes.await_count == 2
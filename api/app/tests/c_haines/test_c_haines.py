@@ -106,7 +106,7 @@ def check_c_haines(collector, c_haines_data):
         generator = CHainesGenerator()
         data = generator.generate_c_haines(gdal_data)
         with gzip.open('data.json.gz', 'wt') as f:
-            json.dump(data, f)
+            json.dump(data.tolist(), f)
     """
     filename = get_complete_filename(__file__, c_haines_data)
     with gzip.open(filename, 'rt') as c_haines_data_file:
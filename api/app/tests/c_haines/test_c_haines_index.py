@@ -0,0 +1,99 @@
+""" Check that the array c-haines calculations give exactly the same results as the cell by cell calculations.
+"""
+import numpy
+from affine import Affine
+from pyproj import CRS
+from app.c_haines import GDALData, c_haines_index
+from app.c_haines.c_haines_index import (BoundingBoxChecker, CHainesGenerator, calculate_c_haines_index,
+                                         calculate_c_haines_index_array, get_bounding_box_mask)
+from app.c_haines.severity_index import generate_severity_data, get_severity
+from app.geospatial import NAD83_CRS
+from app.weather_models.process_grib import get_transformer
+
+# A 10km polar stereographic grid (like RDPS) covering B.C., and the edges of the bounding box.
+PROJECTION = CRS.from_proj4('+proj=stere +lat_0=90 +lat_ts=60 +lon_0=249 +R=6371229 +units=m +no_defs').to_wkt()
+TRANSFORM = Affine(10000.0, 0.0, -1800000.0, 0.0, -10000.0, -1000000.0)
+Y_SIZE, X_SIZE = 160, 200
+
+
+def _random_fields(shape, seed=42):
+    """ Temperature and dew point depression fields, including the odd missing value """
+    rng = numpy.random.default_rng(seed)
+    t700 = rng.uniform(-40, 10, shape).astype(numpy.float32)
+    t850 = (t700 + rng.uniform(-5, 30, shape)).astype(numpy.float32)
+    d850 = rng.uniform(-2, 45, shape).astype(numpy.float32)
+    t700.flat[::97] = numpy.nan
+    d850.flat[::89] = numpy.inf
+    return t700, t850, d850
+
+
+def test_calculate_c_haines_index_array():
+    """ Every cell is bit for bit what calculate_c_haines_index gives for the same (float32) inputs """
+    t700, t850, d850 = _random_fields((50, 60))
+    expected = numpy.array([[calculate_c_haines_index(float(a), float(b), float(c))
+                             for a, b, c in zip(row_700, row_850, row_dew)]
+                            for row_700, row_850, row_dew in zip(t700, t850, d850)])
+    actual = calculate_c_haines_index_array(t700, t850, d850)
+    assert actual.dtype == numpy.float64
+    assert actual.tobytes() == expected.tobytes()
+
+
+def test_generate_severity_data():
+    """ Severity and mask match get_severity, including at the thresholds, and for NaN """
+    c_haines_data = numpy.array([[-1, 0, 3.999, 4, 7.999, 8, 10.999, 11, 30, numpy.nan, numpy.inf, -numpy.inf]])
+    severity_data, mask_data = generate_severity_data(c_haines_data)
+    expected_severity = numpy.array([[get_severity(cell) for cell in row] for row in c_haines_data])
+    assert numpy.array_equal(severity_data, expected_severity)
+    assert severity_data.dtype == expected_severity.dtype
+    assert numpy.array_equal(mask_data, (expected_severity != 0).astype(int))
+
+
+def test_calculate_mask():
+    """ The whole grid mask matches checking one pixel at a time """
+    checker = BoundingBoxChecker(TRANSFORM, get_transformer(CRS.from_wkt(PROJECTION), NAD83_CRS))
+    mask = checker.calculate_mask(X_SIZE, Y_SIZE)
+    expected = numpy.array([[checker.is_inside(x, y) for x in range(X_SIZE)] for y in range(Y_SIZE)])
+    assert mask.any() and not mask.all()
+    assert numpy.array_equal(mask, expected)
+
+
+class MockBand:
+    """ Just enough of a gdal raster band to read values from """
+
+    def __init__(self, data):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+
+    def ReadAsArray(self, buf_type=None):
+        return self.data.copy()
+
+
+class MockDataset:
+    def __init__(self, data):
+        self.band = MockBand(data)
+
+    def GetRasterBand(self, index):
+        return self.band
+
+    def GetProjection(self):
+        return PROJECTION
+
+
+def test_generate_c_haines(monkeypatch):
+    """ Generated c-haines data is what the cell by cell calculation gives, with 0 outside the bounding box,
+    and the mask is only calculated once per grid """
+    monkeypatch.setattr(c_haines_index, 'get_dataset_geometry', lambda filename: TRANSFORM)
+    get_bounding_box_mask.cache_clear()
+    t700, t850, d850 = _random_fields((Y_SIZE, X_SIZE))
+    source_data = GDALData(MockDataset(t700), MockDataset(t850), MockDataset(d850), 'tmp_700.grib2')
+
+    generator = CHainesGenerator()
+    c_haines_data = generator.generate_c_haines(source_data)
+    generator.generate_c_haines(source_data)
+
+    checker = BoundingBoxChecker(TRANSFORM, get_transformer(CRS.from_wkt(PROJECTION), NAD83_CRS))
+    expected = numpy.array([[calculate_c_haines_index(float(t700[y, x]), float(t850[y, x]), float(d850[y, x]))
+                             if checker.is_inside(x, y) else 0
+                             for x in range(X_SIZE)] for y in range(Y_SIZE)])
+    assert c_haines_data.tobytes() == expected.tobytes()
+    assert get_bounding_box_mask.cache_info().misses == 1
@@ -0,0 +1,105 @@
+""" Test the orchestration of processing c-haines model runs: skipping what's already stored, stopping at the
+first prediction that isn't available yet, and keeping within the memory budget.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pytest_mock import MockerFixture
+import app.c_haines.severity_index
+from app.c_haines.object_store import ObjectTypeEnum, generate_full_object_store_path
+from app.c_haines.severity_index import CHainesSeverityGenerator
+from app.jobs.grib_downloader import GribDownloader
+from app.weather_models import ModelEnum, ProjectionEnum
+
+# Estimated memory needed to process one prediction.
+PREDICTION_MEMORY = 1000
+
+
+class MockS3Client:
+    """Just enough of an s3 client to list (a couple of keys per page) and put objects"""
+
+    def __init__(self, existing_keys):
+        self.existing_keys = sorted(existing_keys)
+        self.list_calls = 0
+        self.put_keys = []
+
+    async def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.list_calls += 1
+        keys = [key for key in self.existing_keys if key.startswith(Prefix)]
+        start = int(ContinuationToken or 0)
+        result = {"Contents": [{"Key": key} for key in keys[start:start + 2]], "IsTruncated": start + 2 < len(keys)}
+        if result["IsTruncated"]:
+            result["NextContinuationToken"] = str(start + 2)
+        return result
+
+    async def put_object(self, Bucket, Key, ACL, Body):
+        self.put_keys.append(Key)
+
+
+def _asset_path(prediction, object_type: ObjectTypeEnum):
+    model_run_timestamp, prediction_timestamp = prediction
+    return generate_full_object_store_path(ModelEnum.RDPS, model_run_timestamp, prediction_timestamp, object_type)
+
+
+@pytest.mark.anyio
+async def test_generate(mocker: MockerFixture, monkeypatch):
+    """ Stored predictions are skipped without downloading anything, predictions are processed until one isn't
+    available, and no more predictions are processed at once than fit in the memory budget. """
+    monkeypatch.setenv('C_HAINES_PROCESSES', '3')
+    monkeypatch.setenv('C_HAINES_MAX_MEMORY_BYTES', str(2 * PREDICTION_MEMORY))
+    mocker.patch('app.c_haines.severity_index.ProcessPoolExecutor', ThreadPoolExecutor)
+
+    downloaded_urls = []
+
+    async def mock_download(self, url, path, filename):
+        downloaded_urls.append(url)
+        if int(re.search(r'_P(\d{3})', url).group(1)) >= 40:
+            # The model run isn't complete yet.
+            return None
+        target = os.path.join(path, filename)
+        with open(target, 'wb') as file:
+            file.write(b'grib')
+        return target
+
+    monkeypatch.setattr(GribDownloader, 'download', mock_download)
+    mocker.patch('app.c_haines.severity_index.estimate_memory_use', return_value=PREDICTION_MEMORY)
+
+    lock = threading.Lock()
+    processing = {'now': 0, 'most': 0, 'timestamps': []}
+
+    def mock_generate_c_haines_assets(payload):
+        with lock:
+            processing['now'] += 1
+            processing['most'] = max(processing['most'], processing['now'])
+            processing['timestamps'].append(payload.prediction_timestamp)
+        time.sleep(0.02)
+        with lock:
+            processing['now'] -= 1
+        return {ObjectTypeEnum.KML: b'kml', ObjectTypeEnum.GEOJSON: b'json'}
+
+    monkeypatch.setattr(app.c_haines.severity_index, 'generate_c_haines_assets', mock_generate_c_haines_assets)
+
+    generator = CHainesSeverityGenerator(ModelEnum.RDPS, ProjectionEnum.REGIONAL_PS, None, 'bucket')
+    predictions = [app.c_haines.severity_index.make_model_run_download_urls(
+        ModelEnum.RDPS, app.utils.time.get_utc_now(), 0, hour)[1:] for hour in range(0, 85)]
+    # The first 10 predictions are done, the 11th is missing its geojson.
+    existing_keys = [_asset_path(prediction, object_type)
+                     for prediction in predictions[:10] for object_type in ObjectTypeEnum]
+    existing_keys.append(_asset_path(predictions[10], ObjectTypeEnum.KML))
+    client = MockS3Client(existing_keys)
+    generator.client = client
+
+    await generator.generate()
+
+    # One paginated listing for each type of asset, and the next model run isn't looked at.
+    assert client.list_calls == 5 + 6
+    assert not any('_P00' in url for url in downloaded_urls)
+    assert all('2020052100_' in url for url in downloaded_urls)
+    assert sorted(processing['timestamps']) == [prediction_timestamp for _, prediction_timestamp in predictions[10:40]]
+    assert processing['most'] == 2
+    expected_keys = [_asset_path(predictions[10], ObjectTypeEnum.GEOJSON)] + \
+        [_asset_path(prediction, object_type) for prediction in predictions[11:40] for object_type in ObjectTypeEnum]
+    assert sorted(client.put_keys) == sorted(expected_keys)
@@ -1,13 +1,12 @@
 """ Very basic test for worker - essential just testing if it runs without exceptions """
 import os
+import shutil
 import asyncio
 import pytest
-import requests
-from aiobotocore.client import AioBaseClient
 from app import configure_logging
 import app.c_haines.worker
-import app.c_haines.kml
-from app.tests.common import MockResponse
+from app.c_haines.severity_index import CHainesSeverityGenerator
+from app.jobs.grib_downloader import GribDownloader
 
 configure_logging()
 
@@ -15,37 +14,37 @@ configure_logging()
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get(*args, **kwargs):
+    async def mock_grib_download(self, url, path, filename):
         """ mock env_canada download method """
         dirname = os.path.dirname(os.path.realpath(__file__))
-        if 'TMP_ISBL' in args[0]:
-            if '700' in args[0]:
+        if 'TMP_ISBL' in url:
+            if '700' in url:
                 grib_filename = 'CMC_hrdps_continental_TMP_ISBL_0850_ps2.5km_2021012618_P048-00.grib2'
-            if '850' in args[0]:
+            if '850' in url:
                 grib_filename = 'CMC_hrdps_continental_TMP_ISBL_0700_ps2.5km_2021012618_P048-00.grib2'
-        elif 'DEPR_ISBL' in args[0]:
+        elif 'DEPR_ISBL' in url:
             grib_filename = 'CMC_hrdps_continental_DEPR_ISBL_0850_ps2.5km_2021012618_P048-00.grib2'
-        filename = os.path.join(dirname, grib_filename)
-        with open(filename, 'rb') as file:
-            content = file.read()
-        return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get)
+        target = os.path.join(path, filename)
+        shutil.copyfile(os.path.join(dirname, grib_filename), target)
+        return target
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download)
+
+
+class MockExistingAssets:
+    """ Everything exists, except for a couple of assets """
+
+    def __contains__(self, target_path: str):
+        return target_path not in ("c-haines-polygons/kml/GDPS/2020/5/21/0/2020-05-21T00:00:00.kml", "c-haines-polygons/json/GDPS/2021/5/21/0/2021-05-21T00:00:00.json")
 
 
 @pytest.fixture()
 def mock_s3_client(monkeypatch):
     """ mock s3 client """
-    async def mock_object_exists_v2(target_path: str):
-        """ mock object exists """
-        return target_path not in ("c-haines-polygons/kml/GDPS/2020/5/21/0/2020-05-21T00:00:00.kml", "c-haines-polygons/json/GDPS/2021/5/21/0/2021-05-21T00:00:00.json")
-
-    async def mock_object_exists(client: AioBaseClient, bucket: str, target_path: str):
-        """ mock object exists """
-        return target_path not in ("c-haines-polygons/kml/GDPS/2020/5/21/0/2020-05-21T00:00:00.kml", "c-haines-polygons/json/GDPS/2021/5/21/0/2021-05-21T00:00:00.json")
+    async def mock_list_existing_assets(self, model_run_timestamp):
+        """ mock listing the assets of a model run """
+        return MockExistingAssets()
 
-    monkeypatch.setattr(app.c_haines.severity_index, 'object_exists_v2', mock_object_exists_v2)
-    monkeypatch.setattr(app.c_haines.severity_index, 'object_exists', mock_object_exists)
-    monkeypatch.setattr(app.c_haines.kml, 'object_exists', mock_object_exists)
+    monkeypatch.setattr(CHainesSeverityGenerator, '_list_existing_assets', mock_list_existing_assets)
 
 
 @pytest.mark.usefixtures('mock_download', 'mock_s3_client')
@@ -6,6 +6,7 @@ from typing import Optional
 from unittest.mock import MagicMock
 import requests
 import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
 from pytest_mock import MockerFixture
 from pytest_bdd import then, parsers
 from app.db.models.weather_models import PredictionModel, PredictionModelRunTimestamp
@@ -26,6 +27,7 @@ import app.jobs.env_canada
 import app.weather_models.process_grib
 from app.schemas.shared import WeatherDataRequest
 import app.wildfire_one.wildfire_fetchers
+import app.wildfire_one.wfwx_api
 import app.utils.redis
 from app.tests import load_json_file
 
@@ -97,10 +99,29 @@ def mock_redis(monkeypatch):
         def delete(self, name):
             """mock delete"""
 
+    class MockAsyncRedis:
+        """mocked asyncio redis class"""
+
+        async def get(self, name):
+            """mock get"""
+            return None
+
+        async def set(self, name, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+            """mock set"""
+
     def create_mock_redis():
         return MockRedis()
 
     monkeypatch.setattr(app.utils.redis, "_create_redis", create_mock_redis)
+    monkeypatch.setattr(app.utils.redis, "_create_async_redis", MockAsyncRedis)
+
+
+@pytest.fixture(autouse=True)
+def clear_station_registry():
+    """Each test loads stations from its own (mocked) WFWX responses"""
+    app.wildfire_one.wfwx_api.station_registry.clear()
+    yield
+    app.wildfire_one.wfwx_api.station_registry.clear()
 
 
 @pytest.fixture(autouse=True)
@@ -136,11 +157,20 @@ def mock_get_pst_today_start_and_end(monkeypatch):
     monkeypatch.setattr(app.utils.time, "get_pst_today_start_and_end", mock_get_pst_today)
 
 
+def mock_async_session() -> AsyncSession:
+    """ An async session, where awaiting a query returns a MagicMock result """
+    session = MagicMock(spec=AsyncSession)
+    session.execute.return_value = MagicMock()
+    return session
+
+
 @pytest.fixture(autouse=True)
 def mock_session(monkeypatch):
     """Ensure that all unit tests mock out the database session by default!"""
     monkeypatch.setattr(app.db.database, "_get_write_session", MagicMock())
     monkeypatch.setattr(app.db.database, "_get_read_session", MagicMock())
+    monkeypatch.setattr(app.db.database, "_get_async_write_session", mock_async_session)
+    monkeypatch.setattr(app.db.database, "_get_async_read_session", mock_async_session)
 
     prediction_model = PredictionModel(id=1, abbreviation="GDPS", projection="latlon.15x.15", name="Global Deterministic Prediction System")
 
@@ -0,0 +1,245 @@
+""" Unit tests for the numpy port of cffdrs.
+
+The parity tests compare against the cffdrs R package, and are skipped if rpy2 isn't available.
+"""
+import math
+import numpy as np
+import pytest
+from app.fire_behaviour import cffdrs, cffdrs_numpy
+from app.fire_behaviour.fuel_types import FuelTypeEnum
+
+ROWS = 400
+rng = np.random.default_rng(42)
+fuel_types = np.resize(np.array(cffdrs_numpy.FUEL_TYPES), ROWS)
+ffmc = rng.uniform(0, 101, ROWS)
+isi = rng.uniform(0, 60, ROWS)
+bui = rng.uniform(1, 250, ROWS)
+dmc = rng.uniform(0, 200, ROWS)
+dc = rng.uniform(0, 800, ROWS)
+fmc = rng.uniform(80, 120, ROWS)
+sfc = rng.uniform(0.5, 8, ROWS)
+ros = rng.uniform(0, 60, ROWS)
+pc = rng.uniform(0, 100, ROWS)
+pdf = rng.uniform(0, 100, ROWS)
+cc = rng.uniform(0, 100, ROWS)
+cbh = rng.uniform(1, 20, ROWS)
+cfl = rng.uniform(0.5, 2, ROWS)
+cfb = rng.uniform(0, 1, ROWS)
+temp = rng.uniform(-10, 40, ROWS)
+rh = rng.uniform(5, 100, ROWS)
+ws = rng.uniform(0, 80, ROWS)
+prec = np.where(rng.uniform(0, 1, ROWS) > 0.5, rng.uniform(0, 30, ROWS), 0)
+lat = rng.uniform(-90, 90, ROWS)
+long = rng.uniform(110, 140, ROWS)
+elv = np.where(rng.uniform(0, 1, ROWS) > 0.2, rng.uniform(0, 3000, ROWS), 0)
+day_of_year = rng.integers(1, 366, ROWS)
+month = rng.integers(1, 13, ROWS)
+hours = rng.uniform(0, 240, ROWS)
+
+
+@pytest.fixture(scope='module')
+def r_cffdrs():
+    """ The cffdrs R package """
+    pytest.importorskip('rpy2')
+    return cffdrs.CFFDRS.instance().cffdrs
+
+
+def _f(values):
+    """ Convert to an R FloatVector """
+    import rpy2.robjects as robjs
+    return robjs.FloatVector(values)
+
+
+def _s(values):
+    """ Convert to an R StrVector """
+    import rpy2.robjects as robjs
+    return robjs.StrVector(values)
+
+
+def _i(values):
+    """ Convert to an R IntVector """
+    import rpy2.robjects as robjs
+    return robjs.IntVector(values)
+
+
+def test_ros_c7():
+    """ Same value as the R package gives in test_cffdrs.test_ros """
+    result = cffdrs_numpy.ros_calc(FuelTypeEnum.C7, 1, 1, 1, 1, 100, None, None, 10)
+    assert math.isclose(result, 1.2966988409822604e-05)
+
+
+def test_fwi_system_c1():
+    """ Values from the C1 firebat test for HORSEFLY """
+    assert math.isclose(cffdrs_numpy.bui_calc(103.923, 340.544), 117.899, abs_tol=0.001)
+    assert math.isclose(cffdrs_numpy.fwi_calc(7.462, 117.899), 27.792, abs_tol=0.001)
+    c1_sfc = cffdrs_numpy.sfc_calc('C1', 90.638, 117.899, 100, 0.35)
+    c1_ros = cffdrs_numpy.ros_calc('C1', 7.462, 117.899, 100, c1_sfc, 100, 0, None, 2)
+    assert math.isclose(c1_ros, 1.246, abs_tol=0.001)
+
+
+def test_broadcast_stations_fuel_types_days():
+    """ One call computes every station x fuel type x day combination """
+    stations, days = 3, 5
+    station_isi = np.linspace(1, 20, stations * days).reshape(stations, 1, days)
+    station_bui = np.linspace(10, 150, stations * days).reshape(stations, 1, days)
+    all_fuel_types = np.array(cffdrs_numpy.FUEL_TYPES)[None, :, None]
+    result = cffdrs_numpy.ros_calc(all_fuel_types, station_isi, station_bui, 100, 2, 50, 50, 80, 5)
+    assert result.shape == (stations, len(cffdrs_numpy.FUEL_TYPES), days)
+    # matches calculating each combination separately
+    for fuel_index, fuel_type in enumerate(cffdrs_numpy.FUEL_TYPES):
+        expected = cffdrs_numpy.ros_calc(fuel_type, station_isi[1, 0, 2], station_bui[1, 0, 2], 100, 2, 50, 50, 80, 5)
+        assert math.isclose(result[1, fuel_index, 2], expected)
+
+
+def test_fuel_type_enum_and_string_equivalent():
+    """ FuelTypeEnum members and plain strings give the same result """
+    assert cffdrs_numpy.sfc_calc(FuelTypeEnum.S2, 80, 60, None, 0.35) == cffdrs_numpy.sfc_calc('S2', 80, 60, None, 0.35)
+
+
+def test_unknown_fuel_type():
+    """ Fuel types that cffdrs doesn't know about can't be calculated """
+    assert np.isnan(cffdrs_numpy.ros_calc('C7B', 10, 50, 100, 2, 100, None, None, 10))
+    with pytest.raises(cffdrs.CFFDRSException):
+        cffdrs.surface_fuel_consumption(FuelTypeEnum.C7B, 50, 90, 100)
+
+
+@pytest.mark.parametrize('calc,args', [
+    (cffdrs_numpy.ffmc_calc, (85, 20, 40, 10, 0)),
+    (cffdrs_numpy.dmc_calc, (30, 20, 40, 0, 50, 7)),
+    (cffdrs_numpy.dc_calc, (200, 20, 40, 0, 50, 7)),
+    (cffdrs_numpy.fmc_calc, (50, 120, 500, 200, 0)),
+])
+def test_missing_input_gives_nan(calc, args):
+    """ A missing input gives NaN (NA in R), even where it's only used in a condition """
+    for index in range(len(args)):
+        if calc in (cffdrs_numpy.dmc_calc, cffdrs_numpy.dc_calc) and index == 5:
+            # the month is an index into the day length tables, not a weather input
+            continue
+        if calc is cffdrs_numpy.dc_calc and index == 2:
+            # rh isn't used to calculate dc
+            continue
+        missing = list(args)
+        missing[index] = None
+        assert np.isnan(calc(*missing)), f'{calc.__name__} argument {index}'
+
+
+def test_missing_bui_gives_nan():
+    """ Rate of spread depends on the buildup effect, so a missing bui can't be ignored """
+    assert np.isnan(cffdrs_numpy.be_calc('C2', None))
+    assert np.isnan(cffdrs_numpy.ros_calc('C2', 10, None, 100, 2, 100, None, None, 3))
+    assert np.isnan(cffdrs_numpy.cfb_calc('C2', 100, 2, None, 3))
+
+
+def test_r_backend_selected(monkeypatch: pytest.MonkeyPatch):
+    """ Setting CFFDRS_BACKEND=R delegates to the R package """
+    monkeypatch.setenv('CFFDRS_BACKEND', 'R')
+    assert cffdrs.use_r_backend()
+    monkeypatch.setenv('CFFDRS_BACKEND', 'numpy')
+    assert not cffdrs.use_r_backend()
+
+
+def test_isi_parity(r_cffdrs):
+    """ ISI matches R """
+    for fbp_mod in (False, True):
+        expected = r_cffdrs._ISIcalc(ffmc=_f(ffmc), ws=_f(ws), fbpMod=fbp_mod)
+        np.testing.assert_allclose(cffdrs_numpy.isi_calc(ffmc, ws, fbp_mod), np.array(expected), rtol=1e-9)
+
+
+def test_fwi_system_parity(r_cffdrs):
+    """ BUI, FWI, FFMC, DMC and DC match R """
+    np.testing.assert_allclose(cffdrs_numpy.bui_calc(dmc, dc), np.array(r_cffdrs._buiCalc(dmc=_f(dmc), dc=_f(dc))),
+                               rtol=1e-9)
+    np.testing.assert_allclose(cffdrs_numpy.fwi_calc(isi, bui), np.array(r_cffdrs._fwiCalc(isi=_f(isi), bui=_f(bui))),
+                               rtol=1e-9)
+    expected = r_cffdrs._ffmcCalc(ffmc_yda=_f(ffmc), temp=_f(temp), rh=_f(rh), prec=_f(prec), ws=_f(ws))
+    np.testing.assert_allclose(cffdrs_numpy.ffmc_calc(ffmc, temp, rh, ws, prec), np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._dmcCalc(_f(dmc), _f(temp), _f(rh), _f(prec), _f(lat), _i(month), True)
+    np.testing.assert_allclose(cffdrs_numpy.dmc_calc(dmc, temp, rh, prec, lat, month), np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._dcCalc(_f(dc), _f(temp), _f(rh), _f(prec), _f(lat), _i(month), True)
+    np.testing.assert_allclose(cffdrs_numpy.dc_calc(dc, temp, rh, prec, lat, month), np.array(expected), rtol=1e-9)
+
+
+def test_fbp_parity(r_cffdrs):
+    """ The fire behaviour prediction functions match R, for every fuel type """
+    expected = r_cffdrs._SFCcalc(FUELTYPE=_s(fuel_types), BUI=_f(bui), FFMC=_f(ffmc), PC=_f(pc), GFL=0.35)
+    np.testing.assert_allclose(cffdrs_numpy.sfc_calc(fuel_types, ffmc, bui, pc, 0.35), np.array(expected),
+                               rtol=1e-9)
+    expected = r_cffdrs._ROScalc(FUELTYPE=_s(fuel_types), ISI=_f(isi), BUI=_f(bui), FMC=_f(fmc), SFC=_f(sfc),
+                                 PC=_f(pc), PDF=_f(pdf), CC=_f(cc), CBH=_f(cbh))
+    np.testing.assert_allclose(cffdrs_numpy.ros_calc(fuel_types, isi, bui, fmc, sfc, pc, pdf, cc, cbh),
+                               np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._BROScalc(FUELTYPE=_s(fuel_types), FFMC=_f(ffmc), BUI=_f(bui), WSV=_f(ws), FMC=_f(fmc),
+                                  SFC=_f(sfc), PC=_f(pc), PDF=_f(pdf), CC=_f(cc), CBH=_f(cbh))
+    np.testing.assert_allclose(cffdrs_numpy.bros_calc(fuel_types, ffmc, bui, ws, fmc, sfc, pc, pdf, cc, cbh),
+                               np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._CFBcalc(FUELTYPE=_s(fuel_types), FMC=_f(fmc), SFC=_f(sfc), ROS=_f(ros), CBH=_f(cbh))
+    np.testing.assert_allclose(cffdrs_numpy.cfb_calc(fuel_types, fmc, sfc, ros, cbh), np.array(expected),
+                               rtol=1e-9)
+    expected = r_cffdrs._TFCcalc(FUELTYPE=_s(fuel_types), CFL=_f(cfl), CFB=_f(cfb), SFC=_f(sfc), PC=_f(pc),
+                                 PDF=_f(pdf))
+    np.testing.assert_allclose(cffdrs_numpy.tfc_calc(fuel_types, cfl, cfb, sfc, pc, pdf), np.array(expected),
+                               rtol=1e-9)
+    np.testing.assert_allclose(cffdrs_numpy.fi_calc(sfc, ros), np.array(r_cffdrs._FIcalc(FC=_f(sfc), ROS=_f(ros))),
+                               rtol=1e-9)
+    expected = r_cffdrs._LBcalc(FUELTYPE=_s(fuel_types), WSV=_f(ws))
+    np.testing.assert_allclose(cffdrs_numpy.lb_calc(fuel_types, ws), np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._LBtcalc(FUELTYPE=_s(fuel_types), LB=_f(ws / 10 + 1), HR=_f(hours), CFB=_f(cfb))
+    np.testing.assert_allclose(cffdrs_numpy.lbt_calc(fuel_types, ws / 10 + 1, hours, cfb), np.array(expected),
+                               rtol=1e-9)
+    expected = r_cffdrs._ROStcalc(FUELTYPE=_s(fuel_types), ROSeq=_f(ros), HR=_f(hours), CFB=_f(cfb))
+    np.testing.assert_allclose(cffdrs_numpy.rost_calc(fuel_types, ros, hours, cfb), np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._DISTtcalc(_s(fuel_types), _f(ros), _f(hours), _f(cfb))
+    np.testing.assert_allclose(cffdrs_numpy.distt_calc(fuel_types, ros, hours, cfb), np.array(expected), rtol=1e-9)
+    expected = r_cffdrs._FROScalc(ROS=_f(ros), BROS=_f(sfc), LB=_f(ws / 10 + 1))
+    np.testing.assert_allclose(cffdrs_numpy.fros_calc(ros, sfc, ws / 10 + 1), np.array(expected), rtol=1e-9)
+
+
+def test_fmc_parity(r_cffdrs):
+    """ Foliar moisture content matches R """
+    expected = r_cffdrs._FMCcalc(LAT=_f(np.abs(lat)), LONG=_f(long), ELV=_f(elv), DJ=_i(day_of_year),
+                                 D0=_f(np.zeros(ROWS)))
+    np.testing.assert_allclose(cffdrs_numpy.fmc_calc(np.abs(lat), long, elv, day_of_year, 0), np.array(expected),
+                               rtol=1e-9)
+
+
+def test_ffmc_for_target_hfi_batch():
+    """ Every row converges within the bisection bound, to the lowest FFMC that reaches the target HFI """
+    rows = 1000
+    solver_rng = np.random.default_rng(7)
+    ft = np.resize(np.array(cffdrs_numpy.FUEL_TYPES), rows)
+    args = dict(fuel_type=ft, bui=solver_rng.uniform(10, 200, rows), ws=solver_rng.uniform(0, 40, rows), fmc=100,
+                cfb=solver_rng.uniform(0, 1, rows), cfl=1, target_hfi=solver_rng.choice([500, 4000, 10000], rows),
+                pc=50, pdf=50, cc=80, cbh=5)
+    solution = cffdrs_numpy.ffmc_for_target_hfi(**args)
+    assert solution.ffmc.shape == (rows,)
+    assert solution.iterations.max() <= cffdrs_numpy.max_bisection_iterations(0.01)
+
+    def hfi(ffmc):
+        return cffdrs_numpy.hfi_for_ffmc(ft, ffmc, args['bui'], args['ws'], 100, args['cfb'], 1, 50, 50, 80, 5)
+    target = args['target_hfi']
+    unreachable = solution.ffmc == cffdrs_numpy.FFMC_MAX
+    always = solution.ffmc == cffdrs_numpy.FFMC_MIN
+    solved = ~unreachable & ~always
+    assert solved.any() and unreachable.any()
+    assert np.all(hfi(cffdrs_numpy.FFMC_MAX)[unreachable] < target[unreachable])
+    assert np.all(hfi(cffdrs_numpy.FFMC_MIN)[always] >= target[always])
+    np.testing.assert_allclose(solution.hfi, hfi(solution.ffmc))
+    assert np.all(solution.hfi[solved] >= target[solved])
+    # either within 1% of the target, or just below the FFMC where the target is crossed
+    close = np.abs(solution.hfi[solved] - target[solved]) <= 0.01 * target[solved]
+    assert np.all(close | (hfi(solution.ffmc - 0.01)[solved] < target[solved]))
+    # rows are solved independently of each other
+    single = cffdrs_numpy.ffmc_for_target_hfi(**{key: value[3] if isinstance(value, np.ndarray) else value
+                                                 for key, value in args.items()})
+    assert single.ffmc == solution.ffmc[3]
+
+
+def test_get_ffmc_for_target_hfi():
+    """ The scalar wrapper returns the critical FFMC and the HFI at that FFMC """
+    critical_ffmc, hfi = cffdrs.get_ffmc_for_target_hfi(FuelTypeEnum.C2, 100, None, 118, 9, None, 3, 90, 100,
+                                                        0.1, 0.8, 4000)
+    assert 0 < critical_ffmc < 101
+    assert math.isclose(hfi, 4000, rel_tol=0.01)
+    critical_ffmc, hfi = cffdrs.get_ffmc_for_target_hfi(FuelTypeEnum.C2, 100, None, 118, 9, None, 3, 90, 100,
+                                                        0.1, 0.8, 10 ** 9)
+    assert critical_ffmc == 101 and hfi < 10 ** 9
@@ -0,0 +1,90 @@
+""" Unit tests for the diurnal FFMC lookups used to calculate critical hours """
+import math
+import numpy as np
+import pytest
+from app.fire_behaviour import prediction
+from app.fire_behaviour.prediction import (DiurnalFFMCLookupTable, FireBehaviourPredictionInputError,
+                                           calculate_fire_behaviour_prediction,
+                                           calculate_fire_behaviour_predictions,
+                                           get_afternoon_overnight_diurnal_ffmc,
+                                           get_morning_diurnal_ffmc, get_critical_hours_start,
+                                           get_critical_hours_end)
+from app.schemas.fba_calc import FuelTypeEnum
+
+
+def test_lookup_table_shapes():
+    """ Red Book tables 4.1 and 4.2 are compiled into dense arrays """
+    table = DiurnalFFMCLookupTable.instance()
+    assert table.afternoon_ffmc.shape == (31, 18)
+    assert 17 not in table.afternoon_hours
+    assert table.morning_ffmc.shape == (31, 7, 3)
+    assert list(table.morning_hours) == [7, 8, 9, 10, 11, 12, 13]
+    assert list(table.morning_rh_bounds[0, 1]) == [68, 87]
+
+
+def test_afternoon_overnight_diurnal_ffmc():
+    """ Values from afternoon_overnight.csv, where rows are keyed by the daily FFMC (the 17:00 column) """
+    assert get_afternoon_overnight_diurnal_ffmc(13, 60) == 48
+    assert get_afternoon_overnight_diurnal_ffmc(20.0, 61) == 62
+    # hours past midnight can be given as 24 + hour
+    assert get_afternoon_overnight_diurnal_ffmc(30.0, 100) == get_afternoon_overnight_diurnal_ffmc(6, 100) == 86
+    # 17:00 is the daily FFMC itself, and the nearest later hour is used
+    assert get_afternoon_overnight_diurnal_ffmc(17, 50) == get_afternoon_overnight_diurnal_ffmc(18, 50)
+
+
+def test_morning_diurnal_ffmc():
+    """ Values from morning.csv, and NaN when RH isn't in any band """
+    assert get_morning_diurnal_ffmc(7.0, 50, 70) == 48
+    assert get_morning_diurnal_ffmc(13.0, 100, 10) == 98
+    assert math.isnan(get_morning_diurnal_ffmc(12.0, 90, None))
+
+
+def test_diurnal_curves_vectorized():
+    """ The diurnal curve for many stations is a single lookup """
+    daily_ffmc = np.array([55.0, 71.0, 88.5, 93.2])
+    hours = np.arange(13.0, 32.0)
+    curve = get_afternoon_overnight_diurnal_ffmc(hours[None, :], daily_ffmc[:, None])
+    assert curve.shape == (4, 19)
+    for station, ffmc in enumerate(daily_ffmc):
+        for index, hour in enumerate(hours):
+            assert curve[station, index] == get_afternoon_overnight_diurnal_ffmc(hour, ffmc)
+
+    rh = np.array([[90.0, 60.0, 40.0, 30.0, 20.0, 10.0]])
+    curve = get_morning_diurnal_ffmc(prediction.MORNING_HOURS_REVERSED, daily_ffmc[:, None], rh)
+    assert curve.shape == (4, 6)
+    assert curve[2, 5] == get_morning_diurnal_ffmc(7.0, 88.5, 10.0)
+
+
+def test_critical_hours_start_and_end():
+    """ Critical hours start in the morning when FFMC is high, and run until FFMC drops overnight """
+    rh = {7.0: 80.0, 8.0: 70.0, 9.0: 60.0, 10.0: 50.0, 11.0: 40.0, 12.0: 30.0}
+    start = get_critical_hours_start(80, 92, 90, rh)
+    assert start == 10.0
+    assert get_critical_hours_end(80, 92, start) == 3.0
+    # never reaches the critical FFMC
+    assert get_critical_hours_start(95, 92, 90, rh) is None
+    # above the critical FFMC all night
+    assert get_critical_hours_end(40, 92, 13.0) == 7.0
+
+
+def test_fire_behaviour_predictions_match_scalar():
+    """ The batch calculation gives the same results as calculating one row at a time """
+    rows = [(FuelTypeEnum.C2, 100, 90, 20, None, 100, 10, 0, 3, 0.8),
+            (FuelTypeEnum.M2, 60, 92, 15, None, 50, 12, 0, 6, 0.8),
+            (FuelTypeEnum.O1B, 40, 88, 25, 80, 0, 8, 0, 1, 1.0),
+            (FuelTypeEnum.O1A, 40, 88, 25, None, 0, 8, 0, 1, 1.0),
+            (FuelTypeEnum.C7B, 80, 91, 10, 60, 100, 9, 0, 10, 0.5),
+            (FuelTypeEnum.D1, None, 85, 10, None, 0, 5, 0, 3, 1.0)]
+    columns = dict(zip(('fuel_type', 'bui', 'ffmc', 'wind_speed', 'cc', 'pc', 'isi', 'pdf', 'cbh', 'cfl'),
+                       map(list, zip(*rows))))
+    predictions = calculate_fire_behaviour_predictions(latitude=[50.0] * len(rows), longitude=[-120.0] * len(rows),
+                                                       elevation=[500.0] * len(rows), **columns)
+    for index, row in enumerate(rows):
+        kwargs = {key: values[index] for key, values in columns.items()}
+        try:
+            expected = calculate_fire_behaviour_prediction(latitude=50.0, longitude=-120.0, elevation=500.0,
+                                                           **kwargs)
+        except FireBehaviourPredictionInputError:
+            assert predictions[index] is None, row
+            continue
+        assert vars(predictions[index]) == pytest.approx(vars(expected)), row
@@ -21,11 +21,12 @@ from app.schemas.hfi_calc import (DailyResult, DateRange,
                                   WeatherStationProperties,
                                   required_daily_fields)
 from app.schemas.shared import FuelType
-from app.utils.time import get_pst_now, get_utc_now
+from app.utils.time import get_hour_20_from_date, get_pst_now, get_utc_now
 from app.wildfire_one.schema_parsers import WFWXWeatherStation
 from starlette.testclient import TestClient
 from app.main import app as starlette_app
 import app.routers.hfi_calc
+import app.hfi.hfi_calc
 
 # Kamloops FC fixture
 kamloops_fc = FireCentre(
@@ -123,6 +124,48 @@ def test_requested_fire_starts_unaltered(mocker: MockerFixture):
     assert result[0].daily_results[0].fire_starts == fire_start_ranges[-1]
 
 
+def test_fire_centre_dailies_calculated_once(mocker: MockerFixture):
+    """ A station in two planning areas, with the same fuel type, is only calculated once. Stations are
+    calculated in one batch for the whole fire centre. """
+    fuel_type_lookup = {
+        1: hfi_calc_models.FuelType(
+            id=1, abbrev='C2', description='C2', fuel_type_code='C2',
+            percentage_conifer=100, percentage_dead_fir=0),
+        2: hfi_calc_models.FuelType(
+            id=2, abbrev='C3', description='C3', fuel_type_code='C3',
+            percentage_conifer=100, percentage_dead_fir=0)}
+    wfwx_stations = [WFWXWeatherStation(wfwx_id=str(code), code=code, name=f'station{code}', latitude=50.1,
+                                        longitude=-120.1, elevation=500, zone_code=1) for code in (1, 2)]
+    start_date = get_utc_now().date()
+    raw_dailies = [{'stationId': str(code),
+                    'weatherTimestamp': get_hour_20_from_date(start_date).timestamp() * 1000,
+                    'lastEntityUpdateTimestamp': get_utc_now().timestamp() * 1000,
+                    'buildUpIndex': 20, 'fineFuelMoistureCode': 80, 'initialSpreadIndex': 2, 'windSpeed': 5}
+                   for code in (1, 2)]
+    station_info = {1: [StationInfo(station_code=1, selected=True, fuel_type_id=1),
+                        StationInfo(station_code=2, selected=True, fuel_type_id=1)],
+                    2: [StationInfo(station_code=1, selected=True, fuel_type_id=1),
+                        StationInfo(station_code=2, selected=True, fuel_type_id=2)]}
+    batch_spy = mocker.spy(app.hfi.hfi_calc, 'calculate_fire_behaviour_predictions')
+
+    result = calculate_hfi_results(fuel_type_lookup,
+                                   fire_start_ranges,
+                                   planning_area_fire_starts={},
+                                   fire_start_lookup=fire_start_lookup,
+                                   wfwx_stations=wfwx_stations,
+                                   raw_dailies=raw_dailies,
+                                   num_prep_days=1,
+                                   planning_area_station_info=station_info,
+                                   start_date=start_date)
+
+    assert batch_spy.call_count == 1
+    # station 1 (once), and station 2 with each of its fuel types.
+    assert len(batch_spy.call_args.kwargs['fuel_type']) == 3
+    area_1, area_2 = [[validated.daily for validated in area.daily_results[0].dailies] for area in result]
+    assert area_1[0] == area_2[0]
+    assert area_1[1].hfi != area_2[1].hfi
+
+
 def test_calculate_mean_intensity_basic():
     """ Calculates mean intensity """
     daily1 = StationDaily(
@@ -250,7 +293,7 @@ def test_valid_daily():
 @pytest.mark.usefixtures("mock_jwt_decode")
 def test_valid_fuel_types_response(monkeypatch):
     """ Assert that list of FuelType objects is converted to FuelTypesResponse object correctly """
-    def mock_get_fuel_types(*args, **kwargs):
+    async def mock_get_fuel_types(*args, **kwargs):
         fuel_type_1 = FuelType(id=1, abbrev="T1", fuel_type_code="T1", description="blah",
                                percentage_conifer=0, percentage_dead_fir=0)
         fuel_type_2 = FuelType(id=2, abbrev="T2", fuel_type_code="T2", description="bleep",
@@ -101,7 +101,7 @@ def test_post_stations_duplicate_station(client: TestClient, monkeypatch: pytest
     def mock_admin_role_function(*_, **__):
         return MockJWTDecodeWithRole('hfi_station_admin')
 
-    def mock_db_integrity_error(*_, **__):
+    async def mock_db_integrity_error(*_, **__):
         raise IntegrityError(MagicMock(), MagicMock(), MagicMock())
 
     monkeypatch.setattr(decode_fn, mock_admin_role_function)
@@ -30,7 +30,7 @@ def _setup_mock(monkeypatch: pytest.MonkeyPatch):
     fuel_type_3 = FuelType(id=3, abbrev='C3', fuel_type_code='C3', description='C3',
                            percentage_conifer=100, percentage_dead_fir=0)
 
-    def mock_get_fire_weather_stations(_):
+    async def mock_get_fire_weather_stations(_):
         fire_centre = FireCentre(id=1, name='Kamloops Fire Centre')
         planning_area_1 = PlanningArea(id=1, name='Kamloops (K2)', fire_centre_id=1,
                                        order_of_appearance_in_list=1)
@@ -49,16 +49,16 @@ def _setup_mock(monkeypatch: pytest.MonkeyPatch):
     code2 = 239
     all_station_codes = [{'station_code': code1}, {'station_code': code2}]
 
-    def mock_get_all_stations(__):
+    async def mock_get_all_stations(__):
         """ Returns mocked WFWXWeatherStations codes. """
         return all_station_codes
 
-    def mock_get_fire_centre_fire_start_ranges(_, __: int):
+    async def mock_get_fire_centre_fire_start_ranges(_, __: int):
         """ Returns mocked FireStartRange """
         data = ((1, '0-1'), (2, '1-2'), (3, '2-3'), (4, '3-6'), (5, '6+'))
         return [FireStartRange(id=id, label=range) for id, range in data]
 
-    def mock_get_fire_start_lookup(_):
+    async def mock_get_fire_start_lookup(_):
         """ Returns mocked FireStartLookup """
         data = ((1, 1, 1, 1),
                 (2, 1, 2, 1),
@@ -97,17 +97,17 @@ def _setup_mock(monkeypatch: pytest.MonkeyPatch):
         fuel_type_3
     ]
 
-    def mock_get_fuel_type_by_id(_, fuel_type_id: int):
+    async def mock_get_fuel_type_by_id(_, fuel_type_id: int):
         """ Returns mocked FuelType """
         try:
             return next(fuel_type for fuel_type in fuel_types if fuel_type.id == fuel_type_id)
         except StopIteration:
             return None
 
-    def mock_get_fuel_types(_):
+    async def mock_get_fuel_types(_):
         return fuel_types
 
-    def mock_get_most_recent_updated_hfi_request(*arg):
+    async def mock_get_most_recent_updated_hfi_request(*arg):
         dirname = os.path.dirname(os.path.realpath(__file__))
         filename = os.path.join(dirname, 'test_hfi_endpoint_request.json')
         with open(filename) as f:
@@ -188,7 +188,7 @@ def spy_on_store_hfi_request(mocker: MockerFixture):
 @given(parsers.parse("I have a stored request {stored_request_json}"),
        converters={'stored_request_json': load_json_file(__file__)})
 def given_stored_request(monkeypatch, stored_request_json: Tuple[dict, str]):
-    def mock_get_most_recent_updated_hfi_request(*_, **__):
+    async def mock_get_most_recent_updated_hfi_request(*_, **__):
         """ Returns mocked WFWXWeatherStation with fuel types. """
         return HFIRequest(request=json.dumps(stored_request_json))
 
@@ -21,7 +21,7 @@ def given_hfi_planning_areas_request(monkeypatch):
     """ Make /hfi-calc/ request using mocked out ClientSession.
     """
 
-    def mock_get_fire_weather_stations(_: Session):
+    async def mock_get_fire_weather_stations(_: Session):
         fire_centre = FireCentre(id=1, name='Kamloops Fire Centre')
         planning_area_1 = PlanningArea(id=2, name='Kamloops (K2)', fire_centre_id=1)
         planning_area_2 = PlanningArea(id=3, name='Vernon (K4)', fire_centre_id=1)
@@ -1,3 +1,4 @@
+from unittest.mock import AsyncMock
 from fastapi.testclient import TestClient
 import pytest
 import app
@@ -51,8 +52,9 @@ def client():
 def test_get_all_ready_records(client: TestClient, monkeypatch: pytest.MonkeyPatch):
     """ Basic check for retrieving ready records"""
     monkeypatch.setattr(app.routers.hfi_calc, 'get_most_recent_updated_hfi_request',
-                        lambda *_: mock_hfi_request)
-    monkeypatch.setattr(app.routers.hfi_calc, 'get_latest_hfi_ready_records', lambda *_: mock_latest_ready_records)
+                        AsyncMock(return_value=mock_hfi_request))
+    monkeypatch.setattr(app.routers.hfi_calc, 'get_latest_hfi_ready_records',
+                        AsyncMock(return_value=mock_latest_ready_records))
 
     response = client.get(get_ready_states_url)
     assert response.status_code == 200
@@ -65,8 +67,8 @@ def test_get_all_ready_records(client: TestClient, monkeypatch: pytest.MonkeyPat
 def test_get_all_ready_records_no_hfi_request(client: TestClient, monkeypatch: pytest.MonkeyPatch):
     """ Basic check for retrieving ready records when there is no hfi_request"""
     monkeypatch.setattr(app.routers.hfi_calc, 'get_most_recent_updated_hfi_request',
-                        lambda *_: None)
-    monkeypatch.setattr(app.routers.hfi_calc, 'get_latest_hfi_ready_records', lambda *_: [])
+                        AsyncMock(return_value=None))
+    monkeypatch.setattr(app.routers.hfi_calc, 'get_latest_hfi_ready_records', AsyncMock(return_value=[]))
 
     response = client.get(get_ready_states_url)
     assert response.status_code == 200
@@ -88,7 +90,7 @@ def test_toggle_ready_authorized(client: TestClient, monkeypatch: pytest.MonkeyP
         return MockJWTDecodeWithRole('hfi_set_ready_state')
 
     monkeypatch.setattr("jwt.decode", mock_fire_start_role_function)
-    monkeypatch.setattr(app.routers.hfi_calc, 'toggle_ready', lambda *_: HFIReady(id=1, **ready_state_json))
+    monkeypatch.setattr(app.routers.hfi_calc, 'toggle_ready', AsyncMock(return_value=HFIReady(id=1, **ready_state_json)))
 
     response = client.post(post_toggle_ready_state_url)
     assert response.status_code == 200
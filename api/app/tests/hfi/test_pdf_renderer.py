@@ -0,0 +1,119 @@
+""" Unit tests for rendering PDFs off the event loop """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from time import sleep
+from typing import Optional
+import pytest
+import app.routers.hfi_calc
+from app.hfi.pdf_renderer import PDFRenderer, PDFRenderQueueFull, PDFRenderTimeout, get_cache_key
+from app.schemas.hfi_calc import HFIResultResponse
+from app.tests.hfi.test_pdf_generator import generate_test_input
+
+
+class SlowRender:
+    """ Stands in for rendering a PDF, counting how many are rendered """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self, result, fire_centres, idir, datetime_generated, fuel_types):
+        self.calls += 1
+        sleep(self.seconds)
+        return f'{idir} pdf'.encode(), f'{idir}.pdf', self.seconds
+
+
+@pytest.fixture
+def slow_render(monkeypatch):
+    render = SlowRender(0.05)
+    monkeypatch.setattr('app.hfi.pdf_renderer.ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr('app.hfi.pdf_renderer.render_pdf', render)
+    return render
+
+
+def _render(renderer: PDFRenderer, idir: Optional[str] = 'wps'):
+    result, fire_centres, fuel_types = generate_test_input()
+    return renderer.render(HFIResultResponse(**result), fire_centres, idir, datetime.fromisocalendar(2022, 2, 2),
+                           fuel_types)
+
+
+@pytest.mark.anyio
+async def test_same_pdf_rendered_once(slow_render):
+    renderer = PDFRenderer(processes=2, queue_size=2, timeout_seconds=5, cache_size=4)
+    results = await asyncio.gather(*[_render(renderer) for _ in range(3)])
+    # downloaded again later, it comes from the cache
+    results.append(await _render(renderer))
+    assert slow_render.calls == 1
+    assert all(result == (b'wps pdf', 'wps.pdf') for result in results)
+    assert renderer.stats.renders == 1
+    assert renderer.stats.cache_hits == 1
+
+
+@pytest.mark.anyio
+async def test_full_queue_rejected(slow_render):
+    renderer = PDFRenderer(processes=1, queue_size=1, timeout_seconds=5, cache_size=4)
+    results = await asyncio.gather(*[_render(renderer, f'idir{index}') for index in range(3)],
+                                   return_exceptions=True)
+    assert [isinstance(result, PDFRenderQueueFull) for result in results] == [False, False, True]
+    assert renderer.stats.rejected == 1
+    assert renderer.stats.queue_depth == 0
+
+
+@pytest.mark.anyio
+async def test_render_timeout(slow_render):
+    slow_render.seconds = 0.2
+    renderer = PDFRenderer(processes=1, queue_size=1, timeout_seconds=0.05, cache_size=4)
+    with pytest.raises(PDFRenderTimeout):
+        await _render(renderer)
+    # the render carries on, and is cached when it's done
+    await asyncio.sleep(0.3)
+    assert await _render(renderer) == (b'wps pdf', 'wps.pdf')
+    assert slow_render.calls == 1
+    assert renderer.stats.timeouts == 1
+
+
+def test_cache_key_without_idir():
+    result, fire_centres, fuel_types = generate_test_input()
+    result = HFIResultResponse(**result)
+    key = get_cache_key(result, fire_centres, None, fuel_types)
+    assert key == get_cache_key(result, fire_centres, None, fuel_types)
+    assert key != get_cache_key(result, fire_centres, 'wps', fuel_types)
+
+
+@pytest.mark.anyio
+async def test_render_without_idir(slow_render):
+    renderer = PDFRenderer(processes=1, queue_size=1, timeout_seconds=5, cache_size=4)
+    assert await _render(renderer, None) == (b'None pdf', 'None.pdf')
+    assert await _render(renderer, None) == (b'None pdf', 'None.pdf')
+    assert slow_render.calls == 1
+
+
+@pytest.mark.anyio
+async def test_get_pdf_without_idir(slow_render, monkeypatch):
+    """ A token without an idir username still gets its PDF """
+    result, fire_centres, fuel_types = generate_test_input()
+
+    async def mock_get_prepared_request(*_):
+        return None, None, None
+
+    async def mock_calculate_and_create_response(*_):
+        return HFIResultResponse(**result)
+
+    async def mock_run_in_read_session(*_):
+        return []
+
+    async def mock_hydrate_fire_centres():
+        return fire_centres
+
+    renderer = PDFRenderer(processes=1, queue_size=1, timeout_seconds=5, cache_size=4)
+    monkeypatch.setattr(app.routers.hfi_calc, 'get_prepared_request', mock_get_prepared_request)
+    monkeypatch.setattr(app.routers.hfi_calc, 'calculate_and_create_response', mock_calculate_and_create_response)
+    monkeypatch.setattr(app.routers.hfi_calc, 'run_in_read_session', mock_run_in_read_session)
+    monkeypatch.setattr(app.routers.hfi_calc, 'hydrate_fire_centres', mock_hydrate_fire_centres)
+    monkeypatch.setattr(app.routers.hfi_calc, 'get_pdf_renderer', lambda: renderer)
+
+    response = await app.routers.hfi_calc.get_pdf(1, date(2022, 1, 2), date(2022, 1, 6), None, token={})
+
+    assert response.body == b'None pdf'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=None.pdf'
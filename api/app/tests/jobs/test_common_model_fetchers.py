@@ -1,7 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock
 import numpy
-from app.jobs.common_model_fetchers import accumulate_nam_precipitation
-from app.db.models.weather_models import ModelRunGridSubsetPrediction
+from app.jobs import common_model_fetchers
+from app.jobs.common_model_fetchers import ModelValueProcessor, accumulate_nam_precipitation
+from app.db.models.weather_models import (ModelRunGridSubsetPrediction, ModelRunPrediction, PredictionModel,
+                                          PredictionModelRunTimestamp)
+from app.weather_models import ModelEnum
+from app.weather_models.machine_learning import ModelMachineLearning
+from app.weather_models.interpolate import interpolate_between_two_points
 
 
 ZERO_HOUR_TIMESTAMP = datetime(2023, 9, 7, 0, 0, 0)
@@ -141,3 +148,93 @@ def test_eighteen_hour_model_run_with_non_accumulating_timestamp():
         nam_cumulative_precip, prediction, MODEL_RUN_EIGHTEEN_HOUR)
     assert (cumulative_precip == [1, 0, 0, 0]).all()
     assert (prediction_precip == [2, 0, 0, 0]).all()
+
+
+class LinearMachine:
+    """ Stand in for ModelMachineLearning, bias adjusting by adding the hour """
+
+    def predict_temperature(self, station_codes, values, hours):
+        return values + hours
+
+    predict_rh = predict_wind_speed = predict_precipitation = predict_temperature
+
+    def predict_wind_direction(self, station_codes, wind_speeds, wind_dirs, hours):
+        return wind_dirs + hours
+
+
+def test_add_bias_adjustments_to_predictions():
+    """ Bias adjusted values for a whole model run, interpolating 20:00 from 18:00 and 21:00 where required """
+    station_predictions = [
+        dict(station_code=1, prediction_timestamp=NON_ACCUMULATING_HOUR_TIMESTAMP, tmp_tgl_2=10.0, rh_tgl_2=None,
+             wind_tgl_10=5.0, wdir_tgl_10=90.0, precip_24h=1.0)
+        for _ in range(2)]
+    processor = ModelValueProcessor.__new__(ModelValueProcessor)
+    processor._add_bias_adjustments_to_predictions(station_predictions, numpy.array([False, True]), LinearMachine())
+
+    assert station_predictions[0]['bias_adjusted_temperature'] == 30.0
+    assert station_predictions[0]['bias_adjusted_rh'] is None
+    assert station_predictions[0]['bias_adjusted_wdir'] == 110.0
+    assert station_predictions[1]['bias_adjusted_temperature'] == interpolate_between_two_points(18, 21, 28.0, 31.0, 20)
+    assert station_predictions[1]['bias_adjusted_wind_speed'] == interpolate_between_two_points(18, 21, 23.0, 26.0, 20)
+    # 24 hour precip isn't interpolated
+    assert station_predictions[1]['bias_adjusted_precip_24h'] == 21.0
+
+
+def test_add_precip_to_predictions(monkeypatch):
+    """ Delta and 24 hour precip for a model run, from the run's other predictions (including ones already in the
+    database), or the hourly actuals where there's no prediction 24 hours earlier """
+    run_start = datetime(2023, 9, 7, 0, tzinfo=timezone.utc)
+    actuals = [SimpleNamespace(station_code=1, weather_date=run_start - timedelta(hours=hours), precipitation=1.0)
+               for hours in range(30)]
+    actuals.append(SimpleNamespace(station_code=1, weather_date=run_start - timedelta(hours=3), precipitation=None))
+    existing = [(1, run_start + timedelta(hours=3), 0.5), (2, run_start + timedelta(hours=3), 9.0)]
+    monkeypatch.setattr(common_model_fetchers, 'get_weather_station_model_prediction_apcp', lambda *args: existing)
+    monkeypatch.setattr(common_model_fetchers, 'get_hourly_precipitation_for_stations', lambda *args: actuals)
+
+    def station_prediction(station_code, hours, apcp):
+        return dict(station_code=station_code, prediction_timestamp=run_start + timedelta(hours=hours), apcp_sfc_0=apcp)
+
+    station_predictions = [station_prediction(1, 6, 2.0), station_prediction(1, 27, 5.0),
+                           station_prediction(2, 3, 1.0), station_prediction(2, 6, 1.5)]
+    processor = ModelValueProcessor.__new__(ModelValueProcessor)
+    processor.session = None
+    processor._add_precip_to_predictions(SimpleNamespace(id=1), [1, 2], station_predictions)
+
+    # station 1 hour 6 follows the prediction already in the database for hour 3
+    assert [prediction['delta_precip'] for prediction in station_predictions] == [1.5, 3.0, 1.0, 0.5]
+    # station 1, 24 hours before hour 6 is hour -18, the actuals from then until midnight make up the rest
+    assert station_predictions[0]['precip_24h'] == 18.0 + 2.0
+    # station 1, hour 27 has hour 3 from the database 24 hours earlier
+    assert station_predictions[1]['precip_24h'] == 4.5
+    # station 2 has no actuals
+    assert station_predictions[2]['precip_24h'] == 1.0
+    assert station_predictions[3]['precip_24h'] == 1.5
+
+
+def test_process_model_run(monkeypatch):
+    """ Every prediction in the model run is written with one upsert, including interpolated noon predictions """
+    run_timestamp = datetime(2023, 9, 7, 0, tzinfo=timezone.utc)
+    model_run = PredictionModelRunTimestamp(id=1, prediction_run_timestamp=run_timestamp,
+                                            prediction_model=PredictionModel(id=1))
+    predictions = [ModelRunPrediction(station_code=code, prediction_timestamp=run_timestamp + timedelta(hours=hours),
+                                      tmp_tgl_2=10.0, rh_tgl_2=50.0, apcp_sfc_0=None, wind_tgl_10=5.0, wdir_tgl_10=90.0)
+                   for code in [1, 2] for hours in [18, 21]]
+    monkeypatch.setattr(common_model_fetchers, 'get_model_run_predictions_for_stations', lambda *args: predictions)
+    monkeypatch.setattr(common_model_fetchers, 'get_weather_station_model_prediction_apcp', lambda *args: [])
+    monkeypatch.setattr(common_model_fetchers, 'get_hourly_precipitation_for_stations', lambda *args: [])
+    monkeypatch.setattr(ModelMachineLearning, 'learn', lambda self: None)
+    upsert = MagicMock()
+    monkeypatch.setattr(common_model_fetchers, 'upsert_weather_station_model_predictions', upsert)
+
+    processor = ModelValueProcessor.__new__(ModelValueProcessor)
+    processor.session = MagicMock()
+    processor.stations = [SimpleNamespace(code=1), SimpleNamespace(code=2)]
+    processor.station_count = 2
+    processor._process_model_run(model_run, ModelEnum.GDPS)
+
+    written = upsert.call_args.args[1]
+    assert [(row['station_code'], row['prediction_timestamp'].hour) for row in written] == [
+        (1, 18), (1, 20), (1, 21), (2, 18), (2, 20), (2, 21)]
+    assert all(row['apcp_sfc_0'] == 0.0 and row['bias_adjusted_temperature'] is None for row in written)
+    assert len({tuple(row) for row in written}) == 1
+    assert processor.session.commit.call_count == 1
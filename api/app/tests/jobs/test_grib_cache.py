@@ -0,0 +1,78 @@
+""" Unit tests for the on disk grib cache """
+import os
+import time
+from app.jobs.grib_cache import GribCache
+
+URL = 'https://dd.weather.gc.ca/model_gem_regional/10km/grib2/00/000/CMC_reg_TMP_TGL_2_ps10km_2024061700_P000.grib2'
+
+
+def _write(path, content: bytes) -> str:
+    with open(path, 'wb') as file:
+        file.write(content)
+    return str(path)
+
+
+def test_put_and_copy_to(tmp_path):
+    """ A cached file is linked into place, and keeps its extension so GDAL can open it """
+    cache = GribCache(str(tmp_path / 'cache'), 1000)
+    assert cache.lookup(URL) is None
+    entry = cache.put(URL, _write(tmp_path / 'a.grib2', b'grib'), '"v1"', None)
+    assert entry.path.endswith('.grib2')
+
+    assert cache.lookup(URL) == entry
+    assert cache.copy_to(entry, str(tmp_path / 'b.grib2'))
+    with open(tmp_path / 'b.grib2', 'rb') as file:
+        assert file.read() == b'grib'
+    assert os.listdir(tmp_path / 'cache' / 'tmp') == []
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.evictions) == (1, 1, 0)
+
+
+def test_new_version_gets_a_new_entry(tmp_path):
+    cache = GribCache(str(tmp_path / 'cache'), 1000)
+    first = cache.put(URL, _write(tmp_path / 'a.grib2', b'one'), '"v1"', None)
+    second = cache.put(URL, _write(tmp_path / 'b.grib2', b'two'), '"v2"', None)
+    assert first.path != second.path
+    assert cache.lookup(URL) == second
+    assert cache.conditional_headers(second) == {'If-None-Match': '"v2"'}
+
+
+def test_is_fresh(tmp_path):
+    cache = GribCache(str(tmp_path / 'cache'), 1000)
+    entry = cache.put(URL, _write(tmp_path / 'a.grib2', b'grib'), None, 'Mon, 17 Jun 2024 00:00:00 GMT')
+    assert cache.is_fresh(entry, 60)
+    stale = entry._replace(stored_at=time.time() - 120)
+    assert not cache.is_fresh(stale, 60)
+    assert cache.is_fresh(cache.revalidated(stale), 60)
+    assert cache.conditional_headers(entry) == {'If-Modified-Since': 'Mon, 17 Jun 2024 00:00:00 GMT'}
+
+
+def test_least_recently_used_evicted(tmp_path):
+    """ Past the size limit, files are evicted least recently used first, and become misses """
+    cache = GribCache(str(tmp_path / 'cache'), 1000)
+    entries = []
+    for index in range(3):
+        url = f'{URL}?{index}'
+        entries.append(cache.put(url, _write(tmp_path / f'{index}.grib2', bytes(100)), None, None))
+        os.utime(entries[-1].path, (index, index))
+    cache.max_bytes = 250
+    # use the oldest file, so the second one is least recently used.
+    assert cache.copy_to(entries[0], str(tmp_path / 'used.grib2'))
+    cache.evict()
+    assert cache.stats.evictions == 1
+    assert cache.lookup(f'{URL}?1') is None
+    assert cache.lookup(f'{URL}?0') is not None
+    assert not cache.copy_to(entries[1], str(tmp_path / 'evicted.grib2'))
+
+
+def test_size_kept_as_running_total(tmp_path, mocker):
+    """ The cache directory is walked once, and again only when the cache is over its size limit """
+    cache = GribCache(str(tmp_path / 'cache'), 250)
+    list_files = mocker.spy(cache, '_list_files')
+    for index in range(2):
+        cache.put(f'{URL}?{index}', _write(tmp_path / f'{index}.grib2', bytes(100)), None, None)
+    # caching the same version again doesn't count it twice
+    cache.put(f'{URL}?1', _write(tmp_path / 'again.grib2', bytes(100)), None, None)
+    assert (cache.total_bytes, list_files.call_count, cache.stats.evictions) == (200, 1, 0)
+
+    cache.put(f'{URL}?2', _write(tmp_path / '2.grib2', bytes(100)), None, None)
+    assert (cache.total_bytes, list_files.call_count, cache.stats.evictions) == (200, 2, 1)
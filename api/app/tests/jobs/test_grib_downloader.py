@@ -0,0 +1,183 @@
+""" Unit tests for the concurrent grib downloader, against a local http server """
+import asyncio
+import os
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from app.jobs import grib_downloader
+from app.jobs.grib_cache import GribCache
+from app.jobs.grib_downloader import GribDownloader, HostRateLimiter, get_download_filename, remove_download
+
+CONTENT = bytes(range(256)) * 64
+ETAG = '"grib-v1"'
+
+
+class GribServer:
+    """ Serves CONTENT with an ETag, honouring Range and If-None-Match, optionally failing the first requests """
+
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request: web.Request):
+        self.requests.append(request)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if request.match_info['name'] == 'missing.grib2':
+                return web.Response(status=404)
+            if self.failures > 0:
+                self.failures -= 1
+                return web.Response(status=503)
+            if request.headers.get('If-None-Match') == ETAG:
+                return web.Response(status=304, headers={'ETag': ETAG})
+            range_header = request.headers.get('Range')
+            if range_header and request.headers.get('If-Range') == ETAG:
+                start = int(range_header[len('bytes='):-1])
+                return web.Response(status=206, body=CONTENT[start:], headers={
+                    'ETag': ETAG, 'Content-Range': f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}'})
+            return web.Response(body=CONTENT, headers={'ETag': ETAG})
+        finally:
+            self.active -= 1
+
+
+async def _start(grib_server: GribServer) -> TestServer:
+    application = web.Application()
+    application.router.add_get('/{name}', grib_server.handle)
+    server = TestServer(application)
+    await server.start_server()
+    return server
+
+
+def _downloader(session, **kwargs):
+    return GribDownloader(session, **{'concurrency': 2, 'requests_per_second': 0, 'retries': 2,
+                                      'backoff_seconds': 0, **kwargs})
+
+
+@pytest.mark.anyio
+async def test_download(tmp_path):
+    """ The file is streamed to disk, a 404 gives None """
+    grib_server = GribServer()
+    server = await _start(grib_server)
+    async with ClientSession() as session:
+        downloader = _downloader(session)
+        target = await downloader.download(str(server.make_url('/a.grib2')), str(tmp_path), 'a.grib2')
+        assert await downloader.download(str(server.make_url('/missing.grib2')), str(tmp_path), 'missing.grib2') is None
+    await server.close()
+    with open(target, 'rb') as file:
+        assert file.read() == CONTENT
+    assert not os.path.exists(f'{target}.part')
+    assert (downloader.stats.files, downloader.stats.bytes, downloader.stats.not_found) == (1, len(CONTENT), 1)
+    remove_download(target)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.anyio
+async def test_download_retries(tmp_path):
+    """ 503 responses are retried, until we run out of retries """
+    grib_server = GribServer(failures=2)
+    server = await _start(grib_server)
+    async with ClientSession() as session:
+        downloader = _downloader(session)
+        assert await downloader.download(str(server.make_url('/a.grib2')), str(tmp_path), 'a.grib2')
+        assert downloader.stats.retries == 2
+        grib_server.failures = 3
+        with pytest.raises(Exception):
+            await downloader.download(str(server.make_url('/b.grib2')), str(tmp_path), 'b.grib2')
+    await server.close()
+
+
+@pytest.mark.anyio
+async def test_download_skips_unchanged_and_resumes(tmp_path):
+    """ A file already on disk isn't downloaded again, a partial download continues where it left off """
+    grib_server = GribServer()
+    server = await _start(grib_server)
+    async with ClientSession() as session:
+        downloader = _downloader(session)
+        url = str(server.make_url('/a.grib2'))
+        target = await downloader.download(url, str(tmp_path), 'a.grib2')
+        assert await downloader.download(url, str(tmp_path), 'a.grib2') == target
+        assert downloader.stats.skipped == 1
+
+        # pretend the download was interrupted half way through
+        os.rename(target, f'{target}.part')
+        with open(f'{target}.part', 'r+b') as file:
+            file.truncate(1000)
+        await downloader.download(url, str(tmp_path), 'a.grib2')
+    await server.close()
+    assert grib_server.requests[-1].headers['Range'] == 'bytes=1000-'
+    assert downloader.stats.bytes == 2 * len(CONTENT) - 1000
+    with open(target, 'rb') as file:
+        assert file.read() == CONTENT
+
+
+@pytest.mark.anyio
+async def test_download_all(tmp_path):
+    """ Every url is yielded once, with no more than concurrency downloads at a time, errors are yielded """
+    grib_server = GribServer(delay=0.05)
+    server = await _start(grib_server)
+    names = [f'{index}.grib2' for index in range(6)] + ['missing.grib2']
+    async with ClientSession() as session:
+        downloader = _downloader(session)
+        downloads = [(str(server.make_url(f'/{name}')), name) for name in names]
+        downloads.append(('http://localhost:1/unreachable.grib2', 'unreachable.grib2'))
+        results = [result async for result in downloader.download_all(downloads, str(tmp_path), queue_size=1)]
+    await server.close()
+    assert sorted(result.url for result in results) == sorted(url for url, _ in downloads)
+    assert sorted(os.path.basename(result.target) for result in results if result.target) == names[:6]
+    assert [result.url for result in results if result.error] == ['http://localhost:1/unreachable.grib2']
+    assert grib_server.max_active == 2
+
+
+@pytest.mark.anyio
+async def test_host_rate_limiter():
+    """ Requests to a host are spaced out, other hosts aren't held up """
+    rate_limiter = HostRateLimiter(20)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.gather(*[rate_limiter.wait('a') for _ in range(3)])
+    assert loop.time() - start >= 0.09
+    start = loop.time()
+    await rate_limiter.wait('b')
+    assert loop.time() - start < 0.05
+
+
+def test_get_download_filename():
+    assert get_download_filename('https://dd.weather.gc.ca/a/b/CMC_reg_TMP_TGL_2.grib2', 'RDPS') == 'CMC_reg_TMP_TGL_2.grib2'
+    url = ('https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl?file=gfs.t00z.pgrb2.0p25.f000'
+           '&lev_2_m_above_ground=on&var_TMP=on&dir=%2Fgfs.20230302%2F00%2Fatmos')
+    assert get_download_filename(url, 'GFS') == os.path.split(url)[-1][:81].replace('.', '')
+
+
+@pytest.mark.anyio
+async def test_download_cached(tmp_path, monkeypatch, mocker):
+    """ A fresh cached file is used without asking the server, a stale one is revalidated """
+    monkeypatch.setenv('TEST_GRIB_CACHE', 'True')
+    monkeypatch.setenv('TEST_GRIB_CACHE_EXPIRY', '60')
+    monkeypatch.setattr(grib_downloader, 'get_grib_cache', lambda: cache)
+    cache = GribCache(str(tmp_path / 'cache'), 1024 * 1024)
+    grib_server = GribServer()
+    server = await _start(grib_server)
+    async with ClientSession() as session:
+        downloader = _downloader(session, config_cache_var='TEST_GRIB_CACHE', config_cache_expiry_var='TEST_GRIB_CACHE_EXPIRY')
+        url = str(server.make_url('/a.grib2'))
+        remove_download(await downloader.download(url, str(tmp_path), 'a.grib2'))
+        remove_download(await downloader.download(url, str(tmp_path), 'a.grib2'))
+        assert len(grib_server.requests) == 1
+
+        monkeypatch.setenv('TEST_GRIB_CACHE_EXPIRY', '0')
+        target = await downloader.download(url, str(tmp_path), 'a.grib2')
+    await server.close()
+    assert grib_server.requests[-1].headers['If-None-Match'] == ETAG
+    assert downloader.stats.cache_hits == 2
+    assert (downloader.stats.files, cache.stats.hits) == (1, 2)
+    with open(target, 'rb') as file:
+        assert file.read() == CONTENT
+    # the cache stats are logged along with the download stats
+    log = mocker.spy(cache.stats, 'log')
+    downloader.log_stats('TEST')
+    log.assert_called_once_with('TEST')
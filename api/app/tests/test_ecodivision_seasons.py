@@ -0,0 +1,20 @@
+""" Unit tests for ecodivision lookups """
+from app.data.ecodivision_seasons import EcodivisionSeasons, get_ecodivision_index
+
+
+def test_ecodivision_names():
+    eco_division = EcodivisionSeasons()
+    names = eco_division.get_ecodivision_names([(322, 50.6733333, -120.4816667),
+                                                (1, 61, -130),
+                                                (2, 0, 0)])
+    assert names == ['SEMI-ARID STEPPE HIGHLANDS', 'SUB-ARCTIC HIGHLANDS', 'DEFAULT']
+    assert 'SEMI-ARID STEPPE HIGHLANDS' in eco_division.get_core_seasons()
+
+
+def test_ecodivision_names_memoized_per_station():
+    """ Stations are looked up once, no matter which other stations they're requested with """
+    index = get_ecodivision_index()
+    EcodivisionSeasons().get_ecodivision_names([(317, 49.0623139, -120.7674194), (322, 50.6733333, -120.4816667)])
+    assert (317, 49.0623139, -120.7674194) in index.name_lookup
+    assert EcodivisionSeasons().index is index
+    assert EcodivisionSeasons().get_ecodivision_name(317, 49.0623139, -120.7674194) == 'SEMI-ARID STEPPE HIGHLANDS'
@@ -0,0 +1,58 @@
+""" Unit tests for pre-calculated percentiles """
+import json
+import os
+from statistics import mean
+import pytest
+from fastapi import HTTPException
+from app.percentile import data_folder, get_percentile_store, get_precalculated_percentiles, load_percentile_store
+from app.schemas.percentiles import PercentileRequest, YearRange
+
+
+def _request(stations, start=2014, end=2023) -> PercentileRequest:
+    return PercentileRequest(stations=stations, percentile=90, year_range=YearRange(start=start, end=end))
+
+
+def test_percentiles_match_station_files():
+    """ The store returns the same values as the json file for each station """
+    stations = [331, 328, 1002, 101]
+    response = get_precalculated_percentiles(_request(stations))
+    expected = {'ffmc': [], 'isi': [], 'bui': []}
+    for code in stations:
+        with open(os.path.join(data_folder, '2014-2023', f'{code}.json'), encoding='utf-8') as station_file:
+            summary = json.load(station_file)
+        assert response.stations[code].dict()['ffmc'] == summary['ffmc']
+        assert response.stations[code].station.name == summary['station']['name']
+        if summary['ffmc'] and summary['isi'] and summary['bui']:
+            for key, values in expected.items():
+                values.append(summary[key])
+    assert response.mean_values.ffmc == pytest.approx(mean(expected['ffmc']))
+    assert response.mean_values.isi == pytest.approx(mean(expected['isi']))
+    assert response.mean_values.bui == pytest.approx(mean(expected['bui']))
+
+
+def test_station_without_values():
+    """ Stations missing values aren't counted in the mean values """
+    percentiles = get_percentile_store().get(2014, 2023)
+    incomplete = [code for code, row in percentiles.row_by_code.items() if not percentiles.complete[row]]
+    response = get_precalculated_percentiles(_request(incomplete[:1]))
+    assert response.mean_values.ffmc is None
+
+
+def test_unknown_station():
+    with pytest.raises(HTTPException) as excinfo:
+        get_precalculated_percentiles(_request([331, 999999]))
+    assert excinfo.value.status_code == 400
+
+
+def test_store_footprint():
+    """ The footprint includes the station summaries, which are kept as json rather than pydantic objects """
+    store = get_percentile_store()
+    assert set(store.year_ranges) == {(1994, 2023), (2004, 2023), (2014, 2023)}
+    records_bytes = sum(len(record) for percentiles in store.year_ranges.values() for record in percentiles.records)
+    assert records_bytes < store.nbytes < 1000000
+
+
+@pytest.mark.anyio
+async def test_load_percentile_store():
+    """ Loading the store off the event loop gives the store for the process """
+    assert await load_percentile_store() is get_percentile_store()
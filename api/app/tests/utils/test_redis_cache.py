@@ -0,0 +1,112 @@
+""" Unit tests for the redis cache layer, against fakeredis """
+import asyncio
+import json
+import fakeredis
+import pytest
+from app.utils.redis_cache import RedisCache, decode, encode
+
+
+@pytest.fixture()
+def redis():
+    return fakeredis.FakeAsyncRedis()
+
+
+@pytest.fixture()
+def redis_cache(redis: fakeredis.FakeAsyncRedis):
+    return RedisCache(lambda: redis, compress_threshold=100)
+
+
+def test_encode_decode():
+    small = {'a': 1}
+    large = {'stations': [{'stationCode': code, 'displayLabel': 'NAME'} for code in range(100)]}
+    assert decode(encode(small, 100)) == small
+    assert decode(encode(large, 100)) == large
+    assert len(encode(large, 100)) < len(json.dumps(large)) / 4
+    # values cached before they had a header are plain json
+    assert decode(json.dumps(large).encode()) == large
+
+
+@pytest.mark.anyio
+async def test_get_set(redis_cache: RedisCache, redis: fakeredis.FakeAsyncRedis):
+    assert await redis_cache.get('key') is None
+    await redis_cache.set('key', {'value': [1, 2, 3]}, 60)
+    assert await redis_cache.get('key') == {'value': [1, 2, 3]}
+    assert 0 < await redis.ttl('key') <= 60
+    assert (redis_cache.stats.hits, redis_cache.stats.misses) == (1, 1)
+
+
+@pytest.mark.anyio
+async def test_concurrent_misses_fetch_once(redis_cache: RedisCache):
+    """ Concurrent misses for the same key are coalesced into one fetch, and the value is cached """
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'page': 1}, 60
+
+    results = await asyncio.gather(*[redis_cache.get_or_fetch('key', fetch) for _ in range(5)])
+    assert results == [{'page': 1}] * 5
+    assert len(calls) == 1
+    assert redis_cache.stats.coalesced == 4
+    assert await redis_cache.get_or_fetch('key', fetch) == {'page': 1}
+    assert len(calls) == 1
+
+
+@pytest.mark.anyio
+async def test_waiters_fetch_if_shared_fetch_fails(redis_cache: RedisCache):
+    """ If the fetch callers are waiting on fails (e.g. the first caller's session was closed), they each fetch the
+    value with their own fetch, and the first caller gets the error """
+    async def failing_fetch():
+        await asyncio.sleep(0.01)
+        raise ConnectionError('session closed')
+
+    async def fetch():
+        return {'page': 1}, 60
+
+    results = await asyncio.gather(redis_cache.get_or_fetch('key', failing_fetch),
+                                   redis_cache.get_or_fetch('key', fetch),
+                                   redis_cache.get_or_fetch('key', fetch),
+                                   return_exceptions=True)
+    assert isinstance(results[0], ConnectionError)
+    assert results[1:] == [{'page': 1}] * 2
+    assert redis_cache.stats.coalesced == 2
+
+
+@pytest.mark.anyio
+async def test_not_cached_without_expiry(redis_cache: RedisCache, redis: fakeredis.FakeAsyncRedis):
+    """ A fetch that returns no expiry (e.g. an error response) isn't cached """
+    async def fetch():
+        return {'error': 'bad'}, None
+
+    assert await redis_cache.get_or_fetch('key', fetch) == {'error': 'bad'}
+    assert await redis.get('key') is None
+
+
+@pytest.mark.anyio
+async def test_redis_unavailable():
+    """ If redis is down, everything is a miss, and values are still fetched """
+    class BrokenRedis:
+        async def get(self, name):
+            raise ConnectionError()
+
+        async def set(self, name, value, ex=None):
+            raise ConnectionError()
+
+    cache = RedisCache(BrokenRedis)
+
+    async def fetch():
+        return {'a': 1}, 60
+
+    assert await cache.get_or_fetch('key', fetch) == {'a': 1}
+    assert cache.stats.errors == 2
+
+
+@pytest.mark.anyio
+async def test_stats_logged_periodically(redis: fakeredis.FakeAsyncRedis, mocker):
+    """ The stats are logged every stats_log_interval lookups """
+    cache = RedisCache(lambda: redis, compress_threshold=100, stats_log_interval=2)
+    log = mocker.spy(cache.stats, 'log')
+    for _ in range(5):
+        await cache.get('key')
+    assert log.call_count == 2
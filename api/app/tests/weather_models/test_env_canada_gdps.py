@@ -1,16 +1,18 @@
 """ Unit tests for app/env_canada.py """
 
 import os
+import shutil
 import sys
 import logging
 import datetime
 from datetime import datetime
 import pytest
-import requests
+from aiohttp import ClientResponseError
 from sqlalchemy.orm import Session
 from app.jobs import env_canada
 from app.jobs.env_canada_utils import GRIB_LAYERS, get_global_model_run_download_urls
 from app.jobs import common_model_fetchers
+from app.jobs.grib_downloader import GribDownloader
 import app.utils.time as time_utils
 from app.weather_models import machine_learning
 import app.db.crud.weather_models
@@ -18,7 +20,7 @@ from app.stations import StationSourceEnum
 from app.db.models.weather_models import (PredictionModel, ProcessedModelRunUrl,
                                           PredictionModelRunTimestamp)
 from app.tests.weather_models.crud import get_actuals_left_outer_join_with_predictions
-from app.tests.weather_models.test_models_common import (MockResponse, mock_get_processed_file_count, mock_get_stations)
+from app.tests.weather_models.test_models_common import (mock_get_processed_file_count, mock_get_stations)
 
 logger = logging.getLogger(__name__)
 
@@ -80,24 +82,22 @@ def mock_database(monkeypatch):
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get_gdps(*args, **kwargs):
+    async def mock_grib_download_gdps(self, url, path, filename):
         """ mock env_canada download method for GDPS """
         dirname = os.path.dirname(os.path.realpath(__file__))
-        filename = os.path.join(
-            dirname, 'CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2')
-        with open(filename, 'rb') as file:
-            content = file.read()
-        return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get_gdps)
+        target = os.path.join(path, filename)
+        shutil.copyfile(os.path.join(dirname, 'CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2'), target)
+        return target
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download_gdps)
 
 
 @pytest.fixture()
 def mock_download_fail(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get(*args, **kwargs):
+    async def mock_grib_download(self, url, path, filename):
         """ mock env_canada download method """
-        return MockResponse(status_code=400)
-    monkeypatch.setattr(requests, 'get', mock_requests_get)
+        raise ClientResponseError(None, (), status=400)
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download)
 
 
 def test_get_gdps_download_urls():
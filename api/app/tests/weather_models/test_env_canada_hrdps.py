@@ -1,11 +1,11 @@
 """ Unit tests for app/env_canada.py """
 
 import os
+import shutil
 import sys
 import logging
 from typing import Optional
 import pytest
-import requests
 import datetime
 from sqlalchemy.orm import Session
 from pytest_mock import MockerFixture
@@ -15,12 +15,12 @@ import app.db.database
 import app.db.crud.weather_models
 import app.jobs.env_canada
 import app.jobs.common_model_fetchers
+from app.jobs.grib_downloader import GribDownloader
 import app.weather_models.process_grib
 from app.weather_models import ProjectionEnum
 from app.stations import StationSourceEnum
 from app.db.models.weather_models import (PredictionModel, ProcessedModelRunUrl,
                                           PredictionModelRunTimestamp)
-from app.tests.weather_models.test_env_canada_gdps import MockResponse
 
 
 logger = logging.getLogger(__name__)
@@ -78,15 +78,13 @@ def mock_get_processed_file_record(monkeypatch):
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get_hrdps(*args, **kwargs):
+    async def mock_grib_download_hrdps(self, url, path, filename):
         """ mock env_canada download method for HRDPS """
         dirname = os.path.dirname(os.path.realpath(__file__))
-        filename = os.path.join(
-            dirname, '20230317T18Z_MSC_HRDPS_RH_AGL-2m_RLatLon0.0225_PT001H.grib2')
-        with open(filename, 'rb') as file:
-            content = file.read()
-        return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get_hrdps)
+        target = os.path.join(path, filename)
+        shutil.copyfile(os.path.join(dirname, '20230317T18Z_MSC_HRDPS_RH_AGL-2m_RLatLon0.0225_PT001H.grib2'), target)
+        return target
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download_hrdps)
 
 
 def test_get_hrdps_download_urls():
@@ -1,10 +1,11 @@
 """ Unit tests for app/env_canada.py """
 
 import os
+import shutil
 import sys
 import logging
 import pytest
-import requests
+from aiohttp import ClientResponseError
 from typing import Optional
 from sqlalchemy.orm import Session
 from app.jobs.env_canada_utils import GRIB_LAYERS, get_regional_model_run_download_urls
@@ -12,11 +13,11 @@ import app.utils.time as time_utils
 import app.weather_models.process_grib
 import app.jobs.env_canada
 import app.jobs.common_model_fetchers
+from app.jobs.grib_downloader import GribDownloader
 import app.db.crud.weather_models
 from app.stations import StationSourceEnum
 from app.db.models.weather_models import (PredictionModel, ProcessedModelRunUrl,
                                           PredictionModelRunTimestamp)
-from app.tests.weather_models.test_env_canada_gdps import (MockResponse)
 
 logger = logging.getLogger(__name__)
 
@@ -75,24 +76,22 @@ def mock_get_processed_file_record(monkeypatch):
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get_rdps(*args, **kwargs):
+    async def mock_grib_download_rdps(self, url, path, filename):
         """ mock env_canada download method for RDPS """
         dirname = os.path.dirname(os.path.realpath(__file__))
-        filename = os.path.join(
-            dirname, 'CMC_reg_RH_TGL_2_ps10km_2020110500_P034.grib2')
-        with open(filename, 'rb') as file:
-            content = file.read()
-        return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get_rdps)
+        target = os.path.join(path, filename)
+        shutil.copyfile(os.path.join(dirname, 'CMC_reg_RH_TGL_2_ps10km_2020110500_P034.grib2'), target)
+        return target
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download_rdps)
 
 
 @pytest.fixture()
 def mock_download_fail(monkeypatch):
     """ fixture for env_canada.download """
-    def mock_requests_get(*args, **kwargs):
+    async def mock_grib_download(self, url, path, filename):
         """ mock env_canada download method """
-        return MockResponse(status_code=400)
-    monkeypatch.setattr(requests, 'get', mock_requests_get)
+        raise ClientResponseError(None, (), status=400)
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download)
 
 
 def test_get_rdps_download_urls():
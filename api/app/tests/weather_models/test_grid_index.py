@@ -0,0 +1,88 @@
+""" Unit tests for the cached station grid index """
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from affine import Affine
+from app.geospatial import NAD83_CRS
+from app.weather_models import grid_index
+from app.weather_models.grid_index import StationGridIndex, calculate_station_grid_index, get_station_grid_index
+from app.weather_models.process_grib import calculate_raster_coordinate, get_transformer
+
+transform = Affine(1.0, 0.0, 0.0, 0.0, -1.0, 10.0)
+transformer = get_transformer(NAD83_CRS, NAD83_CRS)
+stations = [SimpleNamespace(code=1, long=2.5, lat=7.5), SimpleNamespace(code=2, long=30.0, lat=5.0),
+            SimpleNamespace(code=3, long=0.25, lat=9.5), SimpleNamespace(code=4, long=9.5, lat=0.5)]
+data = np.arange(100, dtype=np.float32).reshape(10, 10)
+
+
+class DictRedis:
+    """ Just enough of redis to share cached values between tests """
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, name):
+        return self.store.get(name)
+
+    def set(self, name, value, ex=None):
+        self.store[name] = value
+
+
+@pytest.fixture
+def redis_store(monkeypatch):
+    store = {}
+    monkeypatch.setenv('REDIS_USE', 'True')
+    monkeypatch.setattr(grid_index, 'create_redis', lambda: DictRedis(store))
+    monkeypatch.setattr(grid_index, '_grid_indexes', {})
+    return store
+
+
+def test_calculate_station_grid_index():
+    """ Stations outside the grid are left out, pixels match calculate_raster_coordinate """
+    index = calculate_station_grid_index(stations, transform, transformer, 10, 10)
+    assert index.station_codes.tolist() == [1, 3, 4]
+    for code, x, y in zip(index.station_codes, index.x_indexes, index.y_indexes):
+        station = stations[code - 1]
+        assert (x, y) == calculate_raster_coordinate(station.long, station.lat, transform, transformer)
+    assert np.allclose(index.weights.sum(axis=1), 1)
+    assert index.sample(data).tolist() == [22.0, 0.0, 99.0]
+
+
+def test_sample_bilinear():
+    """ Bilinear interpolation of a linear surface is exact, edge pixels are reused at the grid boundary """
+    index = calculate_station_grid_index(stations, transform, transformer, 10, 10)
+    # pixel (x, y) of data is 10y + x, station 1 is at pixel coordinates (2.5, 2.5), station 3 at (0.25, 0.5)
+    assert np.allclose(index.sample_bilinear(data)[:2], [27.5, 5.25])
+    assert index.sample_bilinear(data)[2] == 99.0
+
+
+def test_bytes_round_trip():
+    index = calculate_station_grid_index(stations, transform, transformer, 10, 10)
+    restored = StationGridIndex.from_bytes(index.to_bytes())
+    for name in ['station_codes', 'x_indexes', 'y_indexes', 'weights']:
+        assert np.array_equal(getattr(restored, name), getattr(index, name))
+
+
+def test_get_station_grid_index_cached(redis_store, mocker):
+    """ The index is calculated once, then comes from memory, or from redis in another process """
+    calculate = mocker.spy(grid_index, 'calculate_station_grid_index')
+    index = get_station_grid_index('test:grid', stations, transform, transformer, 10, 10)
+    assert get_station_grid_index('test:grid', stations, transform, transformer, 10, 10) is index
+    assert calculate.call_count == 1
+    assert len(redis_store) == 1
+
+    grid_index._grid_indexes.clear()
+    restored = get_station_grid_index('test:grid', stations, transform, transformer, 10, 10)
+    assert calculate.call_count == 1
+    assert restored.station_codes.tolist() == index.station_codes.tolist()
+
+
+def test_get_station_grid_index_invalidated(redis_store, mocker):
+    """ A different station list, or grid, gets an index of its own """
+    calculate = mocker.spy(grid_index, 'calculate_station_grid_index')
+    get_station_grid_index('test:grid', stations, transform, transformer, 10, 10)
+    moved = stations[:3] + [SimpleNamespace(code=4, long=8.5, lat=0.5)]
+    assert get_station_grid_index('test:grid', moved, transform, transformer, 10, 10).x_indexes.tolist() == [2, 0, 8]
+    get_station_grid_index('test:grid', stations, transform, transformer, 20, 10)
+    assert calculate.call_count == 3
+    assert len(redis_store) == 3
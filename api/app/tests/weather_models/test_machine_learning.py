@@ -1,4 +1,6 @@
 from datetime import datetime
+from types import SimpleNamespace
+import numpy as np
 import pytest
 from app.db.models.observations import HourlyActual
 from app.weather_models import machine_learning
@@ -131,3 +133,104 @@ def test_bias_adjustment_without_samples(mock_get_actuals_left_outer_join_with_p
     assert rh_result is None
     assert wdir_result is None
     assert precip_result is None
+
+
+def station_rows(station_code):
+    """ The mocked actuals and predictions, for a station, with a station specific temperature bias """
+    rows = get_actuals_left_outer_join_with_predictions()
+    for actual, _ in rows:
+        actual.station_code = station_code
+        if actual.temperature is not None:
+            actual.temperature += station_code
+    return rows
+
+
+def latest_prediction_rows(station_code):
+    """ The mocked actuals with the values of their most recent prediction, as selected by
+    get_latest_predictions_for_actuals_for_stations """
+    rows = []
+    for actual, prediction in station_rows(station_code):
+        if rows and rows[-1].weather_date == actual.weather_date:
+            continue
+        rows.append(SimpleNamespace(
+            station_code=actual.station_code, weather_date=actual.weather_date, temperature=actual.temperature,
+            relative_humidity=actual.relative_humidity, wind_speed=actual.wind_speed,
+            wind_direction=actual.wind_direction,
+            **{key: getattr(prediction, key) if prediction else None
+               for key in ('prediction_timestamp', 'tmp_tgl_2', 'rh_tgl_2', 'wind_tgl_10', 'wdir_tgl_10')}))
+    return rows
+
+
+def station_precip(station_code):
+    """ The mocked daily precip, for a station, with a station specific bias """
+    actuals = get_accumulated_precip_by_24h_interval()
+    for actual in actuals:
+        actual.station_code = station_code
+        actual.actual_precip_24h += station_code
+    predictions = get_predicted_daily_precip()
+    for prediction in predictions:
+        prediction.station_code = station_code
+    return actuals, predictions
+
+
+def test_model_machine_learning_matches_station_machine_learning(monkeypatch):
+    """ Training every station at once gives the same predictions as training each station on its own. Wind
+    direction has two samples (of two features) per hour here, which sklearn's result for depends on rounding,
+    so is covered by test_grouped_linear_regression instead. """
+    station_codes = [1, 2]
+    monkeypatch.setattr(machine_learning, 'get_actuals_left_outer_join_with_predictions',
+                        lambda session, model_id, station_code, *args: station_rows(station_code))
+    monkeypatch.setattr(machine_learning, 'get_accumulated_precip_by_24h_interval',
+                        lambda session, station_code, *args: station_precip(station_code)[0])
+    monkeypatch.setattr(machine_learning, 'get_predicted_daily_precip',
+                        lambda session, model, station_code, *args: station_precip(station_code)[1])
+    monkeypatch.setattr(machine_learning, 'get_latest_predictions_for_actuals_for_stations',
+                        lambda *args: [row for code in station_codes for row in latest_prediction_rows(code)])
+    monkeypatch.setattr(machine_learning, 'get_accumulated_precip_by_24h_interval_for_stations',
+                        lambda *args: [actual for code in station_codes for actual in station_precip(code)[0]])
+    monkeypatch.setattr(machine_learning, 'get_predicted_daily_precip_for_stations',
+                        lambda *args: [prediction for code in station_codes for prediction in station_precip(code)[1]])
+
+    model_machine = machine_learning.ModelMachineLearning(
+        session=None, model=PredictionModel(id=1), station_codes=station_codes, max_learn_date=datetime.now())
+    model_machine.learn()
+
+    codes = np.array([1, 1, 1, 2, 2, 2, 3])
+    hours = np.array([18, 21, 1, 18, 21, 20, 21])
+    temperatures = np.array([20.0, 20.0, 20.0, 5.0, np.nan, 20.0, 20.0])
+    rhs = np.full(7, 50.0)
+    wind_speeds = np.full(7, 10.0)
+    wind_dirs = np.array([120.0, 120.0, 120.0, 290.0, 290.0, 290.0, 120.0])
+    precip = np.full(7, 3.0)
+    wind_directions = model_machine.predict_wind_direction(codes, wind_speeds, wind_dirs, hours)
+    assert np.isnan(wind_directions[[2, 5, 6]]).all()
+    assert np.isfinite(wind_directions[[0, 1, 3]]).all()
+    batched = {
+        'temperature': model_machine.predict_temperature(codes, temperatures, hours),
+        'rh': model_machine.predict_rh(codes, rhs, hours),
+        'wind_speed': model_machine.predict_wind_speed(codes, wind_speeds, hours),
+        'precip': model_machine.predict_precipitation(codes, precip, np.full(7, 20)),
+    }
+
+    for index, (code, hour) in enumerate(zip(codes.tolist(), hours.tolist())):
+        timestamp = datetime(2023, 10, 10, hour)
+        if code not in station_codes:
+            # stations that weren't learned don't get bias adjusted
+            assert all(np.isnan(values[index]) for values in batched.values())
+            continue
+        station_machine = StationMachineLearning(
+            session=None, model=PredictionModel(id=1), target_coordinate=None,
+            station_code=code, max_learn_date=datetime.now())
+        station_machine.learn()
+        temperature = None if np.isnan(temperatures[index]) else temperatures[index]
+        expected = {
+            'temperature': station_machine.predict_temperature(temperature, timestamp),
+            'rh': station_machine.predict_rh(rhs[index], timestamp),
+            'wind_speed': station_machine.predict_wind_speed(wind_speeds[index], timestamp),
+            'precip': station_machine.predict_precipitation(precip[index], timestamp.replace(hour=20)),
+        }
+        for key, value in expected.items():
+            if value is None:
+                assert np.isnan(batched[key][index]), key
+            else:
+                assert math.isclose(batched[key][index], value, abs_tol=1e-9), key
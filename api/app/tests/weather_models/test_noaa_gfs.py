@@ -1,18 +1,19 @@
 """ Unit tests for app/jobs/noaa.py """
 
 import os
+import shutil
 import logging
 from datetime import datetime, timezone
 from app.jobs import common_model_fetchers
-from app.tests.weather_models.test_models_common import MockResponse, shape, mock_get_model_run_predictions
+from app.tests.weather_models.test_models_common import shape, mock_get_model_run_predictions
 import app.utils.time as time_utils
 import pytest
-import requests
 from geoalchemy2.shape import from_shape
 from app.db.models.weather_models import (PredictionModel,
                                           PredictionModelGridSubset, PredictionModelRunTimestamp,
                                           ProcessedModelRunUrl)
 from app.jobs import noaa
+from app.jobs.grib_downloader import GribDownloader
 import app.db.crud.weather_models
 
 
@@ -67,15 +68,13 @@ def mock_database(monkeypatch):
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for NOAA download """
-    def mock_requests_get_gfs(*args, **kwargs):
+    async def mock_grib_download_gfs(self, url, path, filename):
         """ mock common_model_fetchers download method for GFS """
         dirname = os.path.dirname(os.path.realpath(__file__))
-        filename = os.path.join(
-            dirname, 'gfs_4_20230219_0600_018.grb2')
-        with open(filename, 'rb') as file:
-            content = file.read()
-        return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get_gfs)
+        target = os.path.join(path, filename)
+        shutil.copyfile(os.path.join(dirname, 'gfs_4_20230219_0600_018.grb2'), target)
+        return target
+    monkeypatch.setattr(GribDownloader, 'download', mock_grib_download_gfs)
 
 
 def test_get_gfs_model_run_download_urls_for_00_utc():
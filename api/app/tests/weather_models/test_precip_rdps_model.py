@@ -1,11 +1,19 @@
 import os
+from contextlib import asynccontextmanager
 import numpy as np
 import pytest
 from pytest_mock import MockerFixture
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from app.tests.utils.raster_reader import read_raster_array
 
-from app.weather_models.precip_rdps_model import TemporalPrecip, compute_precip_difference, get_raster_keys_to_diff, generate_24_hour_accumulating_precip_raster
+from app.weather_models.precip_rdps_model import (
+    TemporalPrecip,
+    compute_and_store_precip_rasters,
+    compute_precip_difference,
+    get_accumulated_precip_key,
+    get_raster_keys_to_diff,
+    generate_24_hour_accumulating_precip_raster,
+)
 from app.weather_models.rdps_filename_marshaller import model_run_for_hour
 
 geotransform = (-4556441.403315245, 10000.0, 0.0, 920682.1411659503, 0.0, -10000.0)
@@ -145,3 +153,58 @@ def test_get_raster_keys_to_diff(timestamp: datetime, expected_yesterday_key, ex
     (yesterday_key, today_key) = get_raster_keys_to_diff(timestamp)
     assert yesterday_key == expected_yesterday_key
     assert today_key == expected_today_key
+
+
+class MockS3Client:
+    """Just enough of an s3 client to list and put objects"""
+
+    def __init__(self, existing_keys):
+        self.existing_keys = existing_keys
+        self.put_keys = []
+
+    async def list_objects_v2(self, Bucket, Prefix):
+        return {"Contents": [{"Key": key} for key in self.existing_keys if key.startswith(Prefix)]}
+
+    async def put_object(self, Bucket, Key, ACL, Body):
+        self.put_keys.append(Key)
+
+
+@pytest.mark.anyio
+async def test_compute_and_store_precip_rasters(mocker: MockerFixture):
+    """
+    Verify that stored hours are skipped without reading any rasters, and every other hour is diffed in place and uploaded.
+    """
+    model_run_timestamp = datetime(2024, 1, 1, 0, tzinfo=timezone.utc)
+    existing_keys = [get_accumulated_precip_key(model_run_timestamp + timedelta(hours=hour)) for hour in range(0, 30)]
+    client = MockS3Client(existing_keys)
+
+    @asynccontextmanager
+    async def mock_get_client():
+        yield client, "bucket"
+
+    read_keys = []
+
+    async def mock_read_into_memory(key: str):
+        read_keys.append(key)
+        # cumulative precip grows by 1 an hour
+        return (np.full((2, 2), int(key[-9:-6]), dtype=np.float32), geotransform, projection)
+
+    written = {}
+
+    def mock_write_geotiff(filename, raster, *args):
+        written[filename] = raster.copy()
+        with open(filename, "wb") as file:
+            file.write(b"tif")
+
+    mocker.patch("app.weather_models.precip_rdps_model.get_client", mock_get_client)
+    mocker.patch("app.weather_models.precip_rdps_model.read_into_memory", mock_read_into_memory)
+    mocker.patch("app.weather_models.precip_rdps_model.write_geotiff", mock_write_geotiff)
+
+    timings = await compute_and_store_precip_rasters(model_run_timestamp)
+
+    assert client.put_keys and sorted(client.put_keys) == sorted(get_accumulated_precip_key(model_run_timestamp + timedelta(hours=hour)) for hour in range(30, 36))
+    # two rasters (the cumulative precip at the start and end of the 24 hours) are read once for each missing hour.
+    assert len(read_keys) == len(set(read_keys)) == 12
+    assert len(written) == 6
+    assert all(np.array_equal(raster, np.full((2, 2), 24, dtype=np.float32)) for raster in written.values())
+    assert timings.read > 0
@@ -1,10 +1,15 @@
 import os
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+import numpy as np
+from affine import Affine
 from osgeo import gdal
 from pyproj import CRS
 import math
 from app.geospatial import NAD83_CRS
 from app.stations import StationSourceEnum
-from app.weather_models import process_grib
+from app.weather_models import grid_index, process_grib
 
 
 def test_convert_mps_to_kph():
@@ -40,9 +45,108 @@ def test_read_single_raster_value():
                                                geo_to_raster_transformer)
 
     raster_band = dataset.GetRasterBand(1)
-    station, value = next(processor.yield_value_for_stations(raster_band))
+    stations, values = processor.get_station_values(raster_band, interpolate=False)
+
+    assert stations[0].code == 3090
+    assert math.isclose(values[0], 67.150, abs_tol=0.001)
 
+    # bilinear interpolation of the four pixels around the station
+    station, value = next(processor.yield_value_for_stations(raster_band))
     assert station.code == 3090
-    assert math.isclose(value, 67.150, abs_tol=0.001)
+    assert math.isclose(value, 87.407, abs_tol=0.001)
 
     del dataset
+
+
+class MockBand:
+    """ Just enough of a gdal raster band to read values from """
+
+    def __init__(self, data):
+        self.data = data
+        self.YSize, self.XSize = data.shape
+
+    def ReadAsArray(self, *args):
+        self.read_count = getattr(self, 'read_count', 0) + 1
+        return self.data
+
+
+def _mock_processor(stations):
+    # the station grid indexes of other tests' processors would be reused for the same grid
+    grid_index._grid_indexes.clear()
+    processor = process_grib.GribFileProcessor.__new__(process_grib.GribFileProcessor)
+    processor.stations = stations
+    processor.padf_transform = Affine(1.0, 0.0, 0.0, 0.0, -1.0, 10.0)
+    processor.geo_to_raster_transformer = process_grib.get_transformer(NAD83_CRS, NAD83_CRS)
+    processor.grid_name = 'test:grid'
+    return processor
+
+
+def test_get_station_values(mocker):
+    """ The band is read once, and values interpolated for stations inside the raster """
+    stations = [SimpleNamespace(code=1, long=2.5, lat=7.5), SimpleNamespace(code=2, long=30.0, lat=5.0),
+                SimpleNamespace(code=3, long=0.5, lat=9.5)]
+    processor = _mock_processor(stations)
+    band = MockBand(np.arange(100, dtype=np.float32).reshape(10, 10))
+
+    in_raster, values = processor.get_station_values(band)
+    assert [station.code for station in in_raster] == [1, 3]
+    # pixel (x, y) of the band is 10y + x, station 1 is at pixel coordinates (2.5, 2.5), station 3 at (0.5, 0.5)
+    assert np.allclose(values, [27.5, 5.5])
+    assert band.read_count == 1
+    assert processor.get_station_values(band, interpolate=False)[1].tolist() == [22.0, 0.0]
+    # the station pixels are only calculated once per grid
+    calculate = mocker.spy(grid_index, 'calculate_station_grid_index')
+    processor.get_station_values(band)
+    assert calculate.call_count == 0
+
+
+def test_env_can_wind_direction_not_interpolated():
+    """ Directions either side of north are not averaged, the station's pixel is used """
+    processor = _mock_processor([SimpleNamespace(code=1, long=0.5, lat=9.5)])
+    band = MockBand(np.array([[350.0, 10.0], [350.0, 10.0]], dtype=np.float32))
+    dataset = SimpleNamespace(GetRasterBand=lambda _: band)
+    stored = {}
+    for variable_name in ['WDIR_TGL_10', 'TMP_TGL_2']:
+        grib_info = process_grib.ModelRunInfo(model_enum=process_grib.ModelEnum.RDPS, variable_name=variable_name)
+        with patch.object(processor, 'store_prediction_values') as store:
+            processor.process_env_can_grib_file(MagicMock(), dataset, grib_info, SimpleNamespace(id=7))
+        stored.update({name: values.tolist() for name, (_, values) in store.call_args.args[0].items()})
+    assert stored == {'wdir_tgl_10': [350.0], 'tmp_tgl_2': [180.0]}
+
+
+def test_noaa_wind_bands_read_once():
+    """ Wind speed and direction are both calculated from one read of the u and v bands """
+    processor = _mock_processor([SimpleNamespace(code=1, long=2.5, lat=7.5)])
+    bands = {index: MockBand(np.full((10, 10), index, dtype=np.float32)) for index in range(2, 6)}
+    dataset = SimpleNamespace(GetRasterBand=bands.get)
+    model_run_timestamp = datetime(2024, 6, 12, tzinfo=timezone.utc)
+    grib_info = process_grib.ModelRunInfo(model_enum=process_grib.ModelEnum.NAM,
+                                          model_run_timestamp=model_run_timestamp,
+                                          prediction_timestamp=model_run_timestamp)
+    with patch.object(processor, 'store_prediction_values') as store:
+        processor.process_noaa_grib_file(MagicMock(), dataset, grib_info, SimpleNamespace(id=7))
+    stored = {name: values.tolist() for name, (_, values) in store.call_args.args[0].items()}
+    # u is 4 and v is 5 metres per second
+    assert np.allclose(stored['wind_tgl_10'], [process_grib.convert_mps_to_kph(math.hypot(4, 5))])
+    assert np.allclose(stored['wdir_tgl_10'], [process_grib.calculate_wind_dir_from_u_v(4, 5)])
+    assert [band.read_count for band in bands.values()] == [1, 1, 1, 1]
+
+
+def test_store_prediction_values():
+    """ All the variables for a station are written in one row, one upsert per set of variables """
+    processor = _mock_processor([])
+    stations = [SimpleNamespace(code=1), SimpleNamespace(code=2)]
+    grib_info = process_grib.ModelRunInfo(prediction_timestamp=datetime(2024, 6, 12, 1, tzinfo=timezone.utc))
+    session = MagicMock()
+    with patch.object(process_grib, 'upsert_model_run_predictions') as upsert:
+        processor.store_prediction_values({'tmp_tgl_2': (stations, np.array([10.0, 11.0])),
+                                           'rh_tgl_2': (stations[:1], np.array([50.0]))},
+                                          SimpleNamespace(id=7), grib_info, session)
+    rows = [row for call in upsert.call_args_list for row in call.args[1]]
+    assert upsert.call_count == 2
+    assert sorted(rows, key=lambda row: row['station_code']) == [
+        {'prediction_model_run_timestamp_id': 7, 'prediction_timestamp': grib_info.prediction_timestamp,
+         'station_code': 1, 'tmp_tgl_2': 10.0, 'rh_tgl_2': 50.0},
+        {'prediction_model_run_timestamp_id': 7, 'prediction_timestamp': grib_info.prediction_timestamp,
+         'station_code': 2, 'tmp_tgl_2': 11.0}]
+    session.commit.assert_called_once()
@@ -1,9 +1,11 @@
+import numpy as np
 import pytest
 from datetime import datetime
 from pytest_mock import MockerFixture
+from sklearn.linear_model import LinearRegression
 from app.db.models.observations import HourlyActual
 from app.db.models.weather_models import ModelRunPrediction
-from app.weather_models.linear_model import LinearModel
+from app.weather_models.linear_model import GroupedLinearRegression, LinearModel
 from app.weather_models.regression_model import RegressionModel
 from app.weather_models.sample import Samples
 
@@ -68,3 +70,22 @@ def test_regression_model_predict(mocker: MockerFixture):
     regression_model.predict(0, [[0, 0]])
 
     assert append_x_y_mock.call_count == 1
+
+
+def test_grouped_linear_regression():
+    """ Every group's regression matches a sklearn LinearRegression fitted to that group's samples """
+    rng = np.random.default_rng(42)
+    groups = rng.integers(0, 10, size=500)
+    x = rng.normal(10, 5, size=(500, 2))
+    y = x @ np.array([[1.5, -0.5], [0.25, 2.0]]) + rng.normal(size=(500, 2))
+    # a group where the predictors don't vary, and a group without any samples
+    x[groups == 3] = [4.0, 2.0]
+    groups[groups == 9] = 8
+    regression = GroupedLinearRegression(10, feature_count=2, target_count=2)
+    regression.fit(groups, x, y)
+
+    test_x = rng.normal(10, 5, size=(5, 2))
+    for group in range(9):
+        expected = LinearRegression().fit(x[groups == group], y[groups == group]).predict(test_x)
+        assert np.allclose(regression.predict(np.full(5, group), test_x), expected)
+    assert np.isnan(regression.predict(np.array([9, -1]), test_x[:2])).all()
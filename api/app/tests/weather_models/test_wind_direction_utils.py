@@ -1,7 +1,9 @@
 
 import math
+import numpy as np
 import pytest
-from app.weather_models.wind_direction_utils import compute_u_v, calculate_wind_dir_from_u_v, calculate_wind_speed_from_u_v
+from app.weather_models.wind_direction_utils import (compute_u_v, calculate_wind_dir_from_u_v, calculate_wind_speed_from_u_v,
+                                                     calculate_wind_dir_from_u_v_array, calculate_wind_speed_from_u_v_array)
 
 
 @pytest.mark.parametrize(
@@ -50,3 +52,10 @@ def test_calculate_wind_speed_from_uv(u_float, v_float, expected_wind_speed):
 def test_calculate_wind_direction_from_uv(u_float, v_float, expected_wind_direction):
     calculated_wind_direction = calculate_wind_dir_from_u_v(u_float, v_float)
     assert round(calculated_wind_direction, 0) == expected_wind_direction
+
+
+def test_wind_from_uv_arrays():
+    u = np.array([-3.711, 2.93, -1.77, 6.04, 0.0])
+    v = np.array([-1.471, 4.06, 1.95, -0.31, 5.0])
+    assert np.allclose(calculate_wind_speed_from_u_v_array(u, v), [calculate_wind_speed_from_u_v(*uv) for uv in zip(u, v)])
+    assert np.allclose(calculate_wind_dir_from_u_v_array(u, v), [calculate_wind_dir_from_u_v(*uv) for uv in zip(u, v)])
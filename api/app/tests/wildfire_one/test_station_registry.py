@@ -0,0 +1,83 @@
+""" Unit tests for the in memory station registry """
+import asyncio
+import pytest
+from app.wildfire_one.station_registry import StationRegistry
+from app.wildfire_one.schema_parsers import wfwx_station_list_mapper
+
+
+def _raw_station(code: int) -> dict:
+    return {'id': f'id-{code}', 'stationCode': code, 'displayLabel': f'STATION {code}', 'latitude': 50,
+            'longitude': -120, 'elevation': 100, 'stationStatus': {'id': 'ACTIVE'},
+            'zone': None, 'fireCentre': None}
+
+
+class Loader:
+    """ Loads a list of stations, slowly, counting how many times it's called """
+
+    def __init__(self, codes):
+        self.codes = codes
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return [_raw_station(code) for code in self.codes]
+
+
+@pytest.mark.anyio
+async def test_concurrent_cold_start_loads_once():
+    loader = Loader([3, 1, 2])
+    registry = StationRegistry(loader, ttl_seconds=60)
+    results = await asyncio.gather(*[registry.get_raw_stations() for _ in range(5)])
+    assert loader.calls == 1
+    assert all(len(result) == 3 for result in results)
+    assert registry.age_seconds is not None and registry.age_seconds < 60
+
+
+@pytest.mark.anyio
+async def test_lookup_by_code_and_id():
+    registry = StationRegistry(Loader([3, 1, 2]), ttl_seconds=60)
+    # in station list order, ignoring unknown codes
+    raw_stations = await registry.get_raw_stations_by_codes([2, 3, 99])
+    assert [raw_station['stationCode'] for raw_station in raw_stations] == [3, 2]
+    assert registry.by_id['id-1']['stationCode'] == 1
+
+
+@pytest.mark.anyio
+async def test_mapped_stations_are_memoized_copies():
+    registry = StationRegistry(Loader([1, 2]), ttl_seconds=60)
+    stations = await registry.map(wfwx_station_list_mapper)
+    stations.pop()
+    again = await registry.map(wfwx_station_list_mapper)
+    assert [station.code for station in again] == [1, 2]
+    assert again[0] is stations[0]
+
+
+@pytest.mark.anyio
+async def test_stale_registry_refreshed_in_background():
+    loader = Loader([1])
+    registry = StationRegistry(loader, ttl_seconds=0)
+    await registry.get_raw_stations()
+    loader.codes = [1, 2]
+    # the stale list is served while the refresh happens
+    assert len(await registry.get_raw_stations()) == 1
+    await asyncio.sleep(0.05)
+    assert loader.calls == 2
+    assert len(registry.raw_stations) == 2
+    assert registry.as_dict()['refreshes'] == 2
+
+
+@pytest.mark.anyio
+async def test_failed_refresh_counted():
+    loader = Loader([1])
+    registry = StationRegistry(loader, ttl_seconds=0)
+    await registry.get_raw_stations()
+
+    async def failing_loader():
+        raise ConnectionError('WFWX is down')
+
+    registry.loader = failing_loader
+    # the stale list is served, and the failed refresh counted once
+    await asyncio.gather(*[registry.get_raw_stations() for _ in range(3)])
+    await asyncio.sleep(0.01)
+    assert registry.as_dict() == {'stations': 1, 'age_seconds': 0, 'refreshes': 1, 'refresh_failures': 1}
@@ -0,0 +1,102 @@
+""" Unit tests for fetching paged WFWX responses, against a local http server """
+import asyncio
+from typing import Optional, Tuple
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from app.wildfire_one.query_builders import BuildQuery
+from app.wildfire_one.wildfire_fetchers import fetch_paged_response_generator
+
+TOTAL_PAGES = 8
+PAGE_SIZE = 3
+
+
+class PagedServer:
+    """ Serves TOTAL_PAGES pages of stations, later pages faster than earlier ones, optionally failing the first
+    request for a page """
+
+    def __init__(self, delay=0.05, failing_pages=()):
+        self.delay = delay
+        self.failing_pages = set(failing_pages)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request: web.Request):
+        page = int(request.query['page'])
+        self.requests.append(page)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay * (TOTAL_PAGES - page) / TOTAL_PAGES)
+            if page in self.failing_pages:
+                self.failing_pages.remove(page)
+                return web.Response(status=503)
+            stations = [{'stationCode': page * PAGE_SIZE + index} for index in range(PAGE_SIZE)]
+            return web.json_response({'_embedded': {'stations': stations}, 'page': {'totalPages': TOTAL_PAGES}})
+        finally:
+            self.active -= 1
+
+
+class BuildQueryTest(BuildQuery):
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url
+
+    def query(self, page) -> Tuple[str, dict]:
+        return f'{self.base_url}/v1/stations', {'page': page}
+
+
+async def _fetch_all(paged_server: PagedServer, limit: Optional[int] = None):
+    application = web.Application()
+    application.router.add_get('/v1/stations', paged_server.handle)
+    server = TestServer(application)
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            query_builder = BuildQueryTest(str(server.make_url('')).rstrip('/'))
+            stations = []
+            generator = fetch_paged_response_generator(session, {}, query_builder, 'stations')
+            async for station in generator:
+                stations.append(station['stationCode'])
+                if len(stations) == limit:
+                    break
+            await generator.aclose()
+            return stations
+    finally:
+        await server.close()
+
+
+@pytest.mark.anyio
+async def test_pages_fetched_concurrently_in_order(monkeypatch):
+    """ After the first page, pages are requested concurrently (up to the limit), and yielded in order """
+    monkeypatch.setenv('WFWX_PAGE_CONCURRENCY', '3')
+    paged_server = PagedServer()
+    stations = await _fetch_all(paged_server)
+    assert stations == list(range(TOTAL_PAGES * PAGE_SIZE))
+    assert paged_server.requests[0] == 0
+    assert sorted(paged_server.requests) == list(range(TOTAL_PAGES))
+    assert paged_server.max_active == 3
+
+
+@pytest.mark.anyio
+async def test_failed_pages_retried(monkeypatch):
+    monkeypatch.setenv('WFWX_BACKOFF_SECONDS', '0')
+    paged_server = PagedServer(delay=0, failing_pages=(0, 5))
+    stations = await _fetch_all(paged_server)
+    assert stations == list(range(TOTAL_PAGES * PAGE_SIZE))
+    assert sorted(paged_server.requests) == sorted(list(range(TOTAL_PAGES)) + [0, 5])
+
+
+@pytest.mark.anyio
+async def test_pages_requested_in_a_window(monkeypatch):
+    """ Only a window of pages is requested ahead of the caller, and nothing more once it stops """
+    monkeypatch.setenv('WFWX_PAGE_CONCURRENCY', '2')
+    paged_server = PagedServer(delay=0.01)
+    # stop part way through the second page
+    stations = await _fetch_all(paged_server, limit=PAGE_SIZE + 1)
+    assert stations == list(range(PAGE_SIZE + 1))
+    # at most the first page, the page being yielded, and the two pages after it
+    assert {0, 1, 2} <= set(paged_server.requests) <= {0, 1, 2, 3}
+    await asyncio.sleep(0.05)
+    assert paged_server.active == 0
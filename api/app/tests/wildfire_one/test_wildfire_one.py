@@ -1,13 +1,14 @@
 """Unit testing for WFWX API code"""
 
 import asyncio
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
 import pytest
 from fastapi import HTTPException
 from pytest_mock import MockFixture
 
 from app.wildfire_one.query_builders import BuildQueryAllForecastsByAfterStart, BuildQueryAllHourliesByRange, BuildQueryDailiesByStationCode, BuildQueryStationGroups
-from app.wildfire_one.wfwx_api import WFWXWeatherStation, get_wfwx_stations_from_station_codes
+from app.wildfire_one import wfwx_api
+from app.wildfire_one.wfwx_api import WFWXWeatherStation, get_stations_by_codes, get_wfwx_stations_from_station_codes
 from app.wildfire_one.wfwx_post_api import post_forecasts
 
 
@@ -58,7 +59,7 @@ def mock_responses(mocker: MockFixture):
         """Returns mocked WFWXWeatherStations."""
         return all_stations
 
-    def mock_get_fire_centre_station_codes(__):
+    async def mock_get_fire_centre_station_codes(__):
         """Returns mocked WFWXWeatherStations codes."""
         return all_station_codes
 
@@ -99,3 +100,28 @@ async def test_wf1_post_failure(mock_client):
     mock_client.post.return_value.__aenter__.return_value = AsyncMock(status=400)
     with pytest.raises(HTTPException):
         await post_forecasts(mock_client, [])
+
+
+def _raw_station(code: int) -> dict:
+    return {"id": f"id-{code}", "stationCode": code, "displayLabel": f"STATION {code}", "latitude": 50.67, "longitude": -120.48,
+            "elevation": 100, "stationStatus": {"id": "ACTIVE"}, "zone": None, "fireCentre": None}
+
+
+@pytest.mark.anyio
+async def test_get_stations_by_codes_not_in_registry(mocker: MockFixture):
+    """Stations missing from the station registry (e.g. added since it was loaded) are looked up in WFWX"""
+    queries = []
+
+    async def mock_fetch_paged_response_generator(_, __, query_builder, *___, **____):
+        queries.append(query_builder.querystring)
+        yield _raw_station(code2)
+
+    mocker.patch.object(wfwx_api.station_registry, "get_raw_stations_by_codes", AsyncMock(return_value=[_raw_station(code1)]))
+    mocker.patch("app.wildfire_one.wfwx_api.fetch_paged_response_generator", mock_fetch_paged_response_generator)
+    mocker.patch("app.wildfire_one.wfwx_api.ClientSession", MagicMock())
+    mocker.patch("app.wildfire_one.wfwx_api.get_auth_header", AsyncMock(return_value={}))
+
+    stations = await get_stations_by_codes([code1, code2])
+
+    assert queries == [f"stationCode=={code2}"]
+    assert [station.code for station in stations] == [code1, code2]
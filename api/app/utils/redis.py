@@ -1,8 +1,15 @@
 """ Central location to instantiate redis for easier mocking in unit tests.
 """
+import asyncio
+from weakref import WeakKeyDictionary
 from redis import StrictRedis
+import redis.asyncio
 from app import config
 
+# One connection pool per event loop (asyncio connections can't be shared between loops). In practice that's one
+# pool for the process.
+_async_pools: WeakKeyDictionary = WeakKeyDictionary()
+
 
 def _create_redis():
     return StrictRedis(host=config.get('REDIS_HOST'),
@@ -16,6 +23,28 @@ def create_redis():
     return _create_redis()
 
 
+def _create_async_redis() -> redis.asyncio.Redis:
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        # When all the connections are in use, wait (up to REDIS_POOL_TIMEOUT seconds) for one to be released,
+        # instead of failing straight away.
+        pool = redis.asyncio.BlockingConnectionPool(host=config.get('REDIS_HOST'),
+                                                    port=config.get('REDIS_PORT', 6379),
+                                                    db=0,
+                                                    password=config.get('REDIS_PASSWORD'),
+                                                    max_connections=int(config.get('REDIS_MAX_CONNECTIONS', 20)),
+                                                    timeout=float(config.get('REDIS_POOL_TIMEOUT', 5)))
+        _async_pools[loop] = pool
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+def create_async_redis() -> redis.asyncio.Redis:
+    """ Return an asyncio redis client, sharing the process wide connection pool. Call _create_async_redis, to make
+    it easy to mock out for everyone in unit testing. """
+    return _create_async_redis()
+
+
 def clear_cache_matching(key_part_match: str):
     """
     Clear cache entry from redis cache
@@ -0,0 +1,163 @@
+""" A small cache API on top of the asyncio redis client, for caching API responses.
+
+Values are serialized with orjson, and compressed with zlib when they're large (WFWX pages of stations and
+dailies are hundreds of kilobytes of very repetitive json). Concurrent misses for the same key are coalesced, so
+that only one of them fetches the value, and the rest wait for it.
+
+Redis is a cache, not a dependency: if it's unavailable, every lookup is a miss, and errors are logged.
+"""
+import asyncio
+from dataclasses import dataclass
+import logging
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import zlib
+import orjson
+from app import config
+from app.utils.redis import create_async_redis
+
+
+logger = logging.getLogger(__name__)
+
+# Each cached value starts with a byte saying how it was encoded. Anything else was cached before values had a
+# header, as plain json.
+_PLAIN: bytes = b'\x00'
+_COMPRESSED: bytes = b'\x01'
+
+
+@dataclass
+class CacheStats:
+    """ Counters for a cache """
+    hits: int = 0
+    misses: int = 0
+    # Misses that waited for another request to fetch the same key, instead of fetching it themselves.
+    coalesced: int = 0
+    errors: int = 0
+    get_seconds: float = 0
+    set_seconds: float = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'hit_ratio': self.hits / lookups if lookups else 0,
+                'mean_get_ms': 1000 * self.get_seconds / lookups if lookups else 0,
+                'set_seconds': self.set_seconds}
+
+    def log(self, name: str):
+        logger.info('%s cache: %s', name, self.as_dict())
+
+
+def encode(value: Any, compress_threshold: int) -> bytes:
+    """ Serialize a value for storing in redis, compressing it if it's larger than compress_threshold bytes """
+    data = orjson.dumps(value)
+    if len(data) > compress_threshold:
+        return _COMPRESSED + zlib.compress(data, 1)
+    return _PLAIN + data
+
+
+def decode(data: bytes) -> Any:
+    """ Deserialize a value stored by encode (or plain json, stored before values had a header) """
+    if data[:1] == _COMPRESSED:
+        return orjson.loads(zlib.decompress(data[1:]))
+    if data[:1] == _PLAIN:
+        return orjson.loads(data[1:])
+    return orjson.loads(data)
+
+
+class RedisCache:
+    """ Get and set json serializable values, with an expiry, in redis. """
+
+    def __init__(self,
+                 redis_factory: Callable = create_async_redis,
+                 compress_threshold: Optional[int] = None,
+                 stats_log_interval: Optional[int] = None):
+        self.redis_factory = redis_factory
+        self.compress_threshold = compress_threshold if compress_threshold is not None \
+            else int(config.get('REDIS_CACHE_COMPRESS_THRESHOLD', 16384))
+        # The stats are logged every stats_log_interval lookups.
+        self.stats_log_interval = stats_log_interval if stats_log_interval is not None \
+            else int(config.get('REDIS_CACHE_STATS_LOG_INTERVAL', 1000))
+        self.stats = CacheStats()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str) -> Optional[Any]:
+        """ The cached value, or None if it isn't cached (or redis isn't available). """
+        start = perf_counter()
+        try:
+            data = await self.redis_factory().get(key)
+            value = decode(data) if data else None
+        except Exception as error:
+            self.stats.errors += 1
+            logger.error(error, exc_info=error)
+            value = None
+        finally:
+            self.stats.get_seconds += perf_counter() - start
+        if value is None:
+            self.stats.misses += 1
+            logger.info('redis cache miss %s', key)
+        else:
+            self.stats.hits += 1
+            logger.info('redis cache hit %s', key)
+        if (self.stats.hits + self.stats.misses) % self.stats_log_interval == 0:
+            self.stats.log('redis')
+        return value
+
+    async def set(self, key: str, value: Any, expiry_seconds: int):
+        """ Cache a value for expiry_seconds. Errors are logged, not raised. """
+        start = perf_counter()
+        try:
+            await self.redis_factory().set(key, encode(value, self.compress_threshold), ex=expiry_seconds)
+        except Exception as error:
+            self.stats.errors += 1
+            logger.error(error, exc_info=error)
+        finally:
+            self.stats.set_seconds += perf_counter() - start
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Tuple[Any, Optional[int]]]]) -> Any:
+        """ Return the cached value for key, or call fetch to get it.
+
+        fetch returns a value, and the number of seconds to cache it for (None if it shouldn't be cached, e.g. an
+        error response). While a fetch for a key is in progress, other callers asking for the same key wait for
+        its result instead of fetching it again, and only fetch it themselves if it fails.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_set(key, fetch))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            # shield - one caller being cancelled shouldn't cancel the fetch the others are waiting on.
+            return await asyncio.shield(task)
+        self.stats.coalesced += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+        except Exception as error:
+            logger.warning('shared fetch of %s failed (%s), fetching it again', key, error)
+        # The shared fetch is the first caller's, using its session (which may have been closed under it), so
+        # if it failed, each waiter fetches the value with its own.
+        return await self._fetch_and_set(key, fetch)
+
+    async def _fetch_and_set(self, key: str, fetch: Callable[[], Awaitable[Tuple[Any, Optional[int]]]]) -> Any:
+        value, expiry_seconds = await fetch()
+        if expiry_seconds:
+            await self.set(key, value, expiry_seconds)
+        return value
+
+
+_redis_cache: Optional[RedisCache] = None
+
+
+def get_redis_cache() -> RedisCache:
+    """ The redis cache for this process. """
+    global _redis_cache  # pylint: disable=global-statement
+    if _redis_cache is None:
+        _redis_cache = RedisCache()
+    return _redis_cache
@@ -1,7 +1,7 @@
 """Utils to help with s3"""
 
 import logging
-from typing import Generator, Tuple
+from typing import Generator, Set, Tuple
 from contextlib import asynccontextmanager
 from aiobotocore.client import AioBaseClient
 from aiobotocore.session import get_session
@@ -41,6 +41,19 @@ async def object_exists(client: AioBaseClient, bucket: str, target_path: str):
     return False
 
 
+async def list_object_keys(client: AioBaseClient, bucket: str, prefix: str) -> Set[str]:
+    """Return the keys of all the objects under prefix, following continuation tokens when there are more
+    than a page of them"""
+    keys = set()
+    kwargs = {}
+    while True:
+        result = await client.list_objects_v2(Bucket=bucket, Prefix=prefix, **kwargs)
+        keys.update(content["Key"] for content in result.get("Contents", []))
+        if not result.get("IsTruncated"):
+            return keys
+        kwargs["ContinuationToken"] = result["NextContinuationToken"]
+
+
 async def object_exists_v2(target_path: str):
     """Check if and object exists in the object store"""
     async with get_client() as (client, bucket):
@@ -0,0 +1,153 @@
+""" Station to grid index for sampling weather model rasters at weather stations.
+
+Weather model grids (GDPS, RDPS, HRDPS, GFS, NAM) don't change from one model run to the next, so the raster pixel
+(and bilinear interpolation weights) of every station only has to be calculated once per grid. Indexes are kept in
+memory, and in redis so that other workers and later runs can reuse them.
+"""
+from dataclasses import dataclass
+import hashlib
+import io
+import logging
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from affine import Affine
+from pyproj import Transformer
+from app import config
+from app.utils.redis import create_redis
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StationGridIndex:
+    """ The pixel of every station inside a grid.
+
+    x_indexes and y_indexes are the top left pixel of the grid square surrounding each station, weights are the
+    bilinear interpolation weights of the four surrounding pixels, ordered clockwise from the top left (the same
+    order as process_grib.get_surrounding_grid).
+    """
+    station_codes: np.ndarray
+    x_indexes: np.ndarray
+    y_indexes: np.ndarray
+    weights: np.ndarray
+
+    def sample(self, data: np.ndarray) -> np.ndarray:
+        """ Value of the pixel each station is in. """
+        return data[self.y_indexes, self.x_indexes]
+
+    def sample_bilinear(self, data: np.ndarray) -> np.ndarray:
+        """ Bilinear interpolation of the four pixels surrounding each station. Stations on the last row or column
+        of the grid use the edge pixel for the missing neighbours. """
+        y_size, x_size = data.shape
+        x_next = np.minimum(self.x_indexes + 1, x_size - 1)
+        y_next = np.minimum(self.y_indexes + 1, y_size - 1)
+        values = np.stack([data[self.y_indexes, self.x_indexes],
+                           data[self.y_indexes, x_next],
+                           data[y_next, x_next],
+                           data[y_next, self.x_indexes]], axis=-1).astype(np.float64)
+        return np.sum(values * self.weights, axis=-1)
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, station_codes=self.station_codes, x_indexes=self.x_indexes,
+                 y_indexes=self.y_indexes, weights=self.weights)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'StationGridIndex':
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(station_codes=arrays['station_codes'], x_indexes=arrays['x_indexes'],
+                       y_indexes=arrays['y_indexes'], weights=arrays['weights'])
+
+
+def calculate_station_grid_index(stations: Sequence,
+                                 transform: Affine,
+                                 transformer: Transformer,
+                                 x_size: int,
+                                 y_size: int) -> StationGridIndex:
+    """ Calculate the pixel and bilinear weights of every station (anything with code, lat and long) in the grid.
+    Stations outside of the grid are left out. """
+    raster_longs, raster_lats = transformer.transform(
+        np.array([station.long for station in stations], dtype=np.float64),
+        np.array([station.lat for station in stations], dtype=np.float64))
+    i_indexes, j_indexes = (~transform) * (np.asarray(raster_longs), np.asarray(raster_lats))
+    x_indexes = np.floor(i_indexes).astype(np.int64)
+    y_indexes = np.floor(j_indexes).astype(np.int64)
+    in_raster = (x_indexes >= 0) & (x_indexes < x_size) & (y_indexes >= 0) & (y_indexes < y_size)
+    for station, inside in zip(stations, in_raster):
+        if not inside:
+            logger.warning('coordinate not in raster - %s', station)
+
+    x_fraction = (i_indexes - x_indexes)[in_raster]
+    y_fraction = (j_indexes - y_indexes)[in_raster]
+    weights = np.stack([(1 - x_fraction) * (1 - y_fraction),
+                        x_fraction * (1 - y_fraction),
+                        x_fraction * y_fraction,
+                        (1 - x_fraction) * y_fraction], axis=-1)
+    station_codes = np.array([station.code for station in stations], dtype=np.int64)
+    return StationGridIndex(station_codes=station_codes[in_raster],
+                            x_indexes=x_indexes[in_raster],
+                            y_indexes=y_indexes[in_raster],
+                            weights=weights)
+
+
+def get_grid_index_key(grid_name: str,
+                       stations: Sequence,
+                       transform: Affine,
+                       transformer: Transformer,
+                       x_size: int,
+                       y_size: int) -> str:
+    """ Cache key for a grid index. Changing the station list (or the location of a station) changes the key,
+    which invalidates any previously cached index. """
+    grid_hash = hashlib.sha1(repr((tuple(transform), transformer.definition, x_size, y_size)).encode()).hexdigest()
+    station_hash = hashlib.sha1(repr([(station.code, station.lat, station.long) for station in stations]).encode()).hexdigest()
+    return f'grid_index:{grid_name}:{grid_hash}:{station_hash}'
+
+
+_grid_indexes: Dict[str, StationGridIndex] = {}
+
+
+def _get_cached_grid_index(key: str) -> Optional[StationGridIndex]:
+    if config.get('REDIS_USE') != 'True':
+        return None
+    try:
+        cached = create_redis().get(key)
+    except Exception as error:
+        logger.error(error, exc_info=error)
+        return None
+    return StationGridIndex.from_bytes(cached) if cached else None
+
+
+def _put_cached_grid_index(key: str, grid_index: StationGridIndex):
+    if config.get('REDIS_USE') != 'True':
+        return
+    try:
+        create_redis().set(key, grid_index.to_bytes(), ex=int(config.get('REDIS_GRID_INDEX_CACHE_EXPIRY', 604800)))
+    except Exception as error:
+        logger.error(error, exc_info=error)
+
+
+def get_station_grid_index(grid_name: str,
+                           stations: List,
+                           transform: Affine,
+                           transformer: Transformer,
+                           x_size: int,
+                           y_size: int) -> StationGridIndex:
+    """ Get the station grid index for a grid, from memory, then redis, calculating it if it isn't cached.
+
+    :param grid_name: Name of the grid, e.g. the model and projection.
+    :param stations: Stations to index, anything with code, lat and long.
+    :param transform: Affine transform of the raster.
+    :param transformer: Transformer from station coordinates (NAD83) to raster coordinates.
+    """
+    key = get_grid_index_key(grid_name, stations, transform, transformer, x_size, y_size)
+    grid_index = _grid_indexes.get(key)
+    if grid_index is None:
+        grid_index = _get_cached_grid_index(key)
+        if grid_index is None:
+            logger.info('Calculating station grid index %s', key)
+            grid_index = calculate_station_grid_index(stations, transform, transformer, x_size, y_size)
+            _put_cached_grid_index(key, grid_index)
+        _grid_indexes[key] = grid_index
+    return grid_index
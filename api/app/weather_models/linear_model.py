@@ -1,6 +1,7 @@
 import logging
 from datetime import datetime
 from typing import List
+import numpy as np
 from sklearn.exceptions import NotFittedError
 from sklearn.linear_model import LinearRegression
 from collections import defaultdict
@@ -8,6 +9,9 @@ from app.weather_models.sample import Samples
 
 logger = logging.getLogger(__name__)
 
+# Relative cut off for small eigenvalues of the normal equations, treated as 0.
+GRAM_RCOND = 1e-10
+
 
 class LinearModel():
     _models: defaultdict[int, LinearRegression]
@@ -31,7 +35,7 @@ class LinearModel():
         for hour in self._samples.hours():
             try:
                 self._models[hour].fit(self._samples.np_x(hour), self._samples.np_y(hour))
-            except ValueError as _:
+            except ValueError:
                 logger.error("Error trying to fit data for model at hour: %s, dumping samples, x: %s, y: %s",
                              hour, self._samples.np_x(hour), self._samples.np_y(hour), exc_info=True)
 
@@ -40,5 +44,69 @@ class LinearModel():
             prediction = self._models[hour].predict(model_value)
             logger.info("Predicted value for model, hour: %s, prediction: %s", hour, prediction)
             return prediction[0]
-        except NotFittedError as _:
+        except NotFittedError:
             return None
+
+
+class GroupedLinearRegression():
+    """ Many ordinary least squares regressions (with intercept), one per group, fitted together in closed form.
+
+    Gives the same result as fitting a sklearn LinearRegression to the samples of each group. Groups with too few
+    distinct samples to determine every coefficient (e.g. a single sample) get the minimum norm solution.
+    """
+
+    def __init__(self, group_count: int, feature_count: int = 1, target_count: int = 1):
+        self.group_count = group_count
+        self.feature_count = feature_count
+        self.target_count = target_count
+        self.coefficients = np.zeros((group_count, feature_count, target_count))
+        self.intercepts = np.zeros((group_count, target_count))
+        self.sample_counts = np.zeros(group_count, dtype=np.int64)
+
+    def _group_sums(self, groups: np.ndarray, values: np.ndarray) -> np.ndarray:
+        return np.stack([np.bincount(groups, weights=values[:, i], minlength=self.group_count)
+                         for i in range(values.shape[1])], axis=-1)
+
+    def fit(self, groups: np.ndarray, x: np.ndarray, y: np.ndarray):
+        """ Fit a regression for every group.
+
+        :param groups: Group of each sample, shape (n,)
+        :param x: Predictors, shape (n, p)
+        :param y: Targets, shape (n, k)
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        x = np.asarray(x, dtype=np.float64).reshape(len(groups), self.feature_count)
+        y = np.asarray(y, dtype=np.float64).reshape(len(groups), self.target_count)
+        self.sample_counts = np.bincount(groups, minlength=self.group_count)
+        divisor = np.maximum(self.sample_counts, 1)[:, np.newaxis]
+        x_mean = self._group_sums(groups, x) / divisor
+        y_mean = self._group_sums(groups, y) / divisor
+        x_centered = x - x_mean[groups]
+        y_centered = y - y_mean[groups]
+        # Normal equations for each group, pinv(X'X)X'y is the same minimum norm solution as lstsq(X, y). The
+        # eigenvalues of X'X are the squared singular values of X, so rounding error in a rank deficient group
+        # (e.g. two samples of two features) shows up around eps * the largest eigenvalue, and has to be cut off.
+        p, k = self.feature_count, self.target_count
+        gram = self._group_sums(groups, (x_centered[:, :, np.newaxis] * x_centered[:, np.newaxis, :])
+                                .reshape(len(groups), p * p)).reshape(self.group_count, p, p)
+        cross = self._group_sums(groups, (x_centered[:, :, np.newaxis] * y_centered[:, np.newaxis, :])
+                                 .reshape(len(groups), p * k)).reshape(self.group_count, p, k)
+        self.coefficients = np.linalg.pinv(gram, rcond=GRAM_RCOND, hermitian=True) @ cross
+        self.intercepts = y_mean - np.einsum('gp,gpk->gk', x_mean, self.coefficients)
+
+    def predict(self, groups: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """ Predict with the regression of each sample's group, NaN for groups without any samples (or a
+        negative group).
+
+        :param groups: Group of each value, shape (n,)
+        :param x: Predictors, shape (n, p)
+        :return: Predictions, shape (n, k)
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        x = np.asarray(x, dtype=np.float64).reshape(len(groups), self.feature_count)
+        valid = groups >= 0
+        safe_groups = np.where(valid, groups, 0)
+        prediction = self.intercepts[safe_groups] + np.einsum('np,npk->nk', x, self.coefficients[safe_groups])
+        fitted = valid & (self.sample_counts[safe_groups] > 0)
+        prediction[~fitted] = np.nan
+        return prediction
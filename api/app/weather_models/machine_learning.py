@@ -3,6 +3,7 @@ Regression.
 """
 from datetime import date, datetime, timedelta, timezone
 from collections import defaultdict
+from time import perf_counter
 from typing import List
 from logging import getLogger
 from sklearn.linear_model import LinearRegression
@@ -14,12 +15,17 @@ from app.weather_models.interpolate import construct_interpolated_noon_predictio
 from app.db.models.weather_models import (PredictionModel, ModelRunPrediction)
 from app.db.models.observations import HourlyActual
 from app.db.crud.observations import (get_accumulated_precip_by_24h_interval,
+                                      get_accumulated_precip_by_24h_interval_for_stations,
                                       get_actuals_left_outer_join_with_predictions,
-                                      get_predicted_daily_precip)
+                                      get_latest_predictions_for_actuals_for_stations,
+                                      get_predicted_daily_precip,
+                                      get_predicted_daily_precip_for_stations)
+from app.weather_models.linear_model import GroupedLinearRegression
 from app.weather_models.sample import Samples
 from app.weather_models.weather_models import RegressionModelsV2
 from app.weather_models.wind_direction_model import compute_u_v
-from app.weather_models.wind_direction_utils import calculate_wind_dir_from_u_v
+from app.weather_models.wind_direction_utils import (calculate_wind_dir_from_u_v, calculate_wind_dir_from_u_v_array,
+                                                     compute_u_v_array)
 
 
 logger = getLogger(__name__)
@@ -28,6 +34,7 @@ logger = getLogger(__name__)
 SAMPLE_VALUE_KEYS = ('temperature', 'relative_humidity', 'wind_speed')
 # Number of days of historical actual data to learn from when training model
 MAX_DAYS_TO_LEARN = 19
+HOURS_PER_DAY = 24
 
 
 class LinearRegressionWrapper:
@@ -273,3 +280,166 @@ class StationMachineLearning:
             # No data to return
             return None
         return max(0, predicted_precip_24h[0])
+
+
+class ModelMachineLearning:
+    """ Bias adjustment for every station of a model, trained together.
+
+    Equivalent to a StationMachineLearning per station, but the learning window for all the stations is loaded
+    with one query per data set, every (station, hour, variable) regression is fitted at once, and predictions
+    are made for whole arrays of model values.
+    """
+
+    def __init__(self,
+                 session: Session,
+                 model: PredictionModel,
+                 station_codes: List[int],
+                 max_learn_date: datetime):
+        """
+        : param session: Database session.
+        : param model: Prediction model, e.g. GDPS
+        : param station_codes: Codes of the weather stations to learn.
+        : param max_learn_date: Maximum date up to which to learn.
+        """
+        self.session = session
+        self.model = model
+        self.station_codes = np.unique(np.asarray(station_codes, dtype=np.int64))
+        self.max_learn_date = max_learn_date
+        self.max_days_to_learn = MAX_DAYS_TO_LEARN
+        # One regression group per station and hour of the day.
+        group_count = len(self.station_codes) * HOURS_PER_DAY
+        self.regressions = {sample_key: GroupedLinearRegression(group_count) for sample_key in SAMPLE_VALUE_KEYS}
+        self.wind_direction_regression = GroupedLinearRegression(group_count, feature_count=2, target_count=2)
+        self.precip_regression = GroupedLinearRegression(group_count)
+
+    def _get_groups(self, station_codes, hours) -> np.ndarray:
+        """ Regression group of each station and hour, -1 for stations that weren't learned. """
+        station_codes = np.asarray(station_codes, dtype=np.int64)
+        hours = np.asarray(hours, dtype=np.int64)
+        if len(self.station_codes) == 0:
+            return np.full(len(station_codes), -1, dtype=np.int64)
+        station_indexes = np.minimum(np.searchsorted(self.station_codes, station_codes), len(self.station_codes) - 1)
+        known = self.station_codes[station_indexes] == station_codes
+        return np.where(known, station_indexes * HOURS_PER_DAY + hours, -1)
+
+    def _fit(self, regression: GroupedLinearRegression, station_codes: List[int], hours: List[int],
+             x: np.ndarray, y: np.ndarray):
+        groups = self._get_groups(station_codes, hours)
+        usable = (groups >= 0) & np.isfinite(x).all(axis=1) & np.isfinite(y).all(axis=1)
+        regression.fit(groups[usable], x[usable], y[usable])
+
+    def _learn_models(self, start_date: datetime):
+        """ Collect temperature, rh, wind speed and wind direction samples for all stations, and fit them. """
+        rows = list(get_latest_predictions_for_actuals_for_stations(
+            self.session, self.model.id, self.station_codes.tolist(), start_date, self.max_learn_date))
+        station_codes = np.array([row.station_code for row in rows], dtype=np.int64)
+        hours = np.array([row.weather_date.hour for row in rows], dtype=np.int64)
+
+        def column(rows, key) -> np.ndarray:
+            # None (no value) becomes NaN, which _fit leaves out.
+            return np.array([getattr(row, key) for row in rows], dtype=np.float64)
+
+        # Rows are ordered by station then weather date, so noon predictions can be interpolated from the rows
+        # walked the same way as StationMachineLearning.
+        noon_rows = []
+        prev_row = None
+        prev_prediction_row = None
+        for row in rows:
+            if prev_row is not None and prev_row.station_code != row.station_code:
+                prev_row = None
+                prev_prediction_row = None
+            if row.prediction_timestamp is not None:
+                if (prev_row is not None
+                        and prev_prediction_row is not None
+                        and prev_row.weather_date.hour == 20
+                        and row.prediction_timestamp.hour == 21
+                        and prev_prediction_row.prediction_timestamp.hour == 18):
+                    noon_rows.append((prev_row, construct_interpolated_noon_prediction(
+                        prev_prediction_row, row, SCALAR_MODEL_VALUE_KEYS)))
+                prev_prediction_row = row
+            prev_row = row
+        noon_actuals = [actual for actual, _ in noon_rows]
+        noon_predictions = [noon_prediction for _, noon_prediction in noon_rows]
+        sample_station_codes = np.concatenate(
+            [station_codes, np.array([actual.station_code for actual in noon_actuals], dtype=np.int64)])
+        sample_hours = np.concatenate(
+            [hours, np.array([actual.weather_date.hour for actual in noon_actuals], dtype=np.int64)])
+        for model_key, sample_key in zip(SCALAR_MODEL_VALUE_KEYS, SAMPLE_VALUE_KEYS):
+            x = np.concatenate([column(rows, model_key), column(noon_predictions, model_key)])
+            y = np.concatenate([column(rows, sample_key), column(noon_actuals, sample_key)])
+            self._fit(self.regressions[sample_key], sample_station_codes, sample_hours,
+                      x.reshape(-1, 1), y.reshape(-1, 1))
+
+        # Interpolated noon predictions never have a wind speed for the wind direction model
+        # (see RegressionModelsV2.collect_data), so only actual predictions are wind samples.
+        predicted_u, predicted_v = compute_u_v_array(column(rows, 'wind_tgl_10'), column(rows, 'wdir_tgl_10'))
+        actual_u, actual_v = compute_u_v_array(column(rows, 'wind_speed'), column(rows, 'wind_direction'))
+        self._fit(self.wind_direction_regression, station_codes, hours,
+                  np.stack([predicted_u, predicted_v], axis=-1), np.stack([actual_u, actual_v], axis=-1))
+
+    def _learn_precip_model(self, start_date: datetime):
+        """ Collect 24 hour precip samples for all stations, and fit them. """
+        start_datetime = datetime(start_date.year, start_date.month, start_date.day, 20, tzinfo=timezone.utc)
+        end_date = date.today() - timedelta(days=-1)
+        end_datetime = datetime(end_date.year, end_date.month, end_date.day, 20, tzinfo=timezone.utc)
+        station_codes = self.station_codes.tolist()
+        actual_daily_precip = get_accumulated_precip_by_24h_interval_for_stations(
+            self.session, station_codes, start_datetime, end_datetime)
+        predicted_daily_precip = defaultdict(list)
+        for prediction in get_predicted_daily_precip_for_stations(
+                self.session, self.model, station_codes, start_datetime, end_datetime):
+            predicted_daily_precip[(prediction.station_code, prediction.prediction_timestamp)].append(
+                prediction.precip_24h)
+
+        codes, hours, x, y = [], [], [], []
+        for actual in actual_daily_precip:
+            for precip_24h in predicted_daily_precip.get((actual.station_code, actual.day), []):
+                if actual.actual_precip_24h is not None and precip_24h is not None:
+                    codes.append(actual.station_code)
+                    hours.append(actual.day.hour)
+                    x.append(precip_24h)
+                    y.append(actual.actual_precip_24h)
+        self._fit(self.precip_regression, codes, hours,
+                  np.array(x, dtype=np.float64).reshape(-1, 1), np.array(y, dtype=np.float64).reshape(-1, 1))
+
+    def learn(self):
+        perf_start = perf_counter()
+        start_date = self.max_learn_date - timedelta(days=self.max_days_to_learn)
+        self._learn_models(start_date)
+        self._learn_precip_model(start_date)
+        logger.info('Learned bias adjustment for %s stations in %.3fs', len(self.station_codes),
+                    perf_counter() - perf_start)
+
+    def _predict(self, regression: GroupedLinearRegression, station_codes, model_values, hours) -> np.ndarray:
+        model_values = np.array(model_values, dtype=np.float64).reshape(len(station_codes), regression.feature_count)
+        return regression.predict(self._get_groups(station_codes, hours), model_values)
+
+    def predict_temperature(self, station_codes, model_temperatures, hours) -> np.ndarray:
+        """ Bias adjusted temperatures, NaN where there's no model temperature or trained model.
+        : param station_codes: Station code of each value.
+        : param model_temperatures: Temperatures as provided by the model.
+        : param hours: Hour (UTC) of each value.
+        """
+        return self._predict(self.regressions['temperature'], station_codes, model_temperatures, hours)[:, 0]
+
+    def predict_rh(self, station_codes, model_rhs, hours) -> np.ndarray:
+        """ Bias adjusted RH, limited to 0 - 100, NaN where there's no model RH or trained model. """
+        predicted_rh = self._predict(self.regressions['relative_humidity'], station_codes, model_rhs, hours)[:, 0]
+        return np.clip(predicted_rh, 0, 100)
+
+    def predict_wind_speed(self, station_codes, model_wind_speeds, hours) -> np.ndarray:
+        """ Bias adjusted wind speed, at least 0, NaN where there's no model wind speed or trained model. """
+        predicted_wind_speed = self._predict(self.regressions['wind_speed'], station_codes, model_wind_speeds, hours)
+        return np.maximum(0, predicted_wind_speed[:, 0])
+
+    def predict_wind_direction(self, station_codes, model_wind_speeds, model_wind_dirs, hours) -> np.ndarray:
+        """ Bias adjusted wind direction, NaN where there's no model wind or trained model. """
+        u, v = compute_u_v_array(np.array(model_wind_speeds, dtype=np.float64),
+                                 np.array(model_wind_dirs, dtype=np.float64))
+        predicted_u_v = self._predict(self.wind_direction_regression, station_codes, np.stack([u, v], axis=-1), hours)
+        return calculate_wind_dir_from_u_v_array(predicted_u_v[:, 0], predicted_u_v[:, 1])
+
+    def predict_precipitation(self, station_codes, model_precipitations, hours) -> np.ndarray:
+        """ Bias adjusted 24 hour precipitation, at least 0, NaN where there's no model precip or trained model. """
+        predicted_precip_24h = self._predict(self.precip_regression, station_codes, model_precipitations, hours)
+        return np.maximum(0, predicted_precip_24h[:, 0])
@@ -1,19 +1,24 @@
+import asyncio
+from contextlib import contextmanager
 import os
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 import logging
+from time import perf_counter
+from typing import Optional
 import numpy
 import tempfile
 from osgeo import gdal, ogr
 from app import config
 from numba import vectorize
-from app.utils.s3 import get_client, read_into_memory
+from app.utils.s3 import get_client, object_exists, read_into_memory
 from app.weather_models import ModelEnum
 from app.weather_models.rdps_filename_marshaller import SourcePrefix, adjust_forecast_hour, compose_precip_rdps_key, compose_computed_precip_rdps_key
 
 logger = logging.getLogger(__name__)
 
 RDPS_PRECIP_ACC_RASTER_PERMISSIONS = "public-read"
+PRECIP_ACCUMULATION_HOURS = 36
 
 
 @dataclass
@@ -27,83 +32,149 @@ class TemporalPrecip:
         return self.timestamp > other.timestamp
 
 
+@dataclass
+class AccumulationTimings:
+    """Seconds spent in each stage of computing the accumulated precip rasters for a model run. Stages overlap
+    (several hours are in flight at once) so these add up to more than the wall clock time."""
+
+    exists: float = 0
+    read: float = 0
+    diff: float = 0
+    write: float = 0
+    upload: float = 0
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, stage, getattr(self, stage) + perf_counter() - start)
+
+
 async def compute_and_store_precip_rasters(model_run_timestamp: datetime):
     """
     Given a UTC datetime, trigger 36 hours worth of accumulated precip
     difference rasters and store them.
-    """
-    async with get_client() as (client, bucket):
-        for hour in range(0, 36):
-            accumulation_timestamp = model_run_timestamp + timedelta(hours=hour)
-            (precip_diff_raster, geotransform, projection) = await generate_24_hour_accumulating_precip_raster(accumulation_timestamp)
-            key = f"weather_models/{ModelEnum.RDPS.lower()}/{accumulation_timestamp.date().isoformat()}/" + compose_computed_precip_rdps_key(
-                accumulation_end_datetime=accumulation_timestamp
-            )
 
-            res = await client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
-            if "Contents" in res:
-                logger.info("File already exists for key: %s, skipping", key)
-                continue
+    Hours that have already been stored are skipped before any source rasters are read. The remaining hours are
+    computed concurrently, each source raster is read once, the difference is taken in place (in the later of the
+    two rasters) and written out while other hours are still being read.
 
-            bucket = config.get("OBJECT_STORE_BUCKET")
-
-            logger.info(
-                "Uploading RDPS 24 hour acc precip raster for date: %s, hour: %s, forecast hour: %s to %s",
-                model_run_timestamp.date().isoformat(),
-                model_run_timestamp.hour,
-                adjust_forecast_hour(model_run_timestamp.hour, hour),
-                key,
-            )
-            with tempfile.TemporaryDirectory() as temp_dir:
-                temp_filename = os.path.join(temp_dir, model_run_timestamp.date().isoformat() + "precip" + str(hour) + ".tif")
-                # Create temp file
-                driver = gdal.GetDriverByName("GTiff")
-                rows, cols = precip_diff_raster.shape
-                output_dataset = driver.Create(temp_filename, cols, rows, 1, gdal.GDT_Float32)
-                output_dataset.SetGeoTransform(geotransform)
-                output_dataset.SetProjection(projection)
-
-                if output_dataset is None:
-                    raise IOError("Unable to create %s", key)
-
-                output_band = output_dataset.GetRasterBand(1)
-                output_band.WriteArray(precip_diff_raster)
-                output_band.FlushCache()
-                output_dataset = None
-                del output_dataset
-                output_band = None
-                del output_band
-
-                await client.put_object(
-                    Bucket=bucket,
-                    Key=key,
-                    ACL=RDPS_PRECIP_ACC_RASTER_PERMISSIONS,  # We need these to be accessible to everyone
-                    Body=open(temp_filename, "rb"),
+    Peak memory is bounded by PRECIP_RDPS_CONCURRENCY (default 4): each hour in flight holds at most two source
+    rasters, the later one doubling as the output - about 3 MB each for the 10km RDPS grid, so ~24 MB by default.
+    """
+    timings = AccumulationTimings()
+    start = perf_counter()
+    semaphore = asyncio.Semaphore(int(config.get("PRECIP_RDPS_CONCURRENCY", 4)))
+    accumulation_timestamps = [model_run_timestamp + timedelta(hours=hour) for hour in range(0, PRECIP_ACCUMULATION_HOURS)]
+    async with get_client() as (client, bucket):
+        keys = [get_accumulated_precip_key(accumulation_timestamp) for accumulation_timestamp in accumulation_timestamps]
+        with timings.measure("exists"):
+            existing = await asyncio.gather(*[object_exists(client, bucket, key) for key in keys])
+
+        async def compute_and_store(hour: int, accumulation_timestamp: datetime, key: str):
+            async with semaphore:
+                (precip_diff_raster, geotransform, projection) = await generate_24_hour_accumulating_precip_raster(accumulation_timestamp, timings)
+                logger.info(
+                    "Uploading RDPS 24 hour acc precip raster for date: %s, hour: %s, forecast hour: %s to %s",
+                    model_run_timestamp.date().isoformat(),
+                    model_run_timestamp.hour,
+                    adjust_forecast_hour(model_run_timestamp.hour, hour),
+                    key,
                 )
-
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    temp_filename = os.path.join(temp_dir, model_run_timestamp.date().isoformat() + "precip" + str(hour) + ".tif")
+                    with timings.measure("write"):
+                        await asyncio.to_thread(write_geotiff, temp_filename, precip_diff_raster, geotransform, projection)
+                    # release the raster before uploading, so that it doesn't count towards peak memory.
+                    del precip_diff_raster
+                    with timings.measure("upload"):
+                        with open(temp_filename, "rb") as file_object:
+                            await client.put_object(
+                                Bucket=bucket,
+                                Key=key,
+                                ACL=RDPS_PRECIP_ACC_RASTER_PERMISSIONS,  # We need these to be accessible to everyone
+                                Body=file_object,
+                            )
                 logger.info("Done uploading file to %s", key)
 
-
-async def generate_24_hour_accumulating_precip_raster(timestamp: datetime):
+        tasks = []
+        for hour, (accumulation_timestamp, key, exists) in enumerate(zip(accumulation_timestamps, keys, existing)):
+            if exists:
+                logger.info("File already exists for key: %s, skipping", key)
+                continue
+            tasks.append(compute_and_store(hour, accumulation_timestamp, key))
+        await asyncio.gather(*tasks)
+
+    logger.info(
+        "Computed %d RDPS 24 hour acc precip rasters for %s in %.1f seconds (exists: %.1f, read: %.1f, diff: %.1f, write: %.1f, upload: %.1f)",
+        len(tasks),
+        model_run_timestamp.isoformat(),
+        perf_counter() - start,
+        timings.exists,
+        timings.read,
+        timings.diff,
+        timings.write,
+        timings.upload,
+    )
+    return timings
+
+
+def get_accumulated_precip_key(accumulation_timestamp: datetime) -> str:
+    """Object store key of the 24 hour accumulated precip raster ending at accumulation_timestamp."""
+    return f"weather_models/{ModelEnum.RDPS.lower()}/{accumulation_timestamp.date().isoformat()}/" + compose_computed_precip_rdps_key(
+        accumulation_end_datetime=accumulation_timestamp
+    )
+
+
+def write_geotiff(filename: str, raster: numpy.ndarray, geotransform, projection):
+    """Write a single band float32 GeoTIFF."""
+    driver = gdal.GetDriverByName("GTiff")
+    rows, cols = raster.shape
+    output_dataset = driver.Create(filename, cols, rows, 1, gdal.GDT_Float32)
+    if output_dataset is None:
+        raise IOError("Unable to create %s", filename)
+    output_dataset.SetGeoTransform(geotransform)
+    output_dataset.SetProjection(projection)
+
+    output_band = output_dataset.GetRasterBand(1)
+    output_band.WriteArray(raster)
+    output_band.FlushCache()
+    output_dataset = None
+    del output_dataset
+    output_band = None
+    del output_band
+
+
+async def generate_24_hour_accumulating_precip_raster(timestamp: datetime, timings: Optional[AccumulationTimings] = None):
     """
     Given a UTC datetime, grab the raster for that date
     and the date for 24 hours before to compute the difference.
     """
+    timings = timings or AccumulationTimings()
     (yesterday_key, today_key) = get_raster_keys_to_diff(timestamp)
-    (day_data, day_geotransform, day_projection) = await read_into_memory(today_key)
+    with timings.measure("read"):
+        if yesterday_key is None:
+            (day_data, day_geotransform, day_projection) = await read_into_memory(today_key)
+        else:
+            ((day_data, day_geotransform, day_projection), (yesterday_data, _, _)) = await asyncio.gather(
+                read_into_memory(today_key), read_into_memory(yesterday_key)
+            )
+    if day_data is None:
+        raise ValueError("No precip raster data for %s" % today_key)
     if yesterday_key is None:
-        if day_data is None:
-            raise ValueError("No precip raster data for %s" % today_key)
         return (day_data, day_geotransform, day_projection)
 
     yesterday_time = timestamp - timedelta(days=1)
-    (yesterday_data, _, _) = await read_into_memory(yesterday_key)
     if yesterday_data is None:
         raise ValueError("No precip raster data for %s" % yesterday_key)
 
     later_precip = TemporalPrecip(timestamp=timestamp, precip_amount=day_data)
     earlier_precip = TemporalPrecip(timestamp=yesterday_time, precip_amount=yesterday_data)
-    return (compute_precip_difference(later_precip, earlier_precip), day_geotransform, day_projection)
+    with timings.measure("diff"):
+        # today's raster isn't used for anything else, so the difference is written over it.
+        return (compute_precip_difference(later_precip, earlier_precip, out=day_data), day_geotransform, day_projection)
 
 
 def get_raster_keys_to_diff(timestamp: datetime):
@@ -126,14 +197,16 @@ def get_raster_keys_to_diff(timestamp: datetime):
     return (None, later_key)
 
 
-def compute_precip_difference(later_precip: TemporalPrecip, earlier_precip: TemporalPrecip):
+def compute_precip_difference(later_precip: TemporalPrecip, earlier_precip: TemporalPrecip, out: Optional[numpy.ndarray] = None):
     """
     Simple function to compute difference between later and earlier precip values
-    to be vectorized with numba.
+    to be vectorized with numba. If given, the difference is written to out (which may be one of the inputs).
     """
     if not later_precip.is_after(earlier_precip):
         raise ValueError("Later precip value must be after earlier precip value")
-    return vectorized_diff(later_precip.precip_amount, earlier_precip.precip_amount)
+    if out is None:
+        return vectorized_diff(later_precip.precip_amount, earlier_precip.precip_amount)
+    return vectorized_diff(later_precip.precip_amount, earlier_precip.precip_amount, out=out)
 
 
 def _diff(value_a: float, value_b: float):
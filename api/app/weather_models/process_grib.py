@@ -1,12 +1,14 @@
 """ Read a grib file, and store values relevant to weather stations in database.
 """
 
+from collections import defaultdict
 from datetime import datetime
 import math
 import struct
 import logging
 import logging.config
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Union
+import numpy as np
 from sqlalchemy.orm import Session
 from osgeo import gdal
 from pyproj import CRS, Transformer
@@ -15,12 +17,15 @@ import rasterio
 from rasterio.io import DatasetReader
 from app.geospatial import NAD83_CRS
 from app.stations import get_stations_synchronously, StationSourceEnum
-from app.db.models.weather_models import (
-    ModelRunPrediction, PredictionModel, PredictionModelRunTimestamp)
+from app.db.models.weather_models import PredictionModel, PredictionModelRunTimestamp
 from app.db.crud.weather_models import (
-    get_prediction_model, get_or_create_prediction_run)
+    get_prediction_model, get_or_create_prediction_run, upsert_model_run_predictions)
+from app.schemas.stations import WeatherStation
 from app.weather_models import ModelEnum, ProjectionEnum
-from app.weather_models.wind_direction_utils import calculate_wind_dir_from_u_v, calculate_wind_speed_from_u_v
+from app.weather_models.grid_index import StationGridIndex, get_station_grid_index
+from app.weather_models.wind_direction_utils import (calculate_wind_dir_from_u_v, calculate_wind_speed_from_u_v,
+                                                     calculate_wind_dir_from_u_v_array,
+                                                     calculate_wind_speed_from_u_v_array)
 
 
 logger = logging.getLogger(__name__)
@@ -127,7 +132,7 @@ def get_transformer(crs_from, crs_to):
     return Transformer.from_crs(crs_from, crs_to, always_xy=True)
 
 
-def convert_mps_to_kph(value: float):
+def convert_mps_to_kph(value: Union[float, np.ndarray]):
     """ Convert a value from metres per second to kilometres per hour. 
     """
     return value / 1000 * 3600
@@ -148,50 +153,49 @@ class GribFileProcessor():
         self.raster_to_geo_transformer = raster_to_geo_transformer
         self.geo_to_raster_transformer = geo_to_raster_transformer
         self.prediction_model: PredictionModel = None
+        # Name of the grid being processed (model and projection), used to look up cached station grid indexes.
+        self.grid_name: str = None
+
+    def get_station_grid_index(self, x_size: int, y_size: int) -> Tuple[List[WeatherStation], StationGridIndex]:
+        """ Get the stations inside the current grid, and their raster pixels. """
+        grid_index = get_station_grid_index(self.grid_name, self.stations, self.padf_transform,
+                                            self.geo_to_raster_transformer, x_size, y_size)
+        stations_by_code = {station.code: station for station in self.stations}
+        return [stations_by_code[code] for code in grid_index.station_codes.tolist()], grid_index
+
+    def get_station_values(self, raster_band: gdal.Dataset,
+                           interpolate: bool = True) -> Tuple[List[WeatherStation], np.ndarray]:
+        """ Read the band once, and pick out the value at every station inside the raster, bilinearly
+        interpolated from the four surrounding pixels (or the value of the pixel the station is in, for values
+        that can't be interpolated, like wind direction). """
+        stations, grid_index = self.get_station_grid_index(raster_band.XSize, raster_band.YSize)
+        data = raster_band.ReadAsArray()
+        return stations, grid_index.sample_bilinear(data) if interpolate else grid_index.sample(data)
+
+    def get_uv_wind_values(self, u_raster_band: gdal.Dataset,
+                           v_raster_band: gdal.Dataset) -> Dict[str, Tuple[List[WeatherStation], np.ndarray]]:
+        """ Given 2 gdal datasets (one for u-component of wind, one for v-component of wind), calculate
+        wind direction (wdir_tgl_10) and wind speed in kilometres per hour (wind_tgl_10) at every station, from
+        the bilinearly interpolated u and v components. Each band is only read once.
+        """
+        stations, grid_index = self.get_station_grid_index(min(u_raster_band.XSize, v_raster_band.XSize),
+                                                           min(u_raster_band.YSize, v_raster_band.YSize))
+        u_values = grid_index.sample_bilinear(u_raster_band.ReadAsArray())
+        v_values = grid_index.sample_bilinear(v_raster_band.ReadAsArray())
+        metres_per_second_speed = calculate_wind_speed_from_u_v_array(u_values, v_values)
+        return {'wdir_tgl_10': (stations, calculate_wind_dir_from_u_v_array(u_values, v_values)),
+                'wind_tgl_10': (stations, convert_mps_to_kph(metres_per_second_speed))}
 
     def yield_value_for_stations(self, raster_band: gdal.Dataset):
         """ Given a list of stations, and a gdal dataset, yield relevant data value
         """
-        for station in self.stations:
-            longitude = station.long
-            latitude = station.lat
-
-            x_coordinate, y_coordinate = calculate_raster_coordinate(
-                longitude, latitude, self.padf_transform, self.geo_to_raster_transformer)
-
-            if 0 <= x_coordinate < raster_band.XSize and 0 <= y_coordinate < raster_band.YSize:
-                value = raster_band.ReadAsArray(x_coordinate, y_coordinate, 1, 1)[0, 0]
-            else:
-                logger.warning('coordinate not in raster - %s', station)
-                continue
-
-            yield (station, value)
+        yield from zip(*self.get_station_values(raster_band))
 
     def yield_uv_wind_data_for_stations(self, u_raster_band: gdal.Dataset, v_raster_band: gdal.Dataset, variable: str):
         """ Given a list of stations and 2 gdal datasets (one for u-component of wind, one for v-component
-        of wind), yield relevant data 
+        of wind), yield relevant data
         """
-        for station in self.stations:
-            longitude = station.long
-            latitude = station.lat
-
-            x_coordinate, y_coordinate = calculate_raster_coordinate(
-                longitude, latitude, self.padf_transform, self.geo_to_raster_transformer)
-
-            if 0 <= x_coordinate < u_raster_band.XSize and 0 <= x_coordinate < v_raster_band.XSize and\
-                    0 <= y_coordinate < u_raster_band.YSize and 0 <= y_coordinate < v_raster_band.YSize:
-
-                u_value = u_raster_band.ReadAsArray(x_coordinate, y_coordinate, 1, 1)[0, 0]
-                v_value = v_raster_band.ReadAsArray(x_coordinate, y_coordinate, 1, 1)[0, 0]
-
-                if variable == 'wdir_tgl_10':
-                    yield (station, calculate_wind_dir_from_u_v(u_value, v_value))
-                elif variable == 'wind_tgl_10':
-                    metres_per_second_speed = calculate_wind_speed_from_u_v(u_value, v_value)
-                    kilometres_per_hour_speed = convert_mps_to_kph(metres_per_second_speed)
-                    yield (station, kilometres_per_hour_speed)
-            else:
-                logger.warning('coordinate not in u/v wind rasters - %s', station)
+        yield from zip(*self.get_uv_wind_values(u_raster_band, v_raster_band)[variable])
 
     def get_wind_dir_values(self, u_points: List[int], zipped_uv_values):
         """ Get calculated wind direction values for list of points and zipped u,v values """
@@ -233,45 +237,44 @@ class GribFileProcessor():
 
         return variable_name
 
-    def store_prediction_value(self,
-                               station_code: int,
-                               value: float,
-                               preduction_model_run: PredictionModelRunTimestamp,
-                               grib_info: ModelRunInfo,
-                               session: Session):
-        """ Store the values around the area of interest.
+    def store_prediction_values(self,
+                                values_by_variable: Dict[str, Tuple[List[WeatherStation], np.ndarray]],
+                                prediction_model_run: PredictionModelRunTimestamp,
+                                grib_info: ModelRunInfo,
+                                session: Session):
+        """ Store the values of every variable at every station for this prediction timestamp, with one
+        upsert per set of variables.
         """
-        # Load the record if it exists.
-        prediction = session.query(ModelRunPrediction)\
-            .filter(
-                ModelRunPrediction.prediction_model_run_timestamp_id == preduction_model_run.id)\
-            .filter(ModelRunPrediction.prediction_timestamp == grib_info.prediction_timestamp)\
-            .filter(ModelRunPrediction.station_code == station_code)\
-            .first()
-        if not prediction:
-            # Record doesn't exist, so we create it.
-            prediction = ModelRunPrediction()
-            prediction.prediction_model_run_timestamp_id = preduction_model_run.id
-            prediction.prediction_timestamp = grib_info.prediction_timestamp
-            prediction.station_code = station_code
-
-        variable_name = self.get_variable_name(grib_info)
-        setattr(prediction, variable_name, value)
-        session.add(prediction)
+        predictions: Dict[int, dict] = {}
+        for variable_name, (stations, values) in values_by_variable.items():
+            for station, value in zip(stations, values.tolist()):
+                prediction = predictions.setdefault(station.code, {
+                    'prediction_model_run_timestamp_id': prediction_model_run.id,
+                    'prediction_timestamp': grib_info.prediction_timestamp,
+                    'station_code': station.code})
+                prediction[variable_name] = value
+        # A multi-row upsert needs the same columns in every row, and a prediction must only update the
+        # variables it has values for.
+        predictions_by_columns: Dict[tuple, List[dict]] = defaultdict(list)
+        for prediction in predictions.values():
+            predictions_by_columns[tuple(prediction)].append(prediction)
+        for column_predictions in predictions_by_columns.values():
+            upsert_model_run_predictions(session, column_predictions)
         session.commit()
 
     def process_env_can_grib_file(self, session: Session, dataset, grib_info: ModelRunInfo,
                                   prediction_run: PredictionModelRunTimestamp):
         # for GDPS, RDPS, HRDPS models, always only ever 1 raster band in the dataset
         raster_band = dataset.GetRasterBand(1)
-        # Iterate through stations:
-        for station, value in self.yield_value_for_stations(raster_band):
-            # Convert wind speed from metres per second to kilometres per hour for Environment Canada
-            # models (NOAA models handled elswhere)
-            if grib_info.variable_name.lower().startswith("wind_agl") or grib_info.variable_name.lower().startswith('wind_tgl'):
-                value = convert_mps_to_kph(value)
+        variable_name = self.get_variable_name(grib_info)
+        # Interpolating between directions either side of north would point the wrong way
+        stations, values = self.get_station_values(raster_band, interpolate=variable_name != 'wdir_tgl_10')
+        # Convert wind speed from metres per second to kilometres per hour for Environment Canada
+        # models (NOAA models handled elswhere)
+        if grib_info.variable_name.lower().startswith("wind_agl") or grib_info.variable_name.lower().startswith('wind_tgl'):
+            values = convert_mps_to_kph(values)
 
-            self.store_prediction_value(station.code, value, prediction_run, grib_info, session)
+        self.store_prediction_values({variable_name: (stations, values)}, prediction_run, grib_info, session)
 
     def get_raster_bands(self, dataset, grib_info: ModelRunInfo):
         """ Returns raster bands of dataset for temperature, RH, U/V wind components, and 
@@ -306,22 +309,14 @@ class GribFileProcessor():
         tmp_raster_band, rh_raster_band, u_wind_raster_band, v_wind_raster_band, precip_raster_band = self.get_raster_bands(
             dataset, grib_info)
 
-        for station, tmp_value in self.yield_value_for_stations(tmp_raster_band):
-            grib_info.variable_name = 'tmp_tgl_2'
-            self.store_prediction_value(station.code, tmp_value, prediction_run, grib_info, session)
-        for station, rh_value in self.yield_value_for_stations(rh_raster_band):
-            grib_info.variable_name = 'rh_tgl_2'
-            self.store_prediction_value(station.code, rh_value, prediction_run, grib_info, session)
+        values_by_variable = {
+            'tmp_tgl_2': self.get_station_values(tmp_raster_band),
+            'rh_tgl_2': self.get_station_values(rh_raster_band)
+        }
         if precip_raster_band:
-            for station, apcp_value in self.yield_value_for_stations(precip_raster_band):
-                grib_info.variable_name = 'apcp_sfc_0'
-                self.store_prediction_value(station.code, apcp_value, prediction_run, grib_info, session)
-        for station, wdir_value in self.yield_uv_wind_data_for_stations(u_wind_raster_band, v_wind_raster_band, 'wdir_tgl_10'):
-            grib_info.variable_name = 'wdir_tgl_10'
-            self.store_prediction_value(station.code, wdir_value, prediction_run, grib_info, session)
-        for station, wind_value in self.yield_uv_wind_data_for_stations(u_wind_raster_band, v_wind_raster_band, 'wind_tgl_10'):
-            grib_info.variable_name = 'wind_tgl_10'
-            self.store_prediction_value(station.code, wind_value, prediction_run, grib_info, session)
+            values_by_variable['apcp_sfc_0'] = self.get_station_values(precip_raster_band)
+        values_by_variable.update(self.get_uv_wind_values(u_wind_raster_band, v_wind_raster_band))
+        self.store_prediction_values(values_by_variable, prediction_run, grib_info, session)
 
     def process_grib_file(self, filename, grib_info: ModelRunInfo, session: Session):
         """ Process a grib file, extracting and storing relevant information. """
@@ -336,6 +331,7 @@ class GribFileProcessor():
         self.geo_to_raster_transformer = get_transformer(NAD83_CRS, crs)
 
         self.padf_transform = get_dataset_geometry(filename)
+        self.grid_name = f'{grib_info.model_enum}:{grib_info.projection}'
         # get the model (.e.g. GPDS/RDPS latlon24x.24):
         self.prediction_model = get_prediction_model(
             session, grib_info.model_enum, grib_info.projection)
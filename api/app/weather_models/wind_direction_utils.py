@@ -1,5 +1,6 @@
 import math
-from typing import List, Optional
+import numpy as np
+from typing import List, Optional, Tuple
 
 
 def calculate_meterological_direction(wind_dir_degrees: float):
@@ -46,3 +47,22 @@ def calculate_wind_dir_from_u_v(u: float, v: float):
     # must convert from trig coordinates to cardinal coordinates
     calc = 90 - calc
     return calc if calc > 0 else 360 + calc
+
+
+def calculate_wind_speed_from_u_v_array(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """ Vectorized calculate_wind_speed_from_u_v """
+    return np.sqrt(np.power(u, 2) + np.power(v, 2))
+
+
+def calculate_wind_dir_from_u_v_array(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """ Vectorized calculate_wind_dir_from_u_v """
+    calc = np.arctan2(u, v) * 180 / math.pi
+    calc += 180
+    calc = 90 - calc
+    return np.where(calc > 0, calc, 360 + calc)
+
+
+def compute_u_v_array(wind_speed: np.ndarray, wind_direction_degrees: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Vectorized compute_u_v """
+    wind_direction_radians = np.radians(calculate_meterological_direction(wind_direction_degrees))
+    return wind_speed * np.sin(wind_direction_radians), wind_speed * np.cos(wind_direction_radians)
@@ -0,0 +1,133 @@
+""" In memory registry of WFWX stations.
+
+Almost every HFI, FBA, Morecast and critical hours request needs stations from WFWX. Instead of each one loading
+(and parsing) the whole station list, it's loaded once per process, and refreshed in the background when it's older
+than STATION_REGISTRY_TTL_SECONDS. Stations are indexed by code and by WFWX id.
+"""
+import asyncio
+import logging
+from time import monotonic
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Iterable, List, Optional
+from app import config
+
+
+logger = logging.getLogger(__name__)
+
+
+async def _iterate(raw_stations: List[dict]) -> AsyncGenerator[dict, None]:
+    """ Serve raw stations the same way fetch_paged_response_generator does, so they can be fed to the
+    same mappers """
+    for raw_station in raw_stations:
+        yield raw_station
+
+
+class StationRegistry:
+    """ The WFWX station list, with indexes by station code and WFWX id.
+
+    :param loader: Loads the raw (json) station list from WFWX.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[List[dict]]], ttl_seconds: Optional[float] = None):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.raw_stations: List[dict] = []
+        self.by_code: Dict[int, dict] = {}
+        self.by_id: Dict[str, dict] = {}
+        self.loaded_at: Optional[float] = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        # The result of each mapper, for the current station list.
+        self._mapped: Dict[Callable, Any] = {}
+        self._load_task: Optional[asyncio.Task] = None
+
+    def _get_ttl_seconds(self) -> float:
+        if self.ttl_seconds is not None:
+            return self.ttl_seconds
+        return float(config.get('STATION_REGISTRY_TTL_SECONDS', 3600))
+
+    @property
+    def age_seconds(self) -> Optional[float]:
+        """ Seconds since the station list was (re)loaded, or None if it hasn't been loaded """
+        return None if self.loaded_at is None else monotonic() - self.loaded_at
+
+    def as_dict(self) -> dict:
+        age_seconds = self.age_seconds
+        return {'stations': len(self.raw_stations),
+                'age_seconds': None if age_seconds is None else round(age_seconds),
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures}
+
+    def clear(self):
+        """ Forget the station list, so that it's loaded again on next use """
+        self.raw_stations = []
+        self.by_code = {}
+        self.by_id = {}
+        self.loaded_at = None
+        self._mapped = {}
+        self._load_task = None
+
+    def _set(self, raw_stations: List[dict]):
+        self.raw_stations = raw_stations
+        self.by_code = {raw_station['stationCode']: raw_station for raw_station in raw_stations}
+        self.by_id = {raw_station['id']: raw_station for raw_station in raw_stations}
+        self._mapped = {}
+        self.loaded_at = monotonic()
+        self.refreshes += 1
+        logger.info('station registry loaded: %s', self.as_dict())
+
+    async def _load(self):
+        self._set(await self.loader())
+
+    def _start_load(self) -> asyncio.Task:
+        """ Start loading the station list, unless a load is already in progress (in this event loop). """
+        task = self._load_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(self._load())
+            self._load_task = task
+        return task
+
+    async def refresh(self):
+        """ Make sure the station list is loaded. If it's never been loaded, wait for it (concurrent callers share
+        the one load). If it's older than the TTL, it's refreshed in the background, and the current list is used
+        in the meantime. """
+        if self.loaded_at is None:
+            await asyncio.shield(self._start_load())
+        elif self.age_seconds > self._get_ttl_seconds():
+            refreshing = self._load_task
+            task = self._start_load()
+            if task is not refreshing:
+                logger.info('station registry is stale, refreshing: %s', self.as_dict())
+                task.add_done_callback(self._log_refresh_failure)
+
+    def _log_refresh_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.refresh_failures += 1
+            logger.error('station registry refresh failed, serving the stale list: %s', self.as_dict(),
+                         exc_info=task.exception())
+
+    async def get_raw_stations(self) -> List[dict]:
+        """ All the raw stations, in the order WFWX returned them """
+        await self.refresh()
+        return self.raw_stations
+
+    async def get_raw_stations_by_codes(self, station_codes: Iterable[int]) -> List[dict]:
+        """ The raw stations for a list of station codes, in the order WFWX returned them. Unknown codes are
+        ignored. """
+        await self.refresh()
+        raw_stations = [self.by_code[code] for code in set(station_codes) if code in self.by_code]
+        order = {id(raw_station): index for index, raw_station in enumerate(self.raw_stations)}
+        raw_stations.sort(key=lambda raw_station: order[id(raw_station)])
+        return raw_stations
+
+    async def map(self, mapper: Callable[[AsyncGenerator[dict, None]], Awaitable[Any]]) -> Any:
+        """ Map the raw stations with one of the schema_parsers mappers. The result is kept until the station list
+        is refreshed - so a copy of the list (or dict) is returned, that callers are free to change. """
+        await self.refresh()
+        if mapper not in self._mapped:
+            self._mapped[mapper] = await mapper(_iterate(self.raw_stations))
+        result = self._mapped[mapper]
+        if isinstance(result, list):
+            return list(result)
+        if isinstance(result, dict):
+            return dict(result)
+        return result
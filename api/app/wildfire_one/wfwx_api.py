@@ -1,7 +1,7 @@
 """ This module contains methods for retrieving information from the WFWX Fireweather API.
 """
 import math
-from typing import List, Optional, Final, AsyncGenerator
+from typing import List, Optional, Final, AsyncGenerator, Set
 from datetime import datetime
 import logging
 import asyncio
@@ -27,6 +27,7 @@ from app.wildfire_one.query_builders import (BuildQueryAllForecastsByAfterStart,
                                              BuildQueryByStationCode,
                                              BuildQueryDailiesByStationCode,
                                              BuildQueryStationGroups)
+from app.wildfire_one.station_registry import StationRegistry
 from app.wildfire_one.util import is_station_valid
 from app.wildfire_one.wildfire_fetchers import (fetch_access_token,
                                                 fetch_detailed_geojson_stations,
@@ -55,46 +56,87 @@ async def get_auth_header(session: ClientSession) -> dict:
     return header
 
 
-async def get_stations_by_codes(station_codes: List[int]) -> List[WeatherStation]:
-    """ Get a list of stations by code, from WFWX Fireweather API. """
-    logger.info('Using WFWX to retrieve stations by code')
-    with EcodivisionSeasons(','.join([str(code) for code in station_codes])) as eco_division:
-        async with ClientSession() as session:
-            header = await get_auth_header(session)
-            stations = []
-            # 1 week seems a reasonable period to cache stations for.
-            redis_station_cache_expiry: Final = int(config.get('REDIS_STATION_CACHE_EXPIRY', 604800))
-            # Iterate through "raw" station data.
-            iterator = fetch_paged_response_generator(session,
-                                                      header,
-                                                      BuildQueryByStationCode(station_codes), 'stations',
-                                                      use_cache=True,
-                                                      cache_expiry_seconds=redis_station_cache_expiry)
-            async for raw_station in iterator:
-                # If the station is valid, add it to our list of stations.
-                if is_station_valid(raw_station):
-                    stations.append(parse_station(raw_station, eco_division))
-            logger.debug('total stations: %d', len(stations))
-            return stations
-
-
-async def get_station_data(session: ClientSession,
-                           header: dict,
-                           mapper=station_list_mapper):
-    """ Get list of stations from WFWX Fireweather API.
-    """
+async def _load_raw_stations() -> List[dict]:
+    """ Load the "raw" list of all stations from WFWX, for the station registry. """
     logger.info('Using WFWX to retrieve station list')
-    # 1 week seems a reasonable period to cache stations for.
-    redis_station_cache_expiry: Final = int(config.get('REDIS_STATION_CACHE_EXPIRY', 604800))
-    # Iterate through "raw" station data.
-    raw_stations = fetch_paged_response_generator(session,
+    async with ClientSession() as session:
+        header = await get_auth_header(session)
+        # 1 week seems a reasonable period to cache stations for.
+        redis_station_cache_expiry: Final = int(config.get('REDIS_STATION_CACHE_EXPIRY', 604800))
+        # Iterate through "raw" station data.
+        iterator = fetch_paged_response_generator(session,
                                                   header,
                                                   BuildQueryStations(),
                                                   'stations',
                                                   use_cache=True,
                                                   cache_expiry_seconds=redis_station_cache_expiry)
-    # Map list of stations into desired shape
-    stations = await mapper(raw_stations)
+        return [raw_station async for raw_station in iterator]
+
+
+# All the WFWX stations, loaded once per process and refreshed in the background every
+# STATION_REGISTRY_TTL_SECONDS.
+station_registry = StationRegistry(_load_raw_stations)
+
+
+def _get_ecodivision_seasons(raw_stations: List[dict]) -> EcodivisionSeasons:
+    """ Ecodivision seasons, with the ecodivisions of the raw stations looked up in one go """
+    eco_division = EcodivisionSeasons()
+    eco_division.get_ecodivision_names([(raw_station['stationCode'], raw_station['latitude'], raw_station['longitude'])
+                                        for raw_station in raw_stations
+                                        if raw_station['latitude'] is not None and raw_station['longitude'] is not None])
+    return eco_division
+
+
+async def _get_raw_stations_by_codes(station_codes: List[int],
+                                     session: Optional[ClientSession] = None,
+                                     header: Optional[dict] = None) -> List[dict]:
+    """ Get the "raw" stations for the list of station codes provided, from the station registry. The registry only
+    has active, test and project stations (as of its last refresh) - any others (e.g. disabled stations, or stations
+    added since) are looked up in WFWX, with the session and header given or a session of its own.
+    """
+    raw_stations = await station_registry.get_raw_stations_by_codes(station_codes)
+    missing_codes = set(station_codes) - set(raw_station.get('stationCode') for raw_station in raw_stations)
+    if not missing_codes:
+        return raw_stations
+    logger.info('%d station codes not in the station registry', len(missing_codes))
+    if session is None:
+        async with ClientSession() as own_session:
+            return raw_stations + await _fetch_raw_stations_by_codes(
+                own_session, await get_auth_header(own_session), missing_codes)
+    return raw_stations + await _fetch_raw_stations_by_codes(session, header, missing_codes)
+
+
+async def _fetch_raw_stations_by_codes(session: ClientSession, header: dict, station_codes: Set[int]) -> List[dict]:
+    """ Fetch the "raw" stations for the list of station codes provided from WFWX. """
+    # 1 week seems a reasonable period to cache stations for.
+    redis_station_cache_expiry: Final = int(config.get('REDIS_STATION_CACHE_EXPIRY', 604800))
+    iterator = fetch_paged_response_generator(session,
+                                              header,
+                                              BuildQueryByStationCode(sorted(station_codes)),
+                                              'stations',
+                                              use_cache=True,
+                                              cache_expiry_seconds=redis_station_cache_expiry)
+    return [raw_station async for raw_station in iterator]
+
+
+async def get_stations_by_codes(station_codes: List[int]) -> List[WeatherStation]:
+    """ Get a list of stations by code, from WFWX Fireweather API. """
+    logger.info('Using WFWX to retrieve stations by code')
+    raw_stations = [raw_station for raw_station in await _get_raw_stations_by_codes(station_codes)
+                    if is_station_valid(raw_station)]
+    eco_division = _get_ecodivision_seasons(raw_stations)
+    stations = [parse_station(raw_station, eco_division) for raw_station in raw_stations]
+    logger.debug('total stations: %d', len(stations))
+    return stations
+
+
+async def get_station_data(session: ClientSession,  # pylint: disable=unused-argument
+                           header: dict,  # pylint: disable=unused-argument
+                           mapper=station_list_mapper):
+    """ Get list of stations from WFWX Fireweather API (by way of the station registry, which loads stations with
+    its own session - session and header are no longer used, and kept so that callers don't have to change).
+    """
+    stations = await station_registry.map(mapper)
     logger.debug('total stations: %d', len(stations))
     return stations
 
@@ -155,35 +197,18 @@ async def get_hourly_readings(
     """
     # Create a list containing all the tasks to run in parallel.
     tasks = []
-    # 1 week seems a reasonable period to cache stations for.
-    redis_station_cache_expiry: Final = int(config.get('REDIS_STATION_CACHE_EXPIRY', 604800))
-    # Iterate through "raw" station data.
-    iterator = fetch_paged_response_generator(session,
-                                              header,
-                                              BuildQueryByStationCode(station_codes),
-                                              'stations',
-                                              True,
-                                              redis_station_cache_expiry)
-    raw_stations = []
-    eco_division_key = ''
-    # not ideal - we iterate through the stations twice. 1'st time to get the list of station codes,
-    # so that we can do an eco division lookup in redis.
-    station_codes = set()
-    async for raw_station in iterator:
-        raw_stations.append(raw_station)
-        station_codes.add(raw_station.get('stationCode'))
-    eco_division_key = ','.join(str(code) for code in station_codes)
-    with EcodivisionSeasons(eco_division_key) as eco_division:
-        for raw_station in raw_stations:
-            task = asyncio.create_task(
-                fetch_hourlies(session,
-                               raw_station,
-                               header,
-                               start_timestamp,
-                               end_timestamp,
-                               use_cache,
-                               eco_division))
-            tasks.append(task)
+    raw_stations = await _get_raw_stations_by_codes(station_codes, session, header)
+    eco_division = _get_ecodivision_seasons(raw_stations)
+    for raw_station in raw_stations:
+        task = asyncio.create_task(
+            fetch_hourlies(session,
+                           raw_station,
+                           header,
+                           start_timestamp,
+                           end_timestamp,
+                           use_cache,
+                           eco_division))
+        tasks.append(task)
 
     # Run the tasks concurrently, waiting for them all to complete.
     return await asyncio.gather(*tasks)
@@ -307,7 +332,7 @@ async def get_wfwx_stations_from_station_codes(
     # be called multiple times!
     wfwx_stations = await get_station_data(session, header, mapper=wfwx_station_list_mapper)
     # TODO: this is not good. Code in wfwx api shouldn't be filtering on stations codes in hfi....
-    fire_centre_station_codes = get_fire_centre_station_codes()
+    fire_centre_station_codes = await get_fire_centre_station_codes()
 
     # Default to all known WFWX station ids if no station codes are specified
     if station_codes is None:
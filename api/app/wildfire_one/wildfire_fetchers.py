@@ -1,11 +1,14 @@
 """ Functions that request and marshall WFWX API responses into our schemas"""
+import asyncio
 import math
 import logging
+from collections import deque
 from datetime import datetime
-from typing import AsyncGenerator, Dict, Tuple, Final
+from typing import AsyncGenerator, Deque, Dict, Tuple, Final
 import json
 from urllib.parse import urlencode
 from aiohttp.client import ClientSession, BasicAuth
+from aiohttp.client_exceptions import ClientConnectionError
 from app.data.ecodivision_seasons import EcodivisionSeasons
 from app.rocketchat_notifications import send_rocketchat_notification
 from app.schemas.observations import WeatherStationHourlyReadings
@@ -17,39 +20,67 @@ from app.wildfire_one.query_builders import BuildQuery
 from app import config
 from app.wildfire_one.schema_parsers import parse_hourly, parse_station
 from app.wildfire_one.util import is_station_valid
-from app.utils.redis import create_redis
+from app.utils.redis_cache import get_redis_cache
 
 logger = logging.getLogger(__name__)
 
 
+class RetryableResponseError(Exception):
+    """ Exception raised when WF1 responds in a way that is worth trying again (429 or 5xx) """
+
+
+async def _get_json(session: ClientSession, headers: dict, url: str, params: dict) -> Tuple[dict, int]:
+    """ Get a json response, retrying with exponential backoff on connection errors, timeouts, 429 and 5xx
+    responses.
+
+    :return: The response json and status.
+    """
+    retries: Final = int(config.get('WFWX_RETRIES', 3))
+    backoff_seconds: Final = float(config.get('WFWX_BACKOFF_SECONDS', 0.5))
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, headers=headers, params=params) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableResponseError(f'{response.status} response for {url}')
+                try:
+                    return await response.json(), response.status
+                except json.decoder.JSONDecodeError as error:
+                    logger.error(error, exc_info=error)
+                    text = await response.text()
+                    logger.error('response.text() = %s', text)
+                    send_rocketchat_notification(f'JSONDecodeError, response.text() = {text}', error)
+                    raise
+        except (RetryableResponseError, ClientConnectionError, asyncio.TimeoutError) as error:
+            if attempt == retries:
+                raise
+            delay = backoff_seconds * 2 ** attempt
+            attempt += 1
+            logger.warning('Retrying %s in %.1f seconds: %r', url, delay, error)
+            await asyncio.sleep(delay)
+
+
 async def _fetch_cached_response(session: ClientSession, headers: dict, url: str, params: dict,
                                  cache_expiry_seconds: int):
-    cache = create_redis()
     key = f'{url}?{urlencode(params)}'
-    try:
-        cached_json = cache.get(key)
-    except Exception as error:
-        cached_json = None
-        logger.error(error, exc_info=error)
-    if cached_json:
-        logger.info('redis cache hit %s', key)
-        response_json = json.loads(cached_json.decode())
-    else:
-        logger.info('redis cache miss %s', key)
-        async with session.get(url, headers=headers, params=params) as response:
-            try:
-                response_json = await response.json()
-            except json.decoder.JSONDecodeError as error:
-                logger.error(error, exc_info=error)
-                text = await response.text()
-                logger.error('response.text() = %s', text)
-                send_rocketchat_notification(f'JSONDecodeError, response.text() = {text}', error)
-                raise
-        try:
-            if response.status == 200:
-                cache.set(key, json.dumps(response_json).encode(), ex=cache_expiry_seconds)
-        except Exception as error:
-            logger.error(error, exc_info=error)
+
+    async def fetch():
+        response_json, status = await _get_json(session, headers, url, params)
+        return response_json, cache_expiry_seconds if status == 200 else None
+
+    return await get_redis_cache().get_or_fetch(key, fetch)
+
+
+async def _fetch_page(session: ClientSession, headers: dict, query_builder: BuildQuery, page: int,
+                      use_cache: bool, cache_expiry_seconds: int) -> dict:
+    # Build up the request URL.
+    url, params = query_builder.query(page)
+    logger.debug('loading page %d...', page)
+    if use_cache and config.get('REDIS_USE') == 'True':
+        # We've been told and configured to use the redis cache.
+        return await _fetch_cached_response(session, headers, url, params, cache_expiry_seconds)
+    response_json, _ = await _get_json(session, headers, url, params)
+    logger.debug('done loading page %d.', page)
     return response_json
 
 
@@ -63,36 +94,51 @@ async def fetch_paged_response_generator(
 ) -> AsyncGenerator[dict, None]:
     """ Asynchronous generator for iterating through responses from the API.
     The response is a paged response, but this generator abstracts that away.
+
+    We don't know how many pages there are until the first one is loaded. The rest are then requested
+    concurrently (no more than WFWX_PAGE_CONCURRENCY pages ahead of the one being yielded), and yielded in order.
     """
-    # We don't know how many pages until our first call - so we assume one page to start with.
-    total_pages = 1
-    page_count = 0
-    while page_count < total_pages:
-        # Build up the request URL.
-        url, params = query_builder.query(page_count)
-        logger.debug('loading page %d...', page_count)
-        if use_cache and config.get('REDIS_USE') == 'True':
-            # We've been told and configured to use the redis cache.
-            response_json = await _fetch_cached_response(session, headers, url, params, cache_expiry_seconds)
-        else:
-            async with session.get(url, headers=headers, params=params) as response:
-                response_json = await response.json()
-                logger.debug('done loading page %d.', page_count)
-
-        # keep this code around for dumping responses to a json file - useful for when you're writing
-        # tests to grab actual responses to use in fixtures.
-        # import base64
-        # TODO: write a beter way to make a temporary filename
-        # fname = 'thing_{}_{}.json'.format(base64.urlsafe_b64encode(url.encode()), random.randint(0, 1000))
-        # with open(fname, 'w') as f:
-        #     json.dump(response_json, f)
-
-        # Update the total page count.
-        total_pages = response_json['page']['totalPages'] if 'page' in response_json else 1
-        for response_object in response_json['_embedded'][content_key]:
-            yield response_object
-        # Keep track of our page count.
-        page_count = page_count + 1
+    response_json = await _fetch_page(session, headers, query_builder, 0, use_cache, cache_expiry_seconds)
+
+    # keep this code around for dumping responses to a json file - useful for when you're writing
+    # tests to grab actual responses to use in fixtures.
+    # import base64
+    # TODO: write a beter way to make a temporary filename
+    # fname = 'thing_{}_{}.json'.format(base64.urlsafe_b64encode(url.encode()), random.randint(0, 1000))
+    # with open(fname, 'w') as f:
+    #     json.dump(response_json, f)
+
+    total_pages = response_json['page']['totalPages'] if 'page' in response_json else 1
+    for response_object in response_json['_embedded'][content_key]:
+        yield response_object
+    if total_pages <= 1:
+        return
+
+    # Only a window of pages is requested ahead of the page being yielded, so a slow (or stopped) caller doesn't
+    # have every page loaded into memory.
+    window = int(config.get('WFWX_PAGE_CONCURRENCY', 4))
+    pages = iter(range(1, total_pages))
+    tasks: Deque[asyncio.Task] = deque()
+
+    def fetch_next_page():
+        page = next(pages, None)
+        if page is not None:
+            tasks.append(asyncio.create_task(
+                _fetch_page(session, headers, query_builder, page, use_cache, cache_expiry_seconds)))
+
+    for _ in range(window):
+        fetch_next_page()
+    try:
+        while tasks:
+            response_json = await tasks.popleft()
+            fetch_next_page()
+            for response_object in response_json['_embedded'][content_key]:
+                yield response_object
+    finally:
+        # If the caller stopped early (or a page failed), there's no point loading the rest.
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 async def fetch_detailed_geojson_stations(
@@ -230,32 +276,22 @@ async def fetch_access_token(session: ClientSession) -> dict:
     password = config.get('WFWX_SECRET')
     user = config.get('WFWX_USER')
     auth_url = config.get('WFWX_AUTH_URL')
-    cache = create_redis()
     # NOTE: Consider using a hashed version of the password as part of the key.
     params = {'user': user}
     key = f'{auth_url}?{urlencode(params)}'
-    try:
-        cached_json = cache.get(key)
-    except Exception as error:
-        cached_json = None
-        logger.error(error, exc_info=error)
-    if cached_json:
-        logger.info('redis cache hit %s', auth_url)
-        response_json = json.loads(cached_json.decode())
-    else:
-        logger.info('redis cache miss %s', auth_url)
+
+    async def fetch():
         async with session.get(auth_url, auth=BasicAuth(login=user, password=password)) as response:
             response_json = await response.json()
-            try:
-                if response.status == 200:
-                    # We expire when the token expires, or 10 minutes, whichever is less.
-                    # NOTE: only caching for 10 minutes right now, since we aren't handling cases
-                    # where the token is invalidated.
-                    redis_auth_cache_expiry: Final = int(config.get('REDIS_AUTH_CACHE_EXPIRY', 600))
-                    expires = min(response_json['expires_in'], redis_auth_cache_expiry)
-                    cache.set(key, json.dumps(response_json).encode(), ex=expires)
-            except Exception as error:
-                logger.error(error, exc_info=error)
+            if response.status != 200 or 'expires_in' not in response_json:
+                return response_json, None
+            # We expire when the token expires, or 10 minutes, whichever is less.
+            # NOTE: only caching for 10 minutes right now, since we aren't handling cases
+            # where the token is invalidated.
+            redis_auth_cache_expiry: Final = int(config.get('REDIS_AUTH_CACHE_EXPIRY', 600))
+            return response_json, min(response_json['expires_in'], redis_auth_cache_expiry)
+
+    response_json = await get_redis_cache().get_or_fetch(key, fetch)
     return response_json
 
 
@@ -0,0 +1,75 @@
+""" Benchmark c-haines index and severity generation: cell by cell (how it used to be done) vs. whole arrays.
+
+Uses random data on an HRDPS sized grid, so no grib files are needed. The cell by cell timing is measured on a
+number of rows, and scaled up to the whole grid (it takes minutes otherwise).
+
+Usage, from the api directory:
+    poetry run python -m scripts.benchmark_c_haines [rows to time cell by cell, default 20]
+"""
+import sys
+from time import perf_counter
+import numpy
+from affine import Affine
+from pyproj import CRS
+from app.c_haines.c_haines_index import (BoundingBoxChecker, calculate_c_haines_index,
+                                         calculate_c_haines_index_array)
+from app.c_haines.severity_index import generate_severity_data, get_severity
+from app.geospatial import NAD83_CRS
+from app.weather_models.process_grib import get_transformer
+
+# HRDPS continental 2.5km grid dimensions.
+Y_SIZE, X_SIZE = 1456, 2576
+PROJECTION = '+proj=stere +lat_0=90 +lat_ts=60 +lon_0=252 +R=6371229 +units=m +no_defs'
+TRANSFORM = Affine(2500.0, 0.0, -3000000.0, 0.0, -2500.0, 1000000.0)
+
+
+def cell_by_cell(checker: BoundingBoxChecker, t700, t850, d850):
+    """ The c-haines index, severity and mask, one cell at a time """
+    severity_data = []
+    mask_data = []
+    for y, (row_700, row_850, row_dew) in enumerate(zip(t700, t850, d850)):
+        severity_row = []
+        mask_row = []
+        for x, (a, b, c) in enumerate(zip(row_700.tolist(), row_850.tolist(), row_dew.tolist())):
+            c_haines = calculate_c_haines_index(a, b, c) if checker.is_inside(x, y) else 0
+            severity = get_severity(c_haines)
+            severity_row.append(severity)
+            mask_row.append(0 if severity == 0 else 1)
+        severity_data.append(severity_row)
+        mask_data.append(mask_row)
+    return numpy.array(severity_data), numpy.array(mask_data)
+
+
+def whole_arrays(checker: BoundingBoxChecker, t700, t850, d850):
+    """ The c-haines index, severity and mask, for the whole grid at once """
+    inside = checker.calculate_mask(t700.shape[1], t700.shape[0])
+    c_haines_data = calculate_c_haines_index_array(t700, t850, d850)
+    c_haines_data[~inside] = 0
+    return generate_severity_data(c_haines_data)
+
+
+def main(rows: int):
+    rng = numpy.random.default_rng(0)
+    t700 = rng.uniform(-40, 10, (Y_SIZE, X_SIZE)).astype(numpy.float32)
+    t850 = (t700 + rng.uniform(-5, 30, (Y_SIZE, X_SIZE))).astype(numpy.float32)
+    d850 = rng.uniform(-2, 45, (Y_SIZE, X_SIZE)).astype(numpy.float32)
+
+    def create_checker():
+        return BoundingBoxChecker(TRANSFORM, get_transformer(CRS.from_proj4(PROJECTION), NAD83_CRS))
+
+    start = perf_counter()
+    severity_data, mask_data = whole_arrays(create_checker(), t700, t850, d850)
+    array_seconds = perf_counter() - start
+
+    start = perf_counter()
+    expected_severity, expected_mask = cell_by_cell(create_checker(), t700[:rows], t850[:rows], d850[:rows])
+    cell_seconds = (perf_counter() - start) * Y_SIZE / rows
+
+    assert numpy.array_equal(severity_data[:rows], expected_severity)
+    assert numpy.array_equal(mask_data[:rows], expected_mask)
+    print(f'{Y_SIZE}x{X_SIZE} grid: whole arrays {array_seconds:.2f}s, '
+          f'cell by cell ~{cell_seconds:.1f}s (measured on {rows} rows), ~{cell_seconds / array_seconds:.0f}x faster')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)